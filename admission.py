@@ -0,0 +1,234 @@
+"""
+admission logic shared by the worker and the cluster simulator
+
+the functions only look at numbers and the config, they do not touch redis or the host,
+so the simulator replays exactly the decisions a real worker makes
+
+"""
+
+
+# a worker does not accept new task if less than this many cores are idle
+MIN_IDLE_CORE_ACCEPT_NEW_TASK = 2
+# when the todo queue is longer than this, a worker only looks at a random sample of it
+TODO_SAMPLE_THRESHOLD = 1000
+TODO_SAMPLE_SIZE = 20
+
+
+def can_accept_new_task(config, total_mem_gb, used_mem_gb, in_prog_need_dram_gb,
+                        n_in_progress, total_core, used_core):
+    """
+    whether a worker has room for one more task
+
+    :param config: RunnerConfig or a snapshot with min_dram_gb_accept_new_task and max_task_per_worker
+    :param used_mem_gb: the measured DRAM usage of the node
+    :param in_prog_need_dram_gb: the sum of declared DRAM of the running tasks
+    :param n_in_progress: the number of running tasks
+
+    """
+
+    min_dram = config.min_dram_gb_accept_new_task
+    if total_mem_gb - used_mem_gb < min_dram:
+        return False
+    if total_mem_gb - in_prog_need_dram_gb < min_dram:
+        return False
+
+    if n_in_progress >= config.max_task_per_worker:
+        return False
+    if total_core - used_core < MIN_IDLE_CORE_ACCEPT_NEW_TASK:
+        return False
+
+    return True
+
+
+def task_fits(task, total_mem_gb, used_mem_gb, in_prog_need_dram_gb):
+    """
+    whether the declared DRAM of the task fits in both the measured and the promised free DRAM
+
+    """
+
+    if task.min_dram_gb > total_mem_gb - used_mem_gb:
+        return False
+    if task.min_dram_gb > total_mem_gb - in_prog_need_dram_gb:
+        return False
+    return True
+
+
+def should_return_task(config, total_mem_gb, used_mem_gb):
+    """
+    whether the node is about to run out of memory and the most recent task should be returned
+
+    """
+
+    return total_mem_gb - used_mem_gb < config.min_dram_gb_trigger_return
+
+
+def task_timeout_seconds(task, config):
+    """
+    the timeout of a task in seconds, 0 means no limit
+
+    """
+
+    if task.timeout_seconds is None:
+        return config.default_task_timeout_seconds
+    return task.timeout_seconds
+
+
+def rank_candidates(tasks, policy="priority", predictor=None):
+    """
+    order the tasks a worker can work on, the first one is claimed first
+
+    :param policy: one of SCHEDULING_POLICIES
+        priority: high priority first
+        longest_first: long expected runtime first, so that long tasks do not stretch the tail of a campaign
+        shortest_first: short expected runtime first, which minimizes the mean waiting time
+    :param predictor: a RuntimePredictor, required by the runtime-based policies
+
+    """
+
+    if policy == "priority" or predictor is None:
+        # pick high priority task first
+        return sorted(tasks, key=lambda x: x.priority, reverse=True)
+
+    expected = [predictor.predict(t) for t in tasks]
+    known = [r for r in expected if r is not None]
+    if len(known) == 0:
+        # no history, fall back to the static priority
+        return sorted(tasks, key=lambda x: x.priority, reverse=True)
+    # a task without history is assumed to take as long as an average candidate
+    default = sum(known) / len(known)
+    expected = [default if r is None else r for r in expected]
+    sign = -1 if policy == "longest_first" else 1
+    order = sorted(range(len(tasks)), key=lambda i: (sign * expected[i], -tasks[i].priority))
+    return [tasks[i] for i in order]
+
+
+def order_by_locality(tasks, inputs_of, is_warm, remote_inputs, allow_remote):
+    """
+    delay scheduling: tasks with a warm input come first, then tasks whose inputs are warm nowhere,
+    tasks whose inputs are only warm on other workers are left for those workers unless allow_remote,
+    the ranked order is kept within each group
+
+    :param inputs_of: task str -> input keys
+    :param is_warm: input key -> whether it is warm on this worker
+    :param remote_inputs: the input keys warm on other workers
+    :return: (the ordered tasks, the number of tasks only warm on other workers)
+
+    """
+
+    local, cold, remote = [], [], []
+    for task in tasks:
+        inputs = inputs_of.get(task.task_str, [])
+        if any(is_warm(key) for key in inputs):
+            local.append(task)
+        elif any(key in remote_inputs for key in inputs):
+            remote.append(task)
+        else:
+            cold.append(task)
+    if allow_remote:
+        return local + cold + remote, len(remote)
+    return local + cold, len(remote)
+
+
+def select_task_batch(config, tasks, total_mem_gb, used_mem_gb, in_prog_need_dram_gb,
+                      n_in_progress, total_core, used_core, max_tasks, keep_order=False):
+    """
+    choose a set of tasks that fills the remaining DRAM, cores and task slots of a worker
+
+    the first ranked task is always taken so that the scheduling policy still decides what runs first,
+    the rest are packed greedily by priority per dominant resource share (the larger of the DRAM and
+    core fractions of the node a task declares), so several small tasks can use the DRAM left
+    next to a large one. Every task is admitted with the same can_accept_new_task/task_fits checks
+    as a single claim, assuming the chosen tasks use their declared DRAM and cores.
+
+    :param tasks: candidates that fit the node, ranked by rank_candidates
+    :param max_tasks: the maximum number of tasks chosen
+    :param keep_order: take the tasks in the given order instead of packing them, e.g., the fair-share order
+    :return: the chosen tasks, the first ranked task first
+
+    """
+
+    if len(tasks) == 0:
+        return []
+
+    def share(task):
+        dram = task.min_dram_gb / total_mem_gb if total_mem_gb > 0 else 0
+        cores = max(1, task.require_cpu_core) / total_core if total_core > 0 else 0
+        return max(dram, cores, 1e-6)
+
+    rest = tasks[1:]
+    if not keep_order:
+        rest = sorted(rest, key=lambda t: (max(t.priority, 0) + 1) / share(t), reverse=True)
+    chosen = []
+    for task in [tasks[0]] + rest:
+        if len(chosen) >= max_tasks:
+            break
+        if len(chosen) > 0 and not can_accept_new_task(config, total_mem_gb, used_mem_gb,
+                                                       in_prog_need_dram_gb, n_in_progress,
+                                                       total_core, used_core):
+            break
+        if not task_fits(task, total_mem_gb, used_mem_gb, in_prog_need_dram_gb):
+            continue
+        chosen.append(task)
+        used_mem_gb += task.min_dram_gb
+        in_prog_need_dram_gb += task.min_dram_gb
+        n_in_progress += 1
+        used_core += max(1, task.require_cpu_core)
+    return chosen
+
+
+def select_micro_batch(tasks, predictor, max_tasks, short_task_sec, target_sec):
+    """
+    group the first ranked task with the other candidates of its family when the family is short,
+    so that the per-task claim, spawn and report overhead is paid once per batch,
+    the batch size adapts to the history: about target_sec of work, at most max_tasks tasks,
+    a task of a long family or without history is not batched
+
+    :param tasks: candidates ranked by rank_candidates
+    :param predictor: a RuntimePredictor
+    :param short_task_sec: the largest mean runtime of a family that is batched
+    :param target_sec: the expected runtime of a batch
+    :return: the tasks of the batch, the first ranked task first
+
+    """
+
+    if len(tasks) == 0:
+        return []
+    if max_tasks <= 1 or predictor is None:
+        return tasks[:1]
+    expected = predictor.predict(tasks[0])
+    if expected is None or expected >= short_task_sec:
+        return tasks[:1]
+
+    n = max(1, min(max_tasks, int(target_sec / max(expected, 1e-3))))
+    family = predictor.family(tasks[0])
+    batch = [tasks[0]]
+    for task in tasks[1:]:
+        if len(batch) >= n:
+            break
+        if task.task_type == tasks[0].task_type and predictor.family(task) == family:
+            batch.append(task)
+    return batch
+
+
+def select_stragglers(running, now, predictor, min_runtime_sec, slowdown):
+    """
+    the tasks running on other workers that are worth a backup copy once the todo queue is drained,
+    a task qualifies after min_runtime_sec, and after slowdown times the mean runtime of its family if
+    the family has history, the longest running first
+
+    :param running: (task, claim time) of the candidates
+    :param predictor: a RuntimePredictor or None
+
+    """
+
+    stragglers = []
+    for task, since in running:
+        elapsed = now - since
+        if elapsed < min_runtime_sec:
+            continue
+        expected = predictor.predict(task) if predictor is not None else None
+        if expected is not None and elapsed < slowdown * expected:
+            continue
+        stragglers.append((elapsed, task))
+    stragglers.sort(key=lambda x: -x[0])
+    return [task for _, task in stragglers]
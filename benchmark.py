@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Hermetic benchmark of the scheduler hot paths
+
+It starts a throwaway redis-server on a free local port (or uses fakeredis with --fake),
+loads queues of 10^3 to 10^6 tasks and measures the real get_task_from_redis, report_task_finish,
+report_task_failed, add_task_to_redis and print_task_status with 1 to 200 simulated workers.
+Results are written as JSON so that regressions can be tracked across commits.
+
+    python3 benchmark.py --queue_sizes 1000,10000,100000 --workers 1,10,50 --output bench_results.json
+"""
+
+import os
+import io
+import json
+import time
+import shutil
+import socket
+import tempfile
+import platform
+import subprocess
+import contextlib
+from threading import Thread, Barrier
+import numpy as np
+import redis
+
+from const import *
+from utils import RunnerConfig, EMPTY_TASK, END_OF_TASK
+import redisWorker
+import redisManager
+
+
+#################################### redis server #####################################
+def find_redis_server():
+    candidates = [os.environ.get("REDIS_SERVER", ""), shutil.which("redis-server") or "",
+                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "redis", "src", "redis-server")]
+    for path in candidates:
+        if path and os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalRedisServer:
+    """
+    a redis-server process without persistence that lives as long as the benchmark
+
+    """
+
+    def __init__(self, binary=None):
+        self.binary = binary or find_redis_server()
+        if self.binary is None:
+            raise RuntimeError("redis-server not found, set REDIS_SERVER, run redis.sh or use --fake")
+        self.port = free_port()
+        self.workdir = tempfile.mkdtemp(prefix="distcomp_bench_")
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen([self.binary, "--port", str(self.port), "--bind", "127.0.0.1",
+                                      "--save", "", "--appendonly", "no", "--dir", self.workdir],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        client = redis.Redis(host="127.0.0.1", port=self.port)
+        for _ in range(100):
+            try:
+                client.ping()
+                return self
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("redis-server did not start on port {}".format(self.port))
+
+    def pool(self, max_connections=20):
+        return redis.ConnectionPool(host="127.0.0.1", port=self.port, decode_responses=True,
+                                    max_connections=max_connections)
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class FakeRedisServer:
+    """
+    in-process fakeredis, no network round trip, useful where redis-server cannot be installed
+
+    """
+
+    def __init__(self):
+        import fakeredis
+        self.server = fakeredis.FakeServer()
+
+    def pool(self, max_connections=20):
+        import fakeredis
+        connection_class = getattr(fakeredis, "FakeRedisConnection", None) or fakeredis.FakeConnection
+        return redis.ConnectionPool(connection_class=connection_class, server=self.server,
+                                    decode_responses=True, max_connections=max_connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+#################################### worker #####################################
+class BenchWorker(redisWorker.Worker):
+    """
+    a worker that runs the real claim code but does not start the monitoring threads,
+    spawn tasks or sample the host resources
+
+    """
+
+    def __init__(self, name, redis_pool, config, total_mem_gb=256, total_core=64):
+        self.bench_redis_pool = redis_pool
+        self.bench_resources = (total_core, total_mem_gb)
+        super(BenchWorker, self).__init__(config=config, name=name)
+
+    def connect_redis(self):
+        self.redis_pool = self.bench_redis_pool
+        self.redis_inst = redis.Redis(connection_pool=self.redis_pool)
+        self.shards = redisWorker.ShardedRedis([self.redis_inst])
+
+    def sync_cluster_config(self):
+        pass
+
+    def get_health_info(self):
+        self.total_core, self.total_mem_gb = self.bench_resources
+        self.used_core, self.used_mem_gb = 0, 0
+        return self.total_core, self.used_core, self.total_mem_gb, self.used_mem_gb
+
+    def start_services(self):
+        pass
+
+
+#################################### benchmarks #####################################
+def summarize(name, queue_size, n_workers, latencies, seconds, ops=None):
+    """
+    :param latencies: per call latency in seconds
+    :param ops: the number of operations if a call handles many, e.g., loading a task file
+
+    """
+
+    lat = np.asarray(latencies, dtype=np.float64) * 1000
+    ops = len(lat) if ops is None else ops
+    record = {"bench": name, "queue_size": queue_size, "workers": n_workers,
+              "ops": int(ops), "seconds": round(seconds, 4),
+              "throughput": round(ops / seconds, 2) if seconds > 0 else None}
+    if len(lat) > 0:
+        p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+        record.update({"p50_ms": round(p50, 3), "p95_ms": round(p95, 3),
+                       "p99_ms": round(p99, 3), "max_ms": round(float(lat.max()), 3)})
+    print("{:20} queue {:>8} workers {:>4} ops {:>7} {:>10.1f} ops/s p50 {:>8.3f}ms p99 {:>8.3f}ms".format(
+        name, queue_size, n_workers, record["ops"], record["throughput"] or 0,
+        record.get("p50_ms", 0), record.get("p99_ms", 0)))
+    return record
+
+
+def make_task_file(path, n_tasks):
+    with open(path, "w") as f:
+        for i in range(n_tasks):
+            # mixed priority and DRAM so that the claim path filters and sorts
+            f.write("shell:{}:{}:1:./cachesim trace{} lru {}\n".format(i % 8, 1 + i % 16, i % 100, i))
+
+
+def task_file(tmpdir, n_tasks):
+    path = os.path.join(tmpdir, "task_{}".format(n_tasks))
+    if not os.path.exists(path):
+        make_task_file(path, n_tasks)
+    return path
+
+
+def bench_add_task(redis_inst, n_tasks, tmpdir):
+    path = task_file(tmpdir, n_tasks)
+    start = time.perf_counter()
+    redisManager.add_task_to_redis(redis_inst, path)
+    seconds = time.perf_counter() - start
+    # one op is one task loaded
+    return summarize("add_task_to_redis", n_tasks, 1, [seconds], seconds, ops=n_tasks)
+
+
+def run_workers(workers, op, ops_per_worker, max_seconds):
+    """
+    run op(worker) ops_per_worker times on each worker concurrently,
+    op returns False when there is nothing left to do
+
+    """
+
+    latencies = [[] for _ in workers]
+    barrier = Barrier(len(workers))
+    deadline = [0]
+
+    def loop(i, worker):
+        barrier.wait()
+        for _ in range(ops_per_worker):
+            if time.perf_counter() > deadline[0]:
+                break
+            start = time.perf_counter()
+            if op(worker) is False:
+                break
+            latencies[i].append(time.perf_counter() - start)
+
+    threads = [Thread(target=loop, args=(i, w)) for i, w in enumerate(workers)]
+    start = time.perf_counter()
+    deadline[0] = start + max_seconds
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = time.perf_counter() - start
+    return [l for worker_lat in latencies for l in worker_lat], seconds
+
+
+def bench_claim_and_report(server, config, queue_size, n_workers, ops_per_worker, max_seconds,
+                           fail_ratio=0.1):
+    workers = [BenchWorker("bench{}".format(i), server.pool(), config) for i in range(n_workers)]
+    claimed = [[] for _ in workers]
+    index = {id(w): i for i, w in enumerate(workers)}
+
+    def claim(worker):
+        task = worker.get_task_from_redis()
+        if task == EMPTY_TASK or task == END_OF_TASK:
+            return False
+        claimed[index[id(worker)]].append(task)
+
+    lat, seconds = run_workers(workers, claim, ops_per_worker, max_seconds)
+    records = [summarize("get_task_from_redis", queue_size, n_workers, lat, seconds)]
+
+    n_fail = [0]
+
+    def report(worker):
+        tasks = claimed[index[id(worker)]]
+        if len(tasks) == 0:
+            return False
+        task = tasks.pop()
+        timing = redisWorker.task_timing_record(worker.name, task, time.time(), time.time(), 0)
+        if hash(task.task_str) % 100 < fail_ratio * 100:
+            n_fail[0] += 1
+            redisWorker.report_task_failed(worker.name, worker.redis_inst, task, "bench failure",
+                                           config.max_retry_per_task, timing=timing)
+        else:
+            redisWorker.report_task_finish(worker.name, worker.redis_inst, task, '"bench"', timing=timing)
+
+    lat, seconds = run_workers(workers, report, ops_per_worker, max_seconds)
+    records.append(summarize("report_task", queue_size, n_workers, lat, seconds))
+    records[-1]["failed_ratio"] = round(n_fail[0] / max(len(lat), 1), 3)
+    return records
+
+
+def bench_print_task_status(redis_inst, queue_size):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        redisManager.print_task_status(redis_inst, failed_reason=False)
+    seconds = time.perf_counter() - start
+    return summarize("print_task_status", queue_size, 1, [seconds], seconds)
+
+
+def environment_info(redis_inst):
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+        rev = rev.stdout.decode().strip()
+    except OSError:
+        rev = ""
+    try:
+        redis_version = redis_inst.info("server").get("redis_version", "")
+    except redis.ResponseError:
+        redis_version = ""
+    return {"git_rev": rev, "redis_version": redis_version, "python": platform.python_version(),
+            "host": socket.gethostname(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="benchmark the scheduler hot paths against a throwaway redis")
+    parser.add_argument("--queue_sizes", type=str, default="1000,10000,100000",
+                        help="comma separated number of tasks in the todo queue")
+    parser.add_argument("--workers", type=str, default="1,10,50,200",
+                        help="comma separated number of simulated workers")
+    parser.add_argument("--ops_per_worker", type=int, default=50,
+                        help="claims and reports per simulated worker")
+    parser.add_argument("--max_seconds", type=float, default=30,
+                        help="time budget of each measurement")
+    parser.add_argument("--fake", action="store_true",
+                        help="use in-process fakeredis instead of starting redis-server")
+    parser.add_argument("--redis_server", type=str, default=None,
+                        help="path to the redis-server binary")
+    parser.add_argument("--output", type=str, default="bench_results.json",
+                        help="where to write the JSON results")
+    ap = parser.parse_args()
+
+    queue_sizes = [int(float(x)) for x in ap.queue_sizes.split(",")]
+    worker_counts = [int(x) for x in ap.workers.split(",")]
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    server = FakeRedisServer() if ap.fake else LocalRedisServer(ap.redis_server)
+
+    results = []
+    with server, tempfile.TemporaryDirectory() as tmpdir:
+        redis_inst = redis.Redis(connection_pool=server.pool())
+        env = environment_info(redis_inst)
+        env["backend"] = "fakeredis" if ap.fake else "redis-server"
+        for queue_size in queue_sizes:
+            for n_workers in worker_counts:
+                redis_inst.flushdb()
+                if n_workers == worker_counts[0]:
+                    results.append(bench_add_task(redis_inst, queue_size, tmpdir))
+                    results.append(bench_print_task_status(redis_inst, queue_size))
+                else:
+                    redisManager.add_task_to_redis(redis_inst, task_file(tmpdir, queue_size))
+                results.extend(bench_claim_and_report(server, config, queue_size, n_workers,
+                                                      ap.ops_per_worker, ap.max_seconds))
+
+    with open(ap.output, "w") as f:
+        json.dump({"env": env, "results": results}, f, indent=2)
+    print("results written to {}".format(ap.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import json
+import time
+import logging
+from threading import Thread
+import redis
+from const import *
+from utils import LOCAL_CONFIG_FIELDS, parse_config
+
+
+"""
+cluster-wide config
+
+the manager publishes the fields of its conf.json that are not node local (see LOCAL_CONFIG_FIELDS)
+to the primary redis with a new version, and announces the version on a pub/sub channel,
+each worker subscribes to the channel and switches its RunnerConfig to the published fields on top of
+its own conf.json, so a tuning reaches all workers within a second instead of editing the file of each node,
+a worker also polls the version in case it missed a message (e.g., its connection was down),
+a published config that does not validate on a worker is logged and ignored by that worker
+
+"""
+
+# KEYS cluster config; ARGV conf json, channel
+# returns the new version
+PUBLISH_CONFIG_SCRIPT = """
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+redis.call('HSET', KEYS[1], 'conf', ARGV[1])
+redis.call('PUBLISH', ARGV[2], version)
+return version
+"""
+
+
+def publish_config(redis_inst, conf_data):
+    """
+    publish the cluster-wide fields of conf_data
+
+    :param redis_inst: the primary redis
+    :return: the new version, ValueError if conf_data is not a valid config
+
+    """
+
+    parse_config(conf_data)
+    cluster_conf = {k: v for k, v in conf_data.items() if k not in LOCAL_CONFIG_FIELDS}
+    script = redis_inst.register_script(PUBLISH_CONFIG_SCRIPT)
+    return int(script(keys=[REDIS_KEY_CLUSTER_CONFIG],
+                      args=[json.dumps(cluster_conf, sort_keys=True), REDIS_CHANNEL_CLUSTER_CONFIG]))
+
+
+def fetch_config(redis_inst):
+    """
+    :return: (version, the published fields), (0, {}) if nothing is published
+
+    """
+
+    version, conf = redis_inst.hmget(REDIS_KEY_CLUSTER_CONFIG, ["version", "conf"])
+    if version is None or conf is None:
+        return 0, {}
+    return int(version), json.loads(conf)
+
+
+class ConfigSubscriber(Thread):
+    def __init__(self, redis_inst, config, poll_sec=30):
+        """
+
+        :param redis_inst: the primary redis
+        :param config: the RunnerConfig switched to the published config
+        :param poll_sec: the version is also checked at this interval
+
+        """
+
+        super(ConfigSubscriber, self).__init__(daemon=True)
+        self.redis_inst = redis_inst
+        self.config = config
+        self.poll_sec = poll_sec
+        self.stop_flag = False
+
+    def sync(self):
+        """
+        apply the published config if it is newer than the one applied
+
+        :return: True if the config changed
+
+        """
+
+        version, conf = fetch_config(self.redis_inst)
+        if version <= self.config.cluster_version:
+            return False
+        if not self.config.apply_cluster_conf(conf, version):
+            # do not retry a bad version until a new one is published
+            self.config.cluster_version = version
+            return False
+        return True
+
+    def run(self):
+        while not self.stop_flag:
+            pubsub = self.redis_inst.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(REDIS_CHANNEL_CLUSTER_CONFIG)
+                # a version published before the subscription
+                self.sync()
+                last_poll = time.time()
+                while not self.stop_flag:
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None or time.time() - last_poll > self.poll_sec:
+                        self.sync()
+                        last_poll = time.time()
+            except redis.exceptions.ConnectionError as e:
+                logging.warning("config subscription lost {}, resubscribe".format(e))
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def stop(self):
+        self.stop_flag = True
+        if self.is_alive():
+            self.join()
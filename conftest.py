@@ -0,0 +1,34 @@
+"""
+Shared test helpers: an in-process fake redis and task files
+
+the test modules import make_redis and write_tasks (their __main__ runners call the tests without pytest),
+pytest tests can ask for the fake_redis fixture instead
+
+"""
+
+import os
+import pytest
+
+
+def make_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+def write_tasks(tmpdir, name, lines):
+    """
+    write a task file of the given lines into tmpdir
+
+    :return: its path
+
+    """
+
+    path = os.path.join(tmpdir, name)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+@pytest.fixture
+def fake_redis():
+    return make_redis()
@@ -16,6 +16,18 @@ TiB = 1024 * GiB
 #################################### task #####################################
 WORKER_STOP_COMMAND = "WORKER_COMMAND_CLOSE"
 TASK_FORMAT_SEPARATOR = ":"
+# the order in which a worker claims the tasks it can work on, see admission.rank_candidates
+SCHEDULING_POLICIES = ("priority", "longest_first", "shortest_first")
+# single: claim the best task and sleep, binpack: claim a set of tasks that fills the node
+ADMISSION_POLICIES = ("single", "binpack")
+# how the DRAM a task needs is decided, see memory_model.py
+DRAM_ESTIMATE_MODES = ("declared", "learned", "capped")
+# worker -> json list of input keys warm on the worker
+REDIS_KEY_WORKER_WARM_INPUTS = "worker_warm_inputs"
+# input_tasks:<input key> -> set of task strs that read the input
+REDIS_KEY_INPUT_TASKS_PREFIX = "input_tasks:"
+# a line in the task file can start with annotations, e.g., "@name=gen1 @after=a,b shell:5:8:2:./gen"
+TASK_ANNOTATION_PREFIX = "@"
 
 
 #################################### redis #####################################
@@ -24,10 +36,74 @@ REDIS_KEY_IN_PROGRESS_TASKS = "in_progress_tasks"
 REDIS_KEY_FAILED_TASKS = "failed_tasks"
 REDIS_KEY_FINISHED_TASKS = "finished_tasks"
 REDIS_KEY_TASK_FAIL_REASON = "task_fail_reason"
+REDIS_KEY_TASK_SUBMIT_TIME = "task_submit_time"
+REDIS_KEY_TASK_TIMING = "task_timing"
+REDIS_KEY_TASK_META = "task_meta"
+# task family -> number of finished runs / sum of their runtime, see predictor.py
+REDIS_KEY_FAMILY_RUNTIME_COUNT = "family_runtime_count"
+REDIS_KEY_FAMILY_RUNTIME_SUM = "family_runtime_sum"
+# "family bucket" -> number of finished runs whose peak memory is in the bucket, see memory_model.py
+REDIS_KEY_FAMILY_PEAK_MEM = "family_peak_mem"
+# task family -> number of its runs that failed for running out of memory, see memory_model.py
+REDIS_KEY_FAMILY_OOM = "family_oom"
+# task -> the time it was claimed, for the in_progress tasks
+REDIS_KEY_IN_PROGRESS_SINCE = "in_progress_since"
+# task -> "worker timestamp line", the last progress line of a running task, see progress.py
+REDIS_KEY_TASK_PROGRESS = "task_progress"
+# task -> the worker running a backup copy of it, see claim_backup_task of the worker
+REDIS_KEY_SPECULATIVE_TASKS = "speculative_tasks"
+
+# failure-class-aware retries, see retry.py
+# task -> the classes of its failures "exit,oom,", in the order of the workers in failed_tasks
+REDIS_KEY_TASK_FAILURE_CLASSES = "task_failure_classes"
+# task -> when its delayed retry is due
+REDIS_KEY_RETRY_BACKOFF = "retry_backoff"
+# task -> the memory in GB a node needs to retry it after it ran out of memory
+REDIS_KEY_TASK_MIN_NODE_MEM = "task_min_node_mem"
+
+# weighted fair share across owners, see fairshare.py
+REDIS_KEY_TASK_OWNER = "task_owner"
+REDIS_KEY_TASK_QUEUE_SCORE = "task_queue_score"
+REDIS_KEY_OWNER_PASS = "owner_pass"
+REDIS_KEY_OWNER_WEIGHTS = "owner_weights"
+REDIS_KEY_OWNER_QUEUE_PREFIX = "todo_queue:"
+
+# cluster-wide resource pools, pool -> capacity and pool_leases:<pool>, see pools.py
+REDIS_KEY_RESOURCE_POOLS = "resource_pools"
+REDIS_KEY_POOL_LEASES_PREFIX = "pool_leases:"
+
+# task dependencies, see dag.py
+REDIS_KEY_BLOCKED_TASKS = "blocked_tasks"
+REDIS_KEY_TASK_NAMES = "task_names"
+REDIS_KEY_TASK_DEPENDENTS = "task_dependents"
+# task -> number of unfinished dependencies, the blocked tasks whose dependency failed for good
+REDIS_KEY_DEPENDENCY_FAILED = "dependency_failed"
+
+# a capped stream of task state transitions, see events.py
+REDIS_KEY_TASK_EVENTS = "task_events"
+EVENT_STREAM_MAXLEN = 1000000
+EVENT_CLAIM = "claim"
+EVENT_FINISH = "finish"
+EVENT_FAIL = "fail"
+EVENT_TIMEOUT = "timeout"
+EVENT_RETURN = "return"
+EVENT_SPECULATE = "speculate"
+
+# export name -> the report time up to which finished tasks are exported, see export.py
+REDIS_KEY_EXPORT_WATERMARK = "export_watermark"
+# export_untimed:<name>, the tasks without a timing record this export name has written
+REDIS_KEY_EXPORT_UNTIMED_PREFIX = "export_untimed:"
+
+# the config published cluster-wide (fields "version" and "conf", a json dict), see config_sync.py,
+# the version is published on the channel when it changes
+REDIS_KEY_CLUSTER_CONFIG = "cluster_config"
+REDIS_CHANNEL_CLUSTER_CONFIG = "cluster_config_updates"
 
 
 #################################### other #####################################
 
 
 CONFIG_PATH = "conf.json"
+# a task writes its progress lines to the file named by this environment variable
+PROGRESS_FILE_ENV = "DISTCOMP_PROGRESS_FILE"
 
@@ -0,0 +1,290 @@
+import json
+import logging
+from collections import defaultdict, deque
+from const import *
+from utils import Task, with_priority
+from fairshare import REQUEUE_LUA
+
+
+"""
+task dependencies
+
+a task declares a name and the names of the tasks it depends on in the task file:
+    @name=gen1 shell:5:8:2:./gen trace1
+    @name=sim1 @after=gen1 shell:5:8:2:./cachesim trace1 lru
+    @after=sim1,sim2 shell:5:8:2:./agg trace1
+
+a task with unfinished dependencies waits in blocked_tasks (task -> number of unfinished dependencies),
+task_dependents maps a task to the tasks waiting for it, when a task finishes, the worker runs
+UNBLOCK_SCRIPT in the same pipeline as the finish report, so the dependents become claimable immediately
+
+when a task fails for good (no retry left), the failure report moves the tasks waiting for it, and the tasks
+waiting for them, from blocked_tasks to dependency_failed with a fail reason (see FAIL_DEPENDENTS_LUA), they are
+not counted as work left, they keep their number of unfinished dependencies and are blocked again when the
+failed tasks are moved back to todo (see restore_dependency_failed), a task loaded after one of its dependencies
+failed for good goes to dependency_failed directly
+
+"""
+
+
+# KEYS: blocked_tasks, task_dependents, finished_tasks, todo_tasks, in_progress_tasks, task_owner,
+#       task_queue_score, failed_tasks, retry_backoff, dependency_failed, task_fail_reason
+# ARGV: task str, dependency task strs...
+# returns the number of unfinished dependencies, -1 if the task is already loaded, -2 if a dependency already
+# failed for good (the task goes to dependency_failed)
+ADD_TASK_SCRIPT = REQUEUE_LUA + """
+for i = 1, 5 do
+    if i ~= 2 and redis.call('HEXISTS', KEYS[i], ARGV[1]) == 1 then
+        return -1
+    end
+end
+if redis.call('HEXISTS', KEYS[10], ARGV[1]) == 1 then
+    return -1
+end
+local remaining = 0
+local reason = nil
+for i = 2, #ARGV do
+    local dep = ARGV[i]
+    if redis.call('HEXISTS', KEYS[3], dep) == 0 then
+        local cur = redis.call('HGET', KEYS[2], dep)
+        local dependents = {}
+        if cur then dependents = cjson.decode(cur) end
+        table.insert(dependents, ARGV[1])
+        redis.call('HSET', KEYS[2], dep, cjson.encode(dependents))
+        remaining = remaining + 1
+        if reason then
+            -- already failed by an earlier dependency
+        elseif redis.call('HEXISTS', KEYS[10], dep) == 1 then
+            -- the dependency waits for a failed task itself, name that task
+            reason = redis.call('HGET', KEYS[11], dep) or ('dependency failed: ' .. dep)
+        elseif redis.call('HEXISTS', KEYS[8], dep) == 1 and redis.call('HEXISTS', KEYS[4], dep) == 0 and
+                redis.call('HEXISTS', KEYS[5], dep) == 0 and not redis.call('ZSCORE', KEYS[9], dep) then
+            -- it failed with no retry left
+            reason = 'dependency failed: ' .. dep
+        end
+    end
+end
+if reason then
+    redis.call('HSET', KEYS[10], ARGV[1], remaining)
+    redis.call('HSET', KEYS[11], ARGV[1], reason)
+    return -2
+elseif remaining > 0 then
+    redis.call('HSET', KEYS[1], ARGV[1], remaining)
+else
+    requeue(KEYS[4], KEYS[6], KEYS[7], ARGV[1])
+end
+return remaining
+"""
+
+# move the tasks waiting for a task that failed for good from blocked_tasks to dependency_failed, transitively,
+# prepended to the failure report script, returns the number of moved tasks
+FAIL_DEPENDENTS_LUA = """
+local function fail_dependents(blocked, dependents, dependency_failed, fail_reason, task)
+    local queue = {task}
+    local i = 1
+    while i <= #queue do
+        local cur = redis.call('HGET', dependents, queue[i])
+        if cur then
+            for _, dependent in ipairs(cjson.decode(cur)) do
+                local remaining = redis.call('HGET', blocked, dependent)
+                if remaining then
+                    redis.call('HDEL', blocked, dependent)
+                    redis.call('HSET', dependency_failed, dependent, remaining)
+                    redis.call('HSET', fail_reason, dependent, 'dependency failed: ' .. task)
+                    table.insert(queue, dependent)
+                end
+            end
+        end
+        i = i + 1
+    end
+    return #queue - 1
+end
+"""
+
+# KEYS: blocked_tasks, task_dependents, todo_tasks, task_owner, task_queue_score, dependency_failed
+# ARGV: the finished task str
+# returns the dependents that become claimable
+UNBLOCK_SCRIPT = REQUEUE_LUA + """
+local cur = redis.call('HGET', KEYS[2], ARGV[1])
+if not cur then
+    return {}
+end
+local ready = {}
+for _, task in ipairs(cjson.decode(cur)) do
+    if redis.call('HEXISTS', KEYS[1], task) == 1 then
+        if redis.call('HINCRBY', KEYS[1], task, -1) <= 0 then
+            redis.call('HDEL', KEYS[1], task)
+            requeue(KEYS[3], KEYS[4], KEYS[5], task)
+            table.insert(ready, task)
+        end
+    elseif redis.call('HEXISTS', KEYS[6], task) == 1 then
+        -- it still waits for its failed dependency
+        redis.call('HINCRBY', KEYS[6], task, -1)
+    end
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+return ready
+"""
+
+# KEYS: dependency_failed, blocked_tasks, task_fail_reason, todo_tasks, task_owner, task_queue_score
+# returns the number of tasks blocked again
+RESTORE_SCRIPT = REQUEUE_LUA + """
+local tasks = redis.call('HGETALL', KEYS[1])
+for i = 1, #tasks, 2 do
+    if tonumber(tasks[i + 1]) > 0 then
+        redis.call('HSET', KEYS[2], tasks[i], tasks[i + 1])
+    else
+        requeue(KEYS[4], KEYS[5], KEYS[6], tasks[i])
+    end
+    redis.call('HDEL', KEYS[3], tasks[i])
+end
+redis.call('DEL', KEYS[1])
+return #tasks / 2
+"""
+
+
+def unblock_dependents(redis_inst, task_str):
+    """
+    make the tasks waiting for task_str claimable if it was their last unfinished dependency,
+    redis_inst can be a pipeline so that it is atomic with the finish report
+
+    """
+
+    script = redis_inst.register_script(UNBLOCK_SCRIPT)
+    return script(keys=[REDIS_KEY_BLOCKED_TASKS, REDIS_KEY_TASK_DEPENDENTS, REDIS_KEY_TODO_TASKS,
+                        REDIS_KEY_TASK_OWNER, REDIS_KEY_TASK_QUEUE_SCORE, REDIS_KEY_DEPENDENCY_FAILED],
+                  args=[task_str])
+
+
+def restore_dependency_failed(redis_inst):
+    """
+    block the tasks whose dependency failed again, before the failed tasks are retried, a task whose
+    dependencies all finished in the meantime goes to todo
+
+    :return: the number of restored tasks
+
+    """
+
+    script = redis_inst.register_script(RESTORE_SCRIPT)
+    return script(keys=[REDIS_KEY_DEPENDENCY_FAILED, REDIS_KEY_BLOCKED_TASKS, REDIS_KEY_TASK_FAIL_REASON,
+                        REDIS_KEY_TODO_TASKS, REDIS_KEY_TASK_OWNER, REDIS_KEY_TASK_QUEUE_SCORE])
+
+
+def critical_path_length(task_strs, deps):
+    """
+    the number of tasks on the longest chain starting from each task (itself included),
+    raise ValueError if the dependencies have a cycle
+
+    :param deps: task str -> list of task strs it depends on (only tasks in task_strs are considered)
+
+    """
+
+    dependents = defaultdict(list)
+    n_deps = {t: 0 for t in task_strs}
+    for t in task_strs:
+        for d in deps.get(t, []):
+            if d in n_deps:
+                dependents[d].append(t)
+                n_deps[t] += 1
+
+    # topological order
+    order = []
+    ready = deque(t for t, n in n_deps.items() if n == 0)
+    while len(ready) > 0:
+        t = ready.popleft()
+        order.append(t)
+        for c in dependents[t]:
+            n_deps[c] -= 1
+            if n_deps[c] == 0:
+                ready.append(c)
+    if len(order) != len(n_deps):
+        raise ValueError("task dependencies have a cycle: {}".format(
+            [t for t, n in n_deps.items() if n > 0][:5]))
+
+    length = {}
+    for t in reversed(order):
+        length[t] = 1 + max((length[c] for c in dependents[t]), default=0)
+    return length
+
+
+def resolve_dependencies(redis_inst, entries, critical_path_boost=0):
+    """
+    resolve the @name/@after annotations of the loaded task lines
+
+    :param entries: a list of (task str, annotations)
+    :param critical_path_boost: add this much priority per task on the longest chain of dependents,
+        so that tasks on the critical path start first
+    :return: a list of (task str, annotations, dependency task strs), the task str has the boosted priority
+
+    """
+
+    names = {}
+    for task_str, ann in entries:
+        if "name" in ann:
+            if ann["name"] in names and names[ann["name"]] != task_str:
+                raise ValueError("duplicate task name {}".format(ann["name"]))
+            names[ann["name"]] = task_str
+
+    # dependencies on tasks loaded from an earlier file
+    unknown = sorted({d for _, ann in entries for d in ann.get("after", "").split(",")
+                      if d and d not in names})
+    if len(unknown) > 0:
+        for name, task_str in zip(unknown, redis_inst.hmget(REDIS_KEY_TASK_NAMES, unknown)):
+            if task_str is None:
+                raise ValueError("unknown task name {} in @after".format(name))
+            names[name] = task_str
+
+    deps = {}
+    for task_str, ann in entries:
+        deps[task_str] = [names[d] for d in ann.get("after", "").split(",") if d]
+
+    # also checks for cycles
+    length = critical_path_length([t for t, _ in entries], deps)
+    new_str = {task_str: task_str for task_str, _ in entries}
+    if critical_path_boost > 0:
+        for task_str, _ in entries:
+            if length[task_str] > 1:
+                priority = Task(task_str).priority + critical_path_boost * (length[task_str] - 1)
+                new_str[task_str] = with_priority(task_str, priority)
+
+    resolved = []
+    for task_str, ann in entries:
+        resolved.append((new_str[task_str], ann, [new_str.get(d, d) for d in deps[task_str]]))
+    return resolved
+
+
+def add_dag_tasks_to_redis(redis_inst, resolved):
+    """
+    add tasks with annotations, the ones with unfinished dependencies are blocked, the ones with a dependency
+that failed for good go to dependency_failed
+
+    :param resolved: the output of resolve_dependencies
+    :return: (number of tasks added to todo, number of blocked tasks)
+
+    """
+
+    script = redis_inst.register_script(ADD_TASK_SCRIPT)
+    p = redis_inst.pipeline()
+    for task_str, ann, deps in resolved:
+        if "name" in ann:
+            p.hset(REDIS_KEY_TASK_NAMES, ann["name"], task_str)
+        p.hset(REDIS_KEY_TASK_META, task_str, json.dumps(ann))
+    p.execute()
+
+    # each task is added atomically, a dependency that finishes concurrently is either seen as finished
+    # or unblocks the task later, so no task misses its unblock
+    p = redis_inst.pipeline()
+    for task_str, ann, deps in resolved:
+        script(keys=[REDIS_KEY_BLOCKED_TASKS, REDIS_KEY_TASK_DEPENDENTS,
+                     REDIS_KEY_FINISHED_TASKS, REDIS_KEY_TODO_TASKS, REDIS_KEY_IN_PROGRESS_TASKS,
+                     REDIS_KEY_TASK_OWNER, REDIS_KEY_TASK_QUEUE_SCORE, REDIS_KEY_FAILED_TASKS,
+                     REDIS_KEY_RETRY_BACKOFF, REDIS_KEY_DEPENDENCY_FAILED, REDIS_KEY_TASK_FAIL_REASON],
+               args=[task_str] + deps, client=p)
+    r = p.execute()
+    n_todo = sum(1 for x in r if x == 0)
+    n_blocked = sum(1 for x in r if x > 0)
+    n_dependency_failed = sum(1 for x in r if x == -2)
+    logging.info("add {} tasks with annotations, {} claimable, {} blocked, {} dependency failed, "
+                 "{} already loaded".format(len(resolved), n_todo, n_blocked, n_dependency_failed,
+                                            len(r) - n_todo - n_blocked - n_dependency_failed))
+    return n_todo, n_blocked
@@ -0,0 +1,186 @@
+import os
+import time
+import heapq
+import signal
+import itertools
+from threading import Condition
+import psutil
+
+
+"""
+task deadlines and process tree kills
+
+the worker keeps the deadline of each running task in a heap (DeadlineQueue), the timeout thread sleeps on a
+condition until the earliest deadline, or until a task with an earlier deadline is added, so a task is
+stopped when it times out instead of at the next periodic scan, a task without a limit (timeout 0) has no entry
+
+a shell task runs in its own process group (session), a timeout kills the group, so the grandchildren of the
+task are killed even after they left the process tree (e.g., started in the background with &),
+with task_kill_grace_sec > 0 the processes get SIGTERM first and SIGKILL after the grace period
+
+"""
+
+
+# a shell task runner stops its task at the timeout and reports it with the output of the task,
+# the worker kills a runner that did not within the grace period and this slack
+RUNNER_TIMEOUT_SLACK_SEC = 2
+
+
+class DeadlineQueue:
+    def __init__(self):
+        self.cond = Condition()
+        self.heap = []  # (deadline, seq, key)
+        self.entries = {}  # key -> its live heap entry
+        self.seq = itertools.count()
+        self.closed = False
+
+    def __len__(self):
+        with self.cond:
+            return len(self.entries)
+
+    def add(self, key, deadline):
+        """
+        set the deadline of a key, replacing its previous one
+
+        """
+
+        with self.cond:
+            entry = (deadline, next(self.seq), key)
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                # the timeout thread sleeps until a later deadline
+                self.cond.notify()
+
+    def discard(self, key):
+        # the entry stays in the heap and is skipped when it comes up
+        with self.cond:
+            self.entries.pop(key, None)
+
+    def next_deadline(self):
+        with self.cond:
+            self._drop_stale()
+            return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def pop_expired(self, now):
+        """
+        :return: the keys whose deadline is not after now, earliest first
+
+        """
+
+        expired = []
+        with self.cond:
+            self._drop_stale()
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                _, _, key = heapq.heappop(self.heap)
+                del self.entries[key]
+                expired.append(key)
+                self._drop_stale()
+        return expired
+
+    def wait(self, now, max_wait_sec):
+        """
+        sleep until the earliest deadline, a new earlier deadline, close() or max_wait_sec
+
+        """
+
+        with self.cond:
+            if self.closed:
+                return
+            self._drop_stale()
+            wait_sec = max_wait_sec
+            if len(self.heap) > 0:
+                wait_sec = min(wait_sec, self.heap[0][0] - now)
+            if wait_sec > 0:
+                self.cond.wait(wait_sec)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _drop_stale(self):
+        while len(self.heap) > 0 and self.entries.get(self.heap[0][2]) is not self.heap[0]:
+            heapq.heappop(self.heap)
+
+
+def _signal_tree(procs, groups, sig):
+    for pgid in groups:
+        try:
+            os.killpg(pgid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+    for proc in procs:
+        try:
+            proc.send_signal(sig)
+        except psutil.NoSuchProcess:
+            pass
+
+
+def _is_alive(proc):
+    try:
+        return proc.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def kill_process_tree(pid, grace_sec=0):
+    """
+    kill a process, its descendants and the process groups they lead or belong to,
+    except the process group of the caller
+
+    :param grace_sec: > 0 sends SIGTERM first and SIGKILL to what is left after grace_sec
+
+    """
+
+    try:
+        parent = psutil.Process(pid)
+        procs = [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    groups = set()
+    for proc in procs:
+        try:
+            groups.add(os.getpgid(proc.pid))
+        except ProcessLookupError:
+            pass
+    groups.discard(os.getpgrp())
+    if grace_sec > 0:
+        _signal_tree(procs, groups, signal.SIGTERM)
+        # not psutil.wait_procs, it would reap the task runner before multiprocessing does
+        deadline = time.time() + grace_sec
+        while time.time() < deadline and any(_is_alive(proc) for proc in procs):
+            time.sleep(0.05)
+    # the processes of a group that left the tree are only reached through the group
+    _signal_tree(procs, groups, signal.SIGKILL)
+
+
+def kill_process_group(popen, grace_sec=0):
+    """
+    kill the process group of a shell task started with start_new_session=True, the shell leads the group
+
+    :param popen: the subprocess.Popen of the shell
+    :param grace_sec: > 0 sends SIGTERM first and SIGKILL to what is left of the group after grace_sec
+
+    """
+
+    if grace_sec > 0:
+        try:
+            os.killpg(popen.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            return
+        # not popen.wait, the shell usually exits at once while the processes it started still clean up
+        deadline = time.time() + grace_sec
+        while time.time() < deadline:
+            # reap the shell, a zombie is still a member of the group
+            popen.poll()
+            try:
+                os.killpg(popen.pid, 0)
+            except ProcessLookupError:
+                return
+            time.sleep(0.05)
+    # the group outlives the shell while one of its processes runs
+    try:
+        os.killpg(popen.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
@@ -0,0 +1,122 @@
+import time
+import logging
+import redis
+from const import *
+from shards import shard_clients
+
+
+"""
+task state transitions are appended to a capped redis stream (task_events),
+each event is a small dict {"e": event type, "t": task str, "w": worker, ...},
+the event time is the stream entry id (milliseconds since epoch)
+
+consumers tail the stream with consumer groups, so dashboards and result collectors only
+read what changed since their last read instead of rescanning the task hashes,
+with several redis shards, each shard has the stream of its own tasks
+
+"""
+
+
+def append_event(redis_inst, event, task_str, worker, **fields):
+    """
+    append an event to the task event stream, redis_inst can be a pipeline
+    so that the event is sent together with the state change
+
+    :param event: one of EVENT_CLAIM, EVENT_FINISH, EVENT_FAIL, EVENT_TIMEOUT, EVENT_RETURN
+    :param fields: extra fields, values are converted to str
+
+    """
+
+    entry = {"e": event, "t": task_str, "w": worker}
+    for k, v in fields.items():
+        if v is not None:
+            entry[k] = str(v)
+    return redis_inst.xadd(REDIS_KEY_TASK_EVENTS, entry,
+                           maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+
+
+def event_time(event_id):
+    """
+    the unix time (seconds) of a stream entry id
+
+    """
+
+    return int(event_id.split("-")[0]) / 1000
+
+
+class EventConsumer:
+    """
+    read task events incrementally as a member of a consumer group,
+    events are delivered to one consumer of the group and redelivered if not acked
+
+    """
+
+    def __init__(self, redis_inst, group, consumer, start_id="0"):
+        """
+
+        :param group: the consumer group name, consumers in different groups all see every event
+        :param consumer: the name of this consumer in the group
+        :param start_id: where a new group starts, "0" for the whole retained stream, "$" for new events
+
+        """
+
+        self.redis_inst = redis_inst
+        self.group = group
+        self.consumer = consumer
+        # deliver our pending (read but not acked) events first, e.g., after a restart
+        self.read_pending = True
+        try:
+            self.redis_inst.xgroup_create(REDIS_KEY_TASK_EVENTS, group, id=start_id, mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def read(self, count=1000, block_ms=2000):
+        """
+        return a list of (event_id, event dict), an empty list if no event arrives within block_ms
+
+        """
+
+        if self.read_pending:
+            r = self.redis_inst.xreadgroup(self.group, self.consumer,
+                                           {REDIS_KEY_TASK_EVENTS: "0"}, count=count)
+            events = r[0][1] if len(r) > 0 else []
+            if len(events) > 0:
+                return events
+            self.read_pending = False
+
+        r = self.redis_inst.xreadgroup(self.group, self.consumer,
+                                       {REDIS_KEY_TASK_EVENTS: ">"}, count=count, block=block_ms)
+        return r[0][1] if r is not None and len(r) > 0 else []
+
+    def ack(self, event_ids):
+        if len(event_ids) > 0:
+            self.redis_inst.xack(REDIS_KEY_TASK_EVENTS, self.group, *event_ids)
+
+
+def tail_events(redis_inst, group, consumer, include_str="", exclude_str="", follow=True):
+    """
+    print task events as they happen, the streams of the shards are read in turn
+
+    """
+
+    consumers = [EventConsumer(shard, group, consumer) for shard in shard_clients(redis_inst)]
+    block_ms = max(2000 // len(consumers), 1)
+    while True:
+        batches = [consumer.read(block_ms=block_ms) for consumer in consumers]
+        events = sorted((e for batch in batches for e in batch), key=lambda x: event_time(x[0]))
+        for event_id, event in events:
+            task_str = event.get("t", "")
+            if len(include_str) > 0 and include_str not in task_str:
+                continue
+            if len(exclude_str) > 0 and exclude_str in task_str:
+                continue
+            extra = " ".join("{}={}".format(k, v) for k, v in event.items() if k not in ("e", "t", "w"))
+            print("{} {:8} {:12} {} {}".format(
+                time.strftime("%H:%M:%S", time.localtime(event_time(event_id))),
+                event.get("e", ""), event.get("w", ""), task_str, extra))
+        for consumer, batch in zip(consumers, batches):
+            consumer.ack([event_id for event_id, _ in batch])
+        if len(events) == 0 and not follow:
+            break
+    logging.info("no more events")
@@ -0,0 +1,228 @@
+import os
+import csv
+import json
+import time
+import logging
+from const import *
+from utils import Task, task_family
+from shards import as_sharded, shard_clients
+
+
+"""
+bulk export of the finished tasks to csv, jsonl or parquet
+
+the finished tasks are read with HSCAN in batches of scan_count, together with their timing records and
+submission times (HMGET per batch), and written batch by batch, so the memory does not grow with the number
+of tasks, the file is written next to the output and renamed when it is complete
+
+an export writes the tasks reported since the previous export of the same name: the primary shard keeps a
+watermark per export name (export_watermark), an export takes the tasks whose report time is after the
+watermark and at least lag_sec old, then moves the watermark, the lag covers the clock skew between the
+workers and the reports still in flight, a task reported later is in the next export
+
+a task finished without a timing record (e.g., by an older worker) has no report time, the shard keeps the
+untimed tasks an export name has written in export_untimed:<name>, so each is written once by the first export
+that sees it, the tasks of a running export are staged in export_untimed:<name>:pending and added when the
+file is complete
+
+HSCAN can return a task twice while redis resizes the hash during the scan, such a task is written twice,
+an export does not remember the tasks it wrote so that its memory does not grow with the export, deduplicate
+on the task column if it matters
+
+parquet needs pyarrow, csv and jsonl do not
+
+"""
+
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
+# (column, type), the columns of an exported task
+EXPORT_COLUMNS = (
+    ("task", str), ("task_type", str), ("priority", int), ("min_dram_gb", float), ("require_cpu_core", int),
+    ("timeout_seconds", int), ("task_params", str), ("family", str), ("worker", str),
+    ("submit_ts", float), ("claim_ts", float), ("start_ts", float), ("finish_ts", float), ("report_ts", float),
+    ("runtime_sec", float), ("exit_code", int), ("peak_rss_kb", float), ("cpu_sec", float), ("stdout", str),
+)
+EXPORT_LAG_SEC = 60
+
+
+def parse_result(value):
+    """
+    split a finished_tasks value "worker: json of stdout" into (worker, stdout)
+
+    """
+
+    worker, _, msg = value.partition(": ")
+    try:
+        stdout = json.loads(msg)
+    except ValueError:
+        # e.g., "stdout is too large"
+        return worker, msg
+    return worker, stdout if isinstance(stdout, str) else msg
+
+
+def export_row(task_str, value, timing, submit_ts, family_params=()):
+    task = Task(task_str)
+    worker, stdout = parse_result(value)
+    row = {"task": task_str, "task_type": task.task_type, "priority": task.priority,
+           "min_dram_gb": task.min_dram_gb, "require_cpu_core": task.require_cpu_core,
+           "timeout_seconds": task.timeout_seconds, "task_params": task.task_params,
+           "family": task_family(task, family_params), "worker": timing.get("worker") or worker,
+           "submit_ts": float(submit_ts) if submit_ts is not None else None, "stdout": stdout}
+    for field in ("claim_ts", "start_ts", "finish_ts", "report_ts", "exit_code", "peak_rss_kb", "cpu_sec"):
+        row[field] = timing.get(field)
+    row["runtime_sec"] = None
+    if timing.get("finish_ts") is not None and timing.get("start_ts") is not None:
+        row["runtime_sec"] = round(timing["finish_ts"] - timing["start_ts"], 3)
+    return row
+
+
+class CsvExportWriter:
+    def __init__(self, path):
+        self.f = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.f, fieldnames=[c for c, _ in EXPORT_COLUMNS])
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class JsonlExportWriter:
+    def __init__(self, path):
+        self.f = open(path, "w")
+
+    def write(self, rows):
+        self.f.write("".join(json.dumps(row) + "\n" for row in rows))
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetExportWriter:
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        types = {str: pa.string(), int: pa.int64(), float: pa.float64()}
+        self.pa = pa
+        self.schema = pa.schema([(c, types[t]) for c, t in EXPORT_COLUMNS])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        # one row group per batch
+        if len(rows) > 0:
+            self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+EXPORT_WRITERS = {"csv": CsvExportWriter, "jsonl": JsonlExportWriter, "parquet": ParquetExportWriter}
+
+
+def export_format(path, fmt=None):
+    """
+    :return: fmt, or the format named by the extension of path
+
+    """
+
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("unknown export format {}, one of {}".format(fmt, "/".join(EXPORT_FORMATS)))
+    if fmt == "parquet":
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("the parquet export needs pyarrow (pip install pyarrow), or export csv/jsonl")
+    return fmt
+
+
+def export_results(redis_inst, path, name="results", fmt=None, scan_count=1000, task_filter=None,
+                   family_params=(), lag_sec=EXPORT_LAG_SEC, now=None):
+    """
+    write the tasks reported since the previous export of this name to path, and the tasks without a timing
+    record that no export of this name wrote yet
+
+    :param fmt: one of EXPORT_FORMATS, the extension of path if None
+    :param task_filter: an optional function task_str -> bool
+    :return: (the number of exported tasks, the new watermark)
+
+    """
+
+    fmt = export_format(path, fmt)
+    primary = as_sharded(redis_inst).primary
+    watermark = primary.hget(REDIS_KEY_EXPORT_WATERMARK, name)
+    since = float(watermark) if watermark is not None else None
+    until = (time.time() if now is None else now) - lag_sec
+    if since is not None:
+        until = max(until, since)
+
+    untimed_key = REDIS_KEY_EXPORT_UNTIMED_PREFIX + name
+    pending_key = untimed_key + ":pending"
+
+    def take(timing):
+        report_ts = timing.get("report_ts")
+        return (since is None or report_ts > since) and report_ts <= until
+
+    def export_batch(shard, batch):
+        if len(batch) == 0:
+            return 0
+        task_strs = [t for t, _ in batch]
+        rows = []
+        pipeline = shard.pipeline(transaction=False)
+        pipeline.hmget(REDIS_KEY_TASK_TIMING, task_strs)
+        pipeline.hmget(REDIS_KEY_TASK_SUBMIT_TIME, task_strs)
+        pipeline.smismember(untimed_key, task_strs)
+        timings, submit_ts, written = pipeline.execute()
+        untimed = []
+        for (task_str, value), timing_str, ts, was_written in zip(batch, timings, submit_ts, written):
+            try:
+                timing = json.loads(timing_str) if timing_str is not None else {}
+            except ValueError:
+                logging.warning("cannot parse timing record of task {}".format(task_str))
+                timing = {}
+            if timing.get("report_ts") is None:
+                if was_written:
+                    continue
+                untimed.append(task_str)
+            elif not take(timing):
+                continue
+            rows.append(export_row(task_str, value, timing, ts, family_params))
+        writer.write(rows)
+        if len(untimed) > 0:
+            shard.sadd(pending_key, *untimed)
+        return len(rows)
+
+    shards = shard_clients(redis_inst)
+    tmp_path = path + ".tmp"
+    writer = EXPORT_WRITERS[fmt](tmp_path)
+    n_rows = 0
+    try:
+        for shard in shards:
+            # left by an export that did not complete
+            shard.delete(pending_key)
+        # the finished task, its timing record and its submission time are on the same shard
+        for shard in shards:
+            batch = []
+            for task_str, value in shard.hscan_iter(REDIS_KEY_FINISHED_TASKS, count=scan_count):
+                if task_filter is not None and not task_filter(task_str):
+                    continue
+                batch.append((task_str, value))
+                if len(batch) >= scan_count:
+                    n_rows += export_batch(shard, batch)
+                    batch = []
+            n_rows += export_batch(shard, batch)
+    except BaseException:
+        writer.close()
+        os.remove(tmp_path)
+        raise
+    writer.close()
+    os.replace(tmp_path, path)
+    # after the file is complete, a failed export is repeated by the next one
+    for shard in shards:
+        pipeline = shard.pipeline()
+        pipeline.sunionstore(untimed_key, [untimed_key, pending_key])
+        pipeline.delete(pending_key)
+        pipeline.execute()
+    primary.hset(REDIS_KEY_EXPORT_WATERMARK, name, until)
+    return n_rows, until
@@ -0,0 +1,210 @@
+import os
+import math
+from const import *
+from utils import Task
+
+
+"""
+weighted fair share across submitters
+
+every task is loaded for an owner (loadTask --owner, or @owner= in front of a task line, default $USER),
+the todo tasks of an owner are indexed in the sorted set todo_queue:<owner>, scored by
+    submit time - priority * fair_share_aging_sec
+so one priority level is worth fair_share_aging_sec of waiting, a task of a low priority reaches the head
+once it waited that much longer than the tasks behind it, and nothing starves behind a stream of
+high-priority tasks
+
+the owners are scheduled by stride scheduling, owner_pass holds the virtual time of each owner,
+a claim adds 1 / weight to the pass of the owner, and a worker claims from the owner with the smallest pass
+that has a task it can run, so owners with weights 2 and 1 get 2/3 and 1/3 of the claims while both have
+tasks, an owner whose queue was empty restarts at the smallest pass of the active owners instead of
+catching up; a claim reads the passes and the heads of the queues and updates them in O(log n)
+
+todo_tasks stays the source of truth: a claim still HDELs it, the scripts that put a task back to todo
+index it again (REQUEUE_LUA), and a member that is no longer in todo (e.g., it was claimed by the scan of
+todo_tasks) is dropped when a claim reaches it, tasks without an owner are claimed by the scan as before,
+the index and the passes are kept per shard, the weights (owner_weights) are on the primary
+
+"""
+
+# the weights are re-read at most this often by a worker
+OWNER_WEIGHTS_REFRESH_SEC = 10
+# rounds of picking the owner queue heads again when other workers claimed them first, then todo is scanned
+FAIR_SHARE_CLAIM_ROUNDS = 3
+
+# put a task back to todo and to the queue of its owner, prepended to the scripts that requeue tasks
+REQUEUE_LUA = """
+local function requeue(todo, owners, scores, task)
+    redis.call('HSET', todo, task, '')
+    local owner = redis.call('HGET', owners, task)
+    if owner then
+        redis.call('ZADD', '""" + REDIS_KEY_OWNER_QUEUE_PREFIX + """' .. owner, redis.call('HGET', scores, task) or 0, task)
+    end
+end
+"""
+
+# KEYS: todo_tasks, task_owner, task_queue_score
+# ARGV: task strs
+REQUEUE_SCRIPT = REQUEUE_LUA + """
+for i = 1, #ARGV do
+    requeue(KEYS[1], KEYS[2], KEYS[3], ARGV[i])
+end
+return #ARGV
+"""
+
+# KEYS: todo_tasks, the queue of the owner, owner_pass, in_progress_tasks, in_progress_since, failed_tasks,
+#       task_events
+# ARGV: task str, owner, worker, pass increment, claim time, stream maxlen, event
+# returns 1 if the task is claimed, 0 if it is no longer in todo (dropped from the queue),
+# -1 if this worker failed it before (left in the queue for the others)
+CLAIM_SCRIPT = """
+local failed = redis.call('HGET', KEYS[6], ARGV[1])
+if failed and string.find(',' .. failed, ',' .. ARGV[3] .. ',', 1, true) then
+    return -1
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZINCRBY', KEYS[3], ARGV[4], ARGV[2])
+redis.call('HSET', KEYS[4], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[5], ARGV[1], ARGV[5])
+redis.call('XADD', KEYS[7], 'MAXLEN', '~', ARGV[6], '*', 'e', ARGV[7], 't', ARGV[1], 'w', ARGV[3])
+return 1
+"""
+
+
+def default_owner():
+    return os.environ.get("USER", "") or "default"
+
+
+def queue_key(owner):
+    return REDIS_KEY_OWNER_QUEUE_PREFIX + owner
+
+
+def queue_score(task_str, submit_ts, aging_sec):
+    return submit_ts - Task(task_str).priority * aging_sec
+
+
+def index_tasks(redis_inst, owner, task_scores, queue=True):
+    """
+    record the owner and queue score of tasks and add them to the queue of the owner,
+    redis_inst can be a pipeline
+
+    :param task_scores: task str -> queue score
+    :param queue: False only records them, for the tasks added to todo by a script that requeues them
+
+    """
+
+    if len(task_scores) == 0:
+        return
+    redis_inst.hset(REDIS_KEY_TASK_OWNER, mapping={t: owner for t in task_scores})
+    redis_inst.hset(REDIS_KEY_TASK_QUEUE_SCORE, mapping=task_scores)
+    if queue:
+        redis_inst.zadd(queue_key(owner), task_scores)
+
+
+def activate_owners(redis_inst, owners):
+    """
+    move the pass of owners that (re)start submitting up to the smallest pass of the active owners,
+    so an owner does not get the slots it did not use while it had no task
+
+    :param redis_inst: a shard
+
+    """
+
+    passes = dict(redis_inst.zrange(REDIS_KEY_OWNER_PASS, 0, -1, withscores=True))
+    pipeline = redis_inst.pipeline()
+    for owner in passes:
+        pipeline.zcard(queue_key(owner))
+    active = [p for (owner, p), n in zip(passes.items(), pipeline.execute()) if n > 0 and owner not in owners]
+    floor = min(active) if len(active) > 0 else 0
+    pipeline = redis_inst.pipeline()
+    for owner in owners:
+        pipeline.zadd(REDIS_KEY_OWNER_PASS, {owner: max(passes.get(owner, floor), floor)})
+    pipeline.execute()
+
+
+def requeue_tasks(redis_inst, task_strs):
+    """
+    put tasks back to todo and to the queues of their owners
+
+    :param redis_inst: the shard of the tasks, or a pipeline of it
+
+    """
+
+    if len(task_strs) == 0:
+        return
+    script = redis_inst.register_script(REQUEUE_SCRIPT)
+    return script(keys=[REDIS_KEY_TODO_TASKS, REDIS_KEY_TASK_OWNER, REDIS_KEY_TASK_QUEUE_SCORE],
+                  args=list(task_strs))
+
+
+def queue_heads(redis_inst, passes, head):
+    """
+    :param passes: the owner_pass entries of the shard, (owner, pass) pairs
+    :return: owner -> (pass, the first head task strs of its queue), only owners with queued tasks
+
+    """
+
+    if len(passes) == 0:
+        return {}
+    pipeline = redis_inst.pipeline(transaction=False)
+    for owner, _ in passes:
+        pipeline.zrange(queue_key(owner), 0, head - 1)
+    return {owner: (p, tasks) for (owner, p), tasks in zip(passes, pipeline.execute()) if len(tasks) > 0}
+
+
+def select_fair_share(heads, weights, fits, max_tasks):
+    """
+    pick the tasks to claim in fair-share order
+
+    :param heads: see queue_heads, owner -> (pass, task strs)
+    :param weights: owner -> weight, 1 for an owner without a weight
+    :param fits: called with a task str, whether the worker can take it on top of the tasks picked before
+    :return: a list of (owner, task str, pass increment)
+
+    """
+
+    passes = {owner: p for owner, (p, _) in heads.items()}
+    queues = {owner: list(tasks) for owner, (_, tasks) in heads.items()}
+    picked = []
+    while len(picked) < max_tasks:
+        best = None
+        for owner in sorted(passes, key=lambda o: (passes[o], o)):
+            for task_str in queues[owner]:
+                if fits(task_str):
+                    best = owner, task_str
+                    break
+            if best is not None:
+                break
+        if best is None:
+            break
+        owner, task_str = best
+        queues[owner].remove(task_str)
+        increment = 1 / owner_weight(weights, owner)
+        passes[owner] += increment
+        picked.append((owner, task_str, increment))
+    return picked
+
+
+def owner_weight(weights, owner):
+    w = float(weights.get(owner, 1))
+    return w if w > 0 and math.isfinite(w) else 1
+
+
+def claim_tasks(redis_inst, worker_name, picked, now):
+    """
+    claim the picked tasks in one round trip
+
+    :return: the results of CLAIM_SCRIPT in the order of picked
+
+    """
+
+    pipeline = redis_inst.pipeline(transaction=False)
+    script = pipeline.register_script(CLAIM_SCRIPT)
+    for owner, task_str, increment in picked:
+        script(keys=[REDIS_KEY_TODO_TASKS, queue_key(owner), REDIS_KEY_OWNER_PASS, REDIS_KEY_IN_PROGRESS_TASKS,
+                     REDIS_KEY_IN_PROGRESS_SINCE, REDIS_KEY_FAILED_TASKS, REDIS_KEY_TASK_EVENTS],
+               args=[task_str, owner, worker_name, increment, now, EVENT_STREAM_MAXLEN, EVENT_CLAIM])
+    return pipeline.execute()
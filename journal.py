@@ -0,0 +1,161 @@
+import os
+import json
+import logging
+import tempfile
+from threading import Lock
+from utils import Task
+
+
+"""
+local write-ahead journal of task results
+
+the result reporter appends the results it is about to report to an append-only file and fsyncs it before the
+redis pipeline, once the pipeline succeeds it appends an ack of them, so a result that was received is on
+local disk until redis has it, whether redis restarts, the network drops or the worker dies in between
+
+one fsync covers all results of a flush (group commit), the journal is truncated whenever every record
+is acked, so it stays small unless redis is unreachable
+
+a restarted worker replays the results without an ack before it returns its in-progress tasks to the todo
+queue (see Worker.reset_task), a task whose result is in the journal is not recomputed,
+a torn last line (the worker died in the middle of a write) is skipped
+
+records, one json object per line
+    {"seq": n, "task": task str, "shard": shard index or null, "status": ..., "msg": ..., "timing": ...,
+     "event": ..., "failure_class": ...}
+    {"ack": [seq, ...]}
+
+"""
+
+# rewrite the journal once this many acked records are kept only for the few that are not
+COMPACT_ACKED_RECORDS = 10000
+
+
+def journal_path(worker_name, journal_dir=""):
+    """
+    :param journal_dir: the directory of the journal, the system temp directory if empty,
+        it survives a restart of the worker, a local disk directory also survives a reboot of the node
+
+    """
+
+    return os.path.join(journal_dir or tempfile.gettempdir(), "distcomp_journal_{}.jsonl".format(worker_name))
+
+
+class ResultJournal:
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.lock = Lock()
+        self.unacked = {}  # seq -> record
+        self.n_acked = 0  # acked records still in the file
+        self.seq = 0
+        self._load()
+        self.file = open(self.path, "a")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("skip a torn record of the result journal {}".format(self.path))
+                    continue
+                if "ack" in record:
+                    for seq in record["ack"]:
+                        if self.unacked.pop(seq, None) is not None:
+                            self.n_acked += 1
+                else:
+                    self.unacked[record["seq"]] = record
+                    self.seq = max(self.seq, record["seq"])
+
+    def __len__(self):
+        with self.lock:
+            return len(self.unacked)
+
+    def _write(self, records):
+        self.file.write("".join(json.dumps(record) + "\n" for record in records))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def append(self, reports):
+        """
+        write the reports and make them durable, sets report["seq"]
+
+        :param reports: dicts of the result reporter, with the Task in "task"
+
+        """
+
+        records = []
+        with self.lock:
+            for report in reports:
+                self.seq += 1
+                report["seq"] = self.seq
+                record = {"seq": self.seq, "task": report["task"].task_str, "shard": report["task"].shard}
+                for field in ("status", "msg", "timing", "event", "failure_class"):
+                    record[field] = report.get(field)
+                records.append(record)
+                self.unacked[self.seq] = record
+            self._write(records)
+
+    def ack(self, reports):
+        """
+        the reports are in redis, their records are dropped at the next truncation or compaction
+
+        """
+
+        seqs = [report["seq"] for report in reports if "seq" in report]
+        if len(seqs) == 0:
+            return
+        with self.lock:
+            for seq in seqs:
+                if self.unacked.pop(seq, None) is not None:
+                    self.n_acked += 1
+            if len(self.unacked) == 0:
+                # no fsync of the ack, a lost ack replays results that redis ignores as not in progress
+                self.file.truncate(0)
+                self.n_acked = 0
+            elif self.n_acked >= COMPACT_ACKED_RECORDS:
+                self._compact()
+            else:
+                self.file.write(json.dumps({"ack": seqs}) + "\n")
+                self.file.flush()
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in self.unacked.values()))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.file.close()
+        self.file = open(self.path, "a")
+        self.n_acked = 0
+
+    def replay(self):
+        """
+        :return: the reports that are not acked, in the order they were written
+
+        """
+
+        reports = []
+        with self.lock:
+            for seq in sorted(self.unacked):
+                record = self.unacked[seq]
+                task = Task(record["task"])
+                task.shard = record["shard"]
+                report = {field: record[field] for field in ("status", "msg", "timing", "event", "failure_class")}
+                report.update({"task": task, "seq": seq})
+                reports.append(report)
+        return reports
+
+    def task_strs(self):
+        with self.lock:
+            return set(record["task"] for record in self.unacked.values())
+
+    def close(self):
+        with self.lock:
+            self.file.close()
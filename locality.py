@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import random
+from collections import OrderedDict
+from threading import Lock
+from const import *
+
+
+"""
+data locality
+
+a task declares the input data it reads with an annotation in the task file:
+    @inputs=traces/w1.bin shell:5:8:2:./cachesim traces/w1.bin lru
+
+the inputs are stored in task_meta and indexed in input_tasks:<input> (input -> task strs),
+each worker keeps the inputs of the tasks it ran recently (likely in its page cache) and the files
+in its local_data_dir, and advertises them in worker_warm_inputs (worker -> json list),
+a worker prefers tasks whose inputs are warm locally and delays tasks that are warm on another worker
+by up to locality_wait_sec, see admission.order_by_locality
+
+"""
+
+
+def task_inputs(annotations):
+    """
+    the input keys declared with @inputs=a,b
+
+    """
+
+    return [x for x in annotations.get("inputs", "").split(",") if x]
+
+
+def index_task_inputs(redis_inst, task_str, inputs):
+    for key in inputs:
+        redis_inst.sadd(REDIS_KEY_INPUT_TASKS_PREFIX + key, task_str)
+
+
+class WarmInputs:
+    def __init__(self, capacity=64, local_data_dir="", scan_interval_sec=60):
+        """
+
+        :param capacity: the number of recently used inputs assumed to be in the page cache
+        :param local_data_dir: inputs whose file name is in this directory are always warm
+        :param scan_interval_sec: how often local_data_dir is listed
+
+        """
+
+        self.capacity = capacity
+        self.local_data_dir = local_data_dir
+        self.scan_interval_sec = scan_interval_sec
+        self.recent = OrderedDict()
+        self.local_files = set()
+        self.last_scan = 0
+        # the heartbeat thread reads the keys while the main thread claims tasks
+        self.lock = Lock()
+
+    def touch(self, inputs):
+        with self.lock:
+            for key in inputs:
+                self.recent.pop(key, None)
+                self.recent[key] = None
+            while len(self.recent) > self.capacity:
+                self.recent.popitem(last=False)
+
+    def scan(self, force=False):
+        if len(self.local_data_dir) == 0:
+            return
+        if not force and time.time() - self.last_scan < self.scan_interval_sec:
+            return
+        try:
+            self.local_files = set(os.listdir(self.local_data_dir))
+        except OSError:
+            self.local_files = set()
+        self.last_scan = time.time()
+
+    def is_warm(self, key):
+        return key in self.recent or os.path.basename(key) in self.local_files
+
+    def keys(self):
+        self.scan()
+        with self.lock:
+            return list(self.recent.keys()) + sorted(self.local_files)
+
+
+def remote_warm_inputs(warm_inputs, worker_name):
+    """
+    input -> the other workers that advertise it as warm
+
+    :param warm_inputs: the content of worker_warm_inputs
+
+    """
+
+    remote = {}
+    for worker, keys in warm_inputs.items():
+        if worker == worker_name:
+            continue
+        try:
+            keys = json.loads(keys)
+        except ValueError:
+            continue
+        for key in keys:
+            remote.setdefault(key, set()).add(worker)
+    return remote
+
+
+def sample_local_tasks(redis_inst, warm_keys, n_keys=8, per_key=10):
+    """
+    todo tasks that read some of the warm inputs, so that a worker finds its local tasks
+    even when it only samples a large todo queue,
+    finished tasks found in the index are removed from it on the way
+
+    :return: task str -> todo value
+
+    """
+
+    if len(warm_keys) == 0:
+        return {}
+    keys = random.sample(warm_keys, min(n_keys, len(warm_keys)))
+    pipeline = redis_inst.pipeline()
+    for key in keys:
+        pipeline.srandmember(REDIS_KEY_INPUT_TASKS_PREFIX + key, per_key)
+    sampled = {}
+    for key, tasks in zip(keys, pipeline.execute()):
+        for task_str in tasks:
+            sampled.setdefault(task_str, []).append(key)
+    if len(sampled) == 0:
+        return {}
+
+    task_strs = list(sampled.keys())
+    pipeline = redis_inst.pipeline()
+    pipeline.hmget(REDIS_KEY_TODO_TASKS, task_strs)
+    pipeline.hmget(REDIS_KEY_FINISHED_TASKS, task_strs)
+    todo, finished = pipeline.execute()
+
+    pipeline = redis_inst.pipeline()
+    for task_str, result in zip(task_strs, finished):
+        if result is not None:
+            for key in sampled[task_str]:
+                pipeline.srem(REDIS_KEY_INPUT_TASKS_PREFIX + key, task_str)
+    pipeline.execute()
+    return {t: v for t, v in zip(task_strs, todo) if v is not None}
@@ -0,0 +1,265 @@
+import math
+import time
+from threading import Thread, Event
+import numpy as np
+import psutil
+from const import *
+from utils import Task, task_family
+from shards import shard_clients
+from task_stats import load_task_timing
+
+
+"""
+DRAM requirements learned from the observed peak memory per task family
+
+workers add the peak RSS of every finished task to a log-scale histogram of its family in the finish report
+(family_peak_mem, "family bucket" -> count, see reporter.REPORT_FINISH_SCRIPT), the bucket b holds the peaks up to
+2 ^ (b / BUCKETS_PER_DOUBLING) MiB, so the estimate is at most 19% above the observed quantile
+
+once a family has dram_estimate_min_samples runs, the DRAM a task needs for admission is
+dram_estimate_headroom times the dram_estimate_quantile of the peaks of its family, dram_estimate:
+    declared  the min_dram of the task line, the history is only reported (the default)
+    learned   the estimate replaces the declared DRAM, which fixes both over- and underestimates
+    capped    the estimate only lowers the declared DRAM, the task line stays an upper bound
+
+the peaks only cover the runs that finished, a run that ran out of memory has no peak but needed more than
+the others, so a failure of class oom is counted per family (family_oom, see reporter.REPORT_FAILED_SCRIPT),
+and the estimate of a family with an oom failure no longer lowers the declared DRAM
+
+the peak of a run is the larger of the peak of the summed RSS of the task processes, sampled every
+TREE_RSS_SAMPLE_SEC by the task runner (TreeRssSampler), and ru_maxrss of RUSAGE_CHILDREN, which also catches
+short spikes but is the peak of the largest single process only, too low for a task that runs several processes
+
+the peak of a task that shares its process with other tasks (the later tasks of a micro-batch runner, the
+python pool) is the peak of the process so far, it is kept in the timing record (peak_shared) but not added
+to the histogram
+
+"""
+
+BUCKETS_PER_DOUBLING = 4
+# the task runner samples the RSS of the task processes this often
+TREE_RSS_SAMPLE_SEC = 0.2
+
+
+def peak_mem_bucket(peak_rss_kb):
+    return max(int(math.ceil(BUCKETS_PER_DOUBLING * math.log2(max(peak_rss_kb * KiB / MiB, 1)))), 0)
+
+
+def bucket_upper_gb(bucket):
+    return 2 ** (bucket / BUCKETS_PER_DOUBLING) * MiB / GiB
+
+
+def peak_mem_field(family, timing):
+    """
+    the histogram field of a finished run, None if the peak is unknown or not of the task alone
+
+    :param timing: the timing record of the run, see redisWorker.task_timing_record
+
+    """
+
+    peak_rss_kb = timing.get("peak_rss_kb")
+    if not family or not peak_rss_kb or timing.get("peak_shared"):
+        return None
+    return "{} {}".format(family, peak_mem_bucket(peak_rss_kb))
+
+
+class TreeRssSampler(Thread):
+    """
+    track the peak of the summed RSS of the descendants of this process, i.e., the processes of the task a
+    task runner runs, the same sum the worker exposes as task_rss_bytes
+
+    """
+
+    def __init__(self, interval_sec=TREE_RSS_SAMPLE_SEC):
+        super(TreeRssSampler, self).__init__(daemon=True)
+        self.interval_sec = interval_sec
+        self.peak_bytes = 0
+        self.stop_event = Event()
+
+    def run(self):
+        me = psutil.Process()
+        while True:
+            rss = 0
+            for child in me.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            self.peak_bytes = max(self.peak_bytes, rss)
+            if self.stop_event.wait(self.interval_sec):
+                return
+
+    def stop(self):
+        """
+        :return: the peak in KiB, like ru_maxrss
+
+        """
+
+        self.stop_event.set()
+        self.join()
+        return self.peak_bytes // KiB
+
+
+class DramEstimator:
+    def __init__(self, family_params=(), mode="learned", quantile=0.95, min_samples=20, headroom=1.2,
+                 refresh_sec=60):
+        """
+
+        :param family_params: see utils.task_family
+        :param mode: one of DRAM_ESTIMATE_MODES
+        :param refresh_sec: how often the histograms are re-read from redis
+
+        """
+
+        self.family_params = tuple(family_params)
+        self.mode = mode
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.refresh_sec = refresh_sec
+        self.hist = {}  # family -> {bucket: count}
+        self.oom = set()  # the families with an oom failure
+        self.last_refresh = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.task_family_params, config.dram_estimate, config.dram_estimate_quantile,
+                   config.dram_estimate_min_samples, config.dram_estimate_headroom,
+                   config.runtime_history_refresh_sec)
+
+    def family(self, task):
+        return task_family(task, self.family_params)
+
+    def observe(self, family, peak_rss_kb):
+        buckets = self.hist.setdefault(family, {})
+        bucket = peak_mem_bucket(peak_rss_kb)
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+
+    def refresh(self, redis_inst, force=False):
+        """
+        re-read the histograms if they are older than refresh_sec
+
+        :param redis_inst: a redis client or ShardedRedis, the histograms of all shards are summed
+
+        """
+
+        if not force and (self.mode == "declared" or time.time() - self.last_refresh < self.refresh_sec):
+            return
+        self.hist, self.oom = {}, set()
+        for shard in shard_clients(redis_inst):
+            pipeline = shard.pipeline(transaction=False)
+            pipeline.hgetall(REDIS_KEY_FAMILY_PEAK_MEM)
+            pipeline.hkeys(REDIS_KEY_FAMILY_OOM)
+            peak_mem, oom = pipeline.execute()
+            for field, n in peak_mem.items():
+                family, _, bucket = field.rpartition(" ")
+                buckets = self.hist.setdefault(family, {})
+                buckets[int(bucket)] = buckets.get(int(bucket), 0) + int(n)
+            self.oom.update(oom)
+        self.last_refresh = time.time()
+
+    def samples(self, family):
+        return sum(self.hist.get(family, {}).values())
+
+    def quantile_gb(self, family, quantile=None):
+        """
+        the upper bound of the bucket of the quantile of the peaks of a family in GB, None if it has no history
+
+        """
+
+        buckets = self.hist.get(family, {})
+        n = sum(buckets.values())
+        if n == 0:
+            return None
+        rank = (self.quantile if quantile is None else quantile) * n
+        seen = 0
+        for bucket in sorted(buckets):
+            seen += buckets[bucket]
+            if seen >= rank:
+                return bucket_upper_gb(bucket)
+        return bucket_upper_gb(max(buckets))
+
+    def estimate_gb(self, family):
+        """
+        the learned DRAM requirement of the tasks of a family in GB, rounded up to 0.1 GB,
+        None if the family has fewer than min_samples runs
+
+        """
+
+        if self.min_samples <= 0 or self.samples(family) < self.min_samples:
+            return None
+        return math.ceil(self.quantile_gb(family) * self.headroom * 10) / 10
+
+    def combine(self, declared_gb, estimate_gb, oom=False):
+        """
+        :param oom: the family ran out of memory before, the estimate does not lower the declared DRAM
+
+        """
+
+        if self.mode == "declared" or estimate_gb is None:
+            return declared_gb
+        if oom and declared_gb is not None:
+            return max(declared_gb, estimate_gb) if self.mode == "learned" else declared_gb
+        if self.mode == "capped" and declared_gb is not None:
+            return min(declared_gb, estimate_gb)
+        return estimate_gb
+
+    def need_dram_gb(self, task):
+        """
+        the DRAM a task needs for admission
+
+        """
+
+        family = self.family(task)
+        return self.combine(task.min_dram_gb, self.estimate_gb(family), family in self.oom)
+
+    def apply(self, task):
+        """
+        set min_dram_gb of a task to the DRAM it needs, the worker admits and accounts the task with it
+
+        """
+
+        if task.task_type is not None:
+            task.min_dram_gb = self.need_dram_gb(task)
+        return task
+
+
+def print_dram_status(redis_inst, estimator, include_str="", exclude_str=""):
+    """
+    print the declared DRAM of each task family next to the observed peaks of its finished runs and the
+    DRAM the workers use for admission
+
+    """
+
+    def task_filter(task_str):
+        if len(include_str) > 0:
+            return include_str in task_str
+        if len(exclude_str) > 0:
+            return exclude_str not in task_str
+        return True
+
+    def fmt(v):
+        return "{:>10}".format("-") if v is None or np.isnan(v) else "{:>10.2f}".format(v)
+
+    estimator.refresh(redis_inst, force=True)
+    cols = load_task_timing(redis_inst, task_filter=task_filter, family_params=estimator.family_params)
+    finished = (cols["status"] == "finished") & ~np.isnan(cols["peak_rss_kb"])
+    families = sorted(set(cols["family"][finished]) | set(estimator.hist))
+    if len(families) == 0:
+        print("no peak memory records")
+        return
+
+    print("dram estimate {}, p{:g} x {:g} after {} runs\n".format(
+        estimator.mode, estimator.quantile * 100, estimator.headroom, estimator.min_samples))
+    print("{}{:40} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}{}".format(
+        STATUS_COLOR, "family", "runs", "declared", "peak p50", "peak p95", "peak max", "admission", NORMAL_COLOR))
+    for family in families:
+        rows = finished & (cols["family"] == family)
+        peak_gb = cols["peak_rss_kb"][rows] * KiB / GiB
+        declared = [Task(t).min_dram_gb for t in cols["task"][rows]]
+        declared_gb = max(declared) if len(declared) > 0 else None
+        admission_gb = estimator.combine(declared_gb, estimator.estimate_gb(family), family in estimator.oom)
+        p50, p95 = np.percentile(peak_gb, [50, 95]) if len(peak_gb) > 0 else (None, None)
+        print("{:40} {:>8} {} {} {} {} {}".format(
+            family[:40], estimator.samples(family), fmt(declared_gb), fmt(p50), fmt(p95),
+            fmt(peak_gb.max() if len(peak_gb) > 0 else None), fmt(admission_gb)))
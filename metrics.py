@@ -0,0 +1,282 @@
+import time
+import logging
+from threading import Thread, Lock
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+"""
+a minimal Prometheus/OpenMetrics registry and HTTP exporter
+
+it has no dependency besides the standard library so that workers do not need prometheus_client,
+metrics are kept in memory and rendered in the text exposition format on every scrape
+
+"""
+
+
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                           0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+        self.values = {}  # label values -> value
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError("metric {} expects labels {}, got {}".format(
+                self.name, self.label_names, tuple(labels.keys())))
+        return tuple(str(labels[k]) for k in self.label_names)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append("{}{} {}".format(
+                    self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append("{}_total{} {}".format(
+                    self.name, _format_labels(self.label_names, label_values), _format_value(value)))
+        return lines
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def replace(self, values):
+        """
+        atomically replace all samples, values is a dict of label values tuple -> value,
+        used for per-task gauges whose label set changes between refreshes
+
+        """
+
+        with self.lock:
+            self.values = dict(values)
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"), )
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                # per-bucket counts (not cumulative), sum
+                self.values[key] = [[0] * len(self.buckets), 0.0]
+            counts, _ = self.values[key]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    counts[i] += 1
+                    break
+            self.values[key][1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.metric_type)]
+        with self.lock:
+            for label_values, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for upper, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        self.name,
+                        _format_labels(self.label_names, label_values,
+                                       (("le", _format_value(upper)), )),
+                        cumulative))
+                labels_str = _format_labels(self.label_names, label_values)
+                lines.append("{}_sum{} {}".format(self.name, labels_str, _format_value(total)))
+                lines.append("{}_count{} {}".format(self.name, labels_str, cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    serve the registry at http://host:port/metrics from a daemon thread
+
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1", before_scrape=None):
+        """
+
+        :param registry: the registry to render
+        :param port: the port to listen on
+        :param host: the address to bind
+        :param before_scrape: an optional callable invoked before rendering, e.g., to refresh gauges
+
+        """
+
+        self.registry = registry
+        self.before_scrape = before_scrape
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                try:
+                    if server.before_scrape is not None:
+                        server.before_scrape()
+                    body = server.registry.render().encode("utf-8")
+                except Exception as e:
+                    logging.error("render metrics error {}".format(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are frequent, do not flood the worker log
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = Thread(target=self.httpd.serve_forever, args=(), daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logging.info("metrics endpoint listening on {}:{}".format(*self.httpd.server_address[:2]))
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class WorkerMetrics:
+    """
+    the metrics exposed by each worker
+
+    """
+
+    def __init__(self):
+        self.registry = Registry()
+        r = self.registry
+        self.running_tasks = r.gauge(
+            "distcomp_running_tasks", "number of tasks running on this worker")
+        self.task_slots = r.gauge(
+            "distcomp_task_slots", "max number of tasks this worker runs concurrently")
+        self.slot_utilization = r.gauge(
+            "distcomp_slot_utilization", "running tasks / task slots")
+        self.need_dram_gb = r.gauge(
+            "distcomp_in_progress_need_dram_gb", "sum of declared DRAM of running tasks")
+        self.mem_gb = r.gauge(
+            "distcomp_node_mem_gb", "node memory in GB", ("kind", ))
+        self.cpu_cores = r.gauge(
+            "distcomp_node_cpu_cores", "node cpu cores", ("kind", ))
+        self.task_rss_bytes = r.gauge(
+            "distcomp_task_rss_bytes", "resident memory of the process tree of a running task",
+            ("pid", "task_family"))
+        self.claim_latency = r.histogram(
+            "distcomp_claim_latency_seconds", "time to fetch and claim a task from redis",
+            ("result", ))
+        self.redis_rtt = r.histogram(
+            "distcomp_redis_rtt_seconds", "redis round trip time", ("op", ))
+        self.spawn_latency = r.histogram(
+            "distcomp_task_spawn_latency_seconds", "time to fork a task runner")
+        self.tasks_claimed = r.counter(
+            "distcomp_tasks_claimed", "number of tasks claimed by this worker")
+        self.claim_conflicts = r.counter(
+            "distcomp_claim_conflicts", "number of tasks another worker claimed first")
+        self.tasks_completed = r.counter(
+            "distcomp_tasks_completed", "number of task runners that exited", ("status", ))
+        self.tasks_returned_oom = r.counter(
+            "distcomp_tasks_returned_oom", "number of tasks killed and returned because DRAM is low")
+        self.task_timeouts = r.counter(
+            "distcomp_task_timeouts", "number of tasks killed because of timeout")
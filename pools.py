@@ -0,0 +1,217 @@
+import json
+from const import *
+
+
+"""
+cluster-wide resource pools
+
+a task names the shared resources it uses with an annotation in the task file:
+    @pools=io_heavy shell:5:8:2:./cachesim traces/w1.bin lru
+    @pools=io_heavy,license shell:5:8:2:./synth design1
+
+the capacity of each pool is in resource_pools (pool -> number of tokens, set with setPool), a task holds
+one token of each of its pools while it runs, a pool without a capacity is not limited
+
+the tokens are leases in pool_leases:<pool>, a sorted set of "worker task str" scored by the lease expiry,
+a worker takes the tokens of a task in one script before it claims the task (ACQUIRE_SCRIPT, all or none),
+renews the leases of its running tasks with its heartbeat and releases them when the task ends,
+so the tokens of a crashed worker are free again resource_lease_sec after its last heartbeat
+
+the pools are on the primary shard, whatever shard the tasks are on
+
+"""
+
+# the capacities are re-read at most this often by a worker
+POOL_CAPACITY_REFRESH_SEC = 10
+
+# KEYS: resource_pools
+# ARGV: lease member, now, lease expiry, pool names...
+# returns "" if the tokens of all pools are taken, or the first pool that has no free token
+ACQUIRE_SCRIPT = """
+for i = 4, #ARGV do
+    local key = '""" + REDIS_KEY_POOL_LEASES_PREFIX + """' .. ARGV[i]
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[2])
+    local capacity = redis.call('HGET', KEYS[1], ARGV[i])
+    if capacity and not redis.call('ZSCORE', key, ARGV[1]) and redis.call('ZCARD', key) >= tonumber(capacity) then
+        return ARGV[i]
+    end
+end
+for i = 4, #ARGV do
+    redis.call('ZADD', '""" + REDIS_KEY_POOL_LEASES_PREFIX + """' .. ARGV[i], ARGV[3], ARGV[1])
+end
+return ''
+"""
+
+
+def task_pools(annotations):
+    """
+    the pools declared with @pools=a,b
+
+    """
+
+    return [x for x in annotations.get("pools", "").split(",") if x]
+
+
+def lease_key(pool):
+    return REDIS_KEY_POOL_LEASES_PREFIX + pool
+
+
+def lease_member(worker_name, task_str):
+    # a backup copy on another worker holds its own tokens
+    return "{} {}".format(worker_name, task_str)
+
+
+def pool_capacities(redis_inst):
+    """
+    :return: pool -> capacity
+
+    """
+
+    return {pool: int(capacity) for pool, capacity in redis_inst.hgetall(REDIS_KEY_RESOURCE_POOLS).items()}
+
+
+def load_task_pools(redis_inst, tasks):
+    """
+    set the pools of tasks from their annotations in task_meta
+
+    :param redis_inst: the shard of the tasks
+
+    """
+
+    if len(tasks) == 0:
+        return
+    for task, ann in zip(tasks, redis_inst.hmget(REDIS_KEY_TASK_META, [t.task_str for t in tasks])):
+        if ann is not None:
+            task.pools = task_pools(json.loads(ann))
+
+
+def exhausted_pools(redis_inst, capacities, now):
+    """
+    :param redis_inst: the primary shard
+    :return: the set of pools with no free token
+
+    """
+
+    pools = sorted(capacities)
+    if len(pools) == 0:
+        return set()
+    pipeline = redis_inst.pipeline(transaction=False)
+    for pool in pools:
+        pipeline.zcount(lease_key(pool), "({}".format(now), "+inf")
+    return {pool for pool, n in zip(pools, pipeline.execute()) if n >= capacities[pool]}
+
+
+def has_exhausted_pool(task, exhausted):
+    return any(pool in exhausted for pool in task.pools)
+
+
+def acquire_pools(redis_inst, worker_name, task_str, pools, now, lease_sec):
+    """
+    take one token of each pool for a task, all or none
+
+    :param redis_inst: the primary shard
+    :return: None if the tokens are taken, otherwise the first pool without a free token
+
+    """
+
+    script = redis_inst.register_script(ACQUIRE_SCRIPT)
+    r = script(keys=[REDIS_KEY_RESOURCE_POOLS],
+               args=[lease_member(worker_name, task_str), now, now + lease_sec] + list(pools))
+    return r or None
+
+
+def renew_leases(redis_inst, worker_name, tasks, now, lease_sec):
+    """
+    extend the leases of running tasks, a lease that expired in the meantime is taken again,
+    the task holds the resource whether or not the pool has room
+
+    :param tasks: tasks with their pools set
+
+    """
+
+    pipeline = redis_inst.pipeline(transaction=False)
+    for task in tasks:
+        for pool in task.pools:
+            pipeline.zadd(lease_key(pool), {lease_member(worker_name, task.task_str): now + lease_sec})
+    pipeline.execute()
+
+
+def release_pools(redis_inst, worker_name, tasks):
+    """
+    :param tasks: tasks with their pools set
+
+    """
+
+    pipeline = redis_inst.pipeline(transaction=False)
+    for task in tasks:
+        for pool in task.pools:
+            pipeline.zrem(lease_key(pool), lease_member(worker_name, task.task_str))
+    pipeline.execute()
+
+
+def release_worker_leases(redis_inst, worker_names):
+    """
+    release all tokens held by workers, e.g., a worker that restarts or is dead
+
+    """
+
+    prefixes = tuple("{} ".format(w) for w in worker_names)
+    for key in redis_inst.scan_iter(match=REDIS_KEY_POOL_LEASES_PREFIX + "*"):
+        held = [m for m in redis_inst.zrange(key, 0, -1) if m.startswith(prefixes)]
+        if len(held) > 0:
+            redis_inst.zrem(key, *held)
+
+
+def set_pool_capacity(redis_inst, capacities):
+    """
+    :param capacities: pool -> capacity, None removes the limit of the pool
+
+    """
+
+    for pool, capacity in capacities.items():
+        if capacity is None:
+            redis_inst.hdel(REDIS_KEY_RESOURCE_POOLS, pool)
+        elif capacity < 0:
+            raise ValueError("the capacity of pool {} must be non-negative".format(pool))
+        else:
+            redis_inst.hset(REDIS_KEY_RESOURCE_POOLS, pool, capacity)
+
+
+def parse_pool_capacities(text):
+    """
+    "io_heavy=40,license=4" -> {"io_heavy": 40, "license": 4}, "io_heavy=" -> {"io_heavy": None}
+
+    """
+
+    capacities = {}
+    for item in [x for x in text.split(",") if x]:
+        pool, sep, capacity = item.partition("=")
+        if not sep or not pool:
+            raise ValueError("pool capacity format pool=capacity, got {}".format(item))
+        capacities[pool] = int(capacity) if capacity else None
+    return capacities
+
+
+def print_pool_status(redis_inst, now):
+    """
+    print the capacity, the tokens in use and their holders of each pool
+
+    :param redis_inst: the primary shard
+
+    """
+
+    capacities = pool_capacities(redis_inst)
+    pools = set(capacities) | {key[len(REDIS_KEY_POOL_LEASES_PREFIX):]
+                               for key in redis_inst.scan_iter(match=REDIS_KEY_POOL_LEASES_PREFIX + "*")}
+    print("{}{:20} {:>10} {:>10} {:>10}  {}{}".format(STATUS_COLOR, "pool", "capacity", "in use", "expired",
+                                                      "holders", NORMAL_COLOR))
+    for pool in sorted(pools):
+        leases = redis_inst.zrange(lease_key(pool), 0, -1, withscores=True)
+        live = [m for m, expiry in leases if expiry > now]
+        workers = {}
+        for m in live:
+            worker = m.split(" ", 1)[0]
+            workers[worker] = workers.get(worker, 0) + 1
+        print("{:20} {:>10} {:>10} {:>10}  {}".format(
+            pool, capacities.get(pool, "-"), len(live), len(leases) - len(live),
+            " ".join("{}:{}".format(w, n) for w, n in sorted(workers.items()))))
@@ -0,0 +1,122 @@
+import time
+import json
+import logging
+from const import *
+from utils import Task, task_family
+from shards import shard_clients
+from memory_model import peak_mem_field
+
+
+"""
+runtime history per task family
+
+workers add the runtime of every finished task to two hashes (family -> count, family -> sum)
+in the finish report, see reporter.REPORT_FINISH_SCRIPT,
+the scheduler uses the mean runtime of the family of a task as its expected runtime
+
+"""
+
+
+class RuntimePredictor:
+    def __init__(self, family_params=(), refresh_sec=60):
+        """
+
+        :param family_params: see utils.task_family
+        :param refresh_sec: how often the history is re-read from redis
+
+        """
+
+        self.family_params = tuple(family_params)
+        self.refresh_sec = refresh_sec
+        self.count = {}
+        self.total = {}
+        self.last_refresh = 0
+
+    def family(self, task):
+        return task_family(task, self.family_params)
+
+    def observe(self, family, runtime_sec):
+        self.count[family] = self.count.get(family, 0) + 1
+        self.total[family] = self.total.get(family, 0.0) + runtime_sec
+
+    def refresh(self, redis_inst, force=False):
+        """
+        re-read the history if it is older than refresh_sec, there are few families so this is cheap
+
+        :param redis_inst: a redis client or ShardedRedis, the history of all shards is summed
+
+        """
+
+        if not force and time.time() - self.last_refresh < self.refresh_sec:
+            return
+        self.count, self.total = {}, {}
+        for shard in shard_clients(redis_inst):
+            pipeline = shard.pipeline()
+            pipeline.hgetall(REDIS_KEY_FAMILY_RUNTIME_COUNT)
+            pipeline.hgetall(REDIS_KEY_FAMILY_RUNTIME_SUM)
+            count, total = pipeline.execute()
+            for k, v in count.items():
+                self.count[k] = self.count.get(k, 0) + int(v)
+            for k, v in total.items():
+                self.total[k] = self.total.get(k, 0.0) + float(v)
+        self.last_refresh = time.time()
+
+    def predict(self, task):
+        """
+        the expected runtime in seconds, None if the family has no history
+
+        """
+
+        family = self.family(task)
+        n = self.count.get(family, 0)
+        if n == 0:
+            return None
+        return self.total.get(family, 0.0) / n
+
+
+def rebuild_runtime_history(redis_inst, family_params=(), scan_count=10000):
+    """
+    recompute the runtime history and the peak memory histograms (see memory_model) from the task timing records,
+    e.g., after changing task_family_params, each shard keeps the history of its own tasks
+
+    """
+
+    predictor = RuntimePredictor(family_params)
+    for shard in shard_clients(redis_inst):
+        shard_predictor = rebuild_shard_runtime_history(shard, family_params, scan_count)
+        for family, n in shard_predictor.count.items():
+            predictor.count[family] = predictor.count.get(family, 0) + n
+            predictor.total[family] = predictor.total.get(family, 0.0) + shard_predictor.total[family]
+    logging.info("rebuild runtime history of {} families from {} tasks".format(
+        len(predictor.count), sum(predictor.count.values())))
+    for family in sorted(predictor.count.keys()):
+        print("{:48} {:>8} runs, mean runtime {:>10.1f}s".format(
+            family, predictor.count[family], predictor.total[family] / predictor.count[family]))
+
+
+def rebuild_shard_runtime_history(redis_inst, family_params=(), scan_count=10000):
+    predictor = RuntimePredictor(family_params)
+    peak_mem = {}
+    for task_str, record_str in redis_inst.hscan_iter(REDIS_KEY_TASK_TIMING, count=scan_count):
+        try:
+            record = json.loads(record_str)
+        except ValueError:
+            continue
+        if record.get("status") != "finished" or record.get("start_ts") is None \
+                or record.get("finish_ts") is None:
+            continue
+        family = predictor.family(Task(task_str))
+        predictor.observe(family, record["finish_ts"] - record["start_ts"])
+        field = peak_mem_field(family, record)
+        if field is not None:
+            peak_mem[field] = peak_mem.get(field, 0) + 1
+
+    pipeline = redis_inst.pipeline()
+    pipeline.delete(REDIS_KEY_FAMILY_RUNTIME_COUNT, REDIS_KEY_FAMILY_RUNTIME_SUM, REDIS_KEY_FAMILY_PEAK_MEM)
+    if len(predictor.count) > 0:
+        pipeline.hset(REDIS_KEY_FAMILY_RUNTIME_COUNT, mapping=predictor.count)
+        pipeline.hset(REDIS_KEY_FAMILY_RUNTIME_SUM, mapping=predictor.total)
+    if len(peak_mem) > 0:
+        pipeline.hset(REDIS_KEY_FAMILY_PEAK_MEM, mapping=peak_mem)
+    pipeline.execute()
+    return predictor
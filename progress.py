@@ -0,0 +1,212 @@
+import os
+import time
+import zlib
+import bisect
+import tempfile
+from collections import defaultdict
+from const import *
+from utils import Task
+from events import event_time
+from shards import shard_clients
+
+
+"""
+campaign progress, throughput and ETA
+
+the completion throughput is counted from the finish events of the task event stream over sliding windows,
+cluster-wide and per worker, the ETA is projected two ways,
+from the remaining tasks and the recent throughput, and from the runtime history of the families of the
+remaining tasks (see predictor) spread over the slots running now
+
+a task can report its own progress by writing lines to the file named by $DISTCOMP_PROGRESS_FILE,
+the worker forwards the last line of the file of each running task with its heartbeat (only when the
+file changed), so the manager shows it next to the task without the task talking to redis
+
+"""
+
+THROUGHPUT_WINDOWS_SEC = (60, 600, 3600)
+# the window of the throughput projection, long enough to smooth the bursts of micro-batches
+ETA_WINDOW_SEC = 600
+
+
+########### task side, see the worker #############
+def progress_dir(worker_name):
+    return os.path.join(tempfile.gettempdir(), "distcomp_progress_" + worker_name)
+
+
+def progress_file(worker_name, task_str):
+    return os.path.join(progress_dir(worker_name), "{:08x}".format(zlib.crc32(task_str.encode())))
+
+
+def read_last_line(path, max_bytes=4096):
+    """
+    the last non-empty line of a file, only its tail is read
+
+    """
+
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - max_bytes, 0))
+        lines = f.read().decode(errors="replace").splitlines()
+    for line in reversed(lines):
+        if line.strip():
+            return line.strip()
+    return ""
+
+
+########### manager side #############
+def finish_times(redis_inst, since, chunk=10000):
+    """
+    :return: {worker: sorted finish times} of the finish events after since (unix seconds)
+
+    """
+
+    times = defaultdict(list)
+    for shard in shard_clients(redis_inst):
+        start = "{}-0".format(int(since * 1000))
+        while True:
+            entries = shard.xrange(REDIS_KEY_TASK_EVENTS, min=start, max="+", count=chunk)
+            for event_id, event in entries:
+                if event.get("e") == EVENT_FINISH:
+                    times[event.get("w", "")].append(event_time(event_id))
+            if len(entries) < chunk:
+                break
+            # exclusive range start
+            start = "(" + entries[-1][0]
+    for v in times.values():
+        v.sort()
+    return times
+
+
+def throughput(times, now, windows=THROUGHPUT_WINDOWS_SEC):
+    """
+    :param times: sorted finish times
+    :return: {window: tasks per second}
+
+    """
+
+    return {w: (len(times) - bisect.bisect_left(times, now - w)) / w for w in windows}
+
+
+def remaining_work_sec(redis_inst, predictor, now):
+    """
+    the expected seconds of work left, from the mean runtime of the family of each todo, blocked and
+    running task, tasks of a family without history count as the mean of all families
+
+    :return: (work seconds, number of running tasks)
+
+    """
+
+    known = [predictor.total[f] / n for f, n in predictor.count.items() if n > 0]
+    default_sec = sum(known) / len(known) if len(known) > 0 else 0
+    cache = {}
+
+    def predict(task_str):
+        task = Task(task_str)
+        family = predictor.family(task)
+        if family not in cache:
+            p = predictor.predict(task)
+            cache[family] = default_sec if p is None else p
+        return cache[family]
+
+    work, n_running = 0.0, 0
+    for shard in shard_clients(redis_inst):
+        for key in (REDIS_KEY_TODO_TASKS, REDIS_KEY_BLOCKED_TASKS):
+            work += sum(predict(task_str) for task_str in shard.hkeys(key) if task_str != WORKER_STOP_COMMAND)
+        running = shard.hgetall(REDIS_KEY_IN_PROGRESS_SINCE)
+        for task_str, since in running.items():
+            work += max(predict(task_str) - (now - float(since)), 0)
+        n_running += len(running)
+    return work, n_running
+
+
+def campaign_progress(redis_inst, predictor, now=None, windows=THROUGHPUT_WINDOWS_SEC):
+    """
+    :return: a dict of counts, throughput (cluster-wide and per worker) and the ETA in seconds
+        (None if it cannot be projected)
+
+    """
+
+    now = time.time() if now is None else now
+    predictor.refresh(redis_inst, force=True)
+    counts = {key: redis_inst.hlen(key) for key in (REDIS_KEY_FINISHED_TASKS, REDIS_KEY_FAILED_TASKS,
+                                                   REDIS_KEY_IN_PROGRESS_TASKS, REDIS_KEY_TODO_TASKS,
+                                                   REDIS_KEY_BLOCKED_TASKS, REDIS_KEY_DEPENDENCY_FAILED)}
+    counts[REDIS_KEY_RETRY_BACKOFF] = redis_inst.zcard(REDIS_KEY_RETRY_BACKOFF)
+    remaining = counts[REDIS_KEY_TODO_TASKS] + counts[REDIS_KEY_BLOCKED_TASKS] + \
+        counts[REDIS_KEY_IN_PROGRESS_TASKS] + counts[REDIS_KEY_RETRY_BACKOFF]
+
+    per_worker = finish_times(redis_inst, now - max(windows))
+    all_times = sorted(t for v in per_worker.values() for t in v)
+    cluster = throughput(all_times, now, windows)
+    eta_window = ETA_WINDOW_SEC if ETA_WINDOW_SEC in windows else max(windows)
+    rate = cluster[eta_window]
+
+    work_sec, n_running = remaining_work_sec(redis_inst, predictor, now)
+    return {
+        "counts": counts,
+        "remaining": remaining,
+        "throughput": cluster,
+        "worker_throughput": {w: throughput(v, now, windows) for w, v in per_worker.items()},
+        "eta_window": eta_window,
+        "eta_by_throughput": remaining / rate if rate > 0 else (0 if remaining == 0 else None),
+        "remaining_work_sec": work_sec,
+        "running": n_running,
+        "eta_by_runtime": work_sec / n_running if n_running > 0 else (0 if remaining == 0 else None),
+    }
+
+
+def format_duration(sec):
+    if sec is None:
+        return "unknown"
+    sec = int(sec)
+    if sec >= 86400:
+        return "{}d{:02d}h".format(sec // 86400, sec % 86400 // 3600)
+    if sec >= 3600:
+        return "{}h{:02d}m".format(sec // 3600, sec % 3600 // 60)
+    return "{}m{:02d}s".format(sec // 60, sec % 60)
+
+
+def format_window(sec):
+    return "{}h".format(sec // 3600) if sec % 3600 == 0 else "{}m".format(sec // 60) if sec % 60 == 0 \
+        else "{}s".format(sec)
+
+
+def print_progress(redis_inst, predictor, include_str="", exclude_str=""):
+    """
+    print the counts, throughput, ETA and the progress lines of the running tasks
+
+    """
+
+    p = campaign_progress(redis_inst, predictor)
+    counts = p["counts"]
+    print("finished {}  failed {}  in_progress {}  todo {}  blocked {}  waiting for a retry {}  "
+          "dependency failed {}".format(
+              counts[REDIS_KEY_FINISHED_TASKS], counts[REDIS_KEY_FAILED_TASKS], counts[REDIS_KEY_IN_PROGRESS_TASKS],
+              counts[REDIS_KEY_TODO_TASKS], counts[REDIS_KEY_BLOCKED_TASKS], counts[REDIS_KEY_RETRY_BACKOFF],
+              counts[REDIS_KEY_DEPENDENCY_FAILED]))
+    print("throughput    " + "  ".join("{} {:.2f}/s".format(format_window(w), r)
+                                       for w, r in p["throughput"].items()))
+    print("eta           {} at the {} throughput, {} from the runtime history "
+          "({:.1f} task-hours of work left on {} running tasks)".format(
+              format_duration(p["eta_by_throughput"]), format_window(p["eta_window"]),
+              format_duration(p["eta_by_runtime"]), p["remaining_work_sec"] / 3600, p["running"]))
+
+    if len(p["worker_throughput"]) > 0:
+        print("\n{:20} ".format("worker") + " ".join("{:>10}".format(format_window(w))
+                                                     for w in THROUGHPUT_WINDOWS_SEC))
+        for worker, rates in sorted(p["worker_throughput"].items()):
+            print("{:20} ".format(worker) + " ".join("{:>8.3f}/s".format(r) for r in rates.values()))
+
+    lines = []
+    for shard in shard_clients(redis_inst):
+        lines.extend(shard.hgetall(REDIS_KEY_TASK_PROGRESS).items())
+    lines = [(t, v) for t, v in lines if (len(include_str) == 0 or include_str in t) and
+             (len(exclude_str) == 0 or exclude_str not in t)]
+    if len(lines) > 0:
+        print("\ntask progress")
+        now = time.time()
+        for task_str, value in sorted(lines):
+            worker, ts, line = value.split(" ", 2)
+            print("{:12} {:>6} ago  {}  {}".format(worker, format_duration(now - float(ts)), task_str, line))
@@ -0,0 +1,313 @@
+import io
+import os
+import sys
+import time
+import shlex
+import runpy
+import logging
+import resource
+import importlib
+import traceback
+import contextlib
+import multiprocessing
+from threading import Thread, Lock, Event
+from multiprocessing.connection import wait
+import psutil
+
+
+"""
+warm interpreter pool for python tasks
+
+the params of a python task are a callable and its arguments,
+    python:5:8:1:analysis.summarize results/w1.csv      ->  analysis.summarize("results/w1.csv")
+or a module entry point, run as __main__ like python -m,
+    python:5:8:1:-m analysis.report results/w1.csv
+
+instead of starting an interpreter per task, the worker keeps pool processes forked from a forkserver
+that imported python_preload_modules (e.g., numpy, pandas) once, a pool process runs one task at a time
+and stays warm for the next one, it is replaced after python_pool_max_tasks tasks or when its RSS grew
+by more than python_pool_max_rss_growth_mb since its first task, so state leaked by a task does not pile up
+
+"""
+
+
+def parse_python_task(task_params):
+    """
+    :return: (module, function or None for a module entry point, args)
+
+    """
+
+    args = shlex.split(task_params)
+    if len(args) == 0:
+        raise ValueError("empty python task")
+    if args[0] == "-m":
+        if len(args) < 2:
+            raise ValueError("python task -m requires a module")
+        return args[1], None, args[2:]
+    module, _, function = args[0].rpartition(".")
+    if module == "":
+        raise ValueError("python task {} is not module.function or -m module".format(args[0]))
+    return module, function, args[1:]
+
+
+def exit_code_of(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def run_python_task(task_params):
+    """
+    run a python task in the current process, the return value of a callable is printed to stdout
+
+    :return: (exit code, stdout, stderr) as the other task types
+
+    """
+
+    o_stdout, o_stderr = io.StringIO(), io.StringIO()
+    exitcode = 0
+    argv, cwd = sys.argv, os.getcwd()
+    try:
+        with contextlib.redirect_stdout(o_stdout), contextlib.redirect_stderr(o_stderr):
+            try:
+                module, function, args = parse_python_task(task_params)
+                if function is None:
+                    sys.argv = [module] + args
+                    runpy.run_module(module, run_name="__main__", alter_sys=True)
+                else:
+                    ret = getattr(importlib.import_module(module), function)(*args)
+                    if ret is not None:
+                        print(ret)
+            except SystemExit as e:
+                exitcode = exit_code_of(e)
+            except Exception:
+                traceback.print_exc()
+                exitcode = 1
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+    return exitcode, o_stdout.getvalue().strip(), o_stderr.getvalue().strip()
+
+
+def serve(conn):
+    """
+    the loop of a pool process, it runs the (task params, environment variables) it receives
+    until it receives None
+
+    """
+
+    proc = psutil.Process()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            # the worker is gone
+            break
+        if message is None:
+            break
+        task_params, env = message
+
+        start_ts = time.time()
+        before = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        saved_env = {k: os.environ.get(k) for k in env}
+        os.environ.update(env)
+        exitcode, o_stdout, o_stderr = run_python_task(task_params)
+        for k, v in saved_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        after = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        conn.send({
+            "exit_code": exitcode,
+            "stdout": o_stdout,
+            "stderr": o_stderr,
+            "start_ts": start_ts,
+            "finish_ts": time.time(),
+            # the peak of the pool process so far, an upper bound of the peak of this task
+            "usage": {
+                "ru_maxrss": max(u.ru_maxrss for u in after),
+                "ru_utime": sum(u.ru_utime for u in after) - sum(u.ru_utime for u in before),
+                "ru_stime": sum(u.ru_stime for u in after) - sum(u.ru_stime for u in before),
+            },
+            "rss_kb": proc.memory_info().rss // 1024,
+        })
+    conn.close()
+
+
+class PooledTask:
+    """
+    a task running in a pool process, it has the pid, is_alive, join and exitcode of the
+    multiprocessing.Process of a TaskRunner, so the worker tracks, times out and kills both the same way,
+    killing the pid kills the pool process and the pool replaces it
+
+    """
+
+    def __init__(self, task, pid):
+        self.task = task
+        self.pid = pid
+        self.exitcode = None
+        self.done = Event()
+
+    def is_alive(self):
+        return not self.done.is_set()
+
+    def join(self, timeout=None):
+        self.done.wait(timeout)
+
+    def finish(self, exitcode):
+        self.exitcode = exitcode
+        self.done.set()
+
+
+class PoolProcess:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=serve, args=(child_conn,))
+        self.process.start()
+        # only the pool process holds the other end, so the pool sees EOF when it dies
+        child_conn.close()
+        self.n_tasks = 0
+        self.base_rss_kb = None
+        self.handle = None
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class PythonPool(Thread):
+    def __init__(self, on_done, size=0, preload_modules=(), max_tasks=100, max_rss_growth_mb=1024):
+        """
+
+        :param on_done: called with (task, result) when a task returns, result is the dict sent by serve,
+            it is not called for a task whose pool process is killed
+        :param size: the number of warm processes kept even when no python task runs
+        :param preload_modules: imported once by the forkserver, every pool process inherits them
+        :param max_tasks: a pool process is replaced after running this many tasks
+        :param max_rss_growth_mb: a pool process is replaced when its RSS grew by more than this since
+            its first task, 0 disables the check
+
+        """
+
+        super(PythonPool, self).__init__(daemon=True)
+        self.on_done = on_done
+        self.size = size
+        self.max_tasks = max_tasks
+        self.max_rss_growth_mb = max_rss_growth_mb
+        self.ctx = multiprocessing.get_context("forkserver")
+        self.ctx.set_forkserver_preload(list(preload_modules))
+        self.idle = []  # warm processes waiting for a task
+        self.busy = {}  # conn -> the PoolProcess running a task
+        self.lock = Lock()
+        # submit wakes up the pool thread so that it waits for the new task too
+        self.wakeup_r, self.wakeup_w = multiprocessing.Pipe(duplex=False)
+        self.stop_flag = False
+        self.n_started = 0
+        self.top_up()
+
+    def top_up(self):
+        while len(self.idle) + len(self.busy) < self.size:
+            self.idle.append(self.start_process())
+
+    def start_process(self):
+        self.n_started += 1
+        return PoolProcess(self.ctx)
+
+    def submit(self, task, env=None):
+        """
+        run a python task on a warm process
+
+        :param env: environment variables set for the task only
+        :return: a PooledTask
+
+        """
+
+        with self.lock:
+            while True:
+                proc = self.idle.pop() if len(self.idle) > 0 else self.start_process()
+                try:
+                    proc.conn.send((task.task_params, env or {}))
+                    break
+                except OSError:
+                    # the idle process died, e.g., it was killed by hand
+                    proc.stop(timeout=0)
+            proc.handle = PooledTask(task, proc.process.pid)
+            self.busy[proc.conn] = proc
+        self.wakeup_w.send_bytes(b"")
+        return proc.handle
+
+    def run(self):
+        while not self.stop_flag:
+            with self.lock:
+                conns = list(self.busy.keys())
+            for conn in wait(conns + [self.wakeup_r], timeout=0.2):
+                if conn is self.wakeup_r:
+                    conn.recv_bytes()
+                else:
+                    self.receive(conn)
+
+    def receive(self, conn):
+        with self.lock:
+            proc = self.busy.pop(conn)
+        try:
+            result = conn.recv()
+        except (EOFError, OSError):
+            # killed by the worker, e.g., timeout or returned because the node is out of DRAM
+            result = None
+
+        if result is None:
+            proc.process.join()
+            conn.close()
+            exitcode = proc.process.exitcode
+            proc.handle.finish(-1 if exitcode is None else exitcode)
+        else:
+            proc.n_tasks += 1
+            if proc.base_rss_kb is None:
+                proc.base_rss_kb = result["rss_kb"]
+            try:
+                self.on_done(proc.handle.task, result)
+            except Exception as e:
+                logging.error("python task {} result error {}".format(proc.handle.task, e))
+            proc.handle.finish(result["exit_code"])
+            proc.handle = None
+
+            grown_mb = (result["rss_kb"] - proc.base_rss_kb) / 1024
+            if proc.n_tasks >= self.max_tasks or 0 < self.max_rss_growth_mb < grown_mb:
+                logging.info("recycle python pool process {} after {} tasks, RSS grew {:.0f} MB".format(
+                    proc.process.pid, proc.n_tasks, grown_mb))
+                proc.stop()
+            else:
+                with self.lock:
+                    self.idle.append(proc)
+
+        with self.lock:
+            self.top_up()
+
+    def close(self):
+        """
+        stop the idle processes and kill the busy ones
+
+        """
+
+        self.stop_flag = True
+        if self.is_alive():
+            self.wakeup_w.send_bytes(b"")
+            self.join()
+        with self.lock:
+            for proc in self.idle:
+                proc.stop()
+            for proc in self.busy.values():
+                proc.process.kill()
+                proc.stop()
+            self.idle, self.busy = [], {}
@@ -8,6 +8,19 @@ from functools import partial
 import redis
 from const import *
 from utils import *
+from task_stats import print_task_stats
+from events import tail_events
+from dag import resolve_dependencies, add_dag_tasks_to_redis, restore_dependency_failed
+from predictor import RuntimePredictor, rebuild_runtime_history
+from memory_model import DramEstimator, print_dram_status
+from export import export_results
+from progress import print_progress
+from top import run_top
+from locality import task_inputs, index_task_inputs
+from shards import ShardedRedis, as_sharded, shard_clients, parse_shard_address
+from config_sync import publish_config, fetch_config
+from fairshare import default_owner, queue_score, index_tasks, activate_owners, requeue_tasks, queue_key
+from pools import set_pool_capacity, parse_pool_capacities, print_pool_status, release_worker_leases
 
 
 CONFIG = RunnerConfig(CONFIG_PATH, auto_reload=False)
@@ -25,7 +38,8 @@ def create_redis_pool(host, port, db, password):
 
 
 def init_redis(redis_inst):
-    redis_inst.flushall()
+    for shard in shard_clients(redis_inst):
+        shard.flushall()
     logging.info("redis initialized")
 
 def verify_task_format(task_str):
@@ -40,38 +54,95 @@ def load_task_from_file(task_filepath):
     """
     load task from file
 
+    :return: a dict of task str -> annotations (empty if the line has none), in file order
+
     """
 
-    tasks = set()
+    tasks = {}
     with open(task_filepath) as ifile:
         for line in ifile:
             if line[0] == "#" or len(line.strip()) <= 2:
                 continue
-            task_str = line.strip("\n")
+            task_str, annotations = split_task_annotations(line.strip("\n"))
             if not verify_task_format(task_str):
                 print("task format error: {}".format(task_str))
                 continue
             if task_str not in tasks:
-                tasks.add(task_str)
+                tasks[task_str] = annotations
     return tasks
 
 
-def add_task_to_redis(redis_inst, task_filepath):
+def add_task_to_redis(redis_inst, task_filepath, critical_path_boost=0, owner=None, aging_sec=3600):
     """
     load tasks from file and add to redis
 
+    :param critical_path_boost: the priority added per task on the longest chain of dependents
+    :param owner: the owner the tasks are queued for, see fairshare, an @owner= annotation overrides it,
+        the tasks without an owner are only in todo_tasks
+    :param aging_sec: the waiting time worth one priority level in the queue of the owner
+
     """
 
+    shards = as_sharded(redis_inst)
     tasks = load_task_from_file(task_filepath)
-    finished = redis_inst.hgetall(REDIS_KEY_FINISHED_TASKS)
-    in_progress = redis_inst.hgetall(REDIS_KEY_IN_PROGRESS_TASKS)
-
-    p = redis_inst.pipeline()
-    for task in tasks:
+    finished = shards.hgetall(REDIS_KEY_FINISHED_TASKS)
+    in_progress = shards.hgetall(REDIS_KEY_IN_PROGRESS_TASKS)
+
+    submit_ts = time.time()
+    pipelines = [shard.pipeline() for shard in shards]
+    n_plain = [0] * len(shards)
+    annotated = []
+    owner_of = {}
+    owned = defaultdict(lambda: defaultdict(dict))  # shard -> owner -> task -> queue score
+    for task, annotations in tasks.items():
+        task_owner = annotations.pop("owner", owner)
         if task not in finished and task not in in_progress:
+            if len(annotations) > 0:
+                annotated.append((task, annotations))
+                if task_owner:
+                    owner_of[task] = task_owner
+                continue
+            shard = shards.shard_of_task_str(task)
+            p = pipelines[shard]
+            n_plain[shard] += 1
             p.hsetnx(REDIS_KEY_TODO_TASKS, task, "")
-    r = p.execute()
-    logging.info("load {} tasks, add {} task".format(len(tasks), sum(r)))
+            p.hsetnx(REDIS_KEY_TASK_SUBMIT_TIME, task, submit_ts)
+            if task_owner:
+                owned[shard][task_owner][task] = queue_score(task, submit_ts, aging_sec)
+    for shard, by_owner in owned.items():
+        for task_owner, task_scores in by_owner.items():
+            index_tasks(pipelines[shard], task_owner, task_scores)
+    n_added = sum(sum(p.execute()[:2 * n][::2]) for p, n in zip(pipelines, n_plain))
+
+    if len(annotated) > 0:
+        resolved = resolve_dependencies(shards, annotated, critical_path_boost)
+        # the resolved task str has the boosted priority
+        owner_of = {task: owner_of[original] for (original, _), (task, _, _) in zip(annotated, resolved)
+                    if original in owner_of}
+        # the tasks with dependencies stay on the primary shard
+        by_shard = defaultdict(list)
+        for task, annotations, deps in resolved:
+            pinned = "name" in annotations or "after" in annotations
+            by_shard[shards.shard_of_task_str(task, pinned)].append((task, annotations, deps))
+        for shard, shard_resolved in sorted(by_shard.items()):
+            p = shards[shard].pipeline()
+            by_owner = defaultdict(dict)
+            for task, annotations, _ in shard_resolved:
+                p.hsetnx(REDIS_KEY_TASK_SUBMIT_TIME, task, submit_ts)
+                index_task_inputs(p, task, task_inputs(annotations))
+                task_owner = owner_of.get(task)
+                if task_owner:
+                    by_owner[task_owner][task] = queue_score(task, submit_ts, aging_sec)
+            # the script that adds a task to todo also queues it for its owner
+            for task_owner, task_scores in by_owner.items():
+                index_tasks(p, task_owner, task_scores, queue=False)
+                owned[shard][task_owner].update(task_scores)
+            p.execute()
+            n_todo, n_blocked = add_dag_tasks_to_redis(shards[shard], shard_resolved)
+            n_added += n_todo + n_blocked
+    for shard, by_owner in owned.items():
+        activate_owners(shards[shard], list(by_owner))
+    logging.info("load {} tasks, add {} task".format(len(tasks), n_added))
 
 
 def filter_func(data, include_str, exclude_str):
@@ -149,9 +220,11 @@ def print_task_status(redis_inst,
         logging.error(str(e))
 
     print(
-        "{} todo tasks, {} in_progress tasks, {} finished tasks, {} failed tasks\n"
+        "{} todo tasks, {} in_progress tasks, {} finished tasks, {} failed tasks, {} blocked tasks, "
+        "{} tasks waiting for a retry, {} tasks whose dependency failed\n"
         .format(len(todo_tasks), len(in_progress_tasks), len(finished_tasks),
-                len(failed_tasks)))
+                len(failed_tasks), redis_inst.hlen(REDIS_KEY_BLOCKED_TASKS),
+                redis_inst.zcard(REDIS_KEY_RETRY_BACKOFF), redis_inst.hlen(REDIS_KEY_DEPENDENCY_FAILED)))
 
     if todo:
         print("##" * 24 + "  todo task  " + "##" * 24)
@@ -173,9 +246,10 @@ def print_task_status(redis_inst,
                     print(task)
     if failed:
         print("##" * 24 + "  failed task  " + "##" * 24)
+        classes = redis_inst.hgetall(REDIS_KEY_TASK_FAILURE_CLASSES)
         for task, worker in failed_tasks.items():
             if my_filter(task):
-                print("{}:         {}".format(task, worker))
+                print("{}:         {} {}".format(task, worker, classes.get(task.task_str, "")))
 
     if failed_reason and len(task_fail_reason) > 0:
         print("##" * 24 + "  task fail reason " + "##" * 24)
@@ -231,23 +305,34 @@ def cleanup_task(redis_inst,
 
     """
 
+    shards = as_sharded(redis_inst)
     dead_workers = set()
-    for worker, status in redis_inst.hscan_iter("worker_status"):
+    for worker, status in shards.primary.hscan_iter("worker_status"):
         last_report_ts, used_core, total_core, used_mem_gb, total_mem_gb = status.split(
             ":")
         if time.time() - int(last_report_ts) > worker_dead_threshold:
             # worker is dead, move its in_progress task to todo
             dead_workers.add(worker)
     for worker in dead_workers:
-        redis_inst.hdel("worker_status", worker)
-
-    to_return_tasks = []
-    for task, worker in redis_inst.hscan_iter(REDIS_KEY_IN_PROGRESS_TASKS):
-        if worker in dead_workers:
-            to_return_tasks.append(task)
-    for task in to_return_tasks:
-        redis_inst.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task)
-        redis_inst.hset(REDIS_KEY_TODO_TASKS, task, "")
+        shards.primary.hdel("worker_status", worker)
+        shards.primary.hdel(REDIS_KEY_WORKER_WARM_INPUTS, worker)
+    if len(dead_workers) > 0:
+        # the leases would expire anyway
+        release_worker_leases(shards.primary, dead_workers)
+
+    for shard in shards:
+        to_return_tasks = []
+        for task, worker in shard.hscan_iter(REDIS_KEY_IN_PROGRESS_TASKS):
+            if worker in dead_workers:
+                to_return_tasks.append(task)
+        for task in to_return_tasks:
+            shard.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task)
+        requeue_tasks(shard, to_return_tasks)
+        # the backup copies of dead workers, the original copies keep running
+        dead_backups = [task for task, worker in shard.hscan_iter(REDIS_KEY_SPECULATIVE_TASKS)
+                        if worker in dead_workers]
+        if len(dead_backups) > 0:
+            shard.hdel(REDIS_KEY_SPECULATIVE_TASKS, *dead_backups)
 
 def remove_finished_tasks():
     """
@@ -255,12 +340,13 @@ def remove_finished_tasks():
     
     """
 
-    to_remove = []
-    for task in redis_inst.hkeys(REDIS_KEY_FINISHED_TASKS):
-        to_remove.append(task)
+    for shard in shard_clients(redis_inst):
+        to_remove = []
+        for task in shard.hkeys(REDIS_KEY_FINISHED_TASKS):
+            to_remove.append(task)
 
-    for task in to_remove:
-        redis_inst.hdel(REDIS_KEY_FINISHED_TASKS, task)
+        for task in to_remove:
+            shard.hdel(REDIS_KEY_FINISHED_TASKS, task)
 
 def move_in_progress_task_to_todo():
     """
@@ -268,10 +354,12 @@ def move_in_progress_task_to_todo():
     
     """
 
-    for task in redis_inst.hkeys(REDIS_KEY_IN_PROGRESS_TASKS):
-        # worker = redis_inst.hget(REDIS_KEY_IN_PROGRESS_TASKS, task)
-        redis_inst.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task)
-        redis_inst.hset(REDIS_KEY_TODO_TASKS, task, "")
+    for shard in shard_clients(redis_inst):
+        tasks = shard.hkeys(REDIS_KEY_IN_PROGRESS_TASKS)
+        for task in tasks:
+            # worker = shard.hget(REDIS_KEY_IN_PROGRESS_TASKS, task)
+            shard.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task)
+        requeue_tasks(shard, tasks)
 
 def move_failed_task_to_todo_task():
     """
@@ -279,12 +367,88 @@ def move_failed_task_to_todo_task():
     
     """
 
-    for task in redis_inst.hkeys(REDIS_KEY_FAILED_TASKS):
-        redis_inst.hdel(REDIS_KEY_FAILED_TASKS, task)
-        redis_inst.hset(REDIS_KEY_TODO_TASKS, task, "")
+    for shard in shard_clients(redis_inst):
+        # the tasks waiting for the failed tasks wait again
+        restore_dependency_failed(shard)
+        tasks = shard.hkeys(REDIS_KEY_FAILED_TASKS)
+        for task in tasks:
+            shard.hdel(REDIS_KEY_FAILED_TASKS, task)
+            # a fresh start, also on the nodes it ran out of memory on
+            shard.hdel(REDIS_KEY_TASK_FAILURE_CLASSES, task)
+            shard.hdel(REDIS_KEY_TASK_MIN_NODE_MEM, task)
+        requeue_tasks(shard, tasks)
+
+        for task in shard.hkeys(REDIS_KEY_TASK_FAIL_REASON):
+            shard.hdel(REDIS_KEY_TASK_FAIL_REASON, task)
+
+def push_config(redis_inst, conf_path):
+    """
+    publish the cluster-wide fields of a config file to all workers
+
+    """
+
+    with open(conf_path) as f:
+        conf_data = json.load(f)
+    version = publish_config(as_sharded(redis_inst).primary, conf_data)
+    print("published {} as cluster config version {}".format(conf_path, version))
+
+def set_owner_weight(redis_inst, owner, weight):
+    if weight <= 0:
+        raise ValueError("the weight of an owner must be positive")
+    as_sharded(redis_inst).primary.hset(REDIS_KEY_OWNER_WEIGHTS, owner, weight)
+
+def print_owner_status(redis_inst):
+    """
+    print the weight, queued and running tasks of each owner, see fairshare
+
+    """
 
-    for task in redis_inst.hkeys(REDIS_KEY_TASK_FAIL_REASON):
-        redis_inst.hdel(REDIS_KEY_TASK_FAIL_REASON, task)
+    shards = as_sharded(redis_inst)
+    weights = shards.primary.hgetall(REDIS_KEY_OWNER_WEIGHTS)
+    queued, running, passes = Counter(), Counter(), defaultdict(list)
+    for shard in shards:
+        for owner, p in shard.zrange(REDIS_KEY_OWNER_PASS, 0, -1, withscores=True):
+            passes[owner].append(p)
+            queued[owner] += shard.zcard(queue_key(owner))
+        in_progress = shard.hkeys(REDIS_KEY_IN_PROGRESS_TASKS)
+        for owner in shard.hmget(REDIS_KEY_TASK_OWNER, in_progress) if len(in_progress) > 0 else []:
+            running[owner or "-"] += 1
+
+    total_weight = sum(float(weights.get(o, 1)) for o in passes if queued[o] > 0) or 1
+    n_running = sum(running.values()) or 1
+    print("{}{:16} {:>8} {:>10} {:>10} {:>12} {:>12} {:>10}{}".format(
+        STATUS_COLOR, "owner", "weight", "queued", "running", "running %", "fair share %", "pass", NORMAL_COLOR))
+    for owner in sorted(set(passes) | set(running)):
+        weight = float(weights.get(owner, 1))
+        print("{:16} {:>8.2f} {:>10} {:>10} {:>12.1f} {:>12.1f} {:>10.1f}".format(
+            owner, weight, queued[owner], running[owner], running[owner] / n_running * 100,
+            weight / total_weight * 100 if queued[owner] > 0 else 0, min(passes.get(owner, [0]))))
+
+def export_finished_tasks(redis_inst, path, name, include_str="", exclude_str=""):
+    """
+    write the tasks finished since the previous export of this name to path, see export
+
+    """
+
+    def task_filter(task_str):
+        if len(include_str) > 0:
+            return include_str in task_str
+        if len(exclude_str) > 0:
+            return exclude_str not in task_str
+        return True
+
+    n_rows, until = export_results(redis_inst, path, name, task_filter=task_filter,
+                                   family_params=CONFIG.task_family_params)
+    print("exported {} finished tasks to {}, reported up to {}".format(
+        n_rows, path, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(until))))
+
+def print_cluster_config(redis_inst):
+    version, conf = fetch_config(as_sharded(redis_inst).primary)
+    if version == 0:
+        print("no cluster config, workers use their conf.json")
+        return
+    print("cluster config version {}".format(version))
+    pprint(conf)
 
 if __name__ == "__main__":
 
@@ -308,12 +472,46 @@ if __name__ == "__main__":
                         type=str,
                         default=CONFIG.redis_db,
                         help="Redis DB")
+    parser.add_argument("--redis_shards",
+                        type=str,
+                        default=",".join(CONFIG.redis_shards),
+                        help="comma separated host:port of the other redis shards")
     parser.add_argument("--task",
                         type=str,
                         required=True,
                         help="task to execute, initRedis/loadTask/checkWorker/checkTask/checkLog/"+
-                                "cleanup/removeFinishedTask/moveInProgressTaskToTodo/moveFailedTaskToTodo"
+                                "cleanup/removeFinishedTask/moveInProgressTaskToTodo/moveFailedTaskToTodo/"+
+                                "taskStats/tailEvents/rebuildRuntimeHistory/pushConfig/showConfig/progress/top/"+
+                                "checkOwner/setOwnerWeight/checkPool/setPool/checkDram/exportResults"
                         )
+    parser.add_argument("--owner",
+                        type=str,
+                        default=default_owner(),
+                        help="the owner loadTask queues the tasks for (fair share), or the owner of setOwnerWeight")
+    parser.add_argument("--weight",
+                        type=float,
+                        default=1,
+                        help="the fair-share weight set by setOwnerWeight")
+    parser.add_argument("--pool",
+                        type=str,
+                        default="",
+                        help="capacities set by setPool, e.g., io_heavy=40,license=4, io_heavy= removes the limit")
+    parser.add_argument("--interval",
+                        type=float,
+                        default=2,
+                        help="refresh interval of top in seconds")
+    parser.add_argument("--conf",
+                        type=str,
+                        default=CONFIG_PATH,
+                        help="config file published by pushConfig")
+    parser.add_argument("--output",
+                        type=str,
+                        default="results.csv",
+                        help="file written by exportResults, .csv, .jsonl or .parquet (needs pyarrow)")
+    parser.add_argument("--export_name",
+                        type=str,
+                        default="results",
+                        help="exportResults writes the tasks finished since the previous export of this name")
     parser.add_argument("--include",
                         type=str,
                         default="",
@@ -322,6 +520,18 @@ if __name__ == "__main__":
                         type=str,
                         default="",
                         help="filter to show some task/worker")
+    parser.add_argument("--critical_path_boost",
+                        type=int,
+                        default=0,
+                        help="loadTask adds this priority per task on the longest chain of dependents")
+    parser.add_argument("--group",
+                        type=str,
+                        default="manager",
+                        help="consumer group of tailEvents, each group sees every event once")
+    parser.add_argument("--consumer",
+                        type=str,
+                        default="manager",
+                        help="consumer name of tailEvents within the group")
     parser.add_argument("--taskfile",
                         type=str,
                         default="task",
@@ -366,7 +576,11 @@ if __name__ == "__main__":
         ap.redis_db,
         ap.redis_pass
     )
-    redis_inst = redis.Redis(connection_pool=redis_pool)
+    shards = [redis.Redis(connection_pool=redis_pool)]
+    for address in [x for x in ap.redis_shards.split(",") if x]:
+        host, port = parse_shard_address(address, ap.redis_port)
+        shards.append(redis.Redis(connection_pool=create_redis_pool(host, port, ap.redis_db, ap.redis_pass)))
+    redis_inst = ShardedRedis(shards)
 
     tasks = []
     if '&' in ap.task:
@@ -380,7 +594,8 @@ if __name__ == "__main__":
         if task == "initRedis":
             init_redis(redis_inst)
         elif task == "loadTask":
-            add_task_to_redis(redis_inst, ap.taskfile)
+            add_task_to_redis(redis_inst, ap.taskfile, ap.critical_path_boost,
+                              owner=ap.owner, aging_sec=CONFIG.fair_share_aging_sec)
         elif task == "checkWorker":
             print_worker_status(redis_inst,
                                 include_str=ap.include,
@@ -395,8 +610,47 @@ if __name__ == "__main__":
                               print_result=ap.print_result,
                               include_str=ap.include,
                               exclude_str=ap.exclude)
+        elif task == "taskStats":
+            print_task_stats(redis_inst,
+                             include_str=ap.include,
+                             exclude_str=ap.exclude,
+                             family_params=CONFIG.task_family_params)
+        elif task == "progress":
+            print_progress(redis_inst, RuntimePredictor(CONFIG.task_family_params),
+                           include_str=ap.include,
+                           exclude_str=ap.exclude)
+        elif task == "top":
+            run_top(redis_inst, ap.interval, CONFIG.max_task_per_worker,
+                    include_str=ap.include,
+                    exclude_str=ap.exclude)
+        elif task == "checkOwner":
+            print_owner_status(redis_inst)
+        elif task == "setOwnerWeight":
+            set_owner_weight(redis_inst, ap.owner, ap.weight)
+        elif task == "checkPool":
+            print_pool_status(redis_inst.primary, time.time())
+        elif task == "setPool":
+            set_pool_capacity(redis_inst.primary, parse_pool_capacities(ap.pool))
+        elif task == "checkDram":
+            print_dram_status(redis_inst, DramEstimator.from_config(CONFIG),
+                              include_str=ap.include,
+                              exclude_str=ap.exclude)
+        elif task == "exportResults":
+            export_finished_tasks(redis_inst, ap.output, ap.export_name,
+                                  include_str=ap.include,
+                                  exclude_str=ap.exclude)
+        elif task == "rebuildRuntimeHistory":
+            rebuild_runtime_history(redis_inst, CONFIG.task_family_params)
+        elif task == "tailEvents":
+            tail_events(redis_inst, ap.group, ap.consumer,
+                        include_str=ap.include,
+                        exclude_str=ap.exclude)
         elif task == "cleanup":
             cleanup_task(redis_inst, CONFIG.health_report_interval * 20)
+        elif task == "pushConfig":
+            push_config(redis_inst, ap.conf)
+        elif task == "showConfig":
+            print_cluster_config(redis_inst)
         elif task == "removeFinishedTask":
             remove_finished_tasks()
         elif task == "moveInProgressTaskToTodo":
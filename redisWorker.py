@@ -2,6 +2,7 @@ import os
 import sys
 
 import time
+import resource
 import signal
 import socket
 import logging
@@ -9,14 +10,31 @@ import json
 from collections import defaultdict
 import psutil
 import subprocess
-from multiprocessing import Process
-from threading import Thread, Lock
+from types import SimpleNamespace
+from multiprocessing import Process, Pipe
+from threading import Thread
 import redis
 from utils import *
 from const import *
-
-
-CONFIG = RunnerConfig(CONFIG_PATH, auto_reload=True)
+from metrics import WorkerMetrics, MetricsServer
+from events import append_event
+from predictor import RuntimePredictor
+from memory_model import DramEstimator, TreeRssSampler
+from reporter import ResultReporter, queue_task_finish, queue_task_failed
+from journal import ResultJournal, journal_path
+from shards import ShardedRedis, parse_shard_address, shard_clients
+from locality import WarmInputs, task_inputs, remote_warm_inputs, sample_local_tasks
+from pyexec import PythonPool, run_python_task
+from admission import *
+from config_sync import ConfigSubscriber
+from progress import progress_dir, progress_file, read_last_line
+from fairshare import OWNER_WEIGHTS_REFRESH_SEC, FAIR_SHARE_CLAIM_ROUNDS, queue_heads, select_fair_share, claim_tasks, requeue_tasks, \
+    owner_weight
+from pools import POOL_CAPACITY_REFRESH_SEC, pool_capacities, load_task_pools, exhausted_pools, has_exhausted_pool, \
+    acquire_pools, renew_leases, release_pools, release_worker_leases
+from retry import PROMOTE_INTERVAL_SEC, failed_workers, fits_node_mem, promote_due_retries
+from deadlines import RUNNER_TIMEOUT_SLACK_SEC, DeadlineQueue, kill_process_tree, kill_process_group
+from task_state import TaskState, TaskTracker
 
 # create redis connection pool
 def create_redis_pool(host, port, db, password):
@@ -58,62 +76,160 @@ def run_shell_task(task_params):
 TASK_TYPE_TO_FUNC = {
     "demo": run_demo_task,
     "shell": run_shell_task,
+    # the worker runs python tasks on its warm PythonPool, this runs one in a fresh TaskRunner
+    "python": run_python_task,
 }
 
-def report_task_finish(worker_name, redis_inst, task, result):
+
+def task_result(exitcode, o_stdout, o_stderr):
     """
-    report a task is finished to redis using pipeline for better performance
+    the status and the reported message of a task run
 
     """
 
-    worker = redis_inst.hget(
-        REDIS_KEY_IN_PROGRESS_TASKS, task.task_str)
-    if worker != worker_name:
-        logging.error(
-            f"finished task is not assigned to worker {worker} != {worker_name}")
+    if exitcode != 0:
+        msg = json.dumps(o_stderr)
+        if len(msg) > 1024:
+            msg = "stderr is too large. " + msg[:1024]
+        return "failed", msg
 
-    # Use pipeline to batch Redis operations
-    pipeline = redis_inst.pipeline()
-    pipeline.hset(REDIS_KEY_FINISHED_TASKS, task.task_str,
-                 "{}: {}".format(worker_name, result))
-    pipeline.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str)
-    pipeline.hdel(REDIS_KEY_FAILED_TASKS, task.task_str)
-    pipeline.execute()
+    msg = "stdout is too large"
+    if len(o_stdout) < 1024 * 1024:
+        msg = json.dumps(o_stdout)
+    return "finished", msg
 
-def report_task_failed(worker_name, redis_inst, task, errmsg, max_retry_per_task):
-    """ 
-    report the task failed using pipeline for better performance
+def task_timing_record(worker_name, task, start_ts, finish_ts, exit_code, usage=None, peak_shared=False):
+    """
+    build the lifecycle record of a task run, submit time is recorded by the manager separately
+
+    :param usage: resource usage of the task processes (resource.getrusage(RUSAGE_CHILDREN)) if known
+    :param peak_shared: the peak RSS is of a process that ran other tasks before, see memory_model
 
     """
 
-    worker = redis_inst.hget(
-        REDIS_KEY_IN_PROGRESS_TASKS, task.task_str)
-    if worker != worker_name:
+    record = {
+        "worker": worker_name,
+        "claim_ts": task.claim_ts,
+        "claim_sec": task.claim_sec,
+        "start_ts": start_ts,
+        "finish_ts": finish_ts,
+        "exit_code": exit_code,
+        "peak_rss_kb": None,
+        "cpu_sec": None,
+    }
+    if usage is not None:
+        # ru_maxrss is in KiB on Linux
+        record["peak_rss_kb"] = usage.ru_maxrss
+        record["cpu_sec"] = round(usage.ru_utime + usage.ru_stime, 3)
+        if peak_shared:
+            record["peak_shared"] = True
+    return record
+
+
+# KEYS: in_progress_tasks, speculative_tasks, task_events
+# ARGV: task str, worker, event, stream maxlen
+# returns 1 if the worker runs the backup copy, 0 if the task is finished, ours or has a backup already
+CLAIM_BACKUP_SCRIPT = """
+local owner = redis.call('HGET', KEYS[1], ARGV[1])
+if not owner or owner == ARGV[2] or redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[4], '*', 'e', ARGV[3], 't', ARGV[1], 'w', ARGV[2], 'of', owner)
+return 1
+"""
+
+
+def report_task_finish(worker_name, redis_inst, task, result, timing=None, family=None):
+    """
+    report a task is finished to redis in one atomic pipeline
+
+    :param timing: the lifecycle record of the task run, see task_timing_record
+    :param family: the task family, the runtime is added to its runtime history if timing is given
+
+    """
+
+    pipeline = redis_inst.pipeline(transaction=True)
+    check = queue_task_finish(pipeline, worker_name, task.task_str, result, timing=timing, family=family)
+    worker = pipeline.execute()[check]
+    if worker is None:
+        logging.info(f"task {task.task_str} is already finished by another copy")
+    elif worker != worker_name:
         logging.error(
             f"finished task is not assigned to worker {worker} != {worker_name}")
 
-    failed_workers = redis_inst.hget(
-        REDIS_KEY_FAILED_TASKS, task.task_str)
-    if failed_workers is None:
-        failed_workers = ""
-    failed_workers += worker_name + ","
-    
-    # Use pipeline to batch Redis operations
-    pipeline = redis_inst.pipeline()
-    pipeline.hset(REDIS_KEY_FAILED_TASKS, task.task_str, failed_workers)
-    pipeline.hset(REDIS_KEY_TASK_FAIL_REASON, task.task_str, errmsg)
-    pipeline.execute()
-    redis_inst.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str)
+def report_task_failed(worker_name, redis_inst, task, errmsg, max_retry_per_task, timing=None,
+                       event=EVENT_FAIL, failure_class=None, retry_policy=None, backoff_max_sec=0,
+                       node_mem_gb=None, family=None, max_node_mem_gb=None):
+    """ 
+    report the task failed in one round trip, the retry decision is made atomically in redis
+
+    :param timing: the lifecycle record of the task run, see task_timing_record
+    :param event: the event appended to the task event stream, EVENT_FAIL or EVENT_TIMEOUT
+    :param failure_class: retry_policy, backoff_max_sec, node_mem_gb, family, max_node_mem_gb: see queue_task_failed
+    :return: True if the task is retried (possibly after a backoff)
 
-    if failed_workers.count(",") < max_retry_per_task:
-        redis_inst.hset(REDIS_KEY_TODO_TASKS, task.task_str, "")
+    """
+
+    pipeline = redis_inst.pipeline(transaction=True)
+    check = queue_task_failed(pipeline, worker_name, task.task_str, errmsg, max_retry_per_task,
+                              timing=timing, event=event, failure_class=failure_class,
+                              retry_policy=retry_policy, backoff_max_sec=backoff_max_sec,
+                              node_mem_gb=node_mem_gb, family=family, max_node_mem_gb=max_node_mem_gb)
+    retry = pipeline.execute()[check]
+    if retry == -1:
+        logging.error(
+            f"failed task {task.task_str} is not assigned to worker {worker_name}")
+    return retry == 1
 
 
 
 class Worker:
-    def __init__(self, conf_path="conf.json"):
-        self.name = "" + socket.gethostname().split(".")[0]
-        self.config = RunnerConfig(conf_path, True)
+    def __init__(self, conf_path="conf.json", admission_policy=None, config=None, name=None):
+        """
+        the node specific parts (redis connections, the cluster config, the host resources and the services
+        that run threads or open ports) are the methods connect_redis, sync_cluster_config, get_health_info and
+        start_services, a subclass overrides them to run the worker without a real node, see benchmark.BenchWorker
+
+        :param admission_policy: overrides admission_policy of the config for this worker
+        :param config: a RunnerConfig, read from conf_path (reloaded when it changes) if None
+        :param name: the worker name, the short host name if None
+
+        """
+
+        self.name = name or socket.gethostname().split(".")[0]
+        self.config = config or RunnerConfig(conf_path, True)
+        self.admission_policy = admission_policy
+        self.connect_redis()
+        # the config published cluster-wide overrides conf.json, it is applied before the first claim
+        self.sync_cluster_config()
+
+        self.runtime_predictor = RuntimePredictor(self.config.task_family_params,
+                                                  self.config.runtime_history_refresh_sec)
+        self.dram_estimator = DramEstimator.from_config(self.config)
+        self.warm_inputs = WarmInputs(self.config.warm_input_capacity, self.config.local_data_dir)
+        self.locality_wait_start = None  # when this worker started to leave tasks to other workers
+        self.owner_weights, self.owner_weights_ts = {}, 0
+        self.failed_queued_tasks = set()  # queued tasks this worker failed before, left to the others
+        self.pool_capacities, self.pool_capacities_ts = {}, 0
+        self.last_promote = {}  # shard -> when the due retries were last moved to todo
+        self.tasks = TaskTracker()  # the tasks this worker holds, with their reserved DRAM, see task_state
+        self.deadlines = DeadlineQueue()  # the running tasks with a timeout, see deadlines
+        # the progress files of the running tasks, see progress.py
+        self.forwarded_progress = {}  # task -> mtime of the progress file when its last line was forwarded
+        os.makedirs(progress_dir(self.name), exist_ok=True)
+        self.stop_flag = False
+        self.last_task_finish_check_time = -1
+        self.get_health_info()
+
+        self.metrics = WorkerMetrics()
+        self.reporter = None
+        # warm interpreters for python tasks, started with the first python task unless python_pool_size > 0
+        self.python_pool = None
+        self.metrics_server = None
+        self.start_services()
+
+    def connect_redis(self):
         # each worker instance uses a separate connection pool
         self.redis_pool = create_redis_pool(
             self.config.redis_host,
@@ -122,13 +238,40 @@ class Worker:
             self.config.redis_pass
         )
         self.redis_inst = redis.Redis(connection_pool=self.redis_pool)
+        shards = [self.redis_inst]
+        for address in self.config.redis_shards:
+            host, port = parse_shard_address(address, self.config.redis_port)
+            shards.append(redis.Redis(connection_pool=create_redis_pool(
+                host, port, self.config.redis_db, self.config.redis_pass)))
+        self.shards = ShardedRedis(shards)
+
+    def sync_cluster_config(self):
+        self.config_subscriber = ConfigSubscriber(self.redis_inst, self.config)
+        self.config_subscriber.sync()
+        self.config_subscriber.start()
+
+    def start_services(self):
+        """
+        start the reporter, the python pool, the metrics endpoint and the monitoring threads,
+        and take over what this worker ran before a restart
 
-        self.in_prog_need_dram_gb = 0
-        self.in_progress_tasks = {}  # task -> (start_time, process)
-        self.stop_flag = False
-        self.last_task_finish_check_time = -1
-        self.get_health_info()
-        self.lock = Lock()
+        """
+
+        os.makedirs(self.config.result_dir, exist_ok=True)
+        # task runners send their results to the reporter instead of writing to redis themselves,
+        # the reporter journals them locally until redis has them, see journal
+        self.journal = ResultJournal(journal_path(self.name, self.config.result_journal_dir))
+        self.reporter = ResultReporter(self.name, self.shards, self.config, self.metrics,
+                                       node_mem_gb=self.total_mem_gb, journal=self.journal)
+        # the results of the tasks that finished before a restart, their tasks are not returned by reset_task
+        journaled_tasks = self.reporter.replay_journal()
+        self.reporter.start()
+        if self.config.python_pool_size > 0:
+            self.start_python_pool()
+        if self.config.metrics_port > 0:
+            self.metrics_server = MetricsServer(self.metrics.registry, self.config.metrics_port,
+                                                host=self.config.metrics_host, before_scrape=self.refresh_metrics)
+            self.metrics_server.start()
 
         self.health_report_thread = Thread(
             target=self.redis_health_report_thread_func, args=())
@@ -144,7 +287,7 @@ class Worker:
         self.timeout_monitor_thread.start()
 
         # fetch whatever this worker was running before (if it is restarted)
-        self.reset_task()
+        self.reset_task(keep=journaled_tasks)
         self.logging_worker_info("worker started")
 
     ########### health #############
@@ -164,16 +307,111 @@ class Worker:
             health_str = "{:.0f}:{:.2f}:{:.2f}:{:.2f}:{:.2f}".format(
                 time.time(), self.used_core, self.total_core, self.used_mem_gb,
                 self.total_mem_gb)
-            self.redis_inst.hset("worker_status", self.name, health_str)
+            with self.metrics.redis_rtt.time(op="heartbeat"):
+                pipeline = self.redis_inst.pipeline()
+                pipeline.hset("worker_status", self.name, health_str)
+                if self.config.locality_wait_sec > 0:
+                    pipeline.hset(REDIS_KEY_WORKER_WARM_INPUTS, self.name, json.dumps(self.warm_inputs.keys()))
+                pipeline.execute()
+            self.forward_task_progress()
+            self.renew_pool_leases()
             time.sleep(self.config.health_report_interval)
 
+    def forward_task_progress(self):
+        """
+        forward the last progress line of each running task whose progress file changed since the last
+        heartbeat, and remove the lines and files of the tasks that are no longer running
+
+        """
+
+        check_ts = time.time()
+        running = [t for e in self.tasks.entries()
+                   for t in (e.task.tasks if isinstance(e.task, TaskBatch) else [e.task])]
+
+        pipelines = {}
+
+        def pipeline_of(task):
+            shard = self.shards.of(task)
+            if id(shard) not in pipelines:
+                pipelines[id(shard)] = shard.pipeline(transaction=False)
+            return pipelines[id(shard)]
+
+        for task in running:
+            try:
+                path = progress_file(self.name, task.task_str)
+                mtime = os.stat(path).st_mtime
+                if self.forwarded_progress.get(task) == mtime:
+                    continue
+                line = read_last_line(path)
+            except OSError:
+                continue
+            self.forwarded_progress[task] = mtime
+            pipeline_of(task).hset(REDIS_KEY_TASK_PROGRESS, task.task_str, "{} {:.0f} {}".format(
+                self.name, mtime, line))
+
+        running_files = {progress_file(self.name, task.task_str) for task in running}
+        running_set = set(running)
+        for task in [t for t in self.forwarded_progress if t not in running_set]:
+            del self.forwarded_progress[task]
+            pipeline_of(task).hdel(REDIS_KEY_TASK_PROGRESS, task.task_str)
+        for name in os.listdir(progress_dir(self.name)):
+            path = os.path.join(progress_dir(self.name), name)
+            try:
+                # a task started after the snapshot of the running tasks writes a newer file
+                if path not in running_files and os.stat(path).st_mtime < check_ts:
+                    os.remove(path)
+            except OSError:
+                pass
+
+        for pipeline in pipelines.values():
+            with self.metrics.redis_rtt.time(op="progress"):
+                pipeline.execute()
+
+    def refresh_metrics(self):
+        """
+        refresh the gauges that are sampled rather than updated on events, called on each scrape
+
+        """
+
+        m = self.metrics
+        running = self.tasks.entries()
+        need_dram_gb = self.tasks.need_dram_gb
+
+        max_task = self.config.max_task_per_worker
+        m.running_tasks.set(len(running))
+        m.task_slots.set(max_task)
+        m.slot_utilization.set(len(running) / max_task if max_task > 0 else 0)
+        m.need_dram_gb.set(need_dram_gb)
+        m.mem_gb.set(self.used_mem_gb, kind="used")
+        m.mem_gb.set(self.total_mem_gb, kind="total")
+        m.cpu_cores.set(self.used_core, kind="used")
+        m.cpu_cores.set(self.total_core, kind="total")
+
+        task_rss = {}
+        for task, _, _, _, proc in running:
+            if proc is None:
+                continue
+            try:
+                parent = psutil.Process(proc.pid)
+                rss = parent.memory_info().rss
+                for child in parent.children(recursive=True):
+                    try:
+                        rss += child.memory_info().rss
+                    except psutil.NoSuchProcess:
+                        pass
+            except (psutil.NoSuchProcess, ValueError, TypeError):
+                continue
+            # not the task string, it is unbounded and may hold secrets on the command line
+            task_rss[(str(proc.pid), task_family(task, self.config.task_family_params))] = rss
+        m.task_rss_bytes.replace(task_rss)
+
     def logging_worker_info(self, msg):
         logging.info(
             "{}: in progress {} tasks, max {}, curr tasks need DRAM {} GB, used dram {:.2f}/{:.2f} GB, "
             "min dram to accept task {:.2f} GB, cpu core {:.2f}/{}"
             .format(msg,
-                    len(self.in_progress_tasks), self.config.max_task_per_worker,
-                    self.in_prog_need_dram_gb, self.used_mem_gb, self.total_mem_gb,
+                    len(self.tasks), self.config.max_task_per_worker,
+                    self.tasks.need_dram_gb, self.used_mem_gb, self.total_mem_gb,
                     self.config.min_dram_gb_accept_new_task,
                     self.used_core, self.total_core,
                     ))
@@ -187,13 +425,13 @@ class Worker:
         logging.info("monitoring starts")
         while not self.stop_flag:
             self.get_health_info()
-            if self.total_mem_gb - self.used_mem_gb < self.config.min_dram_gb_trigger_return:
+            if should_return_task(self.config, self.total_mem_gb, self.used_mem_gb):
                 self.return_most_recent_task()
             time.sleep(2)
             
     def timeout_monitor_thread_func(self):
         """
-        Periodically check task timeouts
+        stop the tasks when they time out, the thread sleeps until the next deadline of a running task
         """
         logging.info("timeout monitoring starts")
         while not self.stop_flag:
@@ -203,26 +441,17 @@ class Worker:
                     logging.info(f"Handled {timeout_count} timeout tasks")
             except Exception as e:
                 logging.error(f"Error in timeout monitor: {e}")
-            
-            # Use configured timeout check interval
-            time.sleep(self.config.task_timeout_check_interval)
+
+            # woken up early by a task with an earlier deadline, or when the worker stops
+            self.deadlines.wait(time.time(), self.config.task_timeout_check_interval)
 
     ########### new task #############
 
     def can_take_new_task(self):
-        can_accept = True
-        # check DRAM
-        min_dram = self.config.min_dram_gb_accept_new_task
-        if self.total_mem_gb - self.used_mem_gb < min_dram:
-            can_accept = False
-        if self.total_mem_gb - self.in_prog_need_dram_gb < min_dram:
-            can_accept = False
-
-        # check CPU
-        if len(self.in_progress_tasks) >= self.config.max_task_per_worker:
-            can_accept = False
-        if self.total_core - self.used_core < 2:
-            can_accept = False
+        # check DRAM and CPU
+        can_accept = can_accept_new_task(self.config, self.total_mem_gb, self.used_mem_gb,
+                                         self.tasks.need_dram_gb, len(self.tasks),
+                                         self.total_core, self.used_core)
 
         if not can_accept:
             self.logging_worker_info("cannot take new task")
@@ -230,207 +459,727 @@ class Worker:
         return can_accept
 
     def add_in_progress_task(self, task, proc):
-        self.lock.acquire()
-        self.in_progress_tasks[task] = (time.time(), proc)
-        self.in_prog_need_dram_gb += task.min_dram_gb
-        self.lock.release()
+        """
+        a claimed task started in proc, see task_state
+
+        """
+
+        if task not in self.tasks:
+            self.tasks.claim(task)
+        start_time = self.tasks.start(task, proc)
+        timeout_seconds = task_timeout_seconds(task, self.config)
+        if timeout_seconds > 0:
+            if isinstance(proc, TaskRunner) and task.task_type == "shell":
+                # the runner kills its shell task at the timeout and reports it, the worker is the backstop
+                timeout_seconds += self.config.task_kill_grace_sec + RUNNER_TIMEOUT_SLACK_SEC
+            self.deadlines.add(task, start_time + timeout_seconds)
 
     def check_task_timeouts(self):
         """Check and handle timeout tasks"""
-        current_time = time.time()
         timeout_tasks = []
-        
-        self.lock.acquire()
-        try:
-            for task, (start_time, proc) in self.in_progress_tasks.items():
-                # Determine timeout duration
-                timeout_seconds = task.timeout_seconds
-                if timeout_seconds is None:
-                    timeout_seconds = self.config.default_task_timeout_seconds
-                
-                if current_time - start_time > timeout_seconds:
-                    timeout_tasks.append((task, proc))
-                    logging.warning(f"Task {task.task_str} has exceeded timeout {timeout_seconds}s")
-        finally:
-            self.lock.release()
-            
+        for task in self.deadlines.pop_expired(time.time()):
+            entry = self.tasks.get(task)
+            # the task may have finished or be returned in the meantime
+            if entry is not None and self.tasks.transition(task, (TaskState.RUNNING, ), TaskState.FINISHING):
+                timeout_tasks.append(entry)
+                logging.warning(f"Task {task.task_str} has exceeded timeout "
+                                f"{task_timeout_seconds(task, self.config)}s")
+
         # Handle timeout tasks
-        for task, proc in timeout_tasks:
-            self._handle_timeout_task(task, proc)
-            
+        for entry in timeout_tasks:
+            self._handle_timeout_task(entry.task, entry.proc, entry.start_ts)
+
         return len(timeout_tasks)
-        
-    def _handle_timeout_task(self, task, proc):
-        """Handle timeout task"""
+
+    def _handle_timeout_task(self, task, proc, start_time):
+        """Handle timeout task, it is finishing"""
         try:
+            # Report task failure, before the kill so that the reporter keeps the results sent before it
+            self.reporter.interrupt(
+                task,
+                "failed",
+                f"Task timed out after {task_timeout_seconds(task, self.config)} seconds",
+                timing=task_timing_record(self.name, task, start_time, time.time(), None),
+                event=EVENT_TIMEOUT
+            )
+
             # Try to terminate process
             if proc.is_alive():
-                parent = psutil.Process(proc.pid)
-                for child in parent.children(recursive=True):
-                    try:
-                        child.kill()
-                    except psutil.NoSuchProcess:
-                        pass
-                try:
-                    parent.kill()
-                except psutil.NoSuchProcess:
-                    pass
-                    
-            # Remove from in-progress tasks
-            self.lock.acquire()
-            try:
-                if task in self.in_progress_tasks:
-                    del self.in_progress_tasks[task]
-                    self.in_prog_need_dram_gb -= task.min_dram_gb
-            finally:
-                self.lock.release()
-                
-            # Report task failure
-            report_task_failed(
-                self.name, 
-                self.redis_inst, 
-                task, 
-                f"Task timed out after {task.timeout_seconds or self.config.default_task_timeout_seconds} seconds", 
-                self.config.max_retry_per_task
-            )
-            
+                kill_process_tree(proc.pid, self.config.task_kill_grace_sec)
+
+            self.metrics.task_timeouts.inc()
+
             logging.info(f"Handled timeout task: {task.task_str}")
-            
+
         except Exception as e:
             logging.error(f"Error handling timeout task {task.task_str}: {e}")
+        finally:
+            self.end_task(task, TaskState.REPORTED)
+
+    def end_task(self, task, state):
+        """
+        the last step of ending a finishing task: forget its deadline, give back its pool tokens,
+        then release its DRAM and slot
+
+        :param state: TaskState.REPORTED or TaskState.RETURNED
+
+        """
+
+        self.deadlines.discard(task)
+        self.release_task_pools(task)
+        self.tasks.transition(task, (TaskState.FINISHING, ), state)
 
     ########### task and redis #############
-    def return_task(self, task_str):
+    def return_task(self, task_str, redis_inst):
         """
         return task to todo queue
 
+        :param redis_inst: the shard of the task
+
         """
 
-        worker = self.redis_inst.hget(REDIS_KEY_IN_PROGRESS_TASKS, task_str)
+        worker = redis_inst.hget(REDIS_KEY_IN_PROGRESS_TASKS, task_str)
         assert worker == self.name, "report task finish, but task is not assigned to worker"
-        self.redis_inst.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task_str)
-        self.redis_inst.hset(REDIS_KEY_TODO_TASKS, task_str, "")
+        pipeline = redis_inst.pipeline()
+        pipeline.hdel(REDIS_KEY_IN_PROGRESS_TASKS, task_str)
+        requeue_tasks(pipeline, [task_str])
+        append_event(pipeline, EVENT_RETURN, task_str, self.name)
+        pipeline.execute()
         self.logging_worker_info("return task")
 
-    def reset_task(self):
+    def reset_task(self, keep=()):
         """
         reset any previous task
 
-        """
+        :param keep: the task strs whose results are in the journal, the reporter reports them
 
-        to_return_task = []
-        for task, worker in self.redis_inst.hscan_iter(REDIS_KEY_IN_PROGRESS_TASKS):
-            if self.name == worker:
-                to_return_task.append(task)
-        for task in to_return_task:
-            self.return_task(task)
+        """
 
+        # the tokens of the tasks that ran before the restart
+        release_worker_leases(self.redis_inst, [self.name])
+        for shard in self.shards:
+            to_return_task = []
+            for task, worker in shard.hscan_iter(REDIS_KEY_IN_PROGRESS_TASKS):
+                if self.name == worker and task not in keep:
+                    to_return_task.append(task)
+            for task in to_return_task:
+                self.return_task(task, shard)
+            # the backup copies this worker ran are gone, the original copies keep running
+            backups = [task for task, worker in shard.hscan_iter(REDIS_KEY_SPECULATIVE_TASKS) if worker == self.name]
+            if len(backups) > 0:
+                shard.hdel(REDIS_KEY_SPECULATIVE_TASKS, *backups)
+
+
+    def max_tasks_per_claim(self):
+        policy = self.admission_policy or self.config.admission_policy
+        if policy == "binpack":
+            return self.config.max_tasks_per_claim
+        return 1
 
     def get_task_from_redis(self):
         """
-        fetch a new task from redis using pipeline for better performance
+        fetch a new task from redis, EMPTY_TASK if there is no task this worker can work on
 
         """
 
+        tasks = self.get_tasks_from_redis(1)
+        if tasks is END_OF_TASK:
+            return END_OF_TASK
+        if len(tasks) == 0:
+            return EMPTY_TASK
+        return tasks[0]
+
+    def get_tasks_from_redis(self, max_tasks):
+        """
+        fetch new tasks from the home shard of the worker, steal from the other shards if it has none
+
+        :param max_tasks: 1 claims the best task, more claims a set of tasks chosen by select_task_batch
+        :return: a list of claimed tasks or END_OF_TASK
+
+        """
+
+        for shard in self.shards.claim_order(self.name):
+            tasks = self.get_tasks_from_shard(shard, max_tasks)
+            if tasks is END_OF_TASK or len(tasks) > 0:
+                return tasks
+        if self.config.speculation_min_runtime_sec > 0:
+            return self.claim_backup_task()
+        return []
+
+    def get_tasks_from_shard(self, shard, max_tasks):
+        """
+        fetch new tasks from one redis shard using pipeline for better performance
+
+        """
+
+        claim_start = time.time()
+        self.promote_retries(shard)
+        self.dram_estimator.refresh(self.shards)
+        redis_inst = self.shards[shard]
+        for _ in range(FAIR_SHARE_CLAIM_ROUNDS):
+            candidates = self.fair_share_candidates(shard)
+            if candidates is END_OF_TASK:
+                return END_OF_TASK
+            if len(candidates) == 0:
+                break
+            claimed, n_conflicts = self.claim_candidates(redis_inst, candidates, max_tasks, claim_start,
+                                                         fair_share=True)
+            if len(claimed) > 0:
+                return claimed
+            if n_conflicts == 0:
+                # none of them can be taken now, e.g., their pools are exhausted
+                break
+            # the candidates were taken by others in the meantime, pick the new heads
+
         # Use pipeline to batch Redis operations
-        pipeline = self.redis_inst.pipeline()
+        pipeline = redis_inst.pipeline()
         pipeline.hlen(REDIS_KEY_TODO_TASKS)
         pipeline.hgetall(REDIS_KEY_TODO_TASKS)
         pipeline.hgetall(REDIS_KEY_FAILED_TASKS)
+        pipeline.hgetall(REDIS_KEY_TASK_MIN_NODE_MEM)
         
         # Execute all operations in a single network call
-        n_todo, todo, failed_tasks = pipeline.execute()
+        with self.metrics.redis_rtt.time(op="claim_scan"):
+            n_todo, todo, failed_tasks, min_node_mem = pipeline.execute()
 
-        if n_todo > 1000:
+        if n_todo > TODO_SAMPLE_THRESHOLD:
             # For large task queues, use random sampling
-            kv_list = self.redis_inst.hrandfield(REDIS_KEY_TODO_TASKS, 20, withvalues=True)
+            with self.metrics.redis_rtt.time(op="claim_sample"):
+                kv_list = redis_inst.hrandfield(REDIS_KEY_TODO_TASKS, TODO_SAMPLE_SIZE,
+                                                     withvalues=True)
             todo = {}
             for i in range(len(kv_list) // 2):
                 todo[kv_list[i*2]] = kv_list[i*2+1]
+            if self.config.locality_wait_sec > 0:
+                # the sample rarely contains the tasks of the warm inputs
+                with self.metrics.redis_rtt.time(op="claim_sample"):
+                    todo.update(sample_local_tasks(redis_inst, self.warm_inputs.keys()))
 
         if WORKER_STOP_COMMAND in todo:
             return END_OF_TASK
 
         task_can_work_on = []
         for task_str, _ in todo.items():
-            if self.name in failed_tasks.get(task_str, ""):
+            if self.name in failed_workers(failed_tasks.get(task_str)):
                 # do not retry failed tasks
                 continue
-            task = Task(task_str)
-            if task.min_dram_gb > self.total_mem_gb - self.used_mem_gb:
+            if not fits_node_mem(task_str, min_node_mem, self.total_mem_gb):
+                # it ran out of memory on a node like this one
                 continue
-            if task.min_dram_gb > self.total_mem_gb - self.in_prog_need_dram_gb:
+            task = self.dram_estimator.apply(Task(task_str))
+            if not task_fits(task, self.total_mem_gb, self.used_mem_gb, self.tasks.need_dram_gb):
                 continue
+            task.shard = shard
 
             task_can_work_on.append(task)
+        exhausted = self.load_pools(redis_inst, task_can_work_on)
+        if len(exhausted) > 0:
+            task_can_work_on = [t for t in task_can_work_on if not has_exhausted_pool(t, exhausted)]
 
         logging.debug(
             "current task dram {}, task can work on {}, in_progress_tasks {}".
-            format(self.in_prog_need_dram_gb, task_can_work_on,
-                   self.in_progress_tasks))
+            format(self.tasks.need_dram_gb, task_can_work_on,
+                   [e.task for e in self.tasks.entries()]))
+        claimed, _ = self.claim_candidates(redis_inst, task_can_work_on, max_tasks, claim_start)
+        return claimed
+
+    def claim_candidates(self, redis_inst, tasks, max_tasks, claim_start, fair_share=False):
+        """
+        rank the candidates, then claim the best task, a micro-batch or a set of tasks that fits the
+        remaining DRAM, cores and slots (select_task_batch)
 
-        # pick high priority task first
-        task_can_work_on.sort(key=lambda x: x.priority, reverse=True)
+        :param redis_inst: the shard of the candidates
+        :param fair_share: the candidates are in fair-share order (see fair_share_candidates),
+            which already ranks them within each owner
+        :return: the claimed tasks, the number of tasks another worker claimed first
 
-        for task in task_can_work_on:
-            r = self.redis_inst.hdel(REDIS_KEY_TODO_TASKS, task.task_str)
+        """
+
+        micro_batching = self.config.micro_batch_max_tasks > 1
+        if self.config.scheduling_policy != "priority" or micro_batching:
+            self.runtime_predictor.refresh(self.shards)
+        if not fair_share:
+            tasks = rank_candidates(tasks, self.config.scheduling_policy, self.runtime_predictor)
+        if self.config.locality_wait_sec > 0:
+            tasks = self.order_by_locality(redis_inst, tasks)
+
+        batch = []
+        if micro_batching and len(tasks) > 0 and tasks[0].task_type != "python":
+            # python tasks are cheap to start on the warm pool already
+            batch = select_micro_batch(tasks, self.runtime_predictor,
+                                       self.config.micro_batch_max_tasks,
+                                       self.config.micro_batch_short_task_sec,
+                                       self.config.micro_batch_target_sec)
+        if len(batch) > 1:
+            claimed, n_conflicts = self.claim_task_batch(batch, claim_start)
+            if len(claimed) > 1:
+                claimed = [TaskBatch(claimed, self.config.default_task_timeout_seconds)]
+        elif max_tasks > 1:
+            claimed, n_conflicts = self.claim_task_batch(select_task_batch(
+                self.config, tasks, self.total_mem_gb, self.used_mem_gb,
+                self.tasks.need_dram_gb, len(self.tasks), self.total_core, self.used_core,
+                max_tasks, keep_order=fair_share), claim_start)
+        else:
+            claimed, n_conflicts = self.claim_best_task(tasks, claim_start)
+
+        if self.config.locality_wait_sec > 0:
+            for task in claimed:
+                if any(self.warm_inputs.is_warm(key) for key in task.inputs):
+                    # delay scheduling restarts the wait after a local task
+                    self.locality_wait_start = None
+                self.warm_inputs.touch(task.inputs)
+        return claimed, n_conflicts
+
+    def fair_share_candidates(self, shard):
+        """
+        the head tasks of the owner queues this worker can run, in weighted fair-share order (see fairshare),
+        the tasks of an owner are ranked by scheduling_policy, or kept in queue order (priority with aging),
+        [] if the shard has no owner queue or none of the head tasks fits, then todo_tasks is scanned
+
+        whether the tasks fit together is decided by claim_candidates, like for the scanned tasks
+
+        """
+
+        redis_inst = self.shards[shard]
+        weights = self.get_owner_weights()
+        with self.metrics.redis_rtt.time(op="claim_fair_share"):
+            pipeline = redis_inst.pipeline(transaction=False)
+            pipeline.zrange(REDIS_KEY_OWNER_PASS, 0, -1, withscores=True)
+            pipeline.hexists(REDIS_KEY_TODO_TASKS, WORKER_STOP_COMMAND)
+            pipeline.hgetall(REDIS_KEY_TASK_MIN_NODE_MEM)
+            passes, stop, min_node_mem = pipeline.execute()
+            if stop:
+                return END_OF_TASK
+            heads = queue_heads(redis_inst, passes, self.config.fair_share_head)
+        if len(heads) == 0:
+            return []
+
+        tasks = {t: self.dram_estimator.apply(Task(t))
+                 for _, head in heads.values() for t in head if Task.is_task_str_valid(t)}
+        exhausted = self.load_pools(redis_inst, list(tasks.values()))
+
+        def fits(task_str):
+            task = tasks.get(task_str)
+            if task is None or task_str in self.failed_queued_tasks or has_exhausted_pool(task, exhausted) or \
+                    not fits_node_mem(task_str, min_node_mem, self.total_mem_gb):
+                return False
+            return task_fits(task, self.total_mem_gb, self.used_mem_gb, self.tasks.need_dram_gb)
+
+        if self.config.scheduling_policy != "priority":
+            self.runtime_predictor.refresh(self.shards)
+            heads = {owner: (p, [t.task_str for t in rank_candidates(
+                [tasks[t] for t in head if t in tasks], self.config.scheduling_policy, self.runtime_predictor)])
+                for owner, (p, head) in heads.items()}
+        candidates = []
+        for owner, task_str, _ in select_fair_share(heads, weights, fits, len(tasks)):
+            task = tasks[task_str]
+            task.shard, task.owner = shard, owner
+            candidates.append(task)
+        return candidates
+
+    def claim_owned_tasks(self, redis_inst, tasks):
+        """
+        claim tasks of the owner queues in one round trip, the pass of an owner grows by 1 / its weight
+        per claimed task
+
+        :return: the results of fairshare.CLAIM_SCRIPT in the order of tasks
+
+        """
+
+        weights = self.get_owner_weights()
+        picked = [(task.owner, task.task_str, 1 / owner_weight(weights, task.owner)) for task in tasks]
+        with self.metrics.redis_rtt.time(op="claim"):
+            results = claim_tasks(redis_inst, self.name, picked, time.time())
+        for task, r in zip(tasks, results):
+            if r == 0:
+                self.metrics.claim_conflicts.inc()
+            elif r == -1:
+                # it failed on this worker before, left to the others
+                self.failed_queued_tasks.add(task.task_str)
+        return results
+
+    def promote_retries(self, shard):
+        """
+        move the delayed retries that are due back to todo, see retry
+
+        """
+
+        now = time.time()
+        if now - self.last_promote.get(shard, 0) < PROMOTE_INTERVAL_SEC:
+            return
+        self.last_promote[shard] = now
+        with self.metrics.redis_rtt.time(op="claim_promote"):
+            n = promote_due_retries(self.shards[shard], now)
+        if n > 0:
+            logging.info("{} delayed retries are due".format(n))
+
+    def get_pool_capacities(self):
+        if time.time() - self.pool_capacities_ts > POOL_CAPACITY_REFRESH_SEC:
+            self.pool_capacities = pool_capacities(self.redis_inst)
+            self.pool_capacities_ts = time.time()
+        return self.pool_capacities
+
+    def get_owner_weights(self):
+        if time.time() - self.owner_weights_ts > OWNER_WEIGHTS_REFRESH_SEC:
+            self.owner_weights = self.redis_inst.hgetall(REDIS_KEY_OWNER_WEIGHTS)
+            self.owner_weights_ts = time.time()
+        return self.owner_weights
+
+    def order_by_locality(self, redis_inst, tasks):
+        """
+        put the tasks with warm inputs first and leave the tasks warm on other workers to them,
+        for at most locality_wait_sec
+
+        :param redis_inst: the shard of the tasks
+
+        """
+
+        if len(tasks) == 0:
+            return tasks
+        with self.metrics.redis_rtt.time(op="claim_locality"):
+            if redis_inst is self.redis_inst:
+                pipeline = self.redis_inst.pipeline()
+                pipeline.hmget(REDIS_KEY_TASK_META, [t.task_str for t in tasks])
+                pipeline.hgetall(REDIS_KEY_WORKER_WARM_INPUTS)
+                meta, warm_inputs = pipeline.execute()
+            else:
+                meta = redis_inst.hmget(REDIS_KEY_TASK_META, [t.task_str for t in tasks])
+                warm_inputs = self.redis_inst.hgetall(REDIS_KEY_WORKER_WARM_INPUTS)
+
+        inputs_of = {}
+        for task, ann in zip(tasks, meta):
+            if ann is not None:
+                task.inputs = task_inputs(json.loads(ann))
+                inputs_of[task.task_str] = task.inputs
+
+        now = time.time()
+        allow_remote = self.locality_wait_start is not None and \
+            now - self.locality_wait_start >= self.config.locality_wait_sec
+        ordered, n_remote = order_by_locality(tasks, inputs_of, self.warm_inputs.is_warm,
+                                              remote_warm_inputs(warm_inputs, self.name), allow_remote)
+        if n_remote == 0:
+            self.locality_wait_start = None
+        elif self.locality_wait_start is None:
+            self.locality_wait_start = now
+        return ordered
+
+    def claim_best_task(self, tasks, claim_start):
+        """
+        claim the first task in the list that is not taken by another worker in the meantime
+
+        :return: [the task] or [], the number of tasks another worker claimed first
+
+        """
+
+        n_conflicts = 0
+        for task in tasks:
+            if not self.acquire_task_pools(task):
+                continue
+            redis_inst = self.shards.of(task)
+            if task.owner is not None:
+                r = self.claim_owned_tasks(redis_inst, [task])[0]
+                if r != 1:
+                    n_conflicts += r == 0
+                    self.release_task_pools(task)
+                    continue
+                task.claim_ts = time.time()
+                task.claim_sec = task.claim_ts - claim_start
+                return [task], n_conflicts
+            with self.metrics.redis_rtt.time(op="claim"):
+                r = redis_inst.hdel(REDIS_KEY_TODO_TASKS, task.task_str)
             if r != 1:
+                self.metrics.claim_conflicts.inc()
+                n_conflicts += 1
+                self.release_task_pools(task)
                 continue
-            r = self.redis_inst.hset(
-                REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, self.name)
+            with self.metrics.redis_rtt.time(op="claim"):
+                pipeline = redis_inst.pipeline()
+                pipeline.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, self.name)
+                pipeline.hset(REDIS_KEY_IN_PROGRESS_SINCE, task.task_str, time.time())
+                append_event(pipeline, EVENT_CLAIM, task.task_str, self.name)
+                r, _, _ = pipeline.execute()
             assert r == 1, "task set in_progress error, task {}".format(task.task_str)
-            return task
+            task.claim_ts = time.time()
+            task.claim_sec = task.claim_ts - claim_start
+            return [task], n_conflicts
+
+        return [], n_conflicts
+
+    def claim_task_batch(self, tasks, claim_start):
+        """
+        claim the tasks in two round trips, the ones taken by other workers in the meantime are skipped,
+        the tasks are from the same shard
+
+        :return: the claimed tasks, the number of tasks another worker claimed first
 
-        return EMPTY_TASK
+        """
+
+        tasks = [task for task in tasks if self.acquire_task_pools(task)]
+        if len(tasks) == 0:
+            return [], 0
+        redis_inst = self.shards.of(tasks[0])
+        # the tasks of the owner queues are claimed by a script, it also moves the pass of the owner
+        owned = [task for task in tasks if task.owner is not None]
+        tasks = [task for task in tasks if task.owner is None]
+        results = self.claim_owned_tasks(redis_inst, owned) if len(owned) > 0 else []
+        if len(tasks) > 0:
+            with self.metrics.redis_rtt.time(op="claim"):
+                pipeline = redis_inst.pipeline()
+                for task in tasks:
+                    pipeline.hdel(REDIS_KEY_TODO_TASKS, task.task_str)
+                results += pipeline.execute()
+        won = []
+        n_conflicts = 0
+        for task, r in zip(owned + tasks, results):
+            if r == 1:
+                won.append(task)
+            else:
+                if task.owner is None:
+                    self.metrics.claim_conflicts.inc()
+                # -1: an owned task failed on this worker before, it is no conflict
+                n_conflicts += task.owner is None or r == 0
+                self.release_task_pools(task)
+        unowned = [task for task in won if task.owner is None]
+        if len(unowned) > 0:
+            with self.metrics.redis_rtt.time(op="claim"):
+                pipeline = redis_inst.pipeline()
+                for task in unowned:
+                    pipeline.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, self.name)
+                    pipeline.hset(REDIS_KEY_IN_PROGRESS_SINCE, task.task_str, time.time())
+                    append_event(pipeline, EVENT_CLAIM, task.task_str, self.name)
+                pipeline.execute()
+        claim_ts = time.time()
+        for task in won:
+            task.claim_ts = claim_ts
+            task.claim_sec = claim_ts - claim_start
+        return won, n_conflicts
+
+    ########### speculative execution #############
+    def claim_backup_task(self):
+        """
+        once the todo queue of every shard is drained, run a backup copy of the longest running straggler
+        of another worker, the first copy that finishes commits the result (see REPORT_FINISH_SCRIPT) and
+        the worker of the other copy cancels it (see cancel_finished_copies)
+
+        :return: a list with the claimed backup task, or an empty list
+
+        """
+
+        claim_start = time.time()
+        running = []
+        for shard, redis_inst in enumerate(self.shards):
+            with self.metrics.redis_rtt.time(op="claim_scan"):
+                pipeline = redis_inst.pipeline()
+                pipeline.hlen(REDIS_KEY_TODO_TASKS)
+                pipeline.zcard(REDIS_KEY_RETRY_BACKOFF)
+                pipeline.hgetall(REDIS_KEY_IN_PROGRESS_TASKS)
+                pipeline.hgetall(REDIS_KEY_SPECULATIVE_TASKS)
+                pipeline.hgetall(REDIS_KEY_FAILED_TASKS)
+                n_todo, n_backoff, in_progress, speculative, failed_tasks = pipeline.execute()
+            if n_todo > 0 or n_backoff > 0:
+                # the tail has not started yet, or the stop command is queued
+                return []
+            task_strs = [t for t, worker in in_progress.items()
+                         if worker != self.name and t not in speculative and
+                         self.name not in failed_workers(failed_tasks.get(t))]
+            if len(task_strs) == 0:
+                continue
+            candidates = []
+            for task_str, since in zip(task_strs, redis_inst.hmget(REDIS_KEY_IN_PROGRESS_SINCE, task_strs)):
+                task = self.dram_estimator.apply(Task(task_str))
+                if since is None or task.task_type is None or \
+                        not task_fits(task, self.total_mem_gb, self.used_mem_gb, self.tasks.need_dram_gb):
+                    continue
+                task.shard = shard
+                candidates.append((task, float(since)))
+            # a backup copy takes its own tokens
+            exhausted = self.load_pools(redis_inst, [task for task, _ in candidates])
+            running.extend((task, since) for task, since in candidates if not has_exhausted_pool(task, exhausted))
+        if len(running) == 0:
+            return []
+
+        self.runtime_predictor.refresh(self.shards)
+        stragglers = select_stragglers(running, time.time(), self.runtime_predictor,
+                                       self.config.speculation_min_runtime_sec, self.config.speculation_slowdown)
+        for task in stragglers:
+            if not self.acquire_task_pools(task):
+                continue
+            redis_inst = self.shards.of(task)
+            with self.metrics.redis_rtt.time(op="claim"):
+                script = redis_inst.register_script(CLAIM_BACKUP_SCRIPT)
+                r = script(keys=[REDIS_KEY_IN_PROGRESS_TASKS, REDIS_KEY_SPECULATIVE_TASKS, REDIS_KEY_TASK_EVENTS],
+                           args=[task.task_str, self.name, EVENT_SPECULATE, EVENT_STREAM_MAXLEN])
+            if r != 1:
+                self.release_task_pools(task)
+                continue
+            task.claim_ts = time.time()
+            task.claim_sec = task.claim_ts - claim_start
+            self.logging_worker_info("run a backup copy of task {}".format(task.task_str))
+            return [task]
+        return []
+
+    def cancel_finished_copies(self):
+        """
+        kill the running tasks that another copy already finished
+
+        """
+
+        running = [(e.task, e.proc) for e in self.tasks.entries(TaskState.RUNNING)
+                   if not isinstance(e.task, TaskBatch)]
+        if len(running) == 0:
+            return
+
+        by_shard = {}
+        for task, proc in running:
+            redis_inst = self.shards.of(task)
+            by_shard.setdefault(id(redis_inst), (redis_inst, []))[1].append((task, proc))
+        for redis_inst, shard_running in by_shard.values():
+            finished = redis_inst.hmget(REDIS_KEY_FINISHED_TASKS, [task.task_str for task, _ in shard_running])
+            for (task, proc), result in zip(shard_running, finished):
+                if result is None or not proc.is_alive() or \
+                        not self.tasks.transition(task, (TaskState.RUNNING, ), TaskState.FINISHING):
+                    continue
+                logging.info("cancel task {}, another copy finished it".format(task.task_str))
+                try:
+                    self.reporter.interrupt(task, "cancelled", "")
+                    kill_process_tree(proc.pid)
+                    self.metrics.tasks_completed.inc(status="failed")
+                finally:
+                    self.end_task(task, TaskState.REPORTED)
+
+    ########### resource pools #############
+    def load_pools(self, redis_inst, tasks):
+        """
+        set the pools of the candidate tasks if resource pools are configured, see pools
+
+        :param redis_inst: the shard of the tasks
+        :return: the pools with no free token
+
+        """
+
+        capacities = self.get_pool_capacities()
+        if len(capacities) == 0 or len(tasks) == 0:
+            return set()
+        with self.metrics.redis_rtt.time(op="claim_pools"):
+            load_task_pools(redis_inst, tasks)
+            return exhausted_pools(self.redis_inst, capacities, time.time())
+
+    def acquire_task_pools(self, task):
+        """
+        take the tokens of a task before it is claimed
+
+        :return: False if one of its pools has no free token
+
+        """
+
+        if len(task.pools) == 0:
+            return True
+        with self.metrics.redis_rtt.time(op="claim_pools"):
+            pool = acquire_pools(self.redis_inst, self.name, task.task_str, task.pools, time.time(),
+                                 self.config.resource_lease_sec)
+        if pool is not None:
+            logging.info("pool {} has no free token, skip task {}".format(pool, task.task_str))
+            return False
+        return True
+
+    def release_task_pools(self, task):
+        """
+        give back the tokens of a task, or of the tasks of a batch, the leases expire if this fails
+
+        """
+
+        held = [t for t in (task.tasks if isinstance(task, TaskBatch) else [task]) if len(t.pools) > 0]
+        if len(held) == 0:
+            return
+        try:
+            release_pools(self.redis_inst, self.name, held)
+        except Exception as e:
+            logging.error("release the pool tokens of {} error {}".format(task, e))
+
+    def renew_pool_leases(self):
+        held = [t for e in self.tasks.entries()
+                for t in (e.task.tasks if isinstance(e.task, TaskBatch) else [e.task]) if len(t.pools) > 0]
+        if len(held) > 0:
+            with self.metrics.redis_rtt.time(op="lease_renew"):
+                renew_leases(self.redis_inst, self.name, held, time.time(), self.config.resource_lease_sec)
+
+    ########### python tasks #############
+    def start_python_pool(self):
+        self.python_pool = PythonPool(self.report_python_task,
+                                      size=self.config.python_pool_size,
+                                      preload_modules=self.config.python_preload_modules,
+                                      max_tasks=self.config.python_pool_max_tasks,
+                                      max_rss_growth_mb=self.config.python_pool_max_rss_growth_mb)
+        self.python_pool.start()
+
+    def run_python_task(self, task):
+        """
+        :return: a PooledTask tracked like a TaskRunner
+
+        """
+
+        if self.python_pool is None:
+            self.start_python_pool()
+        return self.python_pool.submit(task, env={PROGRESS_FILE_ENV: progress_file(self.name, task.task_str)})
+
+    def report_python_task(self, task, result):
+        exitcode = result["exit_code"]
+        # the pool process ran other tasks before
+        timing = task_timing_record(self.name, task, result["start_ts"], result["finish_ts"], exitcode,
+                                    SimpleNamespace(**result["usage"]), peak_shared=True)
+        status, msg = task_result(exitcode, result["stdout"], result["stderr"])
+        self.reporter.submit(task, status, msg, timing)
+        if status == "finished":
+            logging.info("finish task {}".format(task))
+        else:
+            logging.warning("cannot finish task {}\n{}".format(task, result["stderr"]))
 
     ########### util #############
     def return_most_recent_task(self):
         """
         if the node is going to OOM, then kill the most recent process and return it to manager
         """
+        running = self.tasks.entries(TaskState.RUNNING)
+        if len(running) == 0:
+            logging.error("return most recent task error dram usage {:.2f}/{:.2f} no task to return".format(
+                self.used_mem_gb, self.total_mem_gb))
+            self.logging_worker_info("return most recent task failed")
+            return
+
+        # the most recent task
+        task, _, _, start_time, proc = max(running, key=lambda e: e.start_ts)
+        if not proc.is_alive():
+            self.logging_worker_info(
+                "return most recent task but process is not alive")
+            return
+        if not self.tasks.transition(task, (TaskState.RUNNING, ), TaskState.FINISHING):
+            # it timed out or finished in the meantime
+            return
+
+        last_task = len(running) == 1
         try:
-            self.lock.acquire()
-            if len(self.in_progress_tasks) == 0:
-                raise RuntimeError(
-                    "dram usage {:.2f}/{:.2f} no task to return".format(
-                        self.used_mem_gb, self.total_mem_gb))
-
-            # the most recent task
-            task, (start_time, proc) = sorted(self.in_progress_tasks.items(),
-                                              key=lambda x: -x[1][0])[0]
+            # tell the reporter before the kill, see ResultReporter.interrupt
+            if last_task:
+                logging.warning("one task to return")
+                self.reporter.interrupt(
+                    task, "failed", f"require too much dram (worker {self.name})",
+                    timing=task_timing_record(self.name, task, start_time, time.time(), None),
+                    failure_class="oom")
+            else:
+                self.reporter.interrupt(task, "returned", "", event=EVENT_RETURN)
 
-            if proc.is_alive():
-                parent = psutil.Process(proc.pid)
-                for child in parent.children(recursive=True):
-                    child.kill()
-                parent.kill()
-
-                # os.killpg(proc.pid, signal.SIGTERM)
-                # proc.terminate()
-                # proc.close()
-
-                self.in_prog_need_dram_gb -= task.min_dram_gb
-
-                if len(self.in_progress_tasks) == 1:
-                    logging.warning("one task to return")
-                    report_task_failed(self.name, self.redis_inst,
-                        task, f"require too much dram (worker {self.name})", 
-                        self.config.max_retry_per_task)
-                else:
-                    self.return_task(task.task_str)
-                logging.info("return task \"{}\" run time {:.2f}".format(
-                    task,
-                    time.time() - start_time))
-                del self.in_progress_tasks[task]
+            # no grace period, the node is about to run out of memory
+            kill_process_tree(proc.pid)
+            self.metrics.tasks_returned_oom.inc()
 
-            else:
-                self.logging_worker_info(
-                    "return most recent task but process is not alive")
+            logging.info("return task \"{}\" run time {:.2f}".format(
+                task,
+                time.time() - start_time))
         except Exception as e:
             logging.error("return most recent task error {}".format(e))
             self.logging_worker_info("return most recent task failed")
         finally:
-            self.lock.release()
+            self.end_task(task, TaskState.REPORTED if last_task else TaskState.RETURNED)
 
     def find_finished_task(self):
         """
@@ -438,24 +1187,27 @@ class Worker:
 
         """
 
-        finished_tasks = {}
-        self.lock.acquire()
-        try:
-            for task, (start_time, proc) in self.in_progress_tasks.items():
-                if proc.is_alive():
-                    continue
+        if self.config.speculation_min_runtime_sec > 0:
+            try:
+                self.cancel_finished_copies()
+            except Exception as e:
+                logging.error("cancel finished copies error {}".format(e))
 
+        finished_tasks = {}
+        for task, _, _, _, proc in self.tasks.entries(TaskState.RUNNING):
+            if proc.is_alive() or not self.tasks.transition(task, (TaskState.RUNNING, ), TaskState.FINISHING):
+                continue
+            try:
                 proc.join()
                 finished_tasks[task] = proc.exitcode
-                self.in_prog_need_dram_gb -= task.min_dram_gb
-
-            for task in finished_tasks.keys():
-                del self.in_progress_tasks[task]
-
-        except Exception as e:
-            logging.error("check finished task error {}".format(e))
-        finally:
-            self.lock.release()
+                self.metrics.tasks_completed.inc(
+                    len(task) if isinstance(task, TaskBatch) else 1,
+                    status="success" if proc.exitcode == 0 else "failed")
+            except Exception as e:
+                logging.error("check finished task error {}".format(e))
+            finally:
+                # the reporter has the result, it came through the pipe of the runner
+                self.end_task(task, TaskState.REPORTED)
 
         # if self.last_task_finish_check_time + 60 < time.time():
             # self.last_task_finish_check_time = time.time()
@@ -475,7 +1227,7 @@ class Worker:
             timeout = 86400 * 30
 
         while len(finished_tasks) == 0:
-            if len(self.in_progress_tasks) == 0 or timeout <= 0:
+            if len(self.tasks) == 0 or timeout <= 0:
                 return finished_tasks
 
             finished_tasks = self.find_finished_task()
@@ -488,118 +1240,171 @@ class Worker:
 #################################### main  #####################################
 
     def start(self):
-        task = EMPTY_TASK
-        while task != END_OF_TASK:
-            task = self.get_task_from_redis()
-            self.logging_worker_info(f"get task {task}")
-
-            if task != EMPTY_TASK:
-                p = TaskRunner(self.name, self.redis_inst, task,
-                               self.config.max_retry_per_task)
-                p.start()
-                # if task in self.in_progress_tasks:
-                #     # clean up
-                #     self.wait_for_task_completion(timeout=2)
+        while True:
+            claim_start = time.perf_counter()
+            tasks = self.get_tasks_from_redis(self.max_tasks_per_claim())
+            self.metrics.claim_latency.observe(
+                time.perf_counter() - claim_start,
+                result="stop" if tasks is END_OF_TASK else "task" if len(tasks) > 0 else "empty")
+            if tasks is END_OF_TASK:
+                self.logging_worker_info(f"get task {END_OF_TASK}")
+                break
+            self.logging_worker_info(f"get task {tasks if len(tasks) > 0 else EMPTY_TASK}")
+
+            for task in tasks:
+                self.metrics.tasks_claimed.inc(len(task) if isinstance(task, TaskBatch) else 1)
+                self.tasks.claim(task)
+                if task.task_type == "python":
+                    with self.metrics.spawn_latency.time():
+                        p = self.run_python_task(task)
+                    self.add_in_progress_task(task, p)
+                    continue
+                result_conn, runner_conn = Pipe(duplex=False)
+                p = TaskRunner(self.name, runner_conn, task, self.config.snapshot())
+                with self.metrics.spawn_latency.time():
+                    p.start()
+                # only the runner writes to the pipe, so the worker sees EOF if it dies without a result
+                runner_conn.close()
+                self.reporter.watch(task, result_conn)
                 self.add_in_progress_task(task, p)
 
             while not self.can_take_new_task():
                 time.sleep(8)
                 self.find_finished_task()
-                # Check timeout tasks
-                self.check_task_timeouts()
 
             time.sleep(self.config.sleep_sec_between_accepting_task)
             self.find_finished_task()
-            # Periodically check timeout tasks
-            self.check_task_timeouts()
 
         # redis has no task, wait for all tasks to finish
-        while len(self.in_progress_tasks) > 0:
+        while len(self.tasks) > 0:
             self.wait_for_task_completion()
 
         self.logging_worker_info("all tasks are finished")
+        if self.python_pool is not None:
+            self.python_pool.close()
+        self.reporter.stop()
+        self.config_subscriber.stop()
         self.stop_flag = True
+        self.deadlines.close()
         self.health_report_thread.join()
         self.health_monitor_thread.join()
         self.timeout_monitor_thread.join()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
 
 #################################### Task runner #####################################
 class TaskRunner(Process):
-    def __init__(self, worker_name, redis_inst, task, max_retry_per_task):
+    def __init__(self, worker_name, result_conn, task, config):
+        """
+
+        :param result_conn: the sending end of a pipe, the result is sent to the ResultReporter of the worker
+        :param task: a Task, or a TaskBatch whose tasks are run one after another with one result each
+        :param config: the ConfigSnapshot of the worker when the task is started
+
+        """
+
         super(TaskRunner, self).__init__()
         self.worker_name = worker_name
-        self.redis_inst = redis_inst
+        self.result_conn = result_conn
         self.task = task
-        self.max_retry_per_task = max_retry_per_task
-        self.config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+        self.config = config
 
     def run(self):
+        tasks = self.task.tasks if isinstance(self.task, TaskBatch) else [self.task]
+        exitcode = 0
+        for i, task in enumerate(tasks):
+            task_exitcode = self.run_task(task, peak_shared=i > 0)
+            if task_exitcode != 0:
+                exitcode = task_exitcode
+        self.result_conn.close()
+        sys.exit(exitcode)
+
+    def run_task(self, task, peak_shared=False):
         o_stdout, o_stderr, exitcode = "", "", -1
         timeout_occurred = False
-        
+        start_ts = time.time()
+        usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rss_sampler = TreeRssSampler()
+        rss_sampler.start()
+        # inherited by the task, see progress.py
+        os.environ[PROGRESS_FILE_ENV] = progress_file(self.worker_name, task.task_str)
+
         try:
-            func = TASK_TYPE_TO_FUNC[self.task.task_type]
+            func = TASK_TYPE_TO_FUNC[task.task_type]
             
             # Determine timeout duration
-            timeout_seconds = self.task.timeout_seconds
-            if timeout_seconds is None:
-                timeout_seconds = self.config.default_task_timeout_seconds
+            timeout_seconds = task_timeout_seconds(task, self.config)
                 
-            logging.info(f"Running task {self.task.task_str} with timeout {timeout_seconds}s")
+            logging.info(f"Running task {task.task_str} with timeout {timeout_seconds}s")
             
             # Run task with timeout
-            if self.task.task_type == "shell":
+            if task.task_type == "shell":
                 exitcode, o_stdout, o_stderr = self._run_shell_task_with_timeout(
-                    self.task.task_params, timeout_seconds)
+                    task.task_params, timeout_seconds)
             else:
                 # For other task types, use original execution method
-                exitcode, o_stdout, o_stderr = func(self.task.task_params)
+                exitcode, o_stdout, o_stderr = func(task.task_params)
                 
         except subprocess.TimeoutExpired:
             timeout_occurred = True
             o_stderr = f"Task timed out after {timeout_seconds} seconds"
             exitcode = -1
-            logging.warning(f"Task {self.task.task_str} timed out after {timeout_seconds}s")
+            logging.warning(f"Task {task.task_str} timed out after {timeout_seconds}s")
         except Exception as e:
-            logging.warning("error {} task {}".format(e, self.task))
+            logging.warning("error {} task {}".format(e, task))
             o_stderr = "failed task \n" + str(e) + "\n" + o_stderr
             if exitcode == 0:
                 logging.error("exitcode 0 but error {} {}".format(e, o_stderr))
                 exitcode = -1
 
-        if exitcode != 0 or timeout_occurred:
-            msg = json.dumps(o_stderr)
-            if len(msg) > 1024:
-                msg = "stderr is too large. " + msg[:1024]
-            report_task_failed(self.worker_name, self.redis_inst, self.task, msg, self.max_retry_per_task)
+        # the runner only runs its tasks, so the children usage since the start is the usage of the task,
+        # the peak RSS of a later task in a batch is the peak of the batch so far (peak_shared),
+        # ru_maxrss is of the largest single process, the sampled sum covers a task with several processes
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        usage = SimpleNamespace(ru_maxrss=max(usage.ru_maxrss, rss_sampler.stop()),
+                                ru_utime=usage.ru_utime - usage_before.ru_utime,
+                                ru_stime=usage.ru_stime - usage_before.ru_stime)
+        timing = task_timing_record(self.worker_name, task, start_ts, time.time(), exitcode, usage, peak_shared)
+
+        status, msg = task_result(exitcode, o_stdout, o_stderr)
+        if status == "failed":
+            self.send_result(task, "failed", msg, timing, EVENT_TIMEOUT if timeout_occurred else EVENT_FAIL)
             logging.warning(
-                "cannot finish task {}\n{}".format(self.task, o_stderr))
-            sys.exit(exitcode)
+                "cannot finish task {}\n{}".format(task, o_stderr))
+            return exitcode
 
         else:
-            msg = "stdout is too large"
-            if len(o_stdout) < 1024 * 1024:
-                msg = json.dumps(o_stdout)
-            report_task_finish(self.worker_name, self.redis_inst, self.task, msg)
-            logging.info("finish task {}".format(self.task))
-            sys.exit(0)
+            self.send_result(task, "finished", msg, timing)
+            logging.info("finish task {}".format(task))
+            return 0
             
-    def _run_shell_task_with_timeout(self, task_params, timeout_seconds):
-        """Run shell task with timeout support"""
+    def send_result(self, task, status, msg, timing, event=EVENT_FAIL):
         try:
-            p = subprocess.run(task_params,
+            self.result_conn.send({"status": status, "msg": msg, "timing": timing, "event": event})
+        except OSError as e:
+            logging.error("cannot send the result of task {} to the worker: {}".format(task, e))
+
+    def _run_shell_task_with_timeout(self, task_params, timeout_seconds):
+        """
+        run a shell task in its own process group, a timeout kills the whole group, 0 means no limit
+
+        """
+
+        p = subprocess.Popen(task_params,
                              shell=True,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.PIPE,
-                             timeout=timeout_seconds)
-            o_stdout = p.stdout.decode("ascii").strip()
-            o_stderr = p.stderr.decode("ascii").strip()
-            return p.returncode, o_stdout, o_stderr
+                             start_new_session=True)
+        try:
+            o_stdout, o_stderr = p.communicate(timeout=timeout_seconds or None)
         except subprocess.TimeoutExpired:
-            # When timeout occurs, try to terminate process
-            logging.warning(f"Task timed out, attempting to kill process")
+            logging.warning(f"Task timed out, killing its process group")
+            kill_process_group(p, self.config.task_kill_grace_sec)
+            # the pipes are closed once the whole group is gone
+            p.communicate()
             raise
+        return p.returncode, o_stdout.decode("ascii").strip(), o_stderr.decode("ascii").strip()
 
 
 #################################### util function #####################################
@@ -623,10 +1428,15 @@ if __name__ == "__main__":
                         type=str,
                         default="worker",
                         help="worker")
+    parser.add_argument("--admission_policy",
+                        type=str,
+                        default=None,
+                        choices=ADMISSION_POLICIES,
+                        help="override admission_policy in conf.json for this worker")
     ap = parser.parse_args()
 
     if ap.task == "worker":
-        worker = Worker()
+        worker = Worker(admission_policy=ap.admission_policy)
         worker.start()
     else:
         raise RuntimeError("unknown task {}".format(ap.task))
@@ -0,0 +1,507 @@
+import json
+import time
+import logging
+from collections import deque
+from threading import Thread, Lock
+from multiprocessing.connection import wait
+from const import *
+from utils import task_family, TaskBatch
+from dag import FAIL_DEPENDENTS_LUA, unblock_dependents
+from fairshare import REQUEUE_LUA
+from retry import classify_failure, largest_live_node_mem, OOM_RETRY_MEM_FACTOR
+from memory_model import peak_mem_field
+
+
+"""
+task result reporting
+
+a task runner (child process) does not talk to redis, it sends its result to the worker over a pipe,
+the ResultReporter thread of the worker collects the results of all slots and reports the ones received
+within result_flush_interval_sec in one MULTI/EXEC pipeline per shard, in the order they were received,
+the runner of a micro-batch sends one result per task in the order it runs them
+
+with a ResultJournal the results of a flush are written to a local journal before the pipeline and acked
+after it, a flush that fails is retried with backoff and a restarted worker replays the journal, see journal
+
+"""
+
+# the longest wait between the retries of a flush while redis is unreachable
+MAX_FLUSH_BACKOFF_SEC = 30
+
+
+# KEYS: finished_tasks, in_progress_tasks, failed_tasks, speculative_tasks, in_progress_since, task_timing,
+#       family_runtime_count, family_runtime_sum, task_events, task_failure_classes, task_min_node_mem,
+#       family_peak_mem
+# ARGV: task str, worker, result, timing json or "", family or "", runtime sec, stream maxlen, event,
+#       peak memory histogram field or ""
+# the first copy of a task that finishes commits its result, see claim_backup_task of the worker,
+# returns the in_progress owner (the worker itself for a backup copy, "" if none),
+# or nil if another copy already finished the task
+REPORT_FINISH_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return false
+end
+local owner = redis.call('HGET', KEYS[2], ARGV[1]) or ''
+if redis.call('HGET', KEYS[4], ARGV[1]) == ARGV[2] then
+    owner = ARGV[2]
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('HDEL', KEYS[5], ARGV[1])
+redis.call('HDEL', KEYS[10], ARGV[1])
+redis.call('HDEL', KEYS[11], ARGV[1])
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[6], ARGV[1], ARGV[4])
+end
+if ARGV[5] ~= '' then
+    redis.call('HINCRBY', KEYS[7], ARGV[5], 1)
+    redis.call('HINCRBYFLOAT', KEYS[8], ARGV[5], ARGV[6])
+end
+if ARGV[9] ~= '' then
+    redis.call('HINCRBY', KEYS[12], ARGV[9], 1)
+end
+redis.call('XADD', KEYS[9], 'MAXLEN', '~', ARGV[7], '*', 'e', ARGV[8], 't', ARGV[1], 'w', ARGV[2])
+return owner
+"""
+
+
+# KEYS: in_progress_tasks, failed_tasks, task_fail_reason, task_timing, todo_tasks, task_events,
+#       speculative_tasks, in_progress_since, task_owner, task_queue_score, task_failure_classes, retry_backoff,
+#       task_min_node_mem, family_oom, blocked_tasks, task_dependents, dependency_failed
+# ARGV: task str, worker, error message, max retry, timing json or "", event, exit code or "", stream maxlen,
+#       failure class, max retry of the class, backoff sec of the class, max backoff sec, now,
+#       the memory a node needs for the retry or "", the family of an oom failure or ""
+# returns 1 if the task is retried, 0 if not, -1 if the task is not in progress on this worker,
+# e.g., it was already reported or moved back to todo by the manager, or it is a failed backup copy,
+# when the task has a backup copy, the backup takes over instead of a retry, see retry.py for the policy,
+# a task that is not retried fails the tasks waiting for it, see dag.py
+REPORT_FAILED_SCRIPT = REQUEUE_LUA + FAIL_DEPENDENTS_LUA + """
+local backup = redis.call('HGET', KEYS[7], ARGV[1])
+if backup == ARGV[2] then
+    redis.call('HDEL', KEYS[7], ARGV[1])
+    return -1
+end
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return -1
+end
+local failed = (redis.call('HGET', KEYS[2], ARGV[1]) or '') .. ARGV[2] .. ','
+local _, n_failed = string.gsub(failed, ',', '')
+local classes = (redis.call('HGET', KEYS[11], ARGV[1]) or '') .. ARGV[9] .. ','
+local n_class = 0
+for c in string.gmatch(classes, '([^,]+)') do
+    if c == ARGV[9] then
+        n_class = n_class + 1
+    end
+end
+local retry = 0
+if n_failed < tonumber(ARGV[4]) and n_class < tonumber(ARGV[10]) then
+    retry = 1
+end
+local delay = 0
+if retry == 1 and tonumber(ARGV[11]) > 0 then
+    delay = math.min(tonumber(ARGV[11]) * 2 ^ (n_class - 1), tonumber(ARGV[12]))
+end
+redis.call('HSET', KEYS[2], ARGV[1], failed)
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[11], ARGV[1], classes)
+if ARGV[14] ~= '' then
+    redis.call('HSET', KEYS[13], ARGV[1], ARGV[14])
+end
+if ARGV[15] ~= '' then
+    redis.call('HINCRBY', KEYS[14], ARGV[15], 1)
+end
+if ARGV[5] ~= '' then
+    redis.call('HSET', KEYS[4], ARGV[1], ARGV[5])
+end
+local event = {'e', ARGV[6], 't', ARGV[1], 'w', ARGV[2], 'c', ARGV[9]}
+if ARGV[7] ~= '' then
+    table.insert(event, 'x')
+    table.insert(event, ARGV[7])
+end
+table.insert(event, 'retry')
+table.insert(event, tostring(retry))
+if delay > 0 then
+    table.insert(event, 'delay')
+    table.insert(event, tostring(delay))
+end
+redis.call('XADD', KEYS[6], 'MAXLEN', '~', ARGV[8], '*', unpack(event))
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[8], ARGV[1])
+if backup then
+    redis.call('HSET', KEYS[1], ARGV[1], backup)
+    redis.call('HDEL', KEYS[7], ARGV[1])
+elseif delay > 0 then
+    redis.call('ZADD', KEYS[12], tonumber(ARGV[13]) + delay, ARGV[1])
+elseif retry == 1 then
+    requeue(KEYS[5], KEYS[9], KEYS[10], ARGV[1])
+else
+    fail_dependents(KEYS[15], KEYS[16], KEYS[17], KEYS[3], ARGV[1])
+end
+return retry
+"""
+
+
+# KEYS: in_progress_tasks, todo_tasks, task_events, speculative_tasks, in_progress_since, task_owner,
+#       task_queue_score
+# ARGV: task str, worker, event, stream maxlen
+# returns 1 if the task is moved back to todo (or to its backup copy, or it is a backup copy),
+# -1 if it is not in progress on this worker
+REPORT_RETURN_SCRIPT = REQUEUE_LUA + """
+local backup = redis.call('HGET', KEYS[4], ARGV[1])
+if backup == ARGV[2] then
+    redis.call('HDEL', KEYS[4], ARGV[1])
+    return 1
+end
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return -1
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[5], ARGV[1])
+if backup then
+    redis.call('HSET', KEYS[1], ARGV[1], backup)
+    redis.call('HDEL', KEYS[4], ARGV[1])
+else
+    requeue(KEYS[2], KEYS[6], KEYS[7], ARGV[1])
+end
+redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[4], '*', 'e', ARGV[3], 't', ARGV[1], 'w', ARGV[2])
+return 1
+"""
+
+
+def queue_task_finish(pipeline, worker_name, task_str, result, timing=None, family=None):
+    """
+    add the finish report of a task to a pipeline
+
+    :param family: the task family, the runtime and the peak memory are added to its history if timing is given
+    :return: the index of the script result in the pipeline result, see REPORT_FINISH_SCRIPT,
+        to check the task was ours
+
+    """
+
+    timing_str, runtime_sec = "", 0
+    if timing is not None:
+        timing["report_ts"] = time.time()
+        timing["status"] = "finished"
+        timing_str = json.dumps(timing)
+        runtime_sec = round(timing["finish_ts"] - timing["start_ts"], 3)
+    if family is None or timing is None:
+        family = ""
+    peak_mem = peak_mem_field(family, timing) if family else None
+    check = len(pipeline)
+    script = pipeline.register_script(REPORT_FINISH_SCRIPT)
+    script(keys=[REDIS_KEY_FINISHED_TASKS, REDIS_KEY_IN_PROGRESS_TASKS, REDIS_KEY_FAILED_TASKS,
+                 REDIS_KEY_SPECULATIVE_TASKS, REDIS_KEY_IN_PROGRESS_SINCE, REDIS_KEY_TASK_TIMING,
+                 REDIS_KEY_FAMILY_RUNTIME_COUNT, REDIS_KEY_FAMILY_RUNTIME_SUM, REDIS_KEY_TASK_EVENTS,
+                 REDIS_KEY_TASK_FAILURE_CLASSES, REDIS_KEY_TASK_MIN_NODE_MEM, REDIS_KEY_FAMILY_PEAK_MEM],
+           args=[task_str, worker_name, "{}: {}".format(worker_name, result), timing_str, family, runtime_sec,
+                 EVENT_STREAM_MAXLEN, EVENT_FINISH, peak_mem or ""])
+    # a no-op for the copy that finishes second
+    unblock_dependents(pipeline, task_str)
+    return check
+
+
+def queue_task_failed(pipeline, worker_name, task_str, errmsg, max_retry_per_task, timing=None,
+                      event=EVENT_FAIL, failure_class=None, retry_policy=None, backoff_max_sec=0,
+                      node_mem_gb=None, family=None, max_node_mem_gb=None):
+    """
+    add the failure report of a task to a pipeline, the retry decision is made atomically in redis
+
+    :param failure_class: one of retry.FAILURE_CLASSES, classified from the exit code, the message and the event
+        if not given
+    :param retry_policy: failure class -> RetryPolicy, without it a failure of any class is retried at once
+    :param node_mem_gb: the memory of the node, an oom retry needs a node with more
+    :param family: the task family, an oom failure is counted for it, see memory_model
+    :param max_node_mem_gb: the memory of the largest live node (retry.largest_live_node_mem), an oom failure
+        fails for good if it is smaller than the memory the retry needs, not checked if None
+    :return: the index of the script result in the pipeline result, see REPORT_FAILED_SCRIPT
+
+    """
+
+    exit_code = ""
+    timing_str = ""
+    if timing is not None:
+        timing["report_ts"] = time.time()
+        timing["status"] = "failed"
+        timing_str = json.dumps(timing)
+        if timing.get("exit_code") is not None:
+            exit_code = str(timing["exit_code"])
+    if failure_class is None:
+        failure_class = classify_failure(int(exit_code) if exit_code else None, errmsg, event)
+    policy = retry_policy.get(failure_class) if retry_policy is not None else None
+    class_max_retry, backoff_sec = (max_retry_per_task, 0) if policy is None else policy
+    min_node_mem, oom_family = "", ""
+    if failure_class == "oom":
+        if node_mem_gb:
+            min_node_mem = round(node_mem_gb * OOM_RETRY_MEM_FACTOR, 1)
+            if max_node_mem_gb is not None and max_node_mem_gb < min_node_mem:
+                # no node could take the retry, it would wait in todo forever
+                min_node_mem, class_max_retry = "", 0
+                errmsg = "oom, no bigger node: {}".format(errmsg)
+        oom_family = family or ""
+    check = len(pipeline)
+    script = pipeline.register_script(REPORT_FAILED_SCRIPT)
+    script(keys=[REDIS_KEY_IN_PROGRESS_TASKS, REDIS_KEY_FAILED_TASKS, REDIS_KEY_TASK_FAIL_REASON,
+                 REDIS_KEY_TASK_TIMING, REDIS_KEY_TODO_TASKS, REDIS_KEY_TASK_EVENTS,
+                 REDIS_KEY_SPECULATIVE_TASKS, REDIS_KEY_IN_PROGRESS_SINCE, REDIS_KEY_TASK_OWNER,
+                 REDIS_KEY_TASK_QUEUE_SCORE, REDIS_KEY_TASK_FAILURE_CLASSES, REDIS_KEY_RETRY_BACKOFF,
+                 REDIS_KEY_TASK_MIN_NODE_MEM, REDIS_KEY_FAMILY_OOM, REDIS_KEY_BLOCKED_TASKS,
+                 REDIS_KEY_TASK_DEPENDENTS, REDIS_KEY_DEPENDENCY_FAILED],
+           args=[task_str, worker_name, errmsg, max_retry_per_task, timing_str, event, exit_code,
+                 EVENT_STREAM_MAXLEN, failure_class, class_max_retry, backoff_sec, backoff_max_sec, time.time(),
+                 min_node_mem, oom_family])
+    return check
+
+
+def queue_task_return(pipeline, worker_name, task_str):
+    """
+    add moving a task of this worker back to todo to a pipeline, e.g., it is killed to free DRAM
+
+    :return: the index of the script result in the pipeline result, see REPORT_RETURN_SCRIPT
+
+    """
+
+    check = len(pipeline)
+    script = pipeline.register_script(REPORT_RETURN_SCRIPT)
+    script(keys=[REDIS_KEY_IN_PROGRESS_TASKS, REDIS_KEY_TODO_TASKS, REDIS_KEY_TASK_EVENTS,
+                 REDIS_KEY_SPECULATIVE_TASKS, REDIS_KEY_IN_PROGRESS_SINCE, REDIS_KEY_TASK_OWNER,
+                 REDIS_KEY_TASK_QUEUE_SCORE],
+           args=[task_str, worker_name, EVENT_RETURN, EVENT_STREAM_MAXLEN])
+    return check
+
+
+class ResultReporter(Thread):
+    def __init__(self, worker_name, shards, config, metrics=None, node_mem_gb=None, journal=None):
+        """
+
+        :param shards: a ShardedRedis, a report goes to the shard the task was claimed from
+        :param config: RunnerConfig, for result_flush_interval_sec, max_retry_per_task, retry_policy,
+            retry_backoff_max_sec and task_family_params
+        :param metrics: WorkerMetrics, the flush round trips are observed as redis_rtt{op="report"}
+        :param node_mem_gb: the memory of the node, an oom retry needs a node with more
+        :param journal: a ResultJournal, the results are durable on local disk until redis has them
+
+        """
+
+        super(ResultReporter, self).__init__(daemon=True)
+        self.worker_name = worker_name
+        self.shards = shards
+        self.config = config
+        self.metrics = metrics
+        self.node_mem_gb = node_mem_gb
+        self.conns = {}  # receiving end of a runner pipe -> (the watched task, the tasks without result yet)
+        self.watched = {}  # the watched task or batch -> receiving end of its runner pipe
+        self.interrupted = {}  # receiving end of a runner pipe -> the report of the task the worker kills
+        self.pending = []  # reports in the order they are received
+        self.lock = Lock()
+        self.journal = journal
+        self.stop_flag = False
+        self.last_flush = time.time()
+        self.flush_failures = 0  # consecutive flushes that did not reach redis, the retries back off
+
+    def watch(self, task, conn):
+        """
+        receive the result of a task runner from the pipe conn
+
+        :param task: a Task, or a TaskBatch whose runner sends one result per task
+
+        """
+
+        with self.lock:
+            self.conns[conn] = (task, deque(task.tasks if isinstance(task, TaskBatch) else [task]))
+            self.watched[task] = conn
+
+    def submit(self, task, status, msg, timing=None, event=EVENT_FAIL):
+        """
+        report a result decided by the worker itself, e.g., a timeout
+
+        :param status: "finished" or "failed"
+
+        """
+
+        with self.lock:
+            self.pending.append({"task": task, "status": status, "msg": msg, "timing": timing, "event": event})
+
+    def interrupt(self, task, status, msg, timing=None, event=EVENT_FAIL, failure_class=None):
+        """
+        report the result the worker decided for a task it is about to kill, e.g., a timeout,
+        call it before the kill: the results the runner sends before it dies are kept, this result goes to
+        the task that is running when it dies, and the tasks of a batch that did not start are returned
+
+        :param status: "failed", "returned", or "cancelled" to report nothing
+        :param failure_class: the class of the failure if the worker knows it, e.g., "oom"
+
+        """
+
+        report = {"task": task, "status": status, "msg": msg, "timing": timing, "event": event,
+                  "failure_class": failure_class}
+        with self.lock:
+            conn = self.watched.get(task)
+            if conn is None:
+                # a python task on the warm pool, or all results of the runner are already received
+                if not isinstance(task, TaskBatch):
+                    self.pending.append(report)
+            else:
+                self.interrupted[conn] = report
+
+    def run(self):
+        interval = self.config.result_flush_interval_sec
+        while True:
+            with self.lock:
+                conns = list(self.conns.keys())
+                # the results that do not reach redis at the stop are kept by the journal
+                done = self.stop_flag and len(conns) == 0 and (
+                    len(self.pending) == 0 or (self.journal is not None and self.flush_failures > 0))
+            if done:
+                break
+            if len(conns) > 0:
+                ready = wait(conns, timeout=interval)
+            else:
+                ready = []
+                time.sleep(interval)
+            for conn in ready:
+                self.receive(conn)
+            backoff = min(interval * 2 ** self.flush_failures, MAX_FLUSH_BACKOFF_SEC)
+            if self.stop_flag or time.time() - self.last_flush >= backoff:
+                self.flush()
+
+    def receive(self, conn):
+        with self.lock:
+            watched, left = self.conns[conn]
+        try:
+            result = conn.recv()
+        except (EOFError, OSError):
+            # the runner exited without a result, e.g., it was killed
+            result = None
+
+        with self.lock:
+            if result is not None:
+                result["task"] = left.popleft()
+                self.pending.append(result)
+                if len(left) > 0:
+                    return
+            else:
+                report = self.interrupted.get(conn)
+                if report is not None:
+                    report["task"] = left.popleft()
+                    self.pending.append(report)
+                elif isinstance(watched, TaskBatch):
+                    self.pending.append({"task": left.popleft(), "status": "failed",
+                                         "msg": json.dumps("the batch runner exited without a result"),
+                                         "timing": None, "event": EVENT_FAIL})
+                if isinstance(watched, TaskBatch):
+                    for task in left:
+                        self.pending.append({"task": task, "status": "returned", "msg": "", "timing": None,
+                                             "event": EVENT_RETURN})
+            del self.conns[conn]
+            del self.watched[watched]
+            self.interrupted.pop(conn, None)
+        conn.close()
+
+    def flush(self):
+        self.last_flush = time.time()
+        with self.lock:
+            reports, self.pending = self.pending, []
+        # the worker cancelled the copy, another copy finished the task
+        reports = [report for report in reports if report["status"] != "cancelled"]
+        if len(reports) == 0:
+            return
+        if self.journal is not None:
+            # the retried reports are already in the journal
+            new_reports = [report for report in reports if "seq" not in report]
+            if len(new_reports) > 0:
+                try:
+                    self.journal.append(new_reports)
+                except OSError as e:
+                    logging.error("write {} results to the journal error {}".format(len(new_reports), e))
+
+        by_shard = {}
+        for report in reports:
+            redis_inst = self.shards.of(report["task"])
+            by_shard.setdefault(id(redis_inst), (redis_inst, []))[1].append(report)
+        failed = []
+        for redis_inst, shard_reports in by_shard.values():
+            try:
+                self.flush_shard(redis_inst, shard_reports)
+            except Exception as e:
+                logging.error("report {} results error {}".format(len(shard_reports), e))
+                failed.extend(shard_reports)
+                continue
+            if self.journal is not None:
+                self.journal.ack(shard_reports)
+        self.flush_failures = self.flush_failures + 1 if len(failed) > 0 else 0
+        if len(failed) > 0:
+            # retry at the next flush, before the results received in the meantime
+            with self.lock:
+                self.pending = failed + self.pending
+
+    def flush_shard(self, redis_inst, reports):
+        max_node_mem_gb = None
+        if any(report["status"] == "failed" for report in reports):
+            max_node_mem_gb = largest_live_node_mem(self.shards.primary)
+        pipeline = redis_inst.pipeline(transaction=True)
+        checks = []
+        for report in reports:
+            task = report["task"]
+            family = task_family(task, self.config.task_family_params)
+            if report["status"] == "finished":
+                checks.append(queue_task_finish(pipeline, self.worker_name, task.task_str, report["msg"],
+                                                timing=report["timing"], family=family))
+            elif report["status"] == "returned":
+                checks.append(queue_task_return(pipeline, self.worker_name, task.task_str))
+            else:
+                checks.append(queue_task_failed(pipeline, self.worker_name, task.task_str, report["msg"],
+                                                self.config.max_retry_per_task, timing=report["timing"],
+                                                event=report["event"],
+                                                failure_class=report.get("failure_class"),
+                                                retry_policy=self.config.retry_policy,
+                                                backoff_max_sec=self.config.retry_backoff_max_sec,
+                                                node_mem_gb=self.node_mem_gb, family=family,
+                                                max_node_mem_gb=max_node_mem_gb))
+        start = time.perf_counter()
+        r = pipeline.execute()
+        if self.metrics is not None:
+            self.metrics.redis_rtt.observe(time.perf_counter() - start, op="report")
+
+        for report, check in zip(reports, checks):
+            if report["status"] == "finished" and r[check] is None:
+                logging.info("task {} is already finished by another copy".format(report["task"].task_str))
+            elif report["status"] == "finished" and r[check] != self.worker_name:
+                logging.error("finished task is not assigned to worker {} != {}".format(
+                    r[check], self.worker_name))
+            elif report["status"] != "finished" and r[check] == -1:
+                logging.warning("ignore the {} task {}, it is not in progress on this worker".format(
+                    report["status"], report["task"].task_str))
+        logging.debug("report {} results in one pipeline".format(len(reports)))
+
+    def replay_journal(self):
+        """
+        report the results of the journal that did not reach redis before the worker restarted,
+        call it before the worker returns its in-progress tasks
+
+        :return: the task strs whose results are still not in redis, the reporter keeps retrying them
+
+        """
+
+        if self.journal is None:
+            return set()
+        reports = self.journal.replay()
+        if len(reports) > 0:
+            logging.info("replay {} results of the journal {}".format(len(reports), self.journal.path))
+            with self.lock:
+                self.pending = reports + self.pending
+            self.flush()
+        return self.journal.task_strs()
+
+    def stop(self):
+        """
+        report everything that is received or pending and stop,
+        with a journal, the results that redis does not take stay in the journal for the next start
+
+        """
+
+        self.stop_flag = True
+        self.join()
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,120 @@
+import time
+from const import *
+from fairshare import REQUEUE_LUA
+from retry_policy import FAILURE_CLASSES, RetryPolicy, DEFAULT_RETRY_POLICY, parse_retry_policy
+
+
+"""
+failure-class-aware retries
+
+a failed run is classified (classify_failure):
+    oom      the worker killed it to free DRAM, or it was killed by SIGKILL (the kernel OOM killer) or
+             raised MemoryError / std::bad_alloc
+    timeout  it exceeded its timeout
+    signal   it was killed by another signal
+    exit     it exited with a non-zero code, usually a deterministic error
+
+each class has a retry policy (retry_policy in conf.json, parsed by retry_policy): a task is retried while it
+failed fewer than max_retry times with this class (and fewer than max_retry_per_task times in total), after
+backoff_sec * 2 ^ (failures of the class - 1) seconds (at most retry_backoff_max_sec), a delayed retry
+waits in the sorted set retry_backoff (task -> when it is due) and is moved back to todo by the next claim
+after it is due (PROMOTE_SCRIPT)
+
+an oom retry goes to a node with at least OOM_RETRY_MEM_FACTOR times the memory of the node where it ran
+out of memory (task_min_node_mem, task -> GB), the workers a task failed on are still excluded, if no live
+worker is that big the task fails for good with the reason "oom, no bigger node"
+
+"""
+
+# an oom retry needs a node with this much more memory
+OOM_RETRY_MEM_FACTOR = 1.1
+# a worker whose last heartbeat is older does not count as a node an oom retry can go to
+LIVE_WORKER_MAX_AGE_SEC = 60
+# the due retries are moved to todo at most this often by a worker
+PROMOTE_INTERVAL_SEC = 1
+OOM_MARKERS = ("MemoryError", "std::bad_alloc", "Out of memory", "out of memory")
+
+# KEYS: retry_backoff, todo_tasks, task_owner, task_queue_score
+# ARGV: now, max tasks
+# returns the number of tasks moved to todo
+PROMOTE_SCRIPT = REQUEUE_LUA + """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, task in ipairs(due) do
+    redis.call('ZREM', KEYS[1], task)
+    requeue(KEYS[2], KEYS[3], KEYS[4], task)
+end
+return #due
+"""
+
+
+def classify_failure(exit_code, errmsg, event=EVENT_FAIL):
+    """
+    :param exit_code: the exit code of the task, negative for a signal, None if the worker killed it
+    :return: one of FAILURE_CLASSES
+
+    """
+
+    if event == EVENT_TIMEOUT:
+        return "timeout"
+    if any(marker in (errmsg or "") for marker in OOM_MARKERS):
+        return "oom"
+    if exit_code is None:
+        return "signal"
+    # a shell reports a child killed by signal N as 128 + N
+    if exit_code in (-9, 128 + 9):
+        return "oom"
+    if exit_code < 0 or 128 < exit_code < 128 + 65:
+        return "signal"
+    return "exit"
+
+
+def failed_workers(value):
+    """
+    the set of workers a task failed on, from its failed_tasks entry "w1,w2,"
+
+    """
+
+    return set(x for x in (value or "").split(",") if x)
+
+
+def fits_node_mem(task_str, min_node_mem, total_mem_gb):
+    """
+    :param min_node_mem: the content of task_min_node_mem
+
+    """
+
+    need = min_node_mem.get(task_str)
+    return need is None or total_mem_gb >= float(need)
+
+
+def largest_live_node_mem(redis_inst, now=None):
+    """
+    the memory of the largest worker that sent a heartbeat in the last LIVE_WORKER_MAX_AGE_SEC
+
+    :param redis_inst: the primary shard, it has worker_status
+    :return: GB, 0 if no worker is alive
+
+    """
+
+    now = time.time() if now is None else now
+    largest = 0
+    for status in redis_inst.hvals("worker_status"):
+        last_report_ts, used_core, total_core, used_mem_gb, total_mem_gb = status.split(":")
+        if now - float(last_report_ts) <= LIVE_WORKER_MAX_AGE_SEC:
+            largest = max(largest, float(total_mem_gb))
+    return largest
+
+
+def promote_due_retries(redis_inst, now, max_tasks=1000):
+    """
+    move the delayed retries that are due back to todo
+
+    :param redis_inst: a shard
+    :return: the number of tasks moved
+
+    """
+
+    script = redis_inst.register_script(PROMOTE_SCRIPT)
+    return script(keys=[REDIS_KEY_RETRY_BACKOFF, REDIS_KEY_TODO_TASKS, REDIS_KEY_TASK_OWNER,
+                        REDIS_KEY_TASK_QUEUE_SCORE],
+                  args=[now, max_tasks])
@@ -0,0 +1,40 @@
+from collections import namedtuple
+
+
+"""
+the retry policy of each failure class, parsed from retry_policy of conf.json
+
+only parsing, it imports nothing of this project, so the config (utils) can parse it while the retry scripts
+(retry) import the modules that import utils, see retry for how the policy is applied
+
+"""
+
+FAILURE_CLASSES = ("oom", "timeout", "signal", "exit")
+RetryPolicy = namedtuple("RetryPolicy", ["max_retry", "backoff_sec"])
+DEFAULT_RETRY_POLICY = {
+    "oom": RetryPolicy(4, 0),
+    "timeout": RetryPolicy(2, 60),
+    "signal": RetryPolicy(3, 10),
+}
+# a plain non-zero exit is retried like before the per-class policies: up to max_retry_per_task times, at once
+DEFAULT_EXIT_BACKOFF_SEC = 0
+
+
+def parse_retry_policy(conf, max_retry_per_task):
+    """
+    :param conf: class -> {"max_retry": n, "backoff_sec": sec}, the classes that are not given keep the default
+    :param max_retry_per_task: the default max_retry of the exit class
+    :return: class -> RetryPolicy
+
+    """
+
+    defaults = dict(DEFAULT_RETRY_POLICY, exit=RetryPolicy(max_retry_per_task, DEFAULT_EXIT_BACKOFF_SEC))
+    policy = dict(defaults)
+    for failure_class, p in conf.items():
+        if failure_class not in FAILURE_CLASSES:
+            raise ValueError("unknown failure class {} in retry_policy, one of {}".format(
+                failure_class, ", ".join(FAILURE_CLASSES)))
+        default = defaults[failure_class]
+        policy[failure_class] = RetryPolicy(int(p.get("max_retry", default.max_retry)),
+                                            float(p.get("backoff_sec", default.backoff_sec)))
+    return policy
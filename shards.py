@@ -0,0 +1,135 @@
+import zlib
+import random
+import itertools
+
+
+"""
+sharded task keyspace
+
+the redis at redis_host is the primary shard, redis_shards adds more instances,
+the task hashes (todo, in_progress, finished, failed, timing, ...) of a task live on the shard chosen by
+the crc32 of the task str, the worker status and other global keys live on the primary,
+tasks with dependency annotations (@name/@after) are pinned to the primary so that the dependency
+scripts see all of them atomically
+
+a worker claims from its home shard and steals from the other shards when its home shard has no task
+it can work on, a claimed task remembers its shard so that the report goes to the same shard
+
+"""
+
+
+def parse_shard_address(address, default_port):
+    """
+    "host:port" or "host"
+
+    """
+
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return address, default_port
+
+
+def shard_index(key, n_shards):
+    return zlib.crc32(key.encode()) % n_shards
+
+
+def shard_clients(redis_inst):
+    """
+    the redis clients behind redis_inst, one for a plain redis client
+
+    """
+
+    return as_sharded(redis_inst).shards
+
+
+def as_sharded(redis_inst):
+    if isinstance(redis_inst, ShardedRedis):
+        return redis_inst
+    return ShardedRedis([redis_inst])
+
+
+class ShardedRedis:
+    """
+    the shards of the task keyspace,
+    the read commands used by the manager (hgetall, hlen, hvals, hkeys, hscan_iter, hmget) aggregate
+    over all shards, writes go to a shard explicitly
+
+    """
+
+    def __init__(self, shards):
+        if len(shards) == 0:
+            raise ValueError("at least one redis shard is required")
+        self.shards = list(shards)
+        self.primary = self.shards[0]
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __getitem__(self, i):
+        return self.shards[i]
+
+    def shard_of_task_str(self, task_str, pinned=False):
+        """
+        :param pinned: the task has dependency annotations and lives on the primary
+
+        """
+
+        if pinned:
+            return 0
+        return shard_index(task_str, len(self.shards))
+
+    def for_task_str(self, task_str, pinned=False):
+        return self.shards[self.shard_of_task_str(task_str, pinned)]
+
+    def of(self, task):
+        """
+        the shard a claimed task came from
+
+        """
+
+        if task.shard is not None:
+            return self.shards[task.shard]
+        return self.for_task_str(task.task_str)
+
+    def claim_order(self, worker_name, rng=random):
+        """
+        the home shard of the worker first, then the others in random order to spread stealing
+
+        """
+
+        home = shard_index(worker_name, len(self.shards))
+        others = [i for i in range(len(self.shards)) if i != home]
+        rng.shuffle(others)
+        return [home] + others
+
+    ########### aggregated reads #############
+    def hgetall(self, key):
+        merged = {}
+        for shard in self.shards:
+            merged.update(shard.hgetall(key))
+        return merged
+
+    def hlen(self, key):
+        return sum(shard.hlen(key) for shard in self.shards)
+
+    def zcard(self, key):
+        return sum(shard.zcard(key) for shard in self.shards)
+
+    def hvals(self, key):
+        return [v for shard in self.shards for v in shard.hvals(key)]
+
+    def hkeys(self, key):
+        return [k for shard in self.shards for k in shard.hkeys(key)]
+
+    def hscan_iter(self, key, match=None, count=None):
+        return itertools.chain.from_iterable(shard.hscan_iter(key, match=match, count=count)
+                                             for shard in self.shards)
+
+    def hmget(self, key, fields):
+        merged = [None] * len(fields)
+        for shard in self.shards:
+            for i, v in enumerate(shard.hmget(key, fields)):
+                if v is not None:
+                    merged[i] = v
+        return merged
@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+"""
+Discrete-event cluster simulator for scheduling policies
+
+It replays a synthetic or recorded task trace against N virtual nodes, using the same Task model and
+worker admission logic as redisWorker.py (can_accept_new_task, the DRAM checks, returning the most
+recent task when DRAM is low, retries and timeouts), and reports makespan, utilization,
+wasted compute and queue wait distributions.
+
+Failed runs are classified and retried like reporter.REPORT_FAILED_SCRIPT does: the retry_policy of the class
+with its backoff (capped at retry_backoff_max_sec), and an oom retry only on a node with OOM_RETRY_MEM_FACTOR
+times the memory. With dram_estimate learned or capped, the DRAM of a task is learned online from the peaks
+of the finished tasks of its family (memory_model.DramEstimator, without the refresh delay of the workers).
+
+    python3 simulator.py --nodes 100x192x40 --n_tasks 1000000 --set max_task_per_worker=48
+    python3 simulator.py --trace trace.jsonl --set min_dram_gb_accept_new_task=60
+
+A trace is a JSONL (or CSV) file with one task per line:
+    {"task": "shell:5:8:1:./cachesim trace1 lru", "submit": 0, "runtime": 1800, "peak_mem_gb": 6.5, "exit_code": 0}
+"""
+
+import csv
+import json
+import heapq
+import random
+from types import SimpleNamespace
+import numpy as np
+
+from const import *
+from utils import RunnerConfig, ConfigSnapshot, Task
+from admission import *
+from predictor import RuntimePredictor
+from memory_model import DramEstimator
+from retry import OOM_RETRY_MEM_FACTOR, classify_failure, parse_retry_policy
+
+
+#################################### trace #####################################
+class SimTask(Task):
+    """
+    a task with the behavior it shows when it runs
+
+    """
+
+    def __init__(self, task_str, submit_ts, runtime, peak_mem_gb, exit_code=0):
+        super(SimTask, self).__init__(task_str)
+        self.submit_ts = submit_ts
+        self.runtime = runtime
+        self.peak_mem_gb = peak_mem_gb
+        self.exit_code = exit_code
+        self.declared_gb = self.min_dram_gb
+        self.failed_nodes = set()
+        self.failure_classes = []
+        self.min_node_mem = 0
+        self.first_claim_ts = None
+        self.todo_pos = -1
+
+    # tasks in a trace may have the same task str, they are distinct tasks in the simulation
+    __hash__ = object.__hash__
+
+    def __eq__(self, __o):
+        return self is __o
+
+    def __ne__(self, __o):
+        return self is not __o
+
+
+# family name -> (share of tasks, median runtime sec, runtime sigma, median peak GB, priority)
+DEFAULT_FAMILIES = {
+    "./gen": (0.2, 300, 0.5, 2, 3),
+    "./cachesim": (0.7, 1800, 1.0, 8, 2),
+    "./agg": (0.1, 120, 0.3, 1, 1),
+}
+
+
+def synthetic_trace(n_tasks, seed=0, families=DEFAULT_FAMILIES, arrival_rate=0, fail_ratio=0.01,
+                    dram_error=0.3):
+    """
+    generate a campaign of tasks with lognormal runtime and peak memory
+
+    :param arrival_rate: tasks per second (Poisson arrivals), 0 submits all tasks at time 0
+    :param fail_ratio: the ratio of tasks exit with non-zero code
+    :param dram_error: the declared min_dram_gb deviates from the peak by this relative sigma
+
+    """
+
+    rng = np.random.default_rng(seed)
+    names = list(families.keys())
+    shares = np.array([families[n][0] for n in names], dtype=np.float64)
+    fam = rng.choice(len(names), size=n_tasks, p=shares / shares.sum())
+    med_runtime = np.array([families[n][1] for n in names], dtype=np.float64)[fam]
+    sigma = np.array([families[n][2] for n in names], dtype=np.float64)[fam]
+    med_mem = np.array([families[n][3] for n in names], dtype=np.float64)[fam]
+    runtime = med_runtime * np.exp(rng.normal(0, sigma))
+    peak_mem = med_mem * np.exp(rng.normal(0, 0.4, n_tasks))
+    declared = np.maximum(1, np.ceil(peak_mem * np.exp(rng.normal(0, dram_error, n_tasks)))).astype(int)
+    fails = rng.random(n_tasks) < fail_ratio
+    if arrival_rate > 0:
+        submit = np.cumsum(rng.exponential(1 / arrival_rate, n_tasks))
+    else:
+        submit = np.zeros(n_tasks)
+
+    tasks = []
+    for i in range(n_tasks):
+        name = names[fam[i]]
+        # the timeout is generous, tasks only time out in the far tail
+        task_str = "shell:{}:{}:1:{}:{} input{} param{}".format(
+            families[name][4], declared[i], int(families[name][1] * 20), name, i % 1000, i)
+        tasks.append(SimTask(task_str, float(submit[i]), float(runtime[i]), float(peak_mem[i]),
+                             1 if fails[i] else 0))
+    return tasks
+
+
+def load_trace(path):
+    """
+    load a JSONL or CSV trace with columns task, submit, runtime, peak_mem_gb and optional exit_code
+
+    """
+
+    def make(row):
+        return SimTask(row["task"], float(row.get("submit", 0) or 0), float(row["runtime"]),
+                       float(row.get("peak_mem_gb", 0) or 0), int(float(row.get("exit_code", 0) or 0)))
+
+    tasks = []
+    with open(path) as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                tasks.append(make(row))
+        else:
+            for line in f:
+                if len(line.strip()) > 0:
+                    tasks.append(make(json.loads(line)))
+    return tasks
+
+
+def trace_from_redis(redis_inst):
+    """
+    build a trace from the lifecycle records written by the workers (see task_stats.py),
+    tasks without a complete record are skipped
+
+    """
+
+    from task_stats import load_task_timing
+    cols = load_task_timing(redis_inst)
+    runtime = cols["finish_ts"] - cols["start_ts"]
+    ok = ~np.isnan(runtime)
+    t0 = np.nanmin(cols["submit_ts"]) if np.any(~np.isnan(cols["submit_ts"])) else 0
+    tasks = []
+    for i in np.nonzero(ok)[0]:
+        submit = cols["submit_ts"][i] - t0 if not np.isnan(cols["submit_ts"][i]) else 0
+        peak = cols["peak_rss_kb"][i] * KiB / GiB if not np.isnan(cols["peak_rss_kb"][i]) else 0
+        exit_code = int(cols["exit_code"][i]) if not np.isnan(cols["exit_code"][i]) else 1
+        tasks.append(SimTask(cols["task"][i], float(submit), float(runtime[i]), float(peak), exit_code))
+    return tasks
+
+
+#################################### cluster #####################################
+class VirtualNode:
+    def __init__(self, name, total_mem_gb, total_core):
+        self.name = name
+        self.total_mem_gb = total_mem_gb
+        self.total_core = total_core
+        self.used_mem_gb = 0.0
+        self.used_core = 0
+        self.in_prog_need_dram_gb = 0
+        self.running = []  # runs in start order
+        self.next_wake = None
+        self.full = False  # cannot take new task until one of its tasks ends
+
+
+class Run:
+    __slots__ = ("task", "node", "start", "mem_gb", "cores", "valid")
+
+    def __init__(self, task, node, start, mem_gb, cores):
+        self.task = task
+        self.node = node
+        self.start = start
+        self.mem_gb = mem_gb
+        self.cores = cores
+        self.valid = True
+
+
+# event kinds, ordered so that resources are freed before they are claimed at the same time
+EV_END, EV_GROW, EV_SUBMIT, EV_RETRY, EV_WAKE = 0, 1, 2, 3, 4
+# a worker sleeps this long when it cannot take new task, see Worker.start
+FULL_NODE_POLL_SEC = 8
+
+
+class ClusterSimulator:
+    def __init__(self, config, nodes, tasks, seed=0, initial_mem_frac=0.5, ramp_frac=0.2, base_mem_gb=0):
+        """
+
+        :param config: a config object with the RunnerConfig fields
+        :param nodes: a list of VirtualNode
+        :param tasks: a list of SimTask
+        :param initial_mem_frac: the fraction of the peak memory a task uses when it starts
+        :param ramp_frac: a task reaches its peak memory after this fraction of its runtime
+        :param base_mem_gb: the memory used by the OS and other processes on each node
+
+        """
+
+        self.config = config
+        self.nodes = nodes
+        self.tasks = sorted(tasks, key=lambda t: t.submit_ts)
+        self.rng = random.Random(seed)
+        self.initial_mem_frac = initial_mem_frac
+        self.ramp_frac = ramp_frac
+        for node in nodes:
+            node.used_mem_gb = base_mem_gb
+
+        self.events = []
+        self.seq = 0
+        self.now = 0.0
+        self.todo = []
+        self.idle_nodes = set()  # nodes waiting for new tasks in the queue
+        self.next_submit = 0
+        # learns the runtime history online, like the workers do through redis
+        self.predictor = RuntimePredictor(config.task_family_params)
+        # and the peak memory history
+        self.dram_estimator = DramEstimator.from_config(config)
+
+        # statistics
+        self.n_claims = 0
+        self.n_returned = 0
+        self.n_timeout = 0
+        self.n_failed_runs = 0
+        self.n_delayed_retries = 0
+        self.n_finished = 0
+        self.n_dropped = 0
+        self.busy_core_sec = 0.0
+        self.busy_slot_sec = 0.0
+        self.wasted_core_sec = 0.0
+        self.queue_wait = []
+        self.turnaround = []
+        self.last_finish = 0.0
+
+    ########### event queue #############
+    def push(self, t, kind, obj):
+        self.seq += 1
+        heapq.heappush(self.events, (t, kind, self.seq, obj))
+
+    def wake(self, node, t):
+        if node.next_wake is not None and node.next_wake <= t:
+            return
+        node.next_wake = t
+        self.push(t, EV_WAKE, node)
+
+    ########### todo queue #############
+    def enqueue(self, task):
+        task.todo_pos = len(self.todo)
+        self.todo.append(task)
+        if len(self.idle_nodes) > 0:
+            for node in self.idle_nodes:
+                self.wake(node, self.now + self.config.sleep_sec_between_accepting_task)
+            self.idle_nodes.clear()
+
+    def dequeue(self, task):
+        last = self.todo.pop()
+        if last is not task:
+            self.todo[task.todo_pos] = last
+            last.todo_pos = task.todo_pos
+        task.todo_pos = -1
+
+    def pick_tasks(self, node):
+        """
+        the same selection as Worker.get_tasks_from_redis
+
+        """
+
+        if len(self.todo) > TODO_SAMPLE_THRESHOLD:
+            candidates = [self.todo[i] for i in self.rng.sample(range(len(self.todo)), TODO_SAMPLE_SIZE)]
+        else:
+            candidates = self.todo
+        if self.dram_estimator.mode != "declared":
+            for t in candidates:
+                t.min_dram_gb = t.declared_gb
+                self.dram_estimator.apply(t)
+        can_work_on = [t for t in candidates
+                       if node.name not in t.failed_nodes and node.total_mem_gb >= t.min_node_mem and
+                       task_fits(t, node.total_mem_gb, node.used_mem_gb, node.in_prog_need_dram_gb)]
+        if len(can_work_on) == 0:
+            return []
+        ranked = rank_candidates(can_work_on, self.config.scheduling_policy, self.predictor)
+        if self.config.admission_policy == "binpack":
+            return select_task_batch(self.config, ranked, node.total_mem_gb, node.used_mem_gb,
+                                     node.in_prog_need_dram_gb, len(node.running), node.total_core,
+                                     node.used_core, self.config.max_tasks_per_claim)
+        return ranked[:1]
+
+    ########### task lifecycle #############
+    def start_task(self, node, task):
+        self.dequeue(task)
+        self.n_claims += 1
+        if task.first_claim_ts is None:
+            task.first_claim_ts = self.now
+
+        run = Run(task, node, self.now, task.peak_mem_gb * self.initial_mem_frac,
+                  max(1, task.require_cpu_core))
+        node.running.append(run)
+        node.used_mem_gb += run.mem_gb
+        node.used_core += run.cores
+        node.in_prog_need_dram_gb += task.min_dram_gb
+
+        timeout = task_timeout_seconds(task, self.config)
+        if timeout and task.runtime > timeout:
+            self.push(self.now + timeout, EV_END, (run, "timeout"))
+        else:
+            self.push(self.now + task.runtime, EV_END, (run, "finish" if task.exit_code == 0 else "fail"))
+        if self.initial_mem_frac < 1:
+            self.push(self.now + task.runtime * self.ramp_frac, EV_GROW, run)
+        self.check_oom(node)
+
+    def stop_run(self, run):
+        node = run.node
+        run.valid = False
+        node.running.remove(run)
+        node.used_mem_gb -= run.mem_gb
+        node.used_core -= run.cores
+        node.in_prog_need_dram_gb -= run.task.min_dram_gb
+        duration = self.now - run.start
+        self.busy_core_sec += duration * run.cores
+        self.busy_slot_sec += duration
+        return duration * run.cores
+
+    def fail_task(self, task, node, failure_class):
+        """
+        the same retry rule as report_task_failed, see reporter.REPORT_FAILED_SCRIPT
+
+        :param failure_class: one of retry.FAILURE_CLASSES
+
+        """
+
+        self.n_failed_runs += 1
+        task.failed_nodes.add(node.name)
+        task.failure_classes.append(failure_class)
+        policy = self.config.retry_policy.get(failure_class) if self.config.retry_policy is not None else None
+        max_retry, backoff_sec = (self.config.max_retry_per_task, 0) if policy is None else policy
+        if failure_class == "oom":
+            task.min_node_mem = round(node.total_mem_gb * OOM_RETRY_MEM_FACTOR, 1)
+            self.dram_estimator.oom.add(self.dram_estimator.family(task))
+            if all(n.total_mem_gb < task.min_node_mem for n in self.nodes):
+                # oom, no bigger node
+                max_retry = 0
+        n_class = task.failure_classes.count(failure_class)
+        if len(task.failed_nodes) >= self.config.max_retry_per_task or n_class >= max_retry:
+            self.n_dropped += 1
+        elif backoff_sec > 0:
+            self.n_delayed_retries += 1
+            delay = min(backoff_sec * 2 ** (n_class - 1), self.config.retry_backoff_max_sec)
+            self.push(self.now + delay, EV_RETRY, task)
+        else:
+            self.enqueue(task)
+
+    def check_oom(self, node):
+        """
+        the same as Worker.health_monitor_thread_func and return_most_recent_task
+
+        """
+
+        returned = False
+        while should_return_task(self.config, node.total_mem_gb, node.used_mem_gb) and len(node.running) > 0:
+            run = node.running[-1]
+            only_one = len(node.running) == 1
+            self.wasted_core_sec += self.stop_run(run)
+            self.n_returned += 1
+            returned = True
+            if only_one:
+                self.fail_task(run.task, node, "oom")
+            else:
+                self.enqueue(run.task)
+        if returned:
+            self.wake_after_end(node)
+
+    def wake_after_end(self, node):
+        # a full worker checks its tasks every FULL_NODE_POLL_SEC, otherwise between accepting tasks
+        delay = FULL_NODE_POLL_SEC if node.full else self.config.sleep_sec_between_accepting_task
+        node.full = False
+        self.wake(node, self.now + delay)
+
+    ########### events #############
+    def on_wake(self, node):
+        node.next_wake = None
+        cfg = self.config
+        if not can_accept_new_task(cfg, node.total_mem_gb, node.used_mem_gb, node.in_prog_need_dram_gb,
+                                   len(node.running), node.total_core, node.used_core):
+            # woken up again when one of its tasks ends
+            node.full = True
+            return
+        tasks = self.pick_tasks(node)
+        if len(tasks) == 0:
+            # woken up again when a task is added to the queue
+            self.idle_nodes.add(node)
+            return
+        for task in tasks:
+            self.start_task(node, task)
+        self.wake(node, self.now + cfg.sleep_sec_between_accepting_task)
+
+    def on_end(self, run, outcome):
+        if not run.valid:
+            return
+        node, task = run.node, run.task
+        core_sec = self.stop_run(run)
+        if outcome == "finish":
+            self.n_finished += 1
+            self.queue_wait.append(task.first_claim_ts - task.submit_ts)
+            self.turnaround.append(self.now - task.submit_ts)
+            self.last_finish = self.now
+            self.predictor.observe(self.predictor.family(task), task.runtime)
+            if task.peak_mem_gb > 0:
+                self.dram_estimator.observe(self.dram_estimator.family(task), task.peak_mem_gb * GiB / KiB)
+        else:
+            self.wasted_core_sec += core_sec
+            if outcome == "timeout":
+                self.n_timeout += 1
+                self.fail_task(task, node, "timeout")
+            else:
+                self.fail_task(task, node, classify_failure(task.exit_code, ""))
+        self.wake_after_end(node)
+
+    def on_grow(self, run):
+        if not run.valid:
+            return
+        node = run.node
+        node.used_mem_gb += run.task.peak_mem_gb - run.mem_gb
+        run.mem_gb = run.task.peak_mem_gb
+        self.check_oom(node)
+
+    def on_submit(self):
+        t = self.tasks[self.next_submit].submit_ts
+        while self.next_submit < len(self.tasks) and self.tasks[self.next_submit].submit_ts <= t:
+            self.enqueue(self.tasks[self.next_submit])
+            self.next_submit += 1
+        if self.next_submit < len(self.tasks):
+            self.push(self.tasks[self.next_submit].submit_ts, EV_SUBMIT, None)
+
+    def run(self):
+        if len(self.tasks) == 0:
+            return self.report()
+        self.push(self.tasks[0].submit_ts, EV_SUBMIT, None)
+        for node in self.nodes:
+            self.wake(node, self.tasks[0].submit_ts)
+
+        events = self.events
+        while len(events) > 0:
+            t, kind, _, obj = heapq.heappop(events)
+            self.now = t
+            if kind == EV_END:
+                self.on_end(*obj)
+            elif kind == EV_GROW:
+                self.on_grow(obj)
+            elif kind == EV_SUBMIT:
+                self.on_submit()
+            elif kind == EV_RETRY:
+                self.enqueue(obj)
+            elif obj.next_wake == t:
+                self.on_wake(obj)
+        return self.report()
+
+    def report(self):
+        t0 = self.tasks[0].submit_ts if len(self.tasks) > 0 else 0
+        makespan = self.last_finish - t0
+        total_core = sum(n.total_core for n in self.nodes)
+        total_slot = sum(min(n.total_core, self.config.max_task_per_worker) for n in self.nodes)
+        wait = np.asarray(self.queue_wait)
+        turnaround = np.asarray(self.turnaround)
+
+        def pct(a):
+            if len(a) == 0:
+                return {}
+            p50, p95, p99 = np.percentile(a, [50, 95, 99])
+            return {"mean": float(a.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99),
+                    "max": float(a.max())}
+
+        return {
+            "n_tasks": len(self.tasks),
+            "n_nodes": len(self.nodes),
+            "n_finished": self.n_finished,
+            "n_dropped": self.n_dropped,
+            # e.g., tasks that failed on every node they fit on
+            "n_stuck_in_queue": len(self.todo),
+            "n_claims": self.n_claims,
+            "n_returned_oom": self.n_returned,
+            "n_timeout": self.n_timeout,
+            "n_failed_runs": self.n_failed_runs,
+            "n_delayed_retries": self.n_delayed_retries,
+            "makespan_sec": makespan,
+            "core_utilization": self.busy_core_sec / (total_core * makespan) if makespan > 0 else 0,
+            "useful_core_utilization":
+                (self.busy_core_sec - self.wasted_core_sec) / (total_core * makespan) if makespan > 0 else 0,
+            "slot_utilization": self.busy_slot_sec / (total_slot * makespan) if makespan > 0 else 0,
+            "busy_core_hours": self.busy_core_sec / 3600,
+            "wasted_core_hours": self.wasted_core_sec / 3600,
+            "queue_wait_sec": pct(wait),
+            "turnaround_sec": pct(turnaround),
+        }
+
+
+#################################### util #####################################
+def parse_nodes(spec):
+    """
+    "COUNTxMEM_GBxCORES,..." e.g. "90x192x40,10x384x64"
+
+    """
+
+    nodes = []
+    for part in spec.split(","):
+        count, mem, cores = part.lower().split("x")
+        for _ in range(int(count)):
+            nodes.append(VirtualNode("node{}".format(len(nodes)), float(mem), int(cores)))
+    return nodes
+
+
+def sim_config(conf_path=CONFIG_PATH, overrides=None):
+    """
+    a plain copy of the config with overrides, e.g., {"max_task_per_worker": "48"}
+
+    """
+
+    conf = RunnerConfig(conf_path, auto_reload=False)
+    fields = {k: getattr(conf, k) for k in ConfigSnapshot._fields}
+    for k, v in (overrides or {}).items():
+        if k not in fields:
+            raise ValueError("unknown config field {}".format(k))
+        old = fields[k]
+        if k == "retry_policy":
+            fields[k] = parse_retry_policy(
+                json.loads(v), int((overrides or {}).get("max_retry_per_task", fields["max_retry_per_task"])))
+        else:
+            fields[k] = type(old)(v) if old is not None and not isinstance(old, (list, dict)) else json.loads(v)
+    return SimpleNamespace(**fields)
+
+
+def print_report(report):
+    for k, v in report.items():
+        if isinstance(v, dict):
+            print("{:28} {}".format(k, " ".join("{}={:.1f}".format(kk, vv) for kk, vv in v.items())))
+        elif isinstance(v, float):
+            print("{:28} {:.3f}".format(k, v))
+        else:
+            print("{:28} {}".format(k, v))
+
+
+def main():
+    from argparse import ArgumentParser
+    import time
+    parser = ArgumentParser(description="simulate a campaign on a virtual cluster")
+    parser.add_argument("--nodes", type=str, default="100x192x40", help="COUNTxMEM_GBxCORES,...")
+    parser.add_argument("--trace", type=str, default="", help="JSONL or CSV trace, synthetic if empty")
+    parser.add_argument("--from_redis", action="store_true",
+                        help="replay the task timing records in the configured redis")
+    parser.add_argument("--n_tasks", type=int, default=100000, help="number of synthetic tasks")
+    parser.add_argument("--arrival_rate", type=float, default=0,
+                        help="synthetic tasks per second, 0 submits all at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--conf", type=str, default=CONFIG_PATH, help="config file to start from")
+    parser.add_argument("--set", type=str, action="append", default=[],
+                        help="override a config field, e.g., --set max_task_per_worker=48")
+    parser.add_argument("--initial_mem_frac", type=float, default=0.5)
+    parser.add_argument("--ramp_frac", type=float, default=0.2)
+    parser.add_argument("--base_mem_gb", type=float, default=4)
+    parser.add_argument("--output", type=str, default="", help="write the report as JSON")
+    ap = parser.parse_args()
+
+    config = sim_config(ap.conf, dict(kv.split("=", 1) for kv in ap.set))
+    if ap.from_redis:
+        import redis
+        redis_inst = redis.Redis(host=config.redis_host, port=config.redis_port, db=config.redis_db,
+                                 password=config.redis_pass, decode_responses=True)
+        tasks = trace_from_redis(redis_inst)
+    elif ap.trace:
+        tasks = load_trace(ap.trace)
+    else:
+        tasks = synthetic_trace(ap.n_tasks, seed=ap.seed, arrival_rate=ap.arrival_rate)
+
+    start = time.time()
+    sim = ClusterSimulator(config, parse_nodes(ap.nodes), tasks, seed=ap.seed,
+                           initial_mem_frac=ap.initial_mem_frac, ramp_frac=ap.ramp_frac,
+                           base_mem_gb=ap.base_mem_gb)
+    report = sim.run()
+    report["sim_wall_sec"] = time.time() - start
+    print_report(report)
+    if ap.output:
+        with open(ap.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import time
+from collections import namedtuple, Counter
+from threading import Lock
+
+
+"""
+per-task state machine of a worker
+
+a task held by a worker goes through
+    claimed    claimed in redis, its DRAM and slot are reserved, its process is not started yet
+    running    its task runner (or python pool process) runs
+    finishing  one path owns ending it: the process exited, timed out, was cancelled or is returned,
+               that path reports, kills and gives back the pool tokens
+    reported   ended, its result or failure is with the reporter
+    returned   ended, it went back to the to-do queue because the node is low on DRAM
+
+a transition is a compare-and-set, it only happens from the expected states, so when the timeout thread,
+the DRAM monitor and the main loop race to end a task, exactly one of them moves it to finishing and the
+others leave it alone, the reserved DRAM and the slots change in the same step as the state
+
+the tracker serializes the transitions with a short internal lock that only guards a few fields,
+callers never hold a lock while they talk to redis or kill a process, and readers get immutable snapshots
+
+"""
+
+
+class TaskState:
+    CLAIMED = "claimed"
+    RUNNING = "running"
+    FINISHING = "finishing"
+    REPORTED = "reported"
+    RETURNED = "returned"
+
+
+# the states that hold DRAM and a slot, a task is forgotten when it leaves them
+ACTIVE_STATES = (TaskState.CLAIMED, TaskState.RUNNING, TaskState.FINISHING)
+TRANSITIONS = {
+    TaskState.CLAIMED: (TaskState.RUNNING, TaskState.FINISHING),
+    TaskState.RUNNING: (TaskState.FINISHING, ),
+    TaskState.FINISHING: (TaskState.REPORTED, TaskState.RETURNED),
+}
+
+TaskEntry = namedtuple("TaskEntry", ["task", "state", "claim_ts", "start_ts", "proc"])
+
+
+class TaskTracker:
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}  # task -> TaskEntry of the active tasks
+        self.need_dram_gb = 0  # the sum of min_dram_gb of the active tasks
+        self.ended = Counter()  # final state -> number of tasks
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, task):
+        return task in self._entries
+
+    def get(self, task):
+        return self._entries.get(task)
+
+    def state(self, task):
+        entry = self._entries.get(task)
+        return None if entry is None else entry.state
+
+    def entries(self, *states):
+        """
+        a snapshot of the active tasks, of the given states if any
+
+        """
+
+        with self._lock:
+            return [e for e in self._entries.values() if len(states) == 0 or e.state in states]
+
+    def claim(self, task, now=None):
+        """
+        reserve the DRAM and a slot for a claimed task
+
+        """
+
+        with self._lock:
+            if task in self._entries:
+                raise ValueError("task {} is already {}".format(task.task_str, self._entries[task].state))
+            self._entries[task] = TaskEntry(task, TaskState.CLAIMED, time.time() if now is None else now, None, None)
+            self.need_dram_gb += task.min_dram_gb
+
+    def start(self, task, proc, now=None):
+        """
+        claimed -> running
+
+        :return: the start time
+
+        """
+
+        with self._lock:
+            entry = self._entries.get(task)
+            if entry is None or entry.state != TaskState.CLAIMED:
+                raise ValueError("cannot start task {} in state {}".format(
+                    task.task_str, None if entry is None else entry.state))
+            start_ts = time.time() if now is None else now
+            self._entries[task] = entry._replace(state=TaskState.RUNNING, start_ts=start_ts, proc=proc)
+            return start_ts
+
+    def transition(self, task, from_states, to_state):
+        """
+        move a task to to_state if it is in one of from_states
+
+        :return: True if this call moved it, False if the task is in another state or not tracked,
+            e.g., another path ended it first
+
+        """
+
+        with self._lock:
+            entry = self._entries.get(task)
+            if entry is None or entry.state not in from_states:
+                return False
+            if to_state not in TRANSITIONS[entry.state]:
+                raise ValueError("invalid transition of task {} from {} to {}".format(
+                    task.task_str, entry.state, to_state))
+            if to_state in ACTIVE_STATES:
+                self._entries[task] = entry._replace(state=to_state)
+                return True
+            del self._entries[task]
+            self.ended[to_state] += 1
+            # no floating point residue once the node is idle
+            self.need_dram_gb = self.need_dram_gb - task.min_dram_gb if len(self._entries) > 0 else 0
+            return True
+
+    def check_invariants(self):
+        """
+        :return: the violated invariants, empty if there is none
+
+        """
+
+        with self._lock:
+            entries = list(self._entries.values())
+            need_dram_gb = self.need_dram_gb
+        errors = []
+        expected = sum(e.task.min_dram_gb for e in entries)
+        if abs(need_dram_gb - expected) > 1e-6:
+            errors.append("reserved DRAM {} GB, the active tasks need {} GB".format(need_dram_gb, expected))
+        for e in entries:
+            if e.state not in ACTIVE_STATES:
+                errors.append("task {} is tracked in state {}".format(e.task.task_str, e.state))
+            if e.state != TaskState.CLAIMED and e.proc is None:
+                errors.append("task {} is {} without a process".format(e.task.task_str, e.state))
+        return errors
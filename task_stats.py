@@ -0,0 +1,162 @@
+import json
+import logging
+import numpy as np
+from const import *
+from utils import Task, task_family
+from shards import shard_clients
+
+
+"""
+task lifecycle statistics
+
+the records written by the workers (task_timing) are joined with the submission time written by the manager
+(task_submit_time), and the percentiles are computed with vectorized numpy aggregation,
+so a report over millions of tasks takes seconds instead of minutes
+
+"""
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def load_task_timing(redis_inst, scan_count=10000, task_filter=None, family_params=()):
+    """
+    load all task timing records into column arrays
+
+    :param scan_count: the number of records fetched per HSCAN/HMGET round trip
+    :param task_filter: an optional function task_str -> bool
+    :param family_params: see utils.task_family
+
+    """
+
+    cols = {"task": [], "family": [], "worker": [], "status": [],
+            "submit_ts": [], "claim_ts": [], "claim_sec": [], "start_ts": [], "finish_ts": [],
+            "report_ts": [], "exit_code": [], "peak_rss_kb": [], "cpu_sec": []}
+    num_fields = ("claim_ts", "claim_sec", "start_ts", "finish_ts", "report_ts",
+                  "exit_code", "peak_rss_kb", "cpu_sec")
+
+    def add_batch(shard, batch):
+        if len(batch) == 0:
+            return
+        submit_ts = shard.hmget(REDIS_KEY_TASK_SUBMIT_TIME, [t for t, _ in batch])
+        for (task_str, record_str), ts in zip(batch, submit_ts):
+            try:
+                record = json.loads(record_str)
+            except ValueError:
+                logging.warning("cannot parse timing record of task {}".format(task_str))
+                continue
+            cols["task"].append(task_str)
+            cols["family"].append(task_family(Task(task_str), family_params))
+            cols["worker"].append(record.get("worker", ""))
+            cols["status"].append(record.get("status", ""))
+            cols["submit_ts"].append(float(ts) if ts is not None else np.nan)
+            for field in num_fields:
+                v = record.get(field)
+                cols[field].append(float(v) if v is not None else np.nan)
+
+    # the timing record and the submission time of a task are on the same shard
+    for shard in shard_clients(redis_inst):
+        batch = []
+        for task_str, record_str in shard.hscan_iter(REDIS_KEY_TASK_TIMING, count=scan_count):
+            if task_filter is not None and not task_filter(task_str):
+                continue
+            batch.append((task_str, record_str))
+            if len(batch) >= scan_count:
+                add_batch(shard, batch)
+                batch = []
+        add_batch(shard, batch)
+
+    for field in ("submit_ts", ) + num_fields:
+        cols[field] = np.asarray(cols[field], dtype=np.float64)
+    for field in ("task", "family", "worker", "status"):
+        cols[field] = np.asarray(cols[field], dtype=object)
+    return cols
+
+
+def grouped_percentiles(groups, values, quantiles=QUANTILES):
+    """
+    compute the percentiles of values for each group without a python loop over groups,
+    NaN values are ignored, percentiles use linear interpolation (same as np.percentile)
+
+    :param groups: an array of group labels
+    :param values: a float array of the same length
+    :return: (group labels, count per group, array of shape [n_group, len(quantiles)])
+
+    """
+
+    groups = np.asarray(groups)
+    values = np.asarray(values, dtype=np.float64)
+    mask = ~np.isnan(values)
+    labels, codes = np.unique(groups[mask], return_inverse=True)
+    v = values[mask]
+    if len(v) == 0:
+        return labels, np.zeros(0, dtype=np.int64), np.zeros((0, len(quantiles)))
+
+    # sort by group, then by value within a group
+    order = np.lexsort((v, codes))
+    v = v[order]
+    counts = np.bincount(codes, minlength=len(labels))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    pos = (counts - 1)[:, None] * np.asarray(quantiles, dtype=np.float64)[None, :]
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    frac = pos - lo
+    result = v[starts[:, None] + lo] * (1 - frac) + v[starts[:, None] + hi] * frac
+    return labels, counts, result
+
+
+def _print_table(title, groups, queue_wait, runtime):
+    wait_labels, wait_counts, wait_pct = grouped_percentiles(groups, queue_wait)
+    run_labels, run_counts, run_pct = grouped_percentiles(groups, runtime)
+    wait = {label: (n, pct) for label, n, pct in zip(wait_labels, wait_counts, wait_pct)}
+    run = {label: (n, pct) for label, n, pct in zip(run_labels, run_counts, run_pct)}
+
+    print("##" * 24 + "  {}  ".format(title) + "##" * 24)
+    print("{:32} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        title, "n", "wait_p50", "wait_p95", "wait_p99", "run_p50", "run_p95", "run_p99"))
+    nan3 = [np.nan] * len(QUANTILES)
+    for label in sorted(set(wait.keys()) | set(run.keys())):
+        n_wait, w = wait.get(label, (0, nan3))
+        n_run, r = run.get(label, (0, nan3))
+        print("{:32} {:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            str(label)[:32], max(n_wait, n_run), *w, *r))
+    print()
+
+
+def print_task_stats(redis_inst, include_str="", exclude_str="", family_params=()):
+    """
+    print p50/p95/p99 of queue wait (submit -> claim) and runtime (start -> finish) in seconds,
+    per task family and per worker
+
+    """
+
+    def task_filter(task_str):
+        if len(include_str) > 0:
+            return include_str in task_str
+        if len(exclude_str) > 0:
+            return exclude_str not in task_str
+        return True
+
+    cols = load_task_timing(redis_inst, task_filter=task_filter, family_params=family_params)
+    n = len(cols["task"])
+    if n == 0:
+        print("no task timing records")
+        return
+
+    queue_wait = cols["claim_ts"] - cols["submit_ts"]
+    runtime = cols["finish_ts"] - cols["start_ts"]
+    report_delay = cols["report_ts"] - cols["finish_ts"]
+    n_failed = int(np.sum(cols["status"] == "failed"))
+
+    print("{} task records ({} failed), claim time p50 {:.3f}s p99 {:.3f}s, report delay p50 {:.3f}s, "
+          "total cpu {:.1f} core-hours, max peak rss {:.2f} GB\n".format(
+              n, n_failed,
+              np.nanpercentile(cols["claim_sec"], 50) if np.any(~np.isnan(cols["claim_sec"])) else np.nan,
+              np.nanpercentile(cols["claim_sec"], 99) if np.any(~np.isnan(cols["claim_sec"])) else np.nan,
+              np.nanpercentile(report_delay, 50) if np.any(~np.isnan(report_delay)) else np.nan,
+              np.nansum(cols["cpu_sec"]) / 3600,
+              np.nanmax(cols["peak_rss_kb"]) * KiB / GiB if np.any(~np.isnan(cols["peak_rss_kb"])) else np.nan))
+
+    _print_table("family", cols["family"], queue_wait, runtime)
+    _print_table("worker", cols["worker"], queue_wait, runtime)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Test the worker admission decisions that do not depend on redis
+"""
+
+from types import SimpleNamespace
+from utils import Task
+from admission import rank_candidates, select_task_batch, order_by_locality, select_micro_batch
+from predictor import RuntimePredictor
+
+
+CONFIG = SimpleNamespace(min_dram_gb_accept_new_task=8, max_task_per_worker=16)
+
+
+def test_rank_by_priority():
+    tasks = [Task("shell:1:8:1:./a"), Task("shell:5:8:1:./b"), Task("shell:3:8:1:./c")]
+    assert [t.priority for t in rank_candidates(tasks)] == [5, 3, 1]
+
+
+def test_batch_fills_dram_next_to_large_task():
+    tasks = rank_candidates([Task("shell:9:40:1:./huge")] +
+                            [Task("shell:0:8:1:./small {}".format(i)) for i in range(5)])
+    # 64 GB node, 24 GB left after the large task, new tasks need 8 GB free before they are admitted
+    chosen = select_task_batch(CONFIG, tasks, 64, 0, 0, 0, 16, 0, max_tasks=8)
+    assert chosen[0].task_str == "shell:9:40:1:./huge"
+    assert len(chosen) == 4
+
+
+def test_batch_prefers_priority_per_resource():
+    tasks = rank_candidates([Task("shell:9:8:1:./first"), Task("shell:1:32:1:./big"),
+                             Task("shell:1:16:1:./medium"), Task("shell:2:16:1:./medium2")])
+    chosen = select_task_batch(CONFIG, tasks, 64, 0, 0, 0, 16, 0, max_tasks=8)
+    assert [t.task_str for t in chosen] == ["shell:9:8:1:./first", "shell:2:16:1:./medium2",
+                                            "shell:1:16:1:./medium"]
+
+
+def test_batch_respects_slots_and_cores():
+    tasks = [Task("shell:0:1:4:./t {}".format(i)) for i in range(10)]
+    assert len(select_task_batch(CONFIG, tasks, 64, 0, 0, 14, 16, 0, max_tasks=8)) == 2
+    # 16 cores, 2 must stay idle before a new task is admitted
+    assert len(select_task_batch(CONFIG, tasks, 64, 0, 0, 0, 16, 0, max_tasks=8)) == 4
+    assert len(select_task_batch(CONFIG, tasks, 64, 0, 0, 0, 64, 0, max_tasks=3)) == 3
+
+
+def test_locality_delays_tasks_warm_elsewhere():
+    tasks = rank_candidates([Task("shell:9:8:1:./sim a"), Task("shell:5:8:1:./sim b"),
+                             Task("shell:1:8:1:./sim c"), Task("shell:0:8:1:./sim d")])
+    inputs_of = {"shell:9:8:1:./sim a": ["a"], "shell:5:8:1:./sim b": ["b"], "shell:1:8:1:./sim c": ["c"]}
+    # c is warm here, a is warm on another worker, b and d are warm nowhere
+    ordered, n_remote = order_by_locality(tasks, inputs_of, lambda k: k == "c", {"a"}, allow_remote=False)
+    assert [t.task_params for t in ordered] == ["./sim c", "./sim b", "./sim d"]
+    assert n_remote == 1
+    ordered, _ = order_by_locality(tasks, inputs_of, lambda k: k == "c", {"a"}, allow_remote=True)
+    assert [t.task_params for t in ordered] == ["./sim c", "./sim b", "./sim d", "./sim a"]
+
+
+def test_micro_batch_size_follows_history():
+    predictor = RuntimePredictor()
+    predictor.observe("./fast", 0.25)
+    predictor.observe("./slow", 30)
+    tasks = rank_candidates([Task("shell:9:1:1:./fast {}".format(i)) for i in range(30)] +
+                            [Task("shell:9:1:1:./slow 0"), Task("demo:9:1:1:./fast x")])
+    batch = select_micro_batch(tasks, predictor, max_tasks=64, short_task_sec=1, target_sec=5)
+    # about 5 seconds of 0.25 second tasks, only the same family and type
+    assert len(batch) == 20 and batch[0] is tasks[0]
+    assert all(t.task_type == "shell" and t.task_params.startswith("./fast") for t in batch)
+    assert len(select_micro_batch(tasks, predictor, max_tasks=8, short_task_sec=1, target_sec=5)) == 8
+    # long and unknown families are not batched
+    slow = [t for t in tasks if "slow" in t.task_str] + tasks
+    assert len(select_micro_batch(slow, predictor, max_tasks=64, short_task_sec=1, target_sec=5)) == 1
+    assert len(select_micro_batch([Task("shell:1:1:1:./new")] + tasks, predictor, 64, 1, 5)) == 1
+
+
+if __name__ == "__main__":
+    test_rank_by_priority()
+    test_batch_fills_dram_next_to_large_task()
+    test_batch_prefers_priority_per_resource()
+    test_batch_respects_slots_and_cores()
+    test_locality_delays_tasks_warm_elsewhere()
+    test_micro_batch_size_follows_history()
+    print("admission tests passed")
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Test the scheduler benchmark end to end on fakeredis, so that a change of the Worker hooks cannot break it silently
+"""
+
+import os
+import sys
+import json
+import tempfile
+import pytest
+
+
+def test_benchmark_main_on_fakeredis():
+    pytest.importorskip("fakeredis")
+    import benchmark
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output = os.path.join(tmpdir, "bench.json")
+        argv = sys.argv
+        sys.argv = ["benchmark.py", "--fake", "--queue_sizes", "100", "--workers", "1,2",
+                    "--ops_per_worker", "5", "--output", output]
+        try:
+            benchmark.main()
+        finally:
+            sys.argv = argv
+        with open(output) as f:
+            out = json.load(f)
+
+    assert out["env"]["backend"] == "fakeredis"
+    records = {(r["bench"], r["workers"]): r for r in out["results"]}
+    for n_workers in (1, 2):
+        for bench in ("get_task_from_redis", "report_task"):
+            record = records[(bench, n_workers)]
+            assert record["queue_size"] == 100 and record["ops"] > 0
+    assert records[("print_task_status", 1)]["queue_size"] == 100
+    assert records[("add_task_to_redis", 1)]["ops"] == 100
+
+
+if __name__ == "__main__":
+    test_benchmark_main_on_fakeredis()
+    print("benchmark tests passed")
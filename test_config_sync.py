@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Test the config: validated reloads, snapshots and the cluster-wide config published through redis
+"""
+
+import os
+import json
+import time
+import tempfile
+import pytest
+import redis
+
+from const import *
+from utils import RunnerConfig
+from config_sync import publish_config, fetch_config, ConfigSubscriber
+from conftest import make_redis
+
+
+def write_conf(path, **overrides):
+    with open(CONFIG_PATH) as f:
+        conf_data = json.load(f)
+    conf_data["result_dir"] = os.path.join(os.path.dirname(path), "results")
+    conf_data.update(overrides)
+    with open(path, "w") as f:
+        json.dump(conf_data, f)
+    return conf_data
+
+
+def test_reload_and_snapshot():
+    path = os.path.join(tempfile.mkdtemp(), "conf.json")
+    write_conf(path, max_task_per_worker=4, task_family_params=[0])
+    config = RunnerConfig(path, auto_reload=False)
+    snapshot = config.snapshot()
+    assert snapshot.max_task_per_worker == 4 and snapshot.task_family_params == (0,)
+    # validation has no side effects, the worker creates the result directory when it starts
+    assert not os.path.exists(config.result_dir)
+    with pytest.raises(AttributeError):
+        snapshot.max_task_per_worker = 8
+
+    # an invalid file is rejected as a whole and the current config is kept
+    write_conf(path, max_task_per_worker=8, scheduling_policy="random")
+    os.utime(path, (time.time() + 1, time.time() + 1))
+    with pytest.raises(ValueError):
+        config.load_config()
+    assert config.max_task_per_worker == 4 and config.scheduling_policy == "priority"
+
+    write_conf(path, max_task_per_worker=8)
+    os.utime(path, (time.time() + 2, time.time() + 2))
+    config.load_config()
+    assert config.max_task_per_worker == 8 and snapshot.max_task_per_worker == 4
+
+
+def test_publish_and_apply():
+    r = make_redis()
+    path = os.path.join(tempfile.mkdtemp(), "conf.json")
+    conf_data = write_conf(path)
+    config = RunnerConfig(path, auto_reload=False)
+    subscriber = ConfigSubscriber(r, config)
+    assert fetch_config(r) == (0, {}) and not subscriber.sync()
+
+    pushed = dict(conf_data, max_task_per_worker=3, redis_port=1234)
+    assert publish_config(r, pushed) == 1
+    version, conf = fetch_config(r)
+    assert version == 1 and "redis_port" not in conf
+    assert subscriber.sync()
+    # node local fields come from the file of the node
+    assert config.max_task_per_worker == 3 and config.redis_port == conf_data["redis_port"]
+    assert not subscriber.sync()
+
+    with pytest.raises(ValueError):
+        publish_config(r, dict(conf_data, speculation_slowdown=0.5))
+    # a version that does not validate on this node is skipped
+    r.hset(REDIS_KEY_CLUSTER_CONFIG, mapping={"version": 2, "conf": json.dumps({"max_task_per_worker": 0})})
+    assert not subscriber.sync()
+    assert config.max_task_per_worker == 3 and config.cluster_version == 2
+
+
+def test_subscriber_applies_push():
+    pytest.importorskip("fakeredis")
+    from benchmark import FakeRedisServer
+    path = os.path.join(tempfile.mkdtemp(), "conf.json")
+    conf_data = write_conf(path)
+    config = RunnerConfig(path, auto_reload=False)
+    with FakeRedisServer() as server:
+        subscriber = ConfigSubscriber(redis.Redis(connection_pool=server.pool()), config)
+        subscriber.start()
+        try:
+            time.sleep(0.5)
+            publish_config(redis.Redis(connection_pool=server.pool()), dict(conf_data, max_task_per_worker=5))
+            deadline = time.time() + 5
+            while config.max_task_per_worker != 5 and time.time() < deadline:
+                time.sleep(0.05)
+            assert config.max_task_per_worker == 5 and config.cluster_version == 1
+        finally:
+            subscriber.stop()
+
+
+if __name__ == "__main__":
+    test_reload_and_snapshot()
+    test_publish_and_apply()
+    test_subscriber_applies_push()
+    print("config tests passed")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Test task annotations and the critical path used for dependency scheduling
+"""
+
+from const import *
+from utils import split_task_annotations, with_priority, Task
+from dag import critical_path_length, resolve_dependencies, add_dag_tasks_to_redis, restore_dependency_failed
+from fairshare import requeue_tasks
+import redisWorker
+from conftest import make_redis
+
+
+def test_split_task_annotations():
+    assert split_task_annotations("shell:5:8:2:echo hello") == ("shell:5:8:2:echo hello", {})
+    task_str, ann = split_task_annotations("@name=sim1 @after=gen1,gen2  shell:5:8:2:./cachesim t1 lru\n")
+    assert task_str == "shell:5:8:2:./cachesim t1 lru"
+    assert ann == {"name": "sim1", "after": "gen1,gen2"}
+
+
+def test_with_priority():
+    assert with_priority("shell:5:8:2:3600:echo hello", 12) == "shell:12:8:2:3600:echo hello"
+
+
+def test_critical_path_length():
+    deps = {"sim1": ["gen1"], "sim2": ["gen1"], "agg": ["sim1", "sim2", "gen2"]}
+    length = critical_path_length(["gen1", "gen2", "sim1", "sim2", "agg"], deps)
+    assert length == {"gen1": 3, "gen2": 2, "sim1": 2, "sim2": 2, "agg": 1}
+
+
+def test_critical_path_cycle():
+    try:
+        critical_path_length(["a", "b"], {"a": ["b"], "b": ["a"]})
+    except ValueError:
+        return
+    assert False, "cycle not detected"
+
+
+def load_pipeline(r, lines):
+    entries = [split_task_annotations(line) for line in lines]
+    return add_dag_tasks_to_redis(r, resolve_dependencies(r, entries))
+
+
+def run(r, task_str, ok=True):
+    # a worker claims the task and reports it
+    task = Task(task_str)
+    assert r.hdel(REDIS_KEY_TODO_TASKS, task_str) == 1
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task_str, "w0")
+    if ok:
+        redisWorker.report_task_finish("w0", r, task, '"ok"')
+    else:
+        assert not redisWorker.report_task_failed("w0", r, task, "boom", 1)
+
+
+PIPELINE = ["@name=gen1 shell:1:1:1:./gen 1", "@name=gen2 shell:1:1:1:./gen 2",
+            "@name=sim1 @after=gen1 shell:1:1:1:./sim 1", "@name=sim2 @after=gen1,gen2 shell:1:1:1:./sim 2",
+            "@after=sim1,sim2 shell:1:1:1:./agg"]
+
+
+def test_finished_dependencies_unblock_tasks():
+    r = make_redis()
+    assert load_pipeline(r, PIPELINE) == (2, 3)
+    assert r.hget(REDIS_KEY_BLOCKED_TASKS, "shell:1:1:1:./sim 2") == "2"
+    # loading the same lines again adds nothing
+    assert load_pipeline(r, PIPELINE) == (0, 0)
+
+    run(r, "shell:1:1:1:./gen 1")
+    assert sorted(r.hkeys(REDIS_KEY_TODO_TASKS)) == ["shell:1:1:1:./gen 2", "shell:1:1:1:./sim 1"]
+    assert r.hget(REDIS_KEY_BLOCKED_TASKS, "shell:1:1:1:./sim 2") == "1"
+    for task_str in ("shell:1:1:1:./gen 2", "shell:1:1:1:./sim 1", "shell:1:1:1:./sim 2"):
+        run(r, task_str)
+    assert r.hkeys(REDIS_KEY_TODO_TASKS) == ["shell:1:1:1:./agg"] and r.hlen(REDIS_KEY_BLOCKED_TASKS) == 0
+
+    # a task loaded after its dependency finished is claimable at once
+    assert load_pipeline(r, ["@after=gen1 shell:1:1:1:./report"]) == (1, 0)
+
+
+def test_failed_dependency_fails_dependents():
+    r = make_redis()
+    load_pipeline(r, PIPELINE)
+    run(r, "shell:1:1:1:./gen 2")
+    # gen1 fails for good, sim1, sim2 and agg wait for it directly or through them
+    run(r, "shell:1:1:1:./gen 1", ok=False)
+    assert r.hlen(REDIS_KEY_BLOCKED_TASKS) == 0 and r.hlen(REDIS_KEY_TODO_TASKS) == 0
+    assert r.hgetall(REDIS_KEY_DEPENDENCY_FAILED) == {"shell:1:1:1:./sim 1": "1", "shell:1:1:1:./sim 2": "1",
+                                                      "shell:1:1:1:./agg": "2"}
+    assert r.hget(REDIS_KEY_TASK_FAIL_REASON, "shell:1:1:1:./agg") == "dependency failed: shell:1:1:1:./gen 1"
+
+    # the failed task is retried by the manager, its dependents wait for it again
+    assert restore_dependency_failed(r) == 3
+    r.hdel(REDIS_KEY_FAILED_TASKS, "shell:1:1:1:./gen 1")
+    requeue_tasks(r, ["shell:1:1:1:./gen 1"])
+    assert r.hlen(REDIS_KEY_DEPENDENCY_FAILED) == 0 and r.hlen(REDIS_KEY_BLOCKED_TASKS) == 3
+    assert not r.hexists(REDIS_KEY_TASK_FAIL_REASON, "shell:1:1:1:./agg")
+    run(r, "shell:1:1:1:./gen 1")
+    assert sorted(r.hkeys(REDIS_KEY_TODO_TASKS)) == ["shell:1:1:1:./sim 1", "shell:1:1:1:./sim 2"]
+
+
+def test_task_loaded_after_its_dependency_failed():
+    r = make_redis()
+    load_pipeline(r, PIPELINE[:3])
+    run(r, "shell:1:1:1:./gen 1", ok=False)
+    assert r.hgetall(REDIS_KEY_DEPENDENCY_FAILED) == {"shell:1:1:1:./sim 1": "1"}
+
+    # directly after the failed task, or after a task that waits for it
+    assert load_pipeline(r, PIPELINE[3:]) == (0, 0)
+    assert r.hlen(REDIS_KEY_BLOCKED_TASKS) == 0 and r.hkeys(REDIS_KEY_TODO_TASKS) == ["shell:1:1:1:./gen 2"]
+    assert r.hgetall(REDIS_KEY_DEPENDENCY_FAILED) == {"shell:1:1:1:./sim 1": "1", "shell:1:1:1:./sim 2": "2",
+                                                      "shell:1:1:1:./agg": "2"}
+    assert r.hget(REDIS_KEY_TASK_FAIL_REASON, "shell:1:1:1:./agg") == "dependency failed: shell:1:1:1:./gen 1"
+    # loading it again adds nothing
+    assert load_pipeline(r, PIPELINE[3:]) == (0, 0)
+    # they are blocked again when the failed task is retried
+    assert restore_dependency_failed(r) == 3
+    assert r.hlen(REDIS_KEY_BLOCKED_TASKS) == 3
+
+    # a failed task that is retried has not failed for good
+    r2 = make_redis()
+    load_pipeline(r2, PIPELINE[:1])
+    task = Task("shell:1:1:1:./gen 1")
+    r2.hdel(REDIS_KEY_TODO_TASKS, task.task_str)
+    r2.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+    assert redisWorker.report_task_failed("w0", r2, task, "boom", 2)
+    assert load_pipeline(r2, PIPELINE[2:3]) == (0, 1)
+
+
+if __name__ == "__main__":
+    test_split_task_annotations()
+    test_with_priority()
+    test_critical_path_length()
+    test_critical_path_cycle()
+    test_finished_dependencies_unblock_tasks()
+    test_failed_dependency_fails_dependents()
+    test_task_loaded_after_its_dependency_failed()
+    print("dag tests passed")
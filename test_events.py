@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Test the task event stream: event times, the capped length, consumer groups and tailing several shards
+"""
+
+import io
+import time
+from contextlib import redirect_stdout
+import pytest
+
+from const import *
+from shards import ShardedRedis
+import events
+from events import append_event, event_time, EventConsumer, tail_events
+from conftest import make_redis
+
+
+def test_event_time():
+    assert event_time("1700000000123-0") == pytest.approx(1700000000.123)
+    assert event_time("1700000000123-7") == event_time("1700000000123-0")
+    r = make_redis()
+    event_id = append_event(r, EVENT_CLAIM, "shell:1:1:1:./sim", "w0")
+    assert abs(event_time(event_id) - time.time()) < 5
+
+
+def test_stream_is_capped():
+    r = make_redis()
+    maxlen, events.EVENT_STREAM_MAXLEN = events.EVENT_STREAM_MAXLEN, 10
+    try:
+        for i in range(500):
+            append_event(r, EVENT_FINISH, "shell:1:1:1:./sim {}".format(i), "w0", retry=None, exit_code=0)
+    finally:
+        events.EVENT_STREAM_MAXLEN = maxlen
+    # the trimming is approximate, redis keeps whole nodes of the stream
+    assert 10 <= r.xlen(REDIS_KEY_TASK_EVENTS) < 500
+    _, last = r.xrevrange(REDIS_KEY_TASK_EVENTS, count=1)[0]
+    # the fields that are None are left out
+    assert last == {"e": EVENT_FINISH, "t": "shell:1:1:1:./sim 499", "w": "w0", "exit_code": "0"}
+
+
+def test_consumer_redelivers_unacked_events():
+    r = make_redis()
+    for i in range(3):
+        append_event(r, EVENT_CLAIM, "shell:1:1:1:./sim {}".format(i), "w0")
+    consumer = EventConsumer(r, "dashboard", "c0")
+    batch = consumer.read(count=2, block_ms=1)
+    assert [e["t"][-1] for _, e in batch] == ["0", "1"]
+    consumer.ack([batch[0][0]])
+
+    # restarted, the read but not acked event comes first, until it is acked
+    consumer = EventConsumer(r, "dashboard", "c0")
+    batch = consumer.read(block_ms=1)
+    assert [e["t"][-1] for _, e in batch] == ["1"]
+    consumer.ack([event_id for event_id, _ in batch])
+    assert [e["t"][-1] for _, e in consumer.read(block_ms=1)] == ["2"]
+    # another group sees every event
+    assert len(EventConsumer(r, "collector", "c0").read(block_ms=1)) == 3
+
+
+def test_tail_events_pages_over_shards():
+    shards = ShardedRedis([make_redis(), make_redis()])
+    # more events than one read returns on the first shard
+    for i in range(1500):
+        append_event(shards[0], EVENT_FINISH, "shell:1:1:1:./sim {}".format(i), "w0")
+    for i in range(300):
+        append_event(shards[1], EVENT_FAIL, "shell:1:1:1:./agg {}".format(i), "w1", x=1)
+
+    out = io.StringIO()
+    with redirect_stdout(out):
+        tail_events(shards, "tail", "c0", exclude_str="./sim 1", follow=False)
+    lines = out.getvalue().splitlines()
+    # ./sim 1, 10-19, 100-199 and 1000-1499 are excluded
+    assert len(lines) == 1500 - 1 - 10 - 100 - 500 + 300
+    assert sum(1 for line in lines if "./agg" in line and line.endswith(" x=1")) == 300
+    # every event was acked, the group has nothing left to read
+    for shard in shards:
+        assert shard.xpending(REDIS_KEY_TASK_EVENTS, "tail")["pending"] == 0
+    with redirect_stdout(io.StringIO()) as out:
+        tail_events(shards, "tail", "c0", follow=False)
+    assert out.getvalue() == ""
+
+
+if __name__ == "__main__":
+    test_event_time()
+    test_stream_is_capped()
+    test_consumer_redelivers_unacked_events()
+    test_tail_events_pages_over_shards()
+    print("events tests passed")
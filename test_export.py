@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Test the bulk export of finished tasks: columns, batching, formats and incremental exports
+"""
+
+import os
+import csv
+import json
+import time
+import tempfile
+import pytest
+
+from const import *
+from utils import Task
+from shards import ShardedRedis
+import export
+from export import export_results, export_format, parse_result, EXPORT_COLUMNS, EXPORT_LAG_SEC
+import redisWorker
+from conftest import make_redis
+
+
+def finish_tasks(r, names):
+    for name in names:
+        task = Task("shell:2:4:1:./sim {}".format(name))
+        r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+        r.hset(REDIS_KEY_TASK_SUBMIT_TIME, task.task_str, 100)
+        timing = redisWorker.task_timing_record("w0", task, 110.0, 112.5, 0)
+        result = json.dumps("miss rate {}\n".format(name))
+        redisWorker.report_task_finish("w0", r, task, result, timing=timing, family="./sim")
+
+
+def test_incremental_csv_export():
+    r = make_redis()
+    finish_tasks(r, range(5))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "results.csv")
+        # small batches, the rows do not depend on the batch size
+        n, until = export_results(r, path, scan_count=2, now=time.time() + EXPORT_LAG_SEC)
+        assert n == 5 and not os.path.exists(path + ".tmp")
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        assert list(rows[0].keys()) == [c for c, _ in EXPORT_COLUMNS]
+        row = [row for row in rows if row["task"].endswith("./sim 3")][0]
+        assert row["worker"] == "w0" and row["stdout"] == "miss rate 3\n" and row["family"] == "./sim"
+        assert float(row["runtime_sec"]) == 2.5 and float(row["submit_ts"]) == 100 and row["priority"] == "2"
+        assert float(r.hget(REDIS_KEY_EXPORT_WATERMARK, "results")) == until
+
+        # the next export only has the tasks reported since
+        time.sleep(0.01)
+        finish_tasks(r, range(5, 8))
+        n, _ = export_results(r, path, now=time.time() + EXPORT_LAG_SEC)
+        with open(path) as f:
+            assert n == 3 and sorted(row["task"][-1] for row in csv.DictReader(f)) == ["5", "6", "7"]
+        # the tasks reported within the lag wait for a later export
+        finish_tasks(r, [8])
+        assert export_results(r, path)[0] == 0
+        assert export_results(r, path, now=time.time() + EXPORT_LAG_SEC)[0] == 1
+        # another export name starts from the beginning
+        assert export_results(r, path, name="all", task_filter=lambda t: "./sim 1" in t,
+                              now=time.time() + EXPORT_LAG_SEC)[0] == 1
+
+
+class FailingWriter:
+    def __init__(self, path):
+        open(path, "w").close()
+
+    def write(self, rows):
+        if len(rows) > 0:
+            raise OSError("disk full")
+
+    def close(self):
+        pass
+
+
+def test_untimed_tasks_are_written_once():
+    r = make_redis()
+    finish_tasks(r, range(4))
+    r.hset(REDIS_KEY_FINISHED_TASKS, "shell:1:1:1:./old", 'w9: "done"')
+    shards = ShardedRedis([r])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "results.jsonl")
+        # an export that fails does not count its untimed tasks as written
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setitem(export.EXPORT_WRITERS, "jsonl", FailingWriter)
+            with pytest.raises(OSError):
+                export_results(shards, path, name="failed", scan_count=3, now=time.time() + EXPORT_LAG_SEC)
+        assert export_results(shards, path, name="failed", now=time.time() + EXPORT_LAG_SEC)[0] == 5
+
+        assert export_results(shards, path, scan_count=3, now=time.time() + EXPORT_LAG_SEC)[0] == 5
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        old = [row for row in rows if row["task"] == "shell:1:1:1:./old"][0]
+        assert old["worker"] == "w9" and old["report_ts"] is None
+
+        # the untimed task is not in the next exports, a new one is
+        assert export_results(shards, path, now=time.time() + EXPORT_LAG_SEC)[0] == 0
+        r.hset(REDIS_KEY_FINISHED_TASKS, "shell:1:1:1:./old 2", 'w9: "done"')
+        assert export_results(shards, path, now=time.time() + EXPORT_LAG_SEC)[0] == 1
+        assert r.scard(REDIS_KEY_EXPORT_UNTIMED_PREFIX + "results") == 2
+        assert not r.exists(REDIS_KEY_EXPORT_UNTIMED_PREFIX + "results:pending")
+
+
+def test_jsonl_and_parquet_export():
+    r = make_redis()
+    finish_tasks(r, range(3))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "results.jsonl")
+        assert export_results(r, path, now=time.time() + EXPORT_LAG_SEC)[0] == 3
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        assert rows[0]["exit_code"] == 0 and rows[0]["min_dram_gb"] == 4 and rows[0]["report_ts"] > 0
+        assert parse_result("w1: stdout is too large") == ("w1", "stdout is too large")
+        with pytest.raises(ValueError):
+            export_format("results.xlsx")
+
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            with pytest.raises(RuntimeError):
+                export_format("results.parquet")
+            return
+        path = os.path.join(tmpdir, "results.parquet")
+        assert export_results(r, path, name="parquet", scan_count=2, now=time.time() + EXPORT_LAG_SEC)[0] == 3
+        table = pq.read_table(path)
+        assert table.num_rows == 3 and table.column_names == [c for c, _ in EXPORT_COLUMNS]
+
+
+if __name__ == "__main__":
+    test_incremental_csv_export()
+    test_untimed_tasks_are_written_once()
+    test_jsonl_and_parquet_export()
+    print("export tests passed")
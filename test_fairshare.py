@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Test weighted fair share across owners: stride selection, priority aging and requeued tasks
+"""
+
+import tempfile
+from collections import Counter
+import pytest
+
+from const import *
+from utils import RunnerConfig, END_OF_TASK
+from fairshare import select_fair_share, queue_score, queue_key
+import redisWorker
+import redisManager
+from conftest import write_tasks
+
+
+def test_select_fair_share():
+    heads = {"alice": (0, ["a{}".format(i) for i in range(10)]),
+             "bob": (0, ["b{}".format(i) for i in range(10)]),
+             "carol": (0, ["c-big"])}
+    picked = select_fair_share(heads, {"alice": "2"}, lambda t: t != "c-big", 9)
+    owners = Counter(owner for owner, _, _ in picked)
+    assert owners == {"alice": 6, "bob": 3}
+    # each owner is served in queue order
+    assert [t for o, t, _ in picked if o == "bob"] == ["b0", "b1", "b2"]
+    assert {inc for o, _, inc in picked if o == "alice"} == {0.5}
+
+
+def test_priority_aging():
+    # one priority level is worth an hour of waiting
+    old_low = queue_score("shell:1:1:1:./a", 0, 3600)
+    new_high = queue_score("shell:3:1:1:./b", 3 * 3600, 3600)
+    newer_high = queue_score("shell:3:1:1:./c", 3 * 3600 + 10, 3600)
+    assert new_high < newer_high and old_low < newer_high
+
+
+def test_workers_claim_by_weight():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        worker = BenchWorker("w0", server.pool(), config)
+        r = worker.redis_inst
+        # alice loads first and more, and with a higher priority
+        redisManager.add_task_to_redis(r, write_tasks(tmpdir, "a", ["shell:5:1:1:./a {}".format(i)
+                                                                   for i in range(100)]), owner="alice")
+        redisManager.add_task_to_redis(r, write_tasks(tmpdir, "b", ["shell:1:1:1:./b {}".format(i)
+                                                                   for i in range(20)] +
+                                                      ["@owner=carol shell:1:1:1:./c 0"]), owner="bob")
+        redisManager.set_owner_weight(r, "alice", 3)
+        assert r.zcard(queue_key("alice")) == 100 and r.zcard(queue_key("carol")) == 1
+
+        claimed = [worker.get_task_from_redis() for _ in range(25)]
+        owners = Counter(t.task_params[:3] for t in claimed)
+        # alice gets 3 claims per claim of bob once carol's only task is taken
+        assert owners == {"./a": 18, "./b": 6, "./c": 1}
+        assert r.hlen(REDIS_KEY_IN_PROGRESS_TASKS) == 25 and r.hlen(REDIS_KEY_TODO_TASKS) == 96
+
+        # a retried task goes back to the queue of its owner, the worker that failed it leaves it to others
+        failed = next(t for t in claimed if t.task_params.startswith("./b"))
+        assert redisWorker.report_task_failed("w0", r, failed, "boom", 3)
+        assert r.zscore(queue_key("bob"), failed.task_str) is not None
+        again = [worker.get_task_from_redis() for _ in range(10)]
+        assert failed.task_str not in {t.task_str for t in again}
+        assert failed.task_str in worker.failed_queued_tasks
+
+        # a task claimed by the scan of todo_tasks leaves a member that the next claim drops
+        r.hdel(REDIS_KEY_TODO_TASKS, "shell:5:1:1:./a 99")
+        r.zadd(queue_key("alice"), {"shell:5:1:1:./a 99": -1e12})
+        task = worker.get_task_from_redis()
+        assert task.task_str != "shell:5:1:1:./a 99"
+        assert r.zscore(queue_key("alice"), "shell:5:1:1:./a 99") is None
+
+        r.hset(REDIS_KEY_TODO_TASKS, WORKER_STOP_COMMAND, "")
+        assert worker.get_tasks_from_redis(1) is END_OF_TASK
+
+
+def test_new_owner_starts_at_active_pass():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        worker = BenchWorker("w0", server.pool(), config)
+        r = worker.redis_inst
+        redisManager.add_task_to_redis(r, write_tasks(tmpdir, "a", ["shell:1:1:1:./a {}".format(i)
+                                                                   for i in range(20)]), owner="alice")
+        for _ in range(10):
+            worker.get_task_from_redis()
+        # bob comes late and does not get the 10 claims alice had alone
+        redisManager.add_task_to_redis(r, write_tasks(tmpdir, "b", ["shell:1:1:1:./b {}".format(i)
+                                                                   for i in range(20)]), owner="bob")
+        assert r.zscore(REDIS_KEY_OWNER_PASS, "bob") == r.zscore(REDIS_KEY_OWNER_PASS, "alice") == 10
+        owners = Counter(worker.get_task_from_redis().task_params[:3] for _ in range(10))
+        assert owners == {"./a": 5, "./b": 5}
+
+
+def test_batch_claim_of_owned_tasks_fits_the_node():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        worker = BenchWorker("w0", server.pool(), config, total_core=8)
+        worker.admission_policy = "binpack"
+        r = worker.redis_inst
+        for owner in ("alice", "bob"):
+            redisManager.add_task_to_redis(r, write_tasks(tmpdir, owner, ["shell:1:4:2:./{} {}".format(owner, i)
+                                                                         for i in range(10)]), owner=owner)
+
+        # the 2-core tasks fill the 8 cores, in fair-share order
+        claimed = worker.get_tasks_from_redis(worker.max_tasks_per_claim())
+        assert sum(t.require_cpu_core for t in claimed) == 8
+        assert Counter(t.owner for t in claimed) == {"alice": 2, "bob": 2}
+        assert r.zscore(REDIS_KEY_OWNER_PASS, "alice") == r.zscore(REDIS_KEY_OWNER_PASS, "bob") == 2
+        assert r.hlen(REDIS_KEY_IN_PROGRESS_TASKS) == 4 and r.zcard(queue_key("alice")) == 8
+        for task in claimed:
+            worker.tasks.claim(task)
+        worker.used_core = 8
+        assert not worker.can_take_new_task()
+
+        # the task slots bound a claim too
+        worker.used_core = 0
+        config.max_task_per_worker = 5
+        assert len(worker.get_tasks_from_redis(worker.max_tasks_per_claim())) == 1
+        assert worker.metrics.claim_conflicts.values == {}
+
+
+if __name__ == "__main__":
+    test_select_fair_share()
+    test_priority_aging()
+    test_workers_claim_by_weight()
+    test_new_owner_starts_at_active_pass()
+    test_batch_claim_of_owned_tasks_fits_the_node()
+    print("fair share tests passed")
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Test the local result journal: durability across reopen, torn records, and replay after a redis outage
+"""
+
+import os
+import time
+import tempfile
+from types import SimpleNamespace
+import pytest
+
+from const import *
+from utils import RunnerConfig, Task
+from shards import ShardedRedis
+from journal import ResultJournal, journal_path
+from reporter import ResultReporter
+import redisWorker
+from conftest import make_redis
+
+
+class DownRedis:
+    # a shard that is unreachable
+    def pipeline(self, transaction=True):
+        raise ConnectionError("redis is down")
+
+
+def make_config():
+    return SimpleNamespace(result_flush_interval_sec=0.01, max_retry_per_task=4, task_family_params=[],
+                           retry_policy=None, retry_backoff_max_sec=0)
+
+
+def test_journal_keeps_unacked_records():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = journal_path("w0", tmpdir)
+        journal = ResultJournal(path)
+        reports = [{"task": Task("shell:1:1:1:./sim {}".format(i)), "status": "finished", "msg": '"ok"',
+                    "timing": None, "event": EVENT_FAIL} for i in range(3)]
+        journal.append(reports)
+        journal.ack(reports[:1])
+        journal.close()
+        # the worker died in the middle of a write
+        with open(path, "a") as f:
+            f.write('{"seq": 4, "task": "shell:1:1')
+
+        journal = ResultJournal(path)
+        replayed = journal.replay()
+        assert [r["task"].task_str for r in replayed] == [r["task"].task_str for r in reports[1:]]
+        assert replayed[0]["status"] == "finished" and replayed[0]["msg"] == '"ok"'
+        # the sequence continues after the records of the previous run
+        more = [{"task": Task("shell:1:1:1:./sim 3"), "status": "failed", "msg": "", "timing": None,
+                 "event": EVENT_FAIL}]
+        journal.append(more)
+        assert more[0]["seq"] == 4 and len(journal) == 3
+
+        # the file is truncated once everything is acked
+        journal.ack(replayed + more)
+        assert len(journal) == 0 and os.path.getsize(path) == 0
+        journal.close()
+        assert ResultJournal(path).replay() == []
+
+
+def test_results_survive_redis_outage():
+    r = make_redis()
+    tasks = [Task("shell:1:1:1:./sim {}".format(i)) for i in range(3)]
+    for task in tasks:
+        r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+    config = make_config()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = journal_path("w0", tmpdir)
+        reporter = ResultReporter("w0", ShardedRedis([DownRedis()]), config, journal=ResultJournal(path))
+        reporter.start()
+        for task in tasks[:2]:
+            timing = redisWorker.task_timing_record("w0", task, time.time(), time.time(), 0)
+            reporter.submit(task, "finished", '"done"', timing)
+        time.sleep(0.1)
+        assert reporter.flush_failures > 0
+        # the stop does not wait for redis, the results stay in the journal
+        reporter.stop()
+        assert len(reporter.pending) == 2
+
+        # the restarted worker replays them before it returns its in-progress tasks
+        reporter = ResultReporter("w0", ShardedRedis([r]), config, journal=ResultJournal(path))
+        assert reporter.replay_journal() == set()
+        assert all(r.hexists(REDIS_KEY_FINISHED_TASKS, task.task_str) for task in tasks[:2])
+        assert [task for task in r.hkeys(REDIS_KEY_IN_PROGRESS_TASKS)] == [tasks[2].task_str]
+        assert os.path.getsize(path) == 0
+
+
+def test_reset_task_keeps_journaled_tasks():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server:
+        worker = BenchWorker("w0", server.pool(), config)
+        r = worker.redis_inst
+        done, lost = "shell:1:1:1:./sim done", "shell:1:1:1:./sim lost"
+        r.hset(REDIS_KEY_IN_PROGRESS_TASKS, mapping={done: "w0", lost: "w0"})
+        worker.reset_task(keep={done})
+        assert r.hget(REDIS_KEY_IN_PROGRESS_TASKS, done) == "w0"
+        assert not r.hexists(REDIS_KEY_IN_PROGRESS_TASKS, lost) and r.hexists(REDIS_KEY_TODO_TASKS, lost)
+
+
+if __name__ == "__main__":
+    test_journal_keeps_unacked_records()
+    test_results_survive_redis_outage()
+    test_reset_task_keeps_journaled_tasks()
+    print("journal tests passed")
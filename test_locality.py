@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test data locality: the warm inputs of a worker, sampling local tasks and delay scheduling of the claims
+"""
+
+import os
+import json
+import time
+import tempfile
+import pytest
+
+from const import *
+from utils import RunnerConfig, EMPTY_TASK
+from locality import WarmInputs, index_task_inputs, sample_local_tasks
+import redisManager
+from conftest import make_redis, write_tasks
+
+
+def test_warm_inputs_lru():
+    warm = WarmInputs(capacity=3)
+    warm.touch(["a", "b", "c"])
+    # a is used again, b is the least recently used one
+    warm.touch(["a", "d"])
+    assert warm.keys() == ["c", "a", "d"]
+    assert warm.is_warm("a") and not warm.is_warm("b")
+    assert WarmInputs(capacity=0).keys() == []
+
+
+def test_local_data_dir_is_warm():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        open(os.path.join(tmpdir, "w1.bin"), "w").close()
+        warm = WarmInputs(capacity=2, local_data_dir=tmpdir, scan_interval_sec=3600)
+        warm.touch(["traces/w9.bin"])
+        assert warm.keys() == ["traces/w9.bin", "w1.bin"]
+        # an input is matched by its file name
+        assert warm.is_warm("traces/w1.bin")
+        # the directory is listed again only after scan_interval_sec
+        open(os.path.join(tmpdir, "w2.bin"), "w").close()
+        assert not warm.is_warm("w2.bin") and "w2.bin" not in warm.keys()
+        warm.scan(force=True)
+        assert warm.is_warm("traces/w2.bin")
+
+
+def test_sample_local_tasks():
+    r = make_redis()
+    todo = ["shell:1:1:1:./sim a {}".format(i) for i in range(3)]
+    done = "shell:1:1:1:./sim a done"
+    for task_str in todo + [done]:
+        index_task_inputs(r, task_str, ["a"])
+    index_task_inputs(r, "shell:1:1:1:./sim b", ["b"])
+    r.hset(REDIS_KEY_TODO_TASKS, mapping={t: "" for t in todo + ["shell:1:1:1:./sim b"]})
+    r.hset(REDIS_KEY_FINISHED_TASKS, done, 'w0: "ok"')
+
+    assert sample_local_tasks(r, []) == {}
+    assert set(sample_local_tasks(r, ["a"])) == set(todo)
+    # the finished task is dropped from the index on the way
+    assert not r.sismember(REDIS_KEY_INPUT_TASKS_PREFIX + "a", done)
+    assert len(sample_local_tasks(r, ["a", "b"], per_key=1)) == 2
+
+
+def test_claims_wait_for_local_tasks_then_fall_back():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    config.locality_wait_sec = 10
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        worker = BenchWorker("w0", server.pool(), config)
+        r = worker.redis_inst
+        redisManager.add_task_to_redis(r, write_tasks(tmpdir, "task", [
+            "@inputs=a shell:9:1:1:./sim a", "@inputs=c shell:1:1:1:./sim c", "@inputs=z shell:0:1:1:./sim z"]))
+        # c is warm here, a is warm on w1, z is warm nowhere
+        worker.warm_inputs.touch(["c"])
+        r.hset(REDIS_KEY_WORKER_WARM_INPUTS, "w1", json.dumps(["a"]))
+
+        assert worker.get_task_from_redis().task_params == "./sim c"
+        assert worker.get_task_from_redis().task_params == "./sim z"
+        # a is left to w1 for locality_wait_sec
+        assert worker.get_task_from_redis() is EMPTY_TASK
+        assert worker.locality_wait_start is not None
+        assert worker.get_task_from_redis() is EMPTY_TASK
+        worker.locality_wait_start -= config.locality_wait_sec
+        task = worker.get_task_from_redis()
+        assert task.task_params == "./sim a" and worker.warm_inputs.is_warm("a")
+        assert r.hlen(REDIS_KEY_TODO_TASKS) == 0
+
+
+if __name__ == "__main__":
+    test_warm_inputs_lru()
+    test_local_data_dir_is_warm()
+    test_sample_local_tasks()
+    test_claims_wait_for_local_tasks_then_fall_back()
+    print("locality tests passed")
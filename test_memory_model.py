@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Test learned DRAM requirements: peak memory histograms per family, quantile estimates and admission with them
+"""
+
+import io
+import sys
+import json
+import time
+import tempfile
+from types import SimpleNamespace
+from contextlib import redirect_stdout
+import pytest
+
+from const import *
+from utils import RunnerConfig, Task, EMPTY_TASK
+from memory_model import DramEstimator, peak_mem_bucket, bucket_upper_gb, print_dram_status
+from task_state import TaskState
+import redisWorker
+import redisManager
+from conftest import make_redis, write_tasks
+
+
+def test_quantile_estimate():
+    estimator = DramEstimator(mode="learned", quantile=0.9, min_samples=10, headroom=1.0)
+    # 9 runs peak at 1 GB, one at 8 GB
+    for _ in range(9):
+        estimator.observe("./sim", 1024 * 1024)
+    estimator.observe("./sim", 8 * 1024 * 1024)
+    assert estimator.quantile_gb("./sim") == pytest.approx(1.0)
+    assert estimator.quantile_gb("./sim", 1.0) == pytest.approx(8.0)
+    # a peak is rounded up to its bucket, at most 19% above it
+    assert 3.0 <= bucket_upper_gb(peak_mem_bucket(3 * 1024 * 1024)) <= 3.0 * 2 ** 0.25
+
+    big, small = Task("shell:1:64:1:./sim a"), Task("shell:1:0:1:./sim b")
+    assert estimator.need_dram_gb(big) == 1.0 and estimator.need_dram_gb(small) == 1.0
+    estimator.mode = "capped"
+    assert estimator.need_dram_gb(big) == 1.0 and estimator.need_dram_gb(small) == 0
+    estimator.mode = "declared"
+    assert estimator.need_dram_gb(big) == 64
+    # too few runs, the declared DRAM is used
+    estimator.mode, estimator.min_samples = "learned", 11
+    assert estimator.need_dram_gb(big) == 64
+
+
+def test_workers_admit_with_learned_dram():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    config.dram_estimate = "learned"
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        worker = BenchWorker("w0", server.pool(), config, total_mem_gb=256)
+        r = worker.redis_inst
+        path = write_tasks(tmpdir, "task", ["shell:1:200:1:./sim {}".format(i) for i in range(25)])
+        redisManager.add_task_to_redis(r, path)
+
+        # the first runs are admitted with the declared 200 GB, one at a time
+        for _ in range(config.dram_estimate_min_samples):
+            task = worker.get_task_from_redis()
+            worker.tasks.claim(task)
+            assert task.min_dram_gb == 200 and worker.get_task_from_redis() is EMPTY_TASK
+            timing = redisWorker.task_timing_record("w0", task, time.time(), time.time(), 0)
+            timing["peak_rss_kb"] = 3 * 1024 * 1024
+            redisWorker.report_task_finish("w0", r, task, '"ok"', timing=timing, family="./sim")
+            worker.tasks.transition(task, (TaskState.CLAIMED, ), TaskState.FINISHING)
+            worker.tasks.transition(task, (TaskState.FINISHING, ), TaskState.REPORTED)
+        assert sum(int(n) for n in r.hvals(REDIS_KEY_FAMILY_PEAK_MEM)) == config.dram_estimate_min_samples
+
+        # then the family needs about 4 GB, and the tasks share the node
+        worker.dram_estimator.refresh(r, force=True)
+        first = worker.get_task_from_redis()
+        worker.tasks.claim(first)
+        second = worker.get_task_from_redis()
+        assert first.min_dram_gb == second.min_dram_gb < 5
+
+        out = io.StringIO()
+        with redirect_stdout(out):
+            print_dram_status(r, worker.dram_estimator)
+        row = [line for line in out.getvalue().splitlines() if line.startswith("./sim")][0]
+        assert row.split()[1:3] == [str(config.dram_estimate_min_samples), "200.00"]
+
+        # a run out of memory, the family is admitted with the declared DRAM again
+        assert redisWorker.report_task_failed("w0", r, first, "MemoryError", 4, family="./sim")
+        assert r.hget(REDIS_KEY_FAMILY_OOM, "./sim") == "1"
+        worker.dram_estimator.refresh(r, force=True)
+        assert worker.dram_estimator.need_dram_gb(Task("shell:1:200:1:./sim x")) == 200
+        assert worker.dram_estimator.need_dram_gb(Task("shell:1:2:1:./sim x")) < 5
+
+
+def test_shared_peaks_are_not_learned():
+    r = make_redis()
+    task = Task("shell:1:8:1:./sim 0")
+    usage = SimpleNamespace(ru_maxrss=3 * 1024 * 1024, ru_utime=1, ru_stime=0)
+    for peak_shared in (False, True):
+        r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+        timing = redisWorker.task_timing_record("w0", task, time.time(), time.time(), 0, usage, peak_shared)
+        redisWorker.report_task_finish("w0", r, task, '"ok"', timing=timing, family="./sim")
+        r.hdel(REDIS_KEY_FINISHED_TASKS, task.task_str)
+    # only the run that had its process alone is in the histogram, both keep their peak in the timing record
+    assert sum(int(n) for n in r.hvals(REDIS_KEY_FAMILY_PEAK_MEM)) == 1
+    assert json.loads(r.hget(REDIS_KEY_TASK_TIMING, task.task_str))["peak_shared"]
+
+
+def test_peak_covers_all_task_processes():
+    from multiprocessing import Pipe
+    from redisWorker import TaskRunner
+    grow = "{} -c \"b = b'x' * (100 << 20); import time; time.sleep(1)\"".format(sys.executable)
+    task = Task("shell:1:1:1:{} & {} & wait".format(grow, grow))
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False).snapshot()
+    recv, send = Pipe(duplex=False)
+    assert TaskRunner("w0", send, task, config).run_task(task) == 0
+    # two processes of 100 MiB each, ru_maxrss alone is the peak of one of them
+    assert recv.recv()["timing"]["peak_rss_kb"] > 180 * 1024
+
+
+if __name__ == "__main__":
+    test_quantile_estimate()
+    test_workers_admit_with_learned_dram()
+    test_shared_peaks_are_not_learned()
+    test_peak_covers_all_task_processes()
+    print("memory model tests passed")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test the metrics registry and exporter: exposition format of each metric type, label escaping and scrapes
+"""
+
+import urllib.request
+import urllib.error
+import pytest
+
+from metrics import Registry, MetricsServer, WorkerMetrics
+
+
+def scrape(server, path="/metrics"):
+    port = server.httpd.server_address[1]
+    with urllib.request.urlopen("http://127.0.0.1:{}{}".format(port, path), timeout=5) as resp:
+        return resp.headers["Content-Type"], resp.read().decode("utf-8")
+
+
+def test_exposition_format():
+    r = Registry()
+    claimed = r.counter("claimed", "claimed tasks")
+    completed = r.counter("completed", "finished runners", ("status", ))
+    mem = r.gauge("mem_gb", "node memory", ("kind", ))
+    latency = r.histogram("latency_seconds", "claim latency", ("result", ), buckets=(0.1, 1))
+    claimed.inc()
+    claimed.inc(2)
+    completed.inc(status="ok")
+    mem.set(192, kind="total")
+    mem.set(12.5, kind="used")
+    mem.dec(0.5, kind="used")
+    for v in (0.05, 0.5, 0.7, 3):
+        latency.observe(v, result="task")
+
+    lines = r.render().splitlines()
+    assert lines[:3] == ["# HELP claimed claimed tasks", "# TYPE claimed counter", "claimed_total 3.0"]
+    assert 'completed_total{status="ok"} 1.0' in lines
+    assert "# TYPE mem_gb gauge" in lines
+    assert 'mem_gb{kind="total"} 192.0' in lines and 'mem_gb{kind="used"} 12.0' in lines
+    # the buckets are cumulative and end with +Inf
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{result="task",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{result="task",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{result="task",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{result="task"} 4.25' in lines
+    assert 'latency_seconds_count{result="task"} 4' in lines
+    assert lines[-1] == "# EOF"
+
+    with pytest.raises(ValueError):
+        completed.inc(result="ok")
+
+
+def test_label_escaping():
+    r = Registry()
+    rss = r.gauge("rss_bytes", "task rss", ("pid", "task"))
+    rss.replace({("42", 'shell:1:1:1:echo "a\\b"\nc'): 1024})
+    assert r.render().splitlines()[2] == 'rss_bytes{pid="42",task="shell:1:1:1:echo \\"a\\\\b\\"\\nc"} 1024.0'
+
+
+def test_redis_rtt_timer():
+    m = WorkerMetrics()
+    with m.redis_rtt.time(op="claim"):
+        pass
+    # an error is still timed
+    with pytest.raises(ConnectionError):
+        with m.redis_rtt.time(op="report"):
+            raise ConnectionError("redis is down")
+    counts, total = m.redis_rtt.values[("claim", )]
+    assert sum(counts) == 1 and 0 <= total < 1
+    assert sum(m.redis_rtt.values[("report", )][0]) == 1
+    assert ("claim_scan", ) not in m.redis_rtt.values
+
+
+def test_scrape_metrics_server():
+    m = WorkerMetrics()
+    scrapes = []
+    m.tasks_claimed.inc(5)
+    server = MetricsServer(m.registry, 0, host="127.0.0.1",
+                           before_scrape=lambda: scrapes.append(1) or m.running_tasks.set(len(scrapes)))
+    server.start()
+    try:
+        content_type, body = scrape(server)
+        assert content_type.startswith("application/openmetrics-text")
+        assert "distcomp_tasks_claimed_total 5.0" in body.splitlines()
+        # the gauges are refreshed before each scrape
+        assert "distcomp_running_tasks 1.0" in body.splitlines()
+        assert "distcomp_running_tasks 2" in scrape(server, "/")[1]
+        with pytest.raises(urllib.error.HTTPError) as e:
+            scrape(server, "/other")
+        assert e.value.code == 404
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    test_exposition_format()
+    test_label_escaping()
+    test_redis_rtt_timer()
+    test_scrape_metrics_server()
+    print("metrics tests passed")
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Test cluster-wide resource pools: token leases, expiry, and workers skipping tasks of exhausted pools
+"""
+
+import tempfile
+import pytest
+
+from const import *
+from utils import RunnerConfig, Task, EMPTY_TASK
+from pools import acquire_pools, release_pools, exhausted_pools, set_pool_capacity, parse_pool_capacities, \
+    release_worker_leases, lease_key
+import redisManager
+from conftest import make_redis, write_tasks
+
+
+def test_acquire_and_lease_expiry():
+    r = make_redis()
+    set_pool_capacity(r, parse_pool_capacities("io=2,license=1"))
+    now = 1000.0
+    assert acquire_pools(r, "w1", "t1", ["io"], now, 60) is None
+    # all or none, the io token is not taken when license is full
+    assert acquire_pools(r, "w1", "t2", ["io", "license"], now, 60) is None
+    assert acquire_pools(r, "w2", "t3", ["io", "license"], now, 60) == "io"
+    assert r.zcard(lease_key("io")) == 2 and exhausted_pools(r, {"io": 2, "license": 1}, now) == {"io", "license"}
+
+    # the leases of a worker that stops renewing them expire
+    assert acquire_pools(r, "w2", "t3", ["io", "license"], now + 61, 60) is None
+    assert sorted(r.zrange(lease_key("io"), 0, -1)) == ["w2 t3"]
+
+    t3 = Task("shell:1:1:1:./x")
+    t3.task_str, t3.pools = "t3", ["io", "license"]
+    release_pools(r, "w2", [t3])
+    assert exhausted_pools(r, {"io": 2, "license": 1}, now + 61) == set()
+    # a pool without a capacity is not limited
+    assert all(acquire_pools(r, "w1", "u{}".format(i), ["scratch"], now, 60) is None for i in range(5))
+    release_worker_leases(r, ["w1"])
+    assert r.zcard(lease_key("scratch")) == 0
+
+
+def test_worker_skips_tasks_of_exhausted_pools():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        worker = BenchWorker("w0", server.pool(), config)
+        r = worker.redis_inst
+        set_pool_capacity(r, {"io": 1})
+        redisManager.add_task_to_redis(r, write_tasks(tmpdir, "t", [
+            "@pools=io shell:9:1:1:./io 0", "@pools=io shell:8:1:1:./io 1", "shell:1:1:1:./cpu 0"]))
+        redisManager.add_task_to_redis(r, write_tasks(tmpdir, "o", [
+            "@pools=io shell:9:1:1:./io q", "shell:1:1:1:./cpu q"]), owner="alice")
+
+        first = worker.get_task_from_redis()
+        assert first.pools == ["io"] and r.zcard(lease_key("io")) == 1
+        # the other io tasks wait for the token, through the owner queue and the scan of todo_tasks
+        second, third = worker.get_task_from_redis(), worker.get_task_from_redis()
+        assert {second.task_params, third.task_params} == {"./cpu q", "./cpu 0"}
+        assert worker.get_task_from_redis() is EMPTY_TASK
+
+        # the token is given back when the task ends
+        worker.release_task_pools(first)
+        assert worker.get_task_from_redis().pools == ["io"]
+        assert r.hlen(REDIS_KEY_TODO_TASKS) == 1
+
+
+if __name__ == "__main__":
+    test_acquire_and_lease_expiry()
+    test_worker_skips_tasks_of_exhausted_pools()
+    print("pool tests passed")
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Test campaign progress: throughput windows, ETA projections and forwarding of task progress lines
+"""
+
+import os
+import time
+from multiprocessing import Pipe
+import pytest
+
+from const import *
+from utils import RunnerConfig, Task
+from predictor import RuntimePredictor
+from progress import campaign_progress, progress_file, read_last_line
+import redisWorker
+from conftest import make_redis
+
+
+def test_throughput_and_eta():
+    r = make_redis()
+    now = 1700000000.0
+    # w1 finished a task every 10s over the last 20 minutes, w2 one every 60s over the last 5 minutes
+    events = [(now - 1200 + i * 10, EVENT_FINISH, "w1") for i in range(120)] + \
+        [(now - 300 + i * 60, EVENT_FINISH, "w2") for i in range(5)] + [(now - 0.005, EVENT_CLAIM, "w2")]
+    for i, (ts, event, worker) in enumerate(sorted(events)):
+        r.xadd(REDIS_KEY_TASK_EVENTS, {"e": event, "t": "t{}".format(i), "w": worker},
+               id="{}-{}".format(int(ts * 1000), i))
+
+    r.hset(REDIS_KEY_FAMILY_RUNTIME_COUNT, mapping={"./sim": 10})
+    r.hset(REDIS_KEY_FAMILY_RUNTIME_SUM, mapping={"./sim": 1000})
+    r.hset(REDIS_KEY_TODO_TASKS, mapping={"shell:1:1:1:./sim {}".format(i): "" for i in range(9)})
+    r.hset(REDIS_KEY_TODO_TASKS, "shell:1:1:1:./new x", "")
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, mapping={"shell:1:1:1:./sim a": "w1", "shell:1:1:1:./sim b": "w2"})
+    r.hset(REDIS_KEY_IN_PROGRESS_SINCE, mapping={"shell:1:1:1:./sim a": now - 40, "shell:1:1:1:./sim b": now - 300})
+
+    p = campaign_progress(r, RuntimePredictor(), now=now)
+    assert p["remaining"] == 12
+    assert p["throughput"][60] == pytest.approx(7 / 60)
+    assert p["throughput"][600] == pytest.approx(65 / 600)
+    assert p["worker_throughput"]["w2"][3600] == pytest.approx(5 / 3600)
+    assert p["eta_by_throughput"] == pytest.approx(12 / (65 / 600))
+    # 10 todo tasks of 100s (./new has no history and counts as the mean), 60s left of a, none of b
+    assert p["remaining_work_sec"] == pytest.approx(1060) and p["running"] == 2
+    assert p["eta_by_runtime"] == pytest.approx(530)
+
+
+def test_read_last_line(tmp_path):
+    path = str(tmp_path / "progress")
+    with open(path, "w") as f:
+        f.write("step 1\n" + "x" * 10000 + "\nstep 3\n\n")
+    assert read_last_line(path) == "step 3"
+
+
+def test_worker_forwards_task_progress():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server:
+        worker = BenchWorker("w-progress", server.pool(), config)
+        r = worker.redis_inst
+        task = Task("shell:1:1:1:echo step 1 of 2 >> $DISTCOMP_PROGRESS_FILE; sleep 2")
+        result_conn, runner_conn = Pipe(duplex=False)
+        runner = redisWorker.TaskRunner(worker.name, runner_conn, task, config.snapshot())
+        runner.start()
+        runner_conn.close()
+        worker.add_in_progress_task(task, runner)
+
+        deadline = time.time() + 10
+        while not os.path.exists(progress_file(worker.name, task.task_str)) and time.time() < deadline:
+            time.sleep(0.05)
+        worker.forward_task_progress()
+        name, _, line = r.hget(REDIS_KEY_TASK_PROGRESS, task.task_str).split(" ", 2)
+        assert name == worker.name and line == "step 1 of 2"
+
+        runner.join(10)
+        assert result_conn.recv()["status"] == "finished"
+        worker.find_finished_task()
+        worker.forward_task_progress()
+        assert not r.hexists(REDIS_KEY_TASK_PROGRESS, task.task_str)
+        assert not os.path.exists(progress_file(worker.name, task.task_str))
+
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+    test_throughput_and_eta()
+    test_read_last_line(Path(tempfile.mkdtemp()))
+    test_worker_forwards_task_progress()
+    print("progress tests passed")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Test python tasks: parsing, in-process runs and the warm interpreter pool
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+
+from utils import Task
+from pyexec import parse_python_task, run_python_task, PythonPool
+
+TASK_MODULE = """
+import os
+import sys
+import time
+
+calls = []
+
+
+def work(name):
+    calls.append(name)
+    return "{} {} {}".format(name, os.getpid(), len(calls))
+
+
+def sleep(sec):
+    time.sleep(float(sec))
+
+
+if __name__ == "__main__":
+    print("main", " ".join(sys.argv[1:]))
+    sys.exit(int(sys.argv[1]))
+"""
+
+
+def make_task_module():
+    task_dir = tempfile.mkdtemp()
+    with open(os.path.join(task_dir, "pyexec_task_mod.py"), "w") as f:
+        f.write(TASK_MODULE)
+    if task_dir not in sys.path:
+        sys.path.insert(0, task_dir)
+
+
+def test_parse_python_task():
+    assert parse_python_task("analysis.summarize 'a b' c") == ("analysis", "summarize", ["a b", "c"])
+    assert parse_python_task("-m analysis.report --out x") == ("analysis.report", None, ["--out", "x"])
+    for bad in ["", "-m", "summarize x"]:
+        try:
+            parse_python_task(bad)
+        except ValueError:
+            continue
+        raise AssertionError("{} should be rejected".format(bad))
+    assert Task.is_task_str_valid("python:5:8:1:analysis.summarize results/w1.csv")
+
+
+def test_run_python_task():
+    make_task_module()
+    exitcode, o_stdout, _ = run_python_task("pyexec_task_mod.work a")
+    assert exitcode == 0 and o_stdout.startswith("a ")
+    assert run_python_task("-m pyexec_task_mod 0 x")[:2] == (0, "main 0 x")
+    assert run_python_task("-m pyexec_task_mod 3")[0] == 3
+    exitcode, _, o_stderr = run_python_task("pyexec_task_mod.missing")
+    assert exitcode == 1 and "AttributeError" in o_stderr
+
+
+def test_pool_reuses_and_recycles_processes():
+    make_task_module()
+    results = {}
+    done = threading.Event()
+
+    def on_done(task, result):
+        results[task.task_str] = result
+        if len(results) == 4:
+            done.set()
+
+    pool = PythonPool(on_done, size=1, max_tasks=3)
+    pool.start()
+    try:
+        for i in range(4):
+            handle = pool.submit(Task("python:1:1:1:pyexec_task_mod.work t{}".format(i)))
+            handle.join(30)
+            assert not handle.is_alive() and handle.exitcode == 0
+        assert done.wait(5)
+        pids_calls = [results["python:1:1:1:pyexec_task_mod.work t{}".format(i)]["stdout"].split()[1:]
+                      for i in range(4)]
+        # the first three tasks share a warm process and its imported module, the fourth gets a new one
+        assert [c for _, c in pids_calls] == ["1", "2", "3", "1"]
+        assert len({p for p, _ in pids_calls[:3]}) == 1 and pids_calls[3][0] != pids_calls[0][0]
+        assert results["python:1:1:1:pyexec_task_mod.work t0"]["usage"]["ru_maxrss"] > 0
+    finally:
+        pool.close()
+
+
+def test_pool_replaces_killed_process():
+    make_task_module()
+    results = []
+    pool = PythonPool(lambda task, result: results.append(result), size=1)
+    pool.start()
+    try:
+        handle = pool.submit(Task("python:1:1:1:pyexec_task_mod.sleep 30"))
+        time.sleep(0.5)
+        assert handle.is_alive()
+        os.kill(handle.pid, 9)
+        handle.join(10)
+        assert handle.exitcode == -9 and results == []
+
+        handle = pool.submit(Task("python:1:1:1:-m pyexec_task_mod 2"))
+        handle.join(30)
+        assert handle.exitcode == 2 and results[0]["stdout"] == "main 2"
+        assert pool.n_started == 2
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    test_parse_python_task()
+    test_run_python_task()
+    test_pool_reuses_and_recycles_processes()
+    test_pool_replaces_killed_process()
+    print("pyexec tests passed")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Test result reporting: the atomic failure script and the batching reporter thread
+"""
+
+import time
+from multiprocessing import Pipe
+from types import SimpleNamespace
+
+from const import *
+from utils import Task, TaskBatch
+from shards import ShardedRedis
+from reporter import ResultReporter
+import redisWorker
+from conftest import make_redis
+
+
+def test_failure_retry_decision():
+    r = make_redis()
+    task = Task("shell:1:1:1:./sim 1")
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+    timing = redisWorker.task_timing_record("w0", task, time.time(), time.time(), 3)
+    assert redisWorker.report_task_failed("w0", r, task, "boom", 2, timing=timing)
+    assert r.hexists(REDIS_KEY_TODO_TASKS, task.task_str)
+    assert not r.hexists(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str)
+    assert r.hget(REDIS_KEY_FAILED_TASKS, task.task_str) == "w0,"
+
+    r.hdel(REDIS_KEY_TODO_TASKS, task.task_str)
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w1")
+    assert not redisWorker.report_task_failed("w1", r, task, "boom", 2)
+    assert not r.hexists(REDIS_KEY_TODO_TASKS, task.task_str)
+    assert r.hget(REDIS_KEY_FAILED_TASKS, task.task_str) == "w0,w1,"
+
+    events = [e for _, e in r.xrange(REDIS_KEY_TASK_EVENTS)]
+    assert [(e["e"], e["w"], e["retry"]) for e in events] == [(EVENT_FAIL, "w0", "1"), (EVENT_FAIL, "w1", "0")]
+    assert events[0]["x"] == "3" and "x" not in events[1]
+
+
+def test_stale_failure_is_ignored():
+    r = make_redis()
+    task = Task("shell:1:1:1:./sim 1")
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w1")
+    assert not redisWorker.report_task_failed("w0", r, task, "late", 4)
+    assert r.hget(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str) == "w1"
+    assert not r.hexists(REDIS_KEY_FAILED_TASKS, task.task_str)
+
+
+def test_reporter_coalesces_results_in_order():
+    r = make_redis()
+    config = SimpleNamespace(result_flush_interval_sec=0.05, max_retry_per_task=4, task_family_params=[],
+                             retry_policy=None, retry_backoff_max_sec=0)
+    reporter = ResultReporter("w0", ShardedRedis([r]), config)
+    reporter.start()
+
+    tasks = [Task("shell:1:1:1:./sim {}".format(i)) for i in range(6)]
+    for task in tasks:
+        r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+    for i, task in enumerate(tasks):
+        result_conn, runner_conn = Pipe(duplex=False)
+        reporter.watch(task, result_conn)
+        if i == 5:
+            # the runner dies without a result
+            runner_conn.close()
+            continue
+        timing = redisWorker.task_timing_record("w0", task, time.time() - 1, time.time(), 0)
+        runner_conn.send({"status": "finished", "msg": '"ok"', "timing": timing, "event": EVENT_FAIL})
+        runner_conn.close()
+    time.sleep(0.2)
+    # a timeout decided after the task finished must not move it back to todo
+    reporter.submit(tasks[0], "failed", "late timeout", event=EVENT_TIMEOUT)
+    reporter.stop()
+
+    assert r.hlen(REDIS_KEY_FINISHED_TASKS) == 5
+    assert r.hget(REDIS_KEY_FINISHED_TASKS, tasks[0].task_str) == 'w0: "ok"'
+    assert not r.hexists(REDIS_KEY_TODO_TASKS, tasks[0].task_str)
+    assert r.hkeys(REDIS_KEY_IN_PROGRESS_TASKS) == [tasks[5].task_str]
+    assert r.hget(REDIS_KEY_FAMILY_RUNTIME_COUNT, "./sim") == "5"
+
+
+def test_batch_runner_killed_mid_batch():
+    r = make_redis()
+    config = SimpleNamespace(result_flush_interval_sec=0.05, max_retry_per_task=4, task_family_params=[],
+                             retry_policy=None, retry_backoff_max_sec=0)
+    reporter = ResultReporter("w0", ShardedRedis([r]), config)
+    reporter.start()
+
+    tasks = [Task("shell:1:1:1:./fast {}".format(i)) for i in range(5)]
+    for task in tasks:
+        r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+    batch = TaskBatch(tasks, 3600)
+    assert batch.timeout_seconds == 5 * 3600
+    result_conn, runner_conn = Pipe(duplex=False)
+    reporter.watch(batch, result_conn)
+    for task in tasks[:2]:
+        timing = redisWorker.task_timing_record("w0", task, time.time() - 0.1, time.time(), 0)
+        runner_conn.send({"status": "finished", "msg": '"ok"', "timing": timing, "event": EVENT_FAIL})
+    # the worker times out the batch while the third task runs, then kills the runner
+    reporter.interrupt(batch, "failed", "timed out", event=EVENT_TIMEOUT)
+    runner_conn.close()
+    time.sleep(0.2)
+    reporter.stop()
+
+    assert sorted(r.hkeys(REDIS_KEY_FINISHED_TASKS)) == [t.task_str for t in tasks[:2]]
+    assert r.hget(REDIS_KEY_TASK_FAIL_REASON, tasks[2].task_str) == "timed out"
+    assert sorted(r.hkeys(REDIS_KEY_TODO_TASKS)) == [t.task_str for t in tasks[2:]]
+    assert r.hlen(REDIS_KEY_IN_PROGRESS_TASKS) == 0
+    events = [(e["e"], e["t"]) for _, e in r.xrange(REDIS_KEY_TASK_EVENTS)]
+    assert events[2:] == [(EVENT_TIMEOUT, tasks[2].task_str), (EVENT_RETURN, tasks[3].task_str),
+                          (EVENT_RETURN, tasks[4].task_str)]
+
+
+if __name__ == "__main__":
+    test_failure_retry_decision()
+    test_stale_failure_is_ignored()
+    test_reporter_coalesces_results_in_order()
+    test_batch_runner_killed_mid_batch()
+    print("reporter tests passed")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Test failure-class-aware retries: classification, per-class limits, backoff and bigger-node routing of oom retries
+"""
+
+import time
+import tempfile
+import pytest
+
+from const import *
+from utils import RunnerConfig, Task, EMPTY_TASK
+from retry import classify_failure, parse_retry_policy, promote_due_retries, failed_workers, largest_live_node_mem
+from reporter import ResultReporter
+import redisWorker
+import redisManager
+from conftest import make_redis, write_tasks
+
+
+def test_classify_failure():
+    assert classify_failure(1, '"bad input"') == "exit"
+    assert classify_failure(137, "") == "oom" and classify_failure(-9, "") == "oom"
+    assert classify_failure(1, '"Traceback ... MemoryError"') == "oom"
+    assert classify_failure(-11, "") == "signal" and classify_failure(139, "") == "signal"
+    assert classify_failure(None, "Task timed out", EVENT_TIMEOUT) == "timeout"
+    assert failed_workers("node10,node2,") == {"node10", "node2"} and "node1" not in failed_workers("node10,")
+
+
+def test_exit_defaults_to_max_retry_per_task():
+    policy = parse_retry_policy({"timeout": {"max_retry": 3}}, 4)
+    assert policy["exit"] == (4, 0)
+    assert policy["timeout"] == (3, 60)
+
+
+def test_class_limits_and_backoff():
+    r = make_redis()
+    policy = parse_retry_policy({"exit": {"max_retry": 2, "backoff_sec": 30}, "timeout": {"max_retry": 3}}, 4)
+    task = Task("shell:1:1:1:./sim 1")
+
+    def fail(worker, exit_code, event=EVENT_FAIL):
+        r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, worker)
+        timing = redisWorker.task_timing_record(worker, task, time.time(), time.time(), exit_code)
+        return redisWorker.report_task_failed(worker, r, task, "boom", 10, timing=timing, event=event,
+                                              retry_policy=policy, backoff_max_sec=3600)
+
+    # the first exit failure waits 30s before the retry
+    now = time.time()
+    assert fail("w0", 1)
+    assert not r.hexists(REDIS_KEY_TODO_TASKS, task.task_str)
+    assert r.zscore(REDIS_KEY_RETRY_BACKOFF, task.task_str) == pytest.approx(now + 30, abs=5)
+    event = [e for _, e in r.xrange(REDIS_KEY_TASK_EVENTS)][-1]
+    assert event["c"] == "exit" and event["retry"] == "1" and float(event["delay"]) == 30
+    assert promote_due_retries(r, now + 1) == 0
+    assert promote_due_retries(r, now + 60) == 1 and r.hexists(REDIS_KEY_TODO_TASKS, task.task_str)
+
+    # a timeout is counted in its own class, the backoff of the default timeout policy doubles
+    r.hdel(REDIS_KEY_TODO_TASKS, task.task_str)
+    assert fail("w1", None, EVENT_TIMEOUT)
+    assert r.zscore(REDIS_KEY_RETRY_BACKOFF, task.task_str) == pytest.approx(time.time() + 60, abs=5)
+    promote_due_retries(r, time.time() + 3600)
+    r.hdel(REDIS_KEY_TODO_TASKS, task.task_str)
+
+    # the second exit failure reaches the limit of the class
+    assert not fail("w2", 1)
+    assert r.hget(REDIS_KEY_TASK_FAILURE_CLASSES, task.task_str) == "exit,timeout,exit,"
+    assert r.zcard(REDIS_KEY_RETRY_BACKOFF) == 0 and not r.hexists(REDIS_KEY_TODO_TASKS, task.task_str)
+
+
+def test_oom_retry_goes_to_bigger_node():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        node1 = BenchWorker("node1", server.pool(), config, total_mem_gb=64)
+        node10 = BenchWorker("node10", server.pool(), config, total_mem_gb=64)
+        node2 = BenchWorker("node2", server.pool(), config, total_mem_gb=256)
+        r = node1.redis_inst
+        path = write_tasks(tmpdir, "task", ["shell:5:1:1:./big 0", "shell:1:1:1:./bug 0"])
+        redisManager.add_task_to_redis(r, path)
+
+        big = node1.get_task_from_redis()
+        assert redisWorker.report_task_failed("node1", r, big, "require too much dram", 4, failure_class="oom",
+                                              retry_policy=config.retry_policy, node_mem_gb=64)
+        assert float(r.hget(REDIS_KEY_TASK_MIN_NODE_MEM, big.task_str)) > 64
+
+        # node10 is not excluded by name, but it is as small as node1
+        bug = node10.get_task_from_redis()
+        assert bug.task_params == "./bug 0"
+        assert redisWorker.report_task_failed("node10", r, bug, "bad input", 4, retry_policy={})
+        assert node10.get_task_from_redis() is EMPTY_TASK
+        # the exit failure on node10 does not exclude node1
+        assert node1.get_task_from_redis() == bug
+        assert node2.get_task_from_redis() == big
+
+        redisWorker.report_task_finish("node2", r, big, '"ok"')
+        assert not r.hexists(REDIS_KEY_TASK_MIN_NODE_MEM, big.task_str)
+        assert not r.hexists(REDIS_KEY_TASK_FAILURE_CLASSES, big.task_str)
+
+
+def test_oom_retry_without_bigger_node_fails_for_good():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        node1 = BenchWorker("node1", server.pool(), config, total_mem_gb=64)
+        node2 = BenchWorker("node2", server.pool(), config, total_mem_gb=64)
+        r = node1.redis_inst
+        now = time.time()
+        r.hset("worker_status", mapping={"node1": "{:.0f}:1:64:10:64".format(now),
+                                         "node2": "{:.0f}:1:64:10:64".format(now),
+                                         "gone": "{:.0f}:1:64:10:256".format(now - 3600)})
+        assert largest_live_node_mem(r) == 64
+        path = write_tasks(tmpdir, "task", ["shell:5:1:1:./big 0"])
+        redisManager.add_task_to_redis(r, path)
+
+        big = node1.get_task_from_redis()
+        reporter = ResultReporter("node1", node1.shards, config, node_mem_gb=64)
+        reporter.pending.append({"task": big, "status": "failed", "msg": "require too much dram", "timing": None,
+                                 "event": EVENT_FAIL, "failure_class": "oom"})
+        reporter.flush()
+        assert r.hexists(REDIS_KEY_FAILED_TASKS, big.task_str)
+        assert not r.hexists(REDIS_KEY_TODO_TASKS, big.task_str)
+        assert not r.hexists(REDIS_KEY_TASK_MIN_NODE_MEM, big.task_str)
+        assert r.hget(REDIS_KEY_TASK_FAIL_REASON, big.task_str).startswith("oom, no bigger node")
+        assert node2.get_task_from_redis() is EMPTY_TASK
+
+
+if __name__ == "__main__":
+    test_classify_failure()
+    test_exit_defaults_to_max_retry_per_task()
+    test_class_limits_and_backoff()
+    test_oom_retry_goes_to_bigger_node()
+    test_oom_retry_without_bigger_node_fails_for_good()
+    print("retry tests passed")
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test the sharded task keyspace against several local redis-server processes
+(in-process fakeredis servers if redis-server is not installed)
+"""
+
+import time
+import tempfile
+import contextlib
+import pytest
+import redis
+
+from utils import RunnerConfig, EMPTY_TASK
+from const import *
+from shards import ShardedRedis, shard_index
+import redisWorker
+import redisManager
+from benchmark import BenchWorker, LocalRedisServer, FakeRedisServer, find_redis_server
+from conftest import write_tasks
+
+N_SHARDS = 3
+
+
+@contextlib.contextmanager
+def redis_shards(n_shards=N_SHARDS):
+    if find_redis_server() is not None:
+        servers = [LocalRedisServer() for _ in range(n_shards)]
+    else:
+        pytest.importorskip("fakeredis")
+        servers = [FakeRedisServer() for _ in range(n_shards)]
+    with contextlib.ExitStack() as stack:
+        for server in servers:
+            stack.enter_context(server)
+        yield servers
+
+
+def make_worker(name, servers, config):
+    worker = BenchWorker(name, servers[0].pool(), config)
+    worker.shards = ShardedRedis([redis.Redis(connection_pool=s.pool()) for s in servers])
+    worker.redis_inst = worker.shards.primary
+    return worker
+
+
+def test_claim_order():
+    shards = ShardedRedis([None] * N_SHARDS)
+    order = shards.claim_order("node7")
+    assert order[0] == shard_index("node7", N_SHARDS)
+    assert sorted(order) == list(range(N_SHARDS))
+    assert shards.shard_of_task_str("shell:1:1:1:echo hi", pinned=True) == 0
+
+
+def test_sharded_campaign():
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with redis_shards() as servers, tempfile.TemporaryDirectory() as tmpdir:
+        shards = ShardedRedis([redis.Redis(connection_pool=s.pool()) for s in servers])
+        path = write_tasks(tmpdir, "task", ["shell:1:1:1:./sim {}".format(i) for i in range(60)] +
+                           ["@name=gen shell:1:1:1:./gen", "@after=gen shell:1:1:1:./agg"])
+        redisManager.add_task_to_redis(shards, path)
+
+        assert shards.hlen(REDIS_KEY_TODO_TASKS) == 61
+        assert all(shard.hlen(REDIS_KEY_TODO_TASKS) > 0 for shard in shards)
+        # tasks with dependencies are on the primary
+        assert shards.primary.hexists(REDIS_KEY_TODO_TASKS, "shell:1:1:1:./gen")
+        assert shards.primary.hexists(REDIS_KEY_BLOCKED_TASKS, "shell:1:1:1:./agg")
+
+        # two workers drain all shards, stealing once their home shard is empty
+        workers = [make_worker("w{}".format(i), servers, config) for i in range(2)]
+        n_claimed = 0
+        while True:
+            claimed = False
+            for worker in workers:
+                task = worker.get_task_from_redis()
+                if task == EMPTY_TASK:
+                    continue
+                claimed = True
+                n_claimed += 1
+                assert worker.shards.of(task).hget(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str) == worker.name
+                timing = redisWorker.task_timing_record(worker.name, task, time.time(), time.time(), 0)
+                redisWorker.report_task_finish(worker.name, worker.shards.of(task), task, '"ok"', timing=timing)
+            if not claimed:
+                break
+
+        assert n_claimed == 62
+        assert shards.hlen(REDIS_KEY_FINISHED_TASKS) == 62
+        assert shards.hlen(REDIS_KEY_TODO_TASKS) == 0 and shards.hlen(REDIS_KEY_BLOCKED_TASKS) == 0
+        assert len(list(shards.hscan_iter(REDIS_KEY_TASK_TIMING))) == 62
+
+
+if __name__ == "__main__":
+    test_claim_order()
+    test_sharded_campaign()
+    print("shard tests passed")
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Test the cluster simulator on small traces whose outcome is known
+"""
+
+from types import SimpleNamespace
+from simulator import ClusterSimulator, SimTask, VirtualNode, synthetic_trace
+from retry_policy import RetryPolicy
+
+
+def make_config(**overrides):
+    conf = dict(min_dram_gb_trigger_return=4, min_dram_gb_accept_new_task=8, max_task_per_worker=4,
+                max_retry_per_task=2, default_task_timeout_seconds=3600, task_timeout_check_interval=30,
+                sleep_sec_between_accepting_task=2, health_report_interval=2,
+                task_family_params=[], scheduling_policy="priority", admission_policy="single",
+                max_tasks_per_claim=8, retry_policy=None, retry_backoff_max_sec=3600,
+                dram_estimate="declared", dram_estimate_quantile=0.95, dram_estimate_min_samples=20,
+                dram_estimate_headroom=1.2, runtime_history_refresh_sec=60)
+    conf.update(overrides)
+    return SimpleNamespace(**conf)
+
+
+def test_all_tasks_finish():
+    tasks = [SimTask("shell:1:1:1:./sim {}".format(i), 0, 100, 1) for i in range(40)]
+    sim = ClusterSimulator(make_config(), [VirtualNode("n0", 64, 16), VirtualNode("n1", 64, 16)], tasks,
+                           initial_mem_frac=1)
+    report = sim.run()
+    assert report["n_finished"] == 40
+    assert report["wasted_core_hours"] == 0
+    # 8 slots, 5 waves of 100s, plus the 2s pause between claims
+    assert 500 <= report["makespan_sec"] < 600
+
+
+def test_timeout_and_retry():
+    tasks = [SimTask("shell:1:1:1:10:./slow", 0, 100, 1)]
+    nodes = [VirtualNode("n{}".format(i), 64, 16) for i in range(3)]
+    report = ClusterSimulator(make_config(), nodes, tasks).run()
+    assert report["n_timeout"] == 2 and report["n_dropped"] == 1 and report["n_finished"] == 0
+
+
+def test_oom_returns_most_recent_task():
+    # the second task grows to 50 GB, the node has 64 GB and returns a task below 4 GB free
+    tasks = [SimTask("shell:2:1:1:./small", 0, 100, 10), SimTask("shell:1:1:1:./big", 0, 100, 55)]
+    report = ClusterSimulator(make_config(), [VirtualNode("n0", 64, 16)], tasks,
+                              initial_mem_frac=0.1, ramp_frac=0.5).run()
+    assert report["n_returned_oom"] >= 1
+    assert report["n_finished"] == 2
+    assert report["wasted_core_hours"] > 0
+
+
+def test_synthetic_trace_runs():
+    report = ClusterSimulator(make_config(max_task_per_worker=8), [VirtualNode("n0", 192, 40)],
+                              synthetic_trace(500, seed=1)).run()
+    assert report["n_finished"] + report["n_dropped"] + report["n_stuck_in_queue"] == 500
+
+
+def test_longest_first_shortens_makespan():
+    # one slot per node, the history is learned from the first two tasks,
+    # the two long tasks should not be claimed after the short ones
+    def trace():
+        tasks = [SimTask("shell:1:1:1:./long 0", 0, 300, 1), SimTask("shell:1:1:1:./short 0", 0, 10, 1)]
+        tasks += [SimTask("shell:1:1:1:./short {}".format(i), 400, 10, 1) for i in range(1, 21)]
+        tasks += [SimTask("shell:1:1:1:./long {}".format(i), 400, 300, 1) for i in range(1, 3)]
+        return tasks
+
+    def makespan(policy):
+        nodes = [VirtualNode("n{}".format(i), 64, 16) for i in range(3)]
+        sim = ClusterSimulator(make_config(max_task_per_worker=1, scheduling_policy=policy), nodes, trace(),
+                               initial_mem_frac=1)
+        report = sim.run()
+        assert report["n_finished"] == 24
+        return report["makespan_sec"]
+
+    assert makespan("longest_first") < makespan("shortest_first")
+
+
+def test_binpack_improves_utilization():
+    # short tasks of mixed sizes, a single claim per pause cannot keep the slots busy
+    def utilization(policy):
+        tasks = [SimTask("shell:{}:{}:1:./sim {}".format(i % 3, (4, 8, 24)[i % 3], i), 0, 10, 1)
+                 for i in range(300)]
+        config = make_config(max_task_per_worker=16, admission_policy=policy)
+        report = ClusterSimulator(config, [VirtualNode("n0", 128, 32)], tasks, initial_mem_frac=1).run()
+        assert report["n_finished"] == 300
+        return report["slot_utilization"]
+
+    single, binpack = utilization("single"), utilization("binpack")
+    assert binpack > single * 1.2
+
+
+def test_retry_policy_and_backoff():
+    # an exit failure is retried once, after 100s
+    tasks = [SimTask("shell:1:1:1:./bug", 0, 10, 1, exit_code=1)]
+    nodes = [VirtualNode("n{}".format(i), 64, 16) for i in range(3)]
+    config = make_config(max_retry_per_task=10, retry_policy={"exit": RetryPolicy(2, 100)})
+    sim = ClusterSimulator(config, nodes, tasks)
+    report = sim.run()
+    assert report["n_failed_runs"] == 2 and report["n_delayed_retries"] == 1 and report["n_dropped"] == 1
+    assert sim.now >= 10 + 100 + 10
+
+
+def test_oom_retry_goes_to_a_larger_node():
+    # the task grows to 70 GB on n0, the idle n2 of the same size is not tried, it waits for n1
+    tasks = [SimTask("shell:2:1:1:./big", 0, 100, 70), SimTask("shell:1:1:1:./filler", 0, 200, 1)]
+    nodes = [VirtualNode("n0", 64, 16), VirtualNode("n1", 128, 16), VirtualNode("n2", 64, 16)]
+    config = make_config(max_task_per_worker=1, max_retry_per_task=4, retry_policy={"oom": RetryPolicy(4, 0)})
+    report = ClusterSimulator(config, nodes, tasks, initial_mem_frac=0.1, ramp_frac=0.5).run()
+    assert report["n_returned_oom"] == 1 and report["n_failed_runs"] == 1 and report["n_finished"] == 2
+    assert report["makespan_sec"] >= 300
+
+
+def test_oom_retry_without_a_larger_node_is_dropped():
+    tasks = [SimTask("shell:2:1:1:./big", 0, 100, 70), SimTask("shell:1:1:1:./filler", 0, 200, 1)]
+    nodes = [VirtualNode("n0", 64, 16), VirtualNode("n1", 64, 16)]
+    config = make_config(max_task_per_worker=1, max_retry_per_task=4, retry_policy={"oom": RetryPolicy(4, 0)})
+    report = ClusterSimulator(config, nodes, tasks, initial_mem_frac=0.1, ramp_frac=0.5).run()
+    assert report["n_failed_runs"] == 1 and report["n_dropped"] == 1 and report["n_finished"] == 1
+
+
+def test_learned_dram_packs_overestimated_tasks():
+    # the tasks declare 60 GB but peak at 2 GB
+    def makespan(mode):
+        tasks = [SimTask("shell:1:60:1:./sim {}".format(i), 0, 100, 2) for i in range(40)]
+        config = make_config(max_task_per_worker=16, dram_estimate=mode, dram_estimate_min_samples=4)
+        report = ClusterSimulator(config, [VirtualNode("n0", 128, 32)], tasks, initial_mem_frac=1).run()
+        assert report["n_finished"] == 40
+        return report["makespan_sec"]
+
+    assert makespan("learned") < makespan("declared") / 2
+
+
+if __name__ == "__main__":
+    test_all_tasks_finish()
+    test_timeout_and_retry()
+    test_oom_returns_most_recent_task()
+    test_synthetic_trace_runs()
+    test_longest_first_shortens_makespan()
+    test_binpack_improves_utilization()
+    test_retry_policy_and_backoff()
+    test_oom_retry_goes_to_a_larger_node()
+    test_oom_retry_without_a_larger_node_is_dropped()
+    test_learned_dram_packs_overestimated_tasks()
+    print("simulator tests passed")
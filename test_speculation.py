@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Test speculative execution: straggler selection, backup claims and the first-finish-wins commit
+"""
+
+import time
+from multiprocessing import Process
+from types import SimpleNamespace
+import pytest
+
+from const import *
+from utils import RunnerConfig, Task
+from admission import select_stragglers
+from predictor import RuntimePredictor
+from reporter import ResultReporter
+from task_state import TaskState
+import redisWorker
+from conftest import make_redis
+
+
+def make_worker(name, server, config):
+    from benchmark import BenchWorker
+    worker = BenchWorker(name, server.pool(), config)
+    worker.reporter = ResultReporter(name, worker.shards, config)
+    return worker
+
+
+def claim_backup(r, task_str, worker):
+    script = r.register_script(redisWorker.CLAIM_BACKUP_SCRIPT)
+    return script(keys=[REDIS_KEY_IN_PROGRESS_TASKS, REDIS_KEY_SPECULATIVE_TASKS, REDIS_KEY_TASK_EVENTS],
+                  args=[task_str, worker, EVENT_SPECULATE, EVENT_STREAM_MAXLEN])
+
+
+def test_select_stragglers():
+    predictor = RuntimePredictor()
+    predictor.observe("./sim", 100)
+    running = [(Task("shell:1:1:1:./sim a"), 0), (Task("shell:1:1:1:./sim b"), 200),
+               (Task("shell:1:1:1:./new c"), 250), (Task("shell:1:1:1:./new d"), 290)]
+    # at 300s: a ran 300s > 1.5 * 100s, b only 100s, c has no history and ran more than the minimum
+    stragglers = select_stragglers(running, 300, predictor, min_runtime_sec=30, slowdown=1.5)
+    assert [t.task_params for t in stragglers] == ["./sim a", "./new c"]
+
+
+def test_first_copy_wins():
+    r = make_redis()
+    task = Task("shell:1:1:1:./sim 1")
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+    assert claim_backup(r, task.task_str, "w1") == 1
+    assert claim_backup(r, task.task_str, "w2") == 0
+    assert claim_backup(r, task.task_str, "w0") == 0
+
+    timing = redisWorker.task_timing_record("w1", task, time.time() - 1, time.time(), 0)
+    redisWorker.report_task_finish("w1", r, task, '"backup"', timing=timing, family="./sim")
+    timing = redisWorker.task_timing_record("w0", task, time.time() - 9, time.time(), 0)
+    redisWorker.report_task_finish("w0", r, task, '"original"', timing=timing, family="./sim")
+
+    assert r.hget(REDIS_KEY_FINISHED_TASKS, task.task_str) == 'w1: "backup"'
+    assert r.hlen(REDIS_KEY_IN_PROGRESS_TASKS) == 0 and r.hlen(REDIS_KEY_SPECULATIVE_TASKS) == 0
+    assert r.hget(REDIS_KEY_FAMILY_RUNTIME_COUNT, "./sim") == "1"
+    events = [(e["e"], e["w"]) for _, e in r.xrange(REDIS_KEY_TASK_EVENTS)]
+    assert events == [(EVENT_SPECULATE, "w1"), (EVENT_FINISH, "w1")]
+
+
+def test_backup_takes_over_a_failed_original():
+    r = make_redis()
+    task = Task("shell:1:1:1:./sim 2")
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str, "w0")
+    assert claim_backup(r, task.task_str, "w1") == 1
+    # a failed backup leaves the original running
+    assert not redisWorker.report_task_failed("w1", r, task, "boom", 4)
+    assert r.hget(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str) == "w0"
+    assert not r.hexists(REDIS_KEY_FAILED_TASKS, task.task_str)
+
+    assert claim_backup(r, task.task_str, "w2") == 1
+    # the backup becomes the owner instead of a retry
+    assert redisWorker.report_task_failed("w0", r, task, "boom", 4)
+    assert r.hget(REDIS_KEY_IN_PROGRESS_TASKS, task.task_str) == "w2"
+    assert not r.hexists(REDIS_KEY_TODO_TASKS, task.task_str)
+    redisWorker.report_task_finish("w2", r, task, '"ok"')
+    assert r.hget(REDIS_KEY_FINISHED_TASKS, task.task_str) == 'w2: "ok"'
+
+
+def test_idle_worker_backs_up_straggler():
+    pytest.importorskip("fakeredis")
+    from benchmark import FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    config.speculation_min_runtime_sec = 10
+    with FakeRedisServer() as server:
+        w0, w1 = make_worker("w0", server, config), make_worker("w1", server, config)
+        r = w0.redis_inst
+        r.hset(REDIS_KEY_TODO_TASKS, mapping={"shell:1:1:1:./sim slow": "", "shell:1:1:1:./sim fast": ""})
+        slow, fast = sorted([w0.get_task_from_redis(), w0.get_task_from_redis()], key=lambda t: t.task_params)
+        assert w1.get_tasks_from_redis(1) == []
+        r.hset(REDIS_KEY_IN_PROGRESS_SINCE, slow.task_str, time.time() - 60)
+
+        backup = w1.get_tasks_from_redis(1)
+        assert [t.task_str for t in backup] == [slow.task_str]
+        assert r.hget(REDIS_KEY_SPECULATIVE_TASKS, slow.task_str) == "w1"
+        assert w1.get_tasks_from_redis(1) == []
+        redisWorker.report_task_finish("w1", r, backup[0], '"backup"')
+
+        # the original copy is cancelled
+        proc = Process(target=time.sleep, args=(30,))
+        proc.start()
+        running = SimpleNamespace(is_alive=lambda: True)
+        w0.add_in_progress_task(slow, proc)
+        w0.add_in_progress_task(fast, running)
+        w0.cancel_finished_copies()
+        proc.join(10)
+        assert proc.exitcode == -9
+        assert slow not in w0.tasks and w0.tasks.state(fast) == TaskState.RUNNING
+        assert [(p["task"], p["status"]) for p in w0.reporter.pending] == [(slow, "cancelled")]
+        assert r.hget(REDIS_KEY_FINISHED_TASKS, slow.task_str) == 'w1: "backup"'
+
+
+if __name__ == "__main__":
+    test_select_stragglers()
+    test_first_copy_wins()
+    test_backup_takes_over_a_failed_original()
+    test_idle_worker_backs_up_straggler()
+    print("speculation tests passed")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Test the per-task state machine of the worker: transitions, DRAM accounting and racing paths that end a task
+"""
+
+import time
+from threading import Thread, Barrier
+from multiprocessing import Process
+from types import SimpleNamespace
+import pytest
+
+from const import *
+from utils import RunnerConfig, Task
+from task_state import TaskState, TaskTracker
+from reporter import ResultReporter
+
+
+def test_transitions_and_accounting():
+    tracker = TaskTracker()
+    a, b = Task("shell:1:8:1:./a"), Task("shell:1:4:1:./b")
+    tracker.claim(a)
+    tracker.claim(b)
+    assert tracker.need_dram_gb == 12 and len(tracker) == 2
+    with pytest.raises(ValueError):
+        tracker.claim(a)
+
+    tracker.start(a, SimpleNamespace(pid=1))
+    assert tracker.state(a) == TaskState.RUNNING
+    assert tracker.transition(a, (TaskState.RUNNING, ), TaskState.FINISHING)
+    # another path that wants to end it leaves it alone
+    assert not tracker.transition(a, (TaskState.RUNNING, ), TaskState.FINISHING)
+    # a finishing task still holds its DRAM
+    assert tracker.need_dram_gb == 12 and tracker.check_invariants() == []
+    with pytest.raises(ValueError):
+        tracker.transition(b, (TaskState.CLAIMED, ), TaskState.REPORTED)
+
+    assert tracker.transition(a, (TaskState.FINISHING, ), TaskState.RETURNED)
+    assert tracker.need_dram_gb == 4 and a not in tracker
+    assert [e.task for e in tracker.entries(TaskState.CLAIMED)] == [b]
+    assert tracker.transition(b, (TaskState.CLAIMED, ), TaskState.FINISHING)
+    assert tracker.transition(b, (TaskState.FINISHING, ), TaskState.REPORTED)
+    assert tracker.need_dram_gb == 0 and tracker.ended == {TaskState.RETURNED: 1, TaskState.REPORTED: 1}
+
+
+def test_racing_paths_end_a_task_once():
+    tracker = TaskTracker()
+    tasks = [Task("shell:1:{}:1:./t {}".format(i % 5 + 1, i)) for i in range(200)]
+    for task in tasks:
+        tracker.claim(task)
+        tracker.start(task, SimpleNamespace(pid=1))
+    wins = [0] * 4
+    barrier = Barrier(4)
+
+    def end_all(i):
+        # the main loop, the timeout thread, the DRAM monitor and the speculation check
+        barrier.wait()
+        for task in tasks:
+            if tracker.transition(task, (TaskState.RUNNING, ), TaskState.FINISHING):
+                wins[i] += 1
+                tracker.transition(task, (TaskState.FINISHING, ), TaskState.REPORTED)
+
+    threads = [Thread(target=end_all, args=(i, )) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(wins) == len(tasks) and len(tracker) == 0 and tracker.need_dram_gb == 0
+    assert tracker.ended[TaskState.REPORTED] == len(tasks)
+
+
+def test_worker_paths_keep_accounting():
+    pytest.importorskip("fakeredis")
+    from benchmark import BenchWorker, FakeRedisServer
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False)
+    with FakeRedisServer() as server:
+        worker = BenchWorker("w0", server.pool(), config)
+        worker.reporter = ResultReporter("w0", worker.shards, config)
+        done = Task("shell:1:8:1:./done")
+        old, recent = Task("shell:1:16:1:0:./old"), Task("shell:1:32:1:0:./recent")
+        old_proc, recent_proc = Process(target=time.sleep, args=(30, )), Process(target=time.sleep, args=(30, ))
+        old_proc.start()
+        recent_proc.start()
+        for task in (done, old, recent):
+            worker.tasks.claim(task)
+        assert worker.tasks.need_dram_gb == 56 and worker.tasks.check_invariants() == []
+
+        worker.add_in_progress_task(done, SimpleNamespace(is_alive=lambda: False, join=lambda: None, exitcode=0))
+        worker.add_in_progress_task(old, old_proc)
+        time.sleep(0.01)
+        worker.add_in_progress_task(recent, recent_proc)
+        assert list(worker.find_finished_task()) == [done]
+
+        # the DRAM monitor returns the most recent task, the exit of its process does not release it again
+        worker.return_most_recent_task()
+        recent_proc.join(10)
+        assert worker.tasks.state(recent) is None and worker.tasks.ended[TaskState.RETURNED] == 1
+        assert worker.find_finished_task() == {}
+        assert worker.tasks.need_dram_gb == 16 and worker.tasks.check_invariants() == []
+        assert [(p["task"], p["status"]) for p in worker.reporter.pending] == [(recent, "returned")]
+
+        # the last task is failed as too big for the node
+        worker.return_most_recent_task()
+        old_proc.join(10)
+        assert len(worker.tasks) == 0 and worker.tasks.need_dram_gb == 0
+        assert worker.reporter.pending[-1]["failure_class"] == "oom"
+
+
+if __name__ == "__main__":
+    test_transitions_and_accounting()
+    test_racing_paths_end_a_task_once()
+    test_worker_paths_keep_accounting()
+    print("task state tests passed")
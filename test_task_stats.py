@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Test the vectorized percentile aggregation used by the taskStats report
+"""
+
+import numpy as np
+from task_stats import grouped_percentiles
+
+
+def test_grouped_percentiles_match_numpy():
+    rng = np.random.default_rng(42)
+    groups = rng.choice(np.array(["./cachesim", "./gen", "./agg"], dtype=object), 10000)
+    values = rng.exponential(100, 10000)
+    values[rng.random(10000) < 0.1] = np.nan
+
+    labels, counts, pct = grouped_percentiles(groups, values, (0.5, 0.95, 0.99))
+    for label, n, row in zip(labels, counts, pct):
+        v = values[(groups == label) & ~np.isnan(values)]
+        assert n == len(v)
+        assert np.allclose(row, np.percentile(v, [50, 95, 99]))
+
+
+def test_grouped_percentiles_single_and_empty():
+    labels, counts, pct = grouped_percentiles(np.array(["a"], dtype=object), np.array([3.0]))
+    assert list(labels) == ["a"] and list(counts) == [1]
+    assert np.allclose(pct, 3.0)
+
+    labels, counts, pct = grouped_percentiles(np.array([], dtype=object), np.array([]))
+    assert len(labels) == 0 and pct.shape == (0, 3)
+
+
+if __name__ == "__main__":
+    test_grouped_percentiles_match_numpy()
+    test_grouped_percentiles_single_and_empty()
+    print("task stats tests passed")
@@ -54,6 +54,84 @@ def test_timeout_example():
     # Add actual task execution tests here
     print("Timeout example test completed\n")
 
+def test_deadline_queue():
+    from deadlines import DeadlineQueue
+    queue = DeadlineQueue()
+    queue.add("a", 10)
+    queue.add("b", 5)
+    queue.add("c", 7)
+    queue.discard("c")
+    assert queue.pop_expired(8) == ["b"] and len(queue) == 1
+    # a new deadline replaces the old one
+    queue.add("a", 3)
+    assert queue.next_deadline() == 3 and queue.pop_expired(4) == ["a"] and queue.next_deadline() is None
+
+    # the waiting thread wakes up when an earlier deadline is added
+    import threading
+    waited = []
+    def waiter():
+        start = time.time()
+        queue.wait(start, 10)
+        waited.append(time.time() - start)
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    time.sleep(0.2)
+    queue.add("d", time.time())
+    thread.join(5)
+    assert len(waited) == 1 and waited[0] < 5
+
+
+def make_runner(grace_sec):
+    from utils import RunnerConfig, Task
+    from const import CONFIG_PATH
+    from redisWorker import TaskRunner
+    config = RunnerConfig(CONFIG_PATH, auto_reload=False).snapshot()._replace(task_kill_grace_sec=grace_sec)
+    return TaskRunner("w0", None, Task("shell:1:1:1:true"), config)
+
+
+def test_timeout_kills_process_group(tmp_path):
+    import psutil
+    runner = make_runner(0)
+    pid_file = tmp_path / "pid"
+    # the background sleep leaves the process tree when the shell is killed, but not its process group
+    try:
+        runner._run_shell_task_with_timeout("sleep 30 & echo $! > {}; wait".format(pid_file), 1)
+        assert False, "the task should time out"
+    except subprocess.TimeoutExpired:
+        pass
+    pid = int(pid_file.read_text())
+    time.sleep(0.2)
+    assert not psutil.pid_exists(pid) or psutil.Process(pid).status() == psutil.STATUS_ZOMBIE
+
+    # the task can clean up within the grace period
+    runner = make_runner(2)
+    term_file = tmp_path / "term"
+    try:
+        runner._run_shell_task_with_timeout("trap 'echo term > {}; exit 1' TERM; sleep 30 & wait".format(term_file), 1)
+        assert False, "the task should time out"
+    except subprocess.TimeoutExpired:
+        pass
+    assert term_file.read_text().strip() == "term"
+
+    # the shell exits at once on SIGTERM, the process it started still gets the grace period
+    done_file = tmp_path / "done"
+    try:
+        runner._run_shell_task_with_timeout(
+            "sh -c \"trap 'sleep 0.5; echo done > {}; exit 1' TERM; sleep 30 & wait\" & wait".format(done_file), 1)
+        assert False, "the task should time out"
+    except subprocess.TimeoutExpired:
+        pass
+    assert done_file.read_text().strip() == "done"
+
+
+def test_zero_timeout_means_no_limit():
+    from utils import Task, TaskBatch
+    runner = make_runner(0)
+    assert runner._run_shell_task_with_timeout("echo ok", 0) == (0, "ok", "")
+    assert TaskBatch([Task("shell:1:1:1:0:./a"), Task("shell:1:1:1:60:./b")], 3600).timeout_seconds == 0
+    assert TaskBatch([Task("shell:1:1:1:./a"), Task("shell:1:1:1:60:./b")], 3600).timeout_seconds == 3660
+
+
 def main():
     """Main test function"""
     print("=" * 50)
@@ -63,6 +141,11 @@ def main():
     test_task_format_parsing()
     test_timeout_config()
     test_timeout_example()
+    test_deadline_queue()
+    import tempfile
+    from pathlib import Path
+    test_timeout_kills_process_group(Path(tempfile.mkdtemp()))
+    test_zero_timeout_means_no_limit()
     
     print("=" * 50)
     print("Test completed!")
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Test the live cluster view: incremental updates from the event stream and the worker rows
+"""
+
+
+from const import *
+from top import ClusterView
+from conftest import make_redis
+
+
+def add_event(r, ts, event, task_str, worker):
+    r.xadd(REDIS_KEY_TASK_EVENTS, {"e": event, "t": task_str, "w": worker}, id="{}-*".format(int(ts * 1000)))
+
+
+def test_cluster_view_follows_events():
+    r = make_redis()
+    now = 1700000000.0
+    r.hset("worker_status", mapping={"w1": "{:.0f}:3.50:8.00:10.00:64.00".format(now - 5),
+                                     "w2": "{:.0f}:1.00:8.00:2.00:64.00".format(now - 2)})
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, mapping={"t0": "w1", "t1": "w1"})
+    add_event(r, now - 900, EVENT_FINISH, "old", "w1")
+    add_event(r, now - 120, EVENT_FINISH, "a", "w2")
+    add_event(r, now - 30, EVENT_FAIL, "b", "w2")
+
+    view = ClusterView(r)
+    view.start(now)
+    rows = {row["worker"]: row for row in view.rows(now, max_task_per_worker=4)}
+    assert rows["w1"]["running"] == 2 and rows["w1"]["slots"] == 4 and rows["w1"]["used_mem_gb"] == 10
+    assert rows["w2"]["finished_10m"] == 1 and rows["w2"]["finished_1m"] == 0 and rows["w2"]["failed_10m"] == 1
+    assert view.counts[REDIS_KEY_IN_PROGRESS_TASKS] == 2
+
+    # later events are applied without re-reading the task hashes
+    r.hset(REDIS_KEY_IN_PROGRESS_TASKS, "t2", "w2")
+    add_event(r, now + 1, EVENT_CLAIM, "t2", "w2")
+    add_event(r, now + 2, EVENT_SPECULATE, "t0", "w2")
+    add_event(r, now + 3, EVENT_FINISH, "t0", "w2")
+    r.hdel(REDIS_KEY_IN_PROGRESS_TASKS, "t0")
+    view.refresh(now + 5)
+    rows = {row["worker"]: row for row in view.rows(now + 5, max_task_per_worker=4)}
+    assert rows["w1"]["running"] == 1 and rows["w2"]["running"] == 1
+    assert rows["w2"]["finished_1m"] == 1 and rows["w2"]["finished_10m"] == 2
+    assert view.counts[REDIS_KEY_IN_PROGRESS_TASKS] == 2
+    assert "in_progress 2" in view.summary(now + 5)
+
+    # failures leave the window
+    view.refresh(now + 600)
+    assert {row["worker"]: row for row in view.rows(now + 600)}["w2"]["failed_10m"] == 0
+
+
+if __name__ == "__main__":
+    test_cluster_view_follows_events()
+    print("top tests passed")
@@ -0,0 +1,218 @@
+import time
+import curses
+from collections import defaultdict, deque
+from const import *
+from events import event_time
+from shards import shard_clients
+
+
+"""
+a top-like live view of the cluster
+
+it keeps one connection open and refreshes from cheap reads,
+the counts of the task hashes are HLENs (constant time), the per-worker throughput and failures are
+accumulated from the events appended to the task event streams since the last refresh (XREAD from the last
+seen id), the worker status hash has one entry per worker, and the running tasks per worker
+(in_progress and speculative, at most the slots of the cluster) are re-read only every resync_sec
+to correct for events trimmed from the stream
+
+"""
+
+WINDOW_SEC = 600
+COLUMNS = (
+    # key, header, width, sort key of a row
+    ("n", "worker", 16, lambda r: r["worker"]),
+    ("a", "age", 4, lambda r: r["age"]),
+    ("s", "slots", 8, lambda r: r["running"]),
+    ("c", "cpu", 10, lambda r: r["used_core"]),
+    ("m", "mem GB", 12, lambda r: r["used_mem_gb"]),
+    ("t", "fin/1m", 6, lambda r: r["finished_1m"]),
+    ("T", "fin/10m", 7, lambda r: r["finished_10m"]),
+    ("f", "fail/10m", 8, lambda r: r["failed_10m"]),
+)
+COUNTED_KEYS = (REDIS_KEY_TODO_TASKS, REDIS_KEY_BLOCKED_TASKS, REDIS_KEY_IN_PROGRESS_TASKS,
+                REDIS_KEY_FINISHED_TASKS, REDIS_KEY_FAILED_TASKS)
+
+
+class ClusterView:
+    def __init__(self, redis_inst, resync_sec=30, chunk=10000):
+        self.shards = shard_clients(redis_inst)
+        self.resync_sec = resync_sec
+        self.chunk = chunk
+        self.last_ids = [None] * len(self.shards)
+        self.running = defaultdict(set)  # task -> workers running a copy of it
+        self.finished = deque()  # (time, worker) of the finish events in the window
+        self.failed = deque()  # (time, worker) of the fail and timeout events in the window
+        self.counts = {}
+        self.worker_status = {}
+        self.last_resync = 0
+
+    def start(self, now=None):
+        """
+        replay the events of the last WINDOW_SEC, so the throughput columns are filled from the first frame
+
+        """
+
+        now = time.time() if now is None else now
+        self.last_ids = ["{}-0".format(int((now - WINDOW_SEC) * 1000))] * len(self.shards)
+        self.refresh(now)
+
+    def resync_running(self):
+        self.running = defaultdict(set)
+        for shard in self.shards:
+            pipeline = shard.pipeline(transaction=False)
+            pipeline.hgetall(REDIS_KEY_IN_PROGRESS_TASKS)
+            pipeline.hgetall(REDIS_KEY_SPECULATIVE_TASKS)
+            for tasks in pipeline.execute():
+                for task_str, worker in tasks.items():
+                    self.running[task_str].add(worker)
+
+    def apply_event(self, event_id, event):
+        e, task_str, worker = event.get("e"), event.get("t", ""), event.get("w", "")
+        if e in (EVENT_CLAIM, EVENT_SPECULATE):
+            self.running[task_str].add(worker)
+        elif e == EVENT_FINISH:
+            self.finished.append((event_time(event_id), worker))
+            self.running.pop(task_str, None)
+        elif e in (EVENT_FAIL, EVENT_TIMEOUT, EVENT_RETURN):
+            if e != EVENT_RETURN:
+                self.failed.append((event_time(event_id), worker))
+            workers = self.running.get(task_str)
+            if workers is not None:
+                workers.discard(worker)
+                if len(workers) == 0:
+                    del self.running[task_str]
+
+    def read_events(self):
+        for i, shard in enumerate(self.shards):
+            while True:
+                r = shard.xread({REDIS_KEY_TASK_EVENTS: self.last_ids[i]}, count=self.chunk)
+                entries = r[0][1] if r is not None and len(r) > 0 else []
+                for event_id, event in entries:
+                    self.apply_event(event_id, event)
+                if len(entries) > 0:
+                    self.last_ids[i] = entries[-1][0]
+                if len(entries) < self.chunk:
+                    break
+
+    def refresh(self, now=None):
+        now = time.time() if now is None else now
+        self.read_events()
+        if now - self.last_resync >= self.resync_sec:
+            # after the events, so the tasks claimed before the window are counted too
+            self.resync_running()
+            self.last_resync = now
+        for q in (self.finished, self.failed):
+            while len(q) > 0 and q[0][0] < now - WINDOW_SEC:
+                q.popleft()
+
+        counts = defaultdict(int)
+        for shard in self.shards:
+            pipeline = shard.pipeline(transaction=False)
+            for key in COUNTED_KEYS:
+                pipeline.hlen(key)
+            for key, n in zip(COUNTED_KEYS, pipeline.execute()):
+                counts[key] += n
+        self.counts = dict(counts)
+        self.worker_status = self.shards[0].hgetall("worker_status")
+
+    def rows(self, now=None, max_task_per_worker=0):
+        """
+        :return: a dict per worker with the columns of COLUMNS
+
+        """
+
+        now = time.time() if now is None else now
+        running = defaultdict(int)
+        for workers in self.running.values():
+            for worker in workers:
+                running[worker] += 1
+        finished_1m, finished_10m, failed_10m = defaultdict(int), defaultdict(int), defaultdict(int)
+        for ts, worker in self.finished:
+            finished_10m[worker] += 1
+            if ts >= now - 60:
+                finished_1m[worker] += 1
+        for _, worker in self.failed:
+            failed_10m[worker] += 1
+
+        rows = []
+        for worker in set(self.worker_status) | set(running) | set(finished_10m):
+            status = self.worker_status.get(worker)
+            if status is not None:
+                last_ts, used_core, total_core, used_mem_gb, total_mem_gb = status.split(":")
+            else:
+                last_ts, used_core, total_core, used_mem_gb, total_mem_gb = now, 0, 0, 0, 0
+            rows.append({
+                "worker": worker,
+                "age": max(now - float(last_ts), 0),
+                "running": running[worker],
+                "slots": max_task_per_worker,
+                "used_core": float(used_core),
+                "total_core": float(total_core),
+                "used_mem_gb": float(used_mem_gb),
+                "total_mem_gb": float(total_mem_gb),
+                "finished_1m": finished_1m[worker],
+                "finished_10m": finished_10m[worker],
+                "failed_10m": failed_10m[worker],
+            })
+        return rows
+
+    def summary(self, now=None):
+        now = time.time() if now is None else now
+        n_1m = sum(1 for ts, _ in self.finished if ts >= now - 60)
+        return "todo {}  blocked {}  in_progress {}  finished {}  failed {}  |  {:.2f}/s 1m  {:.2f}/s 10m  " \
+               "{} failed 10m".format(*[self.counts.get(k, 0) for k in COUNTED_KEYS],
+                                      n_1m / 60, len(self.finished) / WINDOW_SEC, len(self.failed))
+
+
+def format_row(r):
+    return [r["worker"][:16], "{:.0f}".format(r["age"]),
+            "{}/{}".format(r["running"], r["slots"]),
+            "{:.1f}/{:.0f}".format(r["used_core"], r["total_core"]),
+            "{:.1f}/{:.0f}".format(r["used_mem_gb"], r["total_mem_gb"]),
+            str(r["finished_1m"]), str(r["finished_10m"]), str(r["failed_10m"])]
+
+
+def run_top(redis_inst, interval=2, max_task_per_worker=0, include_str="", exclude_str=""):
+    """
+    the interactive view, a column key sorts by the column (again reverses), q quits
+
+    """
+
+    view = ClusterView(redis_inst)
+    view.start()
+
+    def loop(screen):
+        curses.curs_set(0)
+        screen.timeout(int(interval * 1000))
+        sort_key, reverse = "n", False
+        keys = {c[0]: c for c in COLUMNS}
+        while True:
+            rows = [r for r in view.rows(max_task_per_worker=max_task_per_worker)
+                    if (len(include_str) == 0 or include_str in r["worker"]) and
+                    (len(exclude_str) == 0 or exclude_str not in r["worker"])]
+            rows.sort(key=keys[sort_key][3], reverse=reverse)
+
+            screen.erase()
+            height, width = screen.getmaxyx()
+            lines = [time.strftime("%H:%M:%S ") + view.summary(),
+                     "sort: " + " ".join("{}={}".format(c[0], c[1]) for c in COLUMNS) + "  q=quit", ""]
+            lines.append(" ".join("{:>{}}".format(c[1], c[2]) if i > 0 else "{:{}}".format(c[1], c[2])
+                                  for i, c in enumerate(COLUMNS)))
+            for r in rows:
+                cells = format_row(r)
+                lines.append(" ".join("{:>{}}".format(v, c[2]) if i > 0 else "{:{}}".format(v, c[2])
+                                      for i, (v, c) in enumerate(zip(cells, COLUMNS))))
+            for y, line in enumerate(lines[:height]):
+                screen.addnstr(y, 0, line, width - 1, curses.A_REVERSE if y == 3 else curses.A_NORMAL)
+            screen.refresh()
+
+            ch = screen.getch()
+            if ch == ord("q"):
+                break
+            if ch != -1 and chr(ch) in keys:
+                reverse = not reverse if chr(ch) == sort_key else chr(ch) != "n"
+                sort_key = chr(ch)
+            view.refresh()
+
+    curses.wrapper(loop)
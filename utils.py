@@ -1,13 +1,17 @@
 
 import json
 import time
+from collections import namedtuple
+from types import SimpleNamespace
 from threading import Thread, Lock
 
 import os
 import sys
 import logging
 from abc import ABC, abstractmethod
-from const import TASK_FORMAT_SEPARATOR, WORKER_STOP_COMMAND
+from const import TASK_FORMAT_SEPARATOR, TASK_ANNOTATION_PREFIX, WORKER_STOP_COMMAND, SCHEDULING_POLICIES, \
+    ADMISSION_POLICIES, DRAM_ESTIMATE_MODES
+from retry_policy import parse_retry_policy
 
 #################################### logging related #####################################
 logging.basicConfig(format='%(asctime)s: %(levelname)s [%(filename)s:%(lineno)s]: \t%(message)s',
@@ -16,134 +20,341 @@ logging.basicConfig(format='%(asctime)s: %(levelname)s [%(filename)s:%(lineno)s]
 
 """
 a auto reload config class
-it assumes that each config field is independent and updating one field of the config is atomic
+each field is parsed and validated from a candidate conf dict before the config is switched to it,
+a candidate that does not validate is logged and the current config is kept (except the first load)
+
+the config file is re-read only when it changed, the fields that are not node local can also be published
+cluster-wide through redis (see config_sync), the published fields override the file of every worker,
+a task runner gets an immutable snapshot of the config instead of reading the file again
 
 """
 
+ConfigSnapshot = namedtuple("ConfigSnapshot", [
+    "min_dram_gb_trigger_return",
+    "min_dram_gb_accept_new_task",
+    "max_task_per_worker",
+    "max_retry_per_task",
+    "default_task_timeout_seconds",
+    "task_timeout_check_interval",
+    "task_kill_grace_sec",
+    "result_dir",
+    "health_report_interval",
+    "sleep_sec_between_accepting_task",
+    "redis_host",
+    "redis_port",
+    "redis_pass",
+    "redis_db",
+    "redis_shards",
+    "metrics_port",
+    "metrics_host",
+    "result_flush_interval_sec",
+    "result_journal_dir",
+    "task_family_params",
+    "scheduling_policy",
+    "runtime_history_refresh_sec",
+    "dram_estimate",
+    "dram_estimate_quantile",
+    "dram_estimate_min_samples",
+    "dram_estimate_headroom",
+    "admission_policy",
+    "max_tasks_per_claim",
+    "locality_wait_sec",
+    "warm_input_capacity",
+    "local_data_dir",
+    "micro_batch_max_tasks",
+    "micro_batch_short_task_sec",
+    "micro_batch_target_sec",
+    "speculation_min_runtime_sec",
+    "speculation_slowdown",
+    "fair_share_aging_sec",
+    "fair_share_head",
+    "resource_lease_sec",
+    "retry_policy",
+    "retry_backoff_max_sec",
+    "python_pool_size",
+    "python_preload_modules",
+    "python_pool_max_tasks",
+    "python_pool_max_rss_growth_mb",
+])
+
+# the fields that describe the node or how it reaches redis, they are never taken from the cluster config
+LOCAL_CONFIG_FIELDS = ("redis_host", "redis_port", "redis_pass", "redis_db", "redis_shards", "metrics_port",
+                       "metrics_host", "result_dir", "local_data_dir", "result_journal_dir")
+
+
+def parse_config(conf_data):
+    """
+    :param conf_data: the dict of conf.json, possibly overridden by the cluster config
+    :return: a validated ConfigSnapshot, ValueError if it is not valid
+
+    """
+
+    c = SimpleNamespace()
+    # task related
+    c.min_dram_gb_trigger_return = int(
+        conf_data["min_dram_gb_trigger_return"])
+    c.min_dram_gb_accept_new_task = int(
+        conf_data["min_dram_gb_accept_new_task"])
+    c.max_task_per_worker = int(conf_data["max_task_per_worker"])
+    c.max_retry_per_task = int(conf_data["max_retry_per_task"])
+    # failure class -> RetryPolicy, the retry limit and backoff of each class of failures, see retry
+    c.retry_policy = parse_retry_policy(conf_data.get("retry_policy", {}), c.max_retry_per_task)
+    c.retry_backoff_max_sec = float(conf_data.get("retry_backoff_max_sec", 3600))
+    c.default_task_timeout_seconds = int(
+        conf_data["default_task_timeout_seconds"])
+    c.task_timeout_check_interval = int(
+        conf_data["task_timeout_check_interval"])
+    # a timed out task gets SIGTERM and this long to exit before SIGKILL, 0 kills it at once, see deadlines
+    c.task_kill_grace_sec = float(conf_data.get("task_kill_grace_sec", 5))
+    c.result_dir = conf_data["result_dir"]
+
+    # worker related
+    c.health_report_interval = int(
+        conf_data["health_report_interval"])
+    c.sleep_sec_between_accepting_task = int(
+        conf_data["sleep_sec_between_accepting_task"])
+
+    # redis related
+    c.redis_host = conf_data["redis_host"]
+    c.redis_port = int(conf_data["redis_port"])
+    c.redis_pass = conf_data["redis_pass"]
+    c.redis_db = int(conf_data["redis_db"])
+    # more redis instances ("host:port", same password and db) that share the task keyspace
+    c.redis_shards = list(conf_data.get("redis_shards", []))
+
+    # monitoring related, 0 disables the metrics endpoint, it only listens on localhost unless metrics_host is set
+    c.metrics_port = int(conf_data.get("metrics_port", 0))
+    c.metrics_host = conf_data.get("metrics_host", "127.0.0.1")
+
+    # task results received within this interval are reported in one pipeline
+    c.result_flush_interval_sec = float(conf_data.get("result_flush_interval_sec", 0.5))
+    # the results are journaled here until redis has them, the system temp directory if empty, see journal
+    c.result_journal_dir = conf_data.get("result_journal_dir", "")
+
+    # scheduling related
+    c.task_family_params = [int(x) for x in conf_data.get("task_family_params", [])]
+    c.scheduling_policy = conf_data.get("scheduling_policy", "priority")
+    c.runtime_history_refresh_sec = int(conf_data.get("runtime_history_refresh_sec", 60))
+    # the DRAM of a task for admission is learned from the peak memory of its family, see memory_model
+    c.dram_estimate = conf_data.get("dram_estimate", "declared")
+    c.dram_estimate_quantile = float(conf_data.get("dram_estimate_quantile", 0.95))
+    c.dram_estimate_min_samples = int(conf_data.get("dram_estimate_min_samples", 20))
+    c.dram_estimate_headroom = float(conf_data.get("dram_estimate_headroom", 1.2))
+    c.admission_policy = conf_data.get("admission_policy", "single")
+    c.max_tasks_per_claim = int(conf_data.get("max_tasks_per_claim", 8))
+    # tasks of a family shorter than micro_batch_short_task_sec run in batches of about
+    # micro_batch_target_sec, 1 disables micro-batching
+    c.micro_batch_max_tasks = int(conf_data.get("micro_batch_max_tasks", 1))
+    c.micro_batch_short_task_sec = float(conf_data.get("micro_batch_short_task_sec", 1))
+    c.micro_batch_target_sec = float(conf_data.get("micro_batch_target_sec", 5))
+    # once the todo queue is drained, idle workers run backup copies of the tasks running longer than
+    # speculation_min_runtime_sec and speculation_slowdown times their family mean, 0 disables it
+    c.speculation_min_runtime_sec = float(conf_data.get("speculation_min_runtime_sec", 0))
+    c.speculation_slowdown = float(conf_data.get("speculation_slowdown", 1.5))
+    # one priority level is worth fair_share_aging_sec of waiting in the queue of an owner,
+    # a claim looks at the first fair_share_head tasks of each owner, see fairshare
+    c.fair_share_aging_sec = float(conf_data.get("fair_share_aging_sec", 3600))
+    c.fair_share_head = int(conf_data.get("fair_share_head", 16))
+    # the tokens of resource pools held by a worker expire this long after its last heartbeat, see pools
+    c.resource_lease_sec = float(conf_data.get("resource_lease_sec", 120))
+
+    # data locality related, 0 disables locality-aware claims
+    c.locality_wait_sec = float(conf_data.get("locality_wait_sec", 0))
+    c.warm_input_capacity = int(conf_data.get("warm_input_capacity", 64))
+    c.local_data_dir = conf_data.get("local_data_dir", "")
+
+    # python task related, see pyexec
+    c.python_pool_size = int(conf_data.get("python_pool_size", 0))
+    c.python_preload_modules = list(conf_data.get("python_preload_modules", []))
+    c.python_pool_max_tasks = int(conf_data.get("python_pool_max_tasks", 100))
+    c.python_pool_max_rss_growth_mb = int(conf_data.get("python_pool_max_rss_growth_mb", 1024))
+
+    validate_config(c)
+    return ConfigSnapshot(**vars(c))
+
+
+def validate_config(c):
+    """Validate configuration parameters"""
+    errors = []
+
+    # Validate memory settings
+    if c.min_dram_gb_trigger_return <= 0:
+        errors.append("min_dram_gb_trigger_return must be positive")
+    if c.min_dram_gb_accept_new_task <= 0:
+        errors.append("min_dram_gb_accept_new_task must be positive")
+    if c.min_dram_gb_trigger_return >= c.min_dram_gb_accept_new_task:
+        errors.append("min_dram_gb_trigger_return should be less than min_dram_gb_accept_new_task")
+
+    # Validate task settings
+    if c.max_task_per_worker <= 0:
+        errors.append("max_task_per_worker must be positive")
+    if c.max_retry_per_task < 0:
+        errors.append("max_retry_per_task must be non-negative")
+    for failure_class, policy in c.retry_policy.items():
+        if policy.max_retry < 0 or policy.backoff_sec < 0:
+            errors.append("max_retry and backoff_sec of retry_policy {} must be non-negative".format(failure_class))
+    if c.retry_backoff_max_sec < 0:
+        errors.append("retry_backoff_max_sec must be non-negative")
+    if c.default_task_timeout_seconds < 0:
+        errors.append("default_task_timeout_seconds must be non-negative")
+    if c.task_timeout_check_interval <= 0:
+        errors.append("task_timeout_check_interval must be positive")
+    if c.task_kill_grace_sec < 0:
+        errors.append("task_kill_grace_sec must be non-negative")
+
+    # Validate timing settings
+    if c.health_report_interval <= 0:
+        errors.append("health_report_interval must be positive")
+    if c.sleep_sec_between_accepting_task < 0:
+        errors.append("sleep_sec_between_accepting_task must be non-negative")
+
+    # Validate Redis settings
+    if c.redis_port <= 0 or c.redis_port > 65535:
+        errors.append("redis_port must be between 1 and 65535")
+    if c.redis_db < 0:
+        errors.append("redis_db must be non-negative")
+    if c.metrics_port < 0 or c.metrics_port > 65535:
+        errors.append("metrics_port must be between 0 and 65535")
+    if c.result_flush_interval_sec <= 0:
+        errors.append("result_flush_interval_sec must be positive")
+
+    # Validate scheduling settings
+    if c.scheduling_policy not in SCHEDULING_POLICIES:
+        errors.append("scheduling_policy must be one of {}".format(", ".join(SCHEDULING_POLICIES)))
+    if c.runtime_history_refresh_sec <= 0:
+        errors.append("runtime_history_refresh_sec must be positive")
+    if c.dram_estimate not in DRAM_ESTIMATE_MODES:
+        errors.append("dram_estimate must be one of {}".format(", ".join(DRAM_ESTIMATE_MODES)))
+    if not 0 < c.dram_estimate_quantile <= 1:
+        errors.append("dram_estimate_quantile must be in (0, 1]")
+    if c.dram_estimate_min_samples < 0:
+        errors.append("dram_estimate_min_samples must be non-negative")
+    if c.dram_estimate_headroom < 1:
+        errors.append("dram_estimate_headroom must be at least 1")
+    if c.admission_policy not in ADMISSION_POLICIES:
+        errors.append("admission_policy must be one of {}".format(", ".join(ADMISSION_POLICIES)))
+    if c.max_tasks_per_claim <= 0:
+        errors.append("max_tasks_per_claim must be positive")
+    if c.micro_batch_max_tasks <= 0:
+        errors.append("micro_batch_max_tasks must be positive")
+    if c.micro_batch_short_task_sec < 0:
+        errors.append("micro_batch_short_task_sec must be non-negative")
+    if c.micro_batch_target_sec <= 0:
+        errors.append("micro_batch_target_sec must be positive")
+    if c.speculation_min_runtime_sec < 0:
+        errors.append("speculation_min_runtime_sec must be non-negative")
+    if c.speculation_slowdown < 1:
+        errors.append("speculation_slowdown must be at least 1")
+    if c.fair_share_aging_sec < 0:
+        errors.append("fair_share_aging_sec must be non-negative")
+    if c.fair_share_head <= 0:
+        errors.append("fair_share_head must be positive")
+    if c.resource_lease_sec <= c.health_report_interval:
+        errors.append("resource_lease_sec must be longer than health_report_interval")
+    if c.locality_wait_sec < 0:
+        errors.append("locality_wait_sec must be non-negative")
+    if c.warm_input_capacity < 0:
+        errors.append("warm_input_capacity must be non-negative")
+    if c.python_pool_size < 0:
+        errors.append("python_pool_size must be non-negative")
+    if c.python_pool_max_tasks <= 0:
+        errors.append("python_pool_max_tasks must be positive")
+    if c.python_pool_max_rss_growth_mb < 0:
+        errors.append("python_pool_max_rss_growth_mb must be non-negative")
+
+    # Validate result directory, it is created when the worker starts (validation has no side effects)
+    if not c.result_dir:
+        errors.append("result_dir must not be empty")
+    elif os.path.exists(c.result_dir) and not os.path.isdir(c.result_dir):
+        errors.append(f"result_dir {c.result_dir} is not a directory")
+
+    if errors:
+        error_msg = "Configuration validation failed:\n" + "\n".join(f"- {error}" for error in errors)
+        logging.error(error_msg)
+        raise ValueError(error_msg)
+    else:
+        logging.info("Configuration validation passed")
+
 
 class RunnerConfig:
     def __init__(self, conf_path, auto_reload):
         """
 
         :param conf_path: path to the config file
-        :param auto_reload: if True, the config will be reloaded every 20 seconds
+        :param auto_reload: if True, the config file is checked every 20 seconds and reloaded if it changed
 
         """
 
         # all config fields
-        self.min_dram_gb_trigger_return = None
-        self.min_dram_gb_accept_new_task = None
-        self.max_task_per_worker = None
-        self.max_retry_per_task = None
-        self.default_task_timeout_seconds = None
-        self.task_timeout_check_interval = None
-        self.result_dir = None
-        self.health_report_interval = None
-        self.sleep_sec_between_accepting_task = None
-        self.redis_host = None
-        self.redis_port = None
-        self.redis_pass = None
-        self.redis_db = None
+        for field in ConfigSnapshot._fields:
+            setattr(self, field, None)
 
         self.conf_path = conf_path
         self.auto_reload = auto_reload
         self.stop_flag = False
         self.lock = Lock()
+        self.file_conf = {}
+        self.file_mtime = None
+        # the fields published cluster-wide and their version, 0 if nothing is published
+        self.cluster_conf = {}
+        self.cluster_version = 0
         self.load_config()
 
         if auto_reload:
-            self.thread = Thread(target=self.main_loop, args=())
+            self.thread = Thread(target=self.main_loop, args=(), daemon=True)
             self.thread.start()
 
-
     def load_config(self):
-        self.lock.acquire()
-        try:
-            with open(self.conf_path) as f:
-                conf_data = json.load(f)
-
-            # task related
-            self.min_dram_gb_trigger_return = int(
-                conf_data["min_dram_gb_trigger_return"])
-            self.min_dram_gb_accept_new_task = int(
-                conf_data["min_dram_gb_accept_new_task"])
-            self.max_task_per_worker = int(conf_data["max_task_per_worker"])
-            self.max_retry_per_task = int(conf_data["max_retry_per_task"])
-            self.default_task_timeout_seconds = int(
-                conf_data["default_task_timeout_seconds"])
-            self.task_timeout_check_interval = int(
-                conf_data["task_timeout_check_interval"])
-            self.result_dir = conf_data["result_dir"]
-
-            # worker related
-            self.health_report_interval = int(
-                conf_data["health_report_interval"])
-            self.sleep_sec_between_accepting_task = int(
-                conf_data["sleep_sec_between_accepting_task"])
-
-            # redis related
-            self.redis_host = conf_data["redis_host"]
-            self.redis_port = int(conf_data["redis_port"])
-            self.redis_pass = conf_data["redis_pass"]
-            self.redis_db = int(conf_data["redis_db"])
-            
-            # Validate configuration
-            self._validate_config()
-            
-        except Exception as e:
-            logging.error(f"Failed to load configuration: {e}")
-            raise
-        finally:
-            self.lock.release()
-            
-    def _validate_config(self):
-        """Validate configuration parameters"""
-        errors = []
-        
-        # Validate memory settings
-        if self.min_dram_gb_trigger_return <= 0:
-            errors.append("min_dram_gb_trigger_return must be positive")
-        if self.min_dram_gb_accept_new_task <= 0:
-            errors.append("min_dram_gb_accept_new_task must be positive")
-        if self.min_dram_gb_trigger_return >= self.min_dram_gb_accept_new_task:
-            errors.append("min_dram_gb_trigger_return should be less than min_dram_gb_accept_new_task")
-            
-        # Validate task settings
-        if self.max_task_per_worker <= 0:
-            errors.append("max_task_per_worker must be positive")
-        if self.max_retry_per_task < 0:
-            errors.append("max_retry_per_task must be non-negative")
-        if self.default_task_timeout_seconds < 0:
-            errors.append("default_task_timeout_seconds must be non-negative")
-        if self.task_timeout_check_interval <= 0:
-            errors.append("task_timeout_check_interval must be positive")
-            
-        # Validate timing settings
-        if self.health_report_interval <= 0:
-            errors.append("health_report_interval must be positive")
-        if self.sleep_sec_between_accepting_task < 0:
-            errors.append("sleep_sec_between_accepting_task must be non-negative")
-            
-        # Validate Redis settings
-        if self.redis_port <= 0 or self.redis_port > 65535:
-            errors.append("redis_port must be between 1 and 65535")
-        if self.redis_db < 0:
-            errors.append("redis_db must be non-negative")
-            
-        # Validate result directory
-        if not os.path.exists(self.result_dir):
+        """
+        read the config file if it changed since the last read
+
+        """
+
+        with self.lock:
+            mtime = os.stat(self.conf_path).st_mtime
+            if mtime == self.file_mtime:
+                return
             try:
-                os.makedirs(self.result_dir, exist_ok=True)
-                logging.info(f"Created result directory: {self.result_dir}")
+                with open(self.conf_path) as f:
+                    conf_data = json.load(f)
+                self._apply(conf_data, self.cluster_conf)
             except Exception as e:
-                errors.append(f"Cannot create result directory {self.result_dir}: {e}")
-                
-        if errors:
-            error_msg = "Configuration validation failed:\n" + "\n".join(f"- {error}" for error in errors)
-            logging.error(error_msg)
-            raise ValueError(error_msg)
-        else:
-            logging.info("Configuration validation passed")
+                logging.error(f"Failed to load configuration: {e}")
+                raise
+            self.file_conf, self.file_mtime = conf_data, mtime
+
+    def apply_cluster_conf(self, cluster_conf, version):
+        """
+        override the file with the fields published cluster-wide, the node local fields are ignored
+
+        :return: True if the config switched to it, False if it does not validate
+
+        """
+
+        cluster_conf = {k: v for k, v in cluster_conf.items() if k not in LOCAL_CONFIG_FIELDS}
+        with self.lock:
+            try:
+                self._apply(self.file_conf, cluster_conf)
+            except Exception as e:
+                logging.error(f"Ignore cluster config version {version}: {e}")
+                return False
+            self.cluster_conf, self.cluster_version = cluster_conf, version
+        logging.info(f"Applied cluster config version {version}")
+        return True
+
+    def _apply(self, file_conf, cluster_conf):
+        snapshot = parse_config(dict(file_conf, **cluster_conf))
+        for field, value in snapshot._asdict().items():
+            setattr(self, field, value)
+
+    def snapshot(self):
+        """
+        :return: an immutable ConfigSnapshot of the current fields
+
+        """
+
+        return ConfigSnapshot(*[tuple(v) if isinstance(v, list) else v
+                                for v in (getattr(self, field) for field in ConfigSnapshot._fields)])
 
     def stop(self):
         self.stop_flag = True
@@ -151,8 +362,12 @@ class RunnerConfig:
 
     def main_loop(self):
         while not self.stop_flag:
-            self.load_config()
             time.sleep(20)
+            try:
+                self.load_config()
+            except Exception:
+                # keep the current config until the file is fixed
+                pass
 
     def __del__(self):
         if self.auto_reload:
@@ -174,6 +389,12 @@ class Task:
         self.require_cpu_core = None
         self.priority = None
         self.timeout_seconds = None  # New timeout duration attribute
+        self.claim_ts = None  # set by the worker that claims the task
+        self.claim_sec = None  # time spent on fetching and claiming the task
+        self.inputs = []  # input keys declared with @inputs, set by the worker when locality is enabled
+        self.shard = None  # the redis shard the task is claimed from
+        self.pools = []  # resource pools declared with @pools, set by the worker when pools are configured
+        self.owner = None  # the owner queue the task is claimed from, see fairshare
         try:
             self.parse_task_str(task_str)
         except Exception as e:
@@ -273,6 +494,103 @@ class Task:
         return self.priority >= __o.priority
 
 
+class TaskBatch:
+    """
+    short tasks of the same family claimed together and run one after another by one TaskRunner,
+    the worker tracks the batch as one task in one slot that needs the largest DRAM and cores of its tasks
+
+    """
+
+    def __init__(self, tasks, default_timeout_seconds):
+        """
+
+        :param tasks: the claimed tasks, in the order they run
+        :param default_timeout_seconds: the timeout of a task without one
+
+        """
+
+        self.tasks = list(tasks)
+        lead = self.tasks[0]
+        self.task_str = "batch[{}]:{}".format(len(self.tasks), lead.task_str)
+        self.task_type = lead.task_type
+        self.task_params = lead.task_params
+        self.priority = lead.priority
+        self.min_dram_gb = max(t.min_dram_gb for t in self.tasks)
+        self.require_cpu_core = max(t.require_cpu_core for t in self.tasks)
+        # the runner enforces the timeout of each task, the worker only kills a batch that exceeds them all,
+        # a batch with a task without a limit (0) has no limit
+        timeouts = [default_timeout_seconds if t.timeout_seconds is None else t.timeout_seconds for t in self.tasks]
+        self.timeout_seconds = 0 if 0 in timeouts else sum(timeouts)
+        self.claim_ts = lead.claim_ts
+        self.claim_sec = lead.claim_sec
+        self.inputs = [key for t in self.tasks for key in t.inputs]
+        self.shard = lead.shard
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __str__(self):
+        return "batch of {} tasks, first {}".format(len(self.tasks), self.tasks[0])
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __hash__(self) -> int:
+        return hash(self.task_str)
+
+    def __eq__(self, __o: object) -> bool:
+        return self.task_str == __o.task_str
+
+    def __ne__(self, __o: object) -> bool:
+        return self.task_str != __o.task_str
+
+
+def split_task_annotations(line):
+    """
+    split the leading annotations from a task line,
+    "@name=sim1 @after=gen1 shell:5:8:2:./cachesim t1" -> ("shell:5:8:2:./cachesim t1", {"name": "sim1", "after": "gen1"})
+
+    """
+
+    annotations = {}
+    line = line.strip()
+    while line.startswith(TASK_ANNOTATION_PREFIX):
+        token, _, line = line.partition(" ")
+        key, _, value = token[len(TASK_ANNOTATION_PREFIX):].partition("=")
+        annotations[key] = value
+        line = line.lstrip()
+    return line, annotations
+
+
+def with_priority(task_str, priority):
+    """
+    return the task str with a different priority
+
+    """
+
+    parts = task_str.split(TASK_FORMAT_SEPARATOR)
+    parts[1] = str(priority)
+    return TASK_FORMAT_SEPARATOR.join(parts)
+
+
+def task_family(task, family_params=()):
+    """
+    the family of a task is the binary it runs, e.g., ./cachesim for "shell:5:8:2:./cachesim trace1 lru"
+    tasks in the same family are expected to have similar runtime and resource usage
+
+    :param family_params: the indices of the parameters after the binary that are also part of the family,
+        e.g., (2, ) makes "./cachesim lru" the family of the task above
+
+    """
+
+    if task.task_params is None:
+        return ""
+    params = task.task_params.split()
+    if len(params) == 0:
+        return ""
+    return " ".join([params[0]] + [params[i] for i in family_params if 0 < i < len(params)])
+
+
 class EmptyTask(Task):
     def __init__(self):
         super(EmptyTask, self).__init__(f"0:0:0:0:0")